@@ -0,0 +1,238 @@
+"""
+Run many esx operations at once on a bounded java.util.concurrent thread pool.
+
+Jython has no GIL, so a fixed thread pool lets ESX work on several clones,
+copies or power operations at the same time. Besides the pool size, each
+job can name the resources it uses (ex: ('host','ha-host'),
+('datastore','datastore1')) and each resource can be given its own limit,
+so a batch never puts more than N operations on one datastore.
+
+A job that fails doesn't stop the batch or the process. Each job gets an
+OpResult holding its return value or error and how long it took.
+
+Example:
+>> jobs = [BatchJob(name,esx.startVM,(session,name),keys=[('host','ha-host')]) for name in vms]
+>> batch = runBatch(jobs,4,{('host','ha-host'):2})
+>> for r in batch.failed(): print r.name, r.error
+"""
+
+from java.util.concurrent import Callable,Executors
+from java.lang import Throwable
+
+from honeyclient.util.config import *
+import threading,time
+
+
+class OpResult(object):
+    """
+    The outcome of one job in a batch
+    """
+    def __init__(self,name):
+        self.name = name
+        self.result = None
+        self.error = None
+        self.started = None
+        self.elapsed = None
+
+    def ok(self):
+        """
+        :return: True if the job finished without an error
+        """
+        return self.error is None and self.elapsed is not None
+
+    def __repr__(self):
+        if self.ok():
+            return "<OpResult %s ok %0.2fs>" % (self.name,self.elapsed)
+        return "<OpResult %s failed: %s>" % (self.name,self.error)
+
+
+class BatchResult(object):
+    """
+    The outcome of a batch: an OpResult per job plus the total time
+    """
+    def __init__(self,results,elapsed):
+        self.results = results
+        self.elapsed = elapsed
+
+    def succeeded(self):
+        """
+        :return: the OpResults of the jobs that worked
+        """
+        return [r for r in self.results if r.ok()]
+
+    def failed(self):
+        """
+        :return: the OpResults of the jobs that failed
+        """
+        return [r for r in self.results if not r.ok()]
+
+    def summary(self):
+        """
+        :return: a one line summary of the batch
+        """
+        times = [r.elapsed for r in self.results if r.elapsed is not None]
+        average = 0.0
+        if times:
+            average = sum(times) / len(times)
+        return "%d ok, %d failed in %0.2fs (avg %0.2fs per job)" % \
+            (len(self.succeeded()),len(self.failed()),self.elapsed,average)
+
+
+class BatchJob(object):
+    """
+    One function call to run in a batch
+    """
+    def __init__(self,name,fn,args=(),kwargs=None,keys=()):
+        """
+        :param name: a name for the job, copied to its OpResult
+        :param fn: the function to call
+        :param args: positional arguments for fn
+        :param kwargs: keyword arguments for fn
+        :param keys: the resources the job uses, checked against the batch limits
+        """
+        self.name = name
+        self.fn = fn
+        self.args = args
+        self.kwargs = kwargs or {}
+        self.keys = keys
+
+
+class _Task(Callable):
+    """
+    Wraps a BatchJob for the executor
+    """
+    def __init__(self,job,result,semaphores):
+        self.job = job
+        self.result = result
+        self.semaphores = semaphores
+
+    def call(self):
+        # Always acquire in the same order so two jobs can't deadlock
+        held = []
+        try:
+            for key in sorted(self.semaphores.keys()):
+                self.semaphores[key].acquire()
+                held.append(self.semaphores[key])
+
+            self.result.started = time.time()
+            try:
+                self.result.result = self.job.fn(*self.job.args,**self.job.kwargs)
+            except Exception, e:
+                self.result.error = e
+            except Throwable, e:
+                self.result.error = e
+            self.result.elapsed = time.time() - self.result.started
+            if self.result.error is not None:
+                LOG.error("Batch job %s failed: %s" % (self.job.name,self.result.error))
+        finally:
+            for s in held:
+                s.release()
+        return self.result
+
+
+class _Limit(object):
+    """
+    A semaphore whose number of permits can be changed while it's in use
+    """
+    def __init__(self,limit):
+        self.limit = limit
+        self.running = 0
+        self.__cond = threading.Condition()
+
+    def acquire(self):
+        self.__cond.acquire()
+        try:
+            while self.running >= self.limit:
+                self.__cond.wait()
+            self.running += 1
+        finally:
+            self.__cond.release()
+
+    def release(self):
+        self.__cond.acquire()
+        try:
+            self.running -= 1
+            self.__cond.notifyAll()
+        finally:
+            self.__cond.release()
+
+    def resize(self,limit):
+        """
+        Change the limit. Jobs already running above a lower limit finish,
+        new ones wait until there's room
+        """
+        self.__cond.acquire()
+        try:
+            self.limit = limit
+            self.__cond.notifyAll()
+        finally:
+            self.__cond.release()
+
+
+# Resource limits are shared by every batch in the process, so two batches
+# running at once still respect them together. The last limit given for a
+# resource is the one in force.
+# Maps a resource key to its _Limit
+__semaphores = {}
+__semaphores_lock = threading.Lock()
+
+def __getSemaphore(key,limit):
+    __semaphores_lock.acquire()
+    try:
+        semaphore = __semaphores.get(key)
+        if semaphore is None:
+            semaphore = _Limit(limit)
+            __semaphores[key] = semaphore
+        elif semaphore.limit != limit:
+            LOG.info("Batch limit for %s changed from %d to %d" % (key,semaphore.limit,limit))
+            semaphore.resize(limit)
+        return semaphore
+    finally:
+        __semaphores_lock.release()
+
+def getLimit(key):
+    """
+    :param key: a resource key, ex: ('datastore','datastore1')
+    :return: the limit in force for the resource, None if no batch set one
+    """
+    __semaphores_lock.acquire()
+    try:
+        semaphore = __semaphores.get(key)
+        if semaphore is None:
+            return None
+        return semaphore.limit
+    finally:
+        __semaphores_lock.release()
+
+def runBatch(jobs,max_workers,limits=None):
+    """
+    Run the jobs on a fixed thread pool and wait for all of them
+
+    :param jobs: a list of BatchJob
+    :param max_workers: the number of threads in the pool
+    :param limits: (optional) a dict of {resource key: max jobs at once}. A
+                   limit applies to every batch using the resource, so a
+                   different limit replaces the one in force
+    :return: BatchResult with the OpResults in the same order as the jobs
+    """
+    limits = limits or {}
+    results = []
+    tasks = []
+    for job in jobs:
+        semaphores = {}
+        for key in job.keys:
+            if limits.has_key(key):
+                semaphores[key] = __getSemaphore(key,int(limits[key]))
+        result = OpResult(job.name)
+        results.append(result)
+        tasks.append(_Task(job,result,semaphores))
+
+    started = time.time()
+    if tasks:
+        executor = Executors.newFixedThreadPool(max(1,min(int(max_workers),len(tasks))))
+        try:
+            executor.invokeAll(tasks)
+        finally:
+            executor.shutdown()
+
+    return BatchResult(results,time.time() - started)
@@ -0,0 +1,165 @@
+"""
+Session scoped caches used by the esx module.
+
+Looking up a VM by name means walking the whole ESX inventory with an
+InventoryNavigator. On hosts with hundreds of registered clones that walk is
+most of the cost of a call, and a single esx call may do it several times.
+This module keeps a name -> ManagedObjectReference map for each session so
+the walk is only done once per VM (or once per 'ttl' seconds).
+
+The cache is keyed by the session object handed out by esx.login(). The esx
+functions that register, unregister or destroy VMs keep it up to date, and
+invalidate() can be used to drop entries by hand.
+
+The same kind of cache, keyed by VM, holds the snapshot indexes and device
+topologies of each session (see getSnapshotCache and getDeviceCache).
+"""
+
+import threading,time
+
+# Default number of seconds a cached entry stays valid
+DEFAULT_TTL = 300
+
+
+class VMCache(object):
+    """
+    A thread safe name -> ManagedObjectReference map with a time to live.
+    Values can be anything, the snapshot cache stores SnapshotIndex objects.
+    """
+    def __init__(self,ttl=DEFAULT_TTL):
+        self.ttl = ttl
+        self.__entries = {}
+        self.__lock = threading.RLock()
+
+    def get(self,name):
+        """
+        Return the cached MOR for the name or None if missing/expired
+
+        :param name: the name of the VM
+        :return: the ManagedObjectReference or None
+        """
+        self.__lock.acquire()
+        try:
+            entry = self.__entries.get(name)
+            if not entry:
+                return None
+            mor,stamp = entry
+            if self.ttl >= 0 and time.time() - stamp > self.ttl:
+                del self.__entries[name]
+                return None
+            return mor
+        finally:
+            self.__lock.release()
+
+    def put(self,name,mor):
+        """
+        Add or replace the entry for a VM
+
+        :param name: the name of the VM
+        :param mor: the ManagedObjectReference of the VM
+        """
+        if not name or mor is None:
+            return
+        self.__lock.acquire()
+        try:
+            self.__entries[name] = (mor,time.time())
+        finally:
+            self.__lock.release()
+
+    def invalidate(self,name=None):
+        """
+        Drop the entry for a VM. If name is None, drop everything
+
+        :param name: the name of the VM (optional)
+        """
+        self.__lock.acquire()
+        try:
+            if name is None:
+                self.__entries.clear()
+            elif self.__entries.has_key(name):
+                del self.__entries[name]
+        finally:
+            self.__lock.release()
+
+    def names(self):
+        """
+        :return: a list of the names currently cached (expired or not)
+        """
+        self.__lock.acquire()
+        try:
+            return self.__entries.keys()
+        finally:
+            self.__lock.release()
+
+    def __len__(self):
+        self.__lock.acquire()
+        try:
+            return len(self.__entries)
+        finally:
+            self.__lock.release()
+
+
+# Registry of caches by session. Java objects can't carry extra python
+# attributes, so we keep the caches here instead of on the session itself.
+__caches = {}
+__caches_lock = threading.Lock()
+
+def getCache(session,ttl=None):
+    """
+    Return the VMCache attached to the session, creating it if needed
+
+    :param session: the session returned by esx.login()
+    :param ttl: the time to live (in seconds). If given, it's applied to the
+                session's caches, otherwise new caches use DEFAULT_TTL
+    :return: VMCache
+    """
+    return __getCaches(session,ttl)['vms']
+
+def getSnapshotCache(session):
+    """
+    Return the cache of snapshot indexes attached to the session. It maps a
+    VM's MOR value to the SnapshotIndex of the VM.
+
+    :param session: the session returned by esx.login()
+    :return: VMCache
+    """
+    return __getCaches(session)['snapshots']
+
+def getDeviceCache(session):
+    """
+    Return the cache of device topologies attached to the session. It maps a
+    VM's (or snapshot's) MOR value to its DeviceTopology.
+
+    :param session: the session returned by esx.login()
+    :return: VMCache
+    """
+    return __getCaches(session)['devices']
+
+def dropCache(session):
+    """
+    Remove the caches attached to the session. Called on logout.
+
+    :param session: the session returned by esx.login()
+    """
+    __caches_lock.acquire()
+    try:
+        if __caches.has_key(session):
+            del __caches[session]
+    finally:
+        __caches_lock.release()
+
+def __getCaches(session,ttl=None):
+    __caches_lock.acquire()
+    try:
+        caches = __caches.get(session)
+        if caches is None:
+            caches = {'vms':VMCache(DEFAULT_TTL),
+                      'snapshots':VMCache(DEFAULT_TTL),
+                      'devices':VMCache(DEFAULT_TTL)}
+            __caches[session] = caches
+        if ttl is not None:
+            for c in caches.values():
+                c.ttl = ttl
+        return caches
+    finally:
+        __caches_lock.release()
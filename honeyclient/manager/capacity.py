@@ -0,0 +1,416 @@
+"""
+Free space of the datastores, shared by the clones of a session.
+
+Clone used to check 'min_space_free' on its own before every clone, with
+a round trip each time, and clones made at the same time could all pass
+the check and then fill the datastore together. A CapacityTracker reads
+the free space of every datastore with one PropertyCollector request,
+then keeps it up to date from the session's UpdateChannel. It's read
+again every 'refresh_interval' seconds, and after a reservation is
+released, in case ESX didn't send an update yet.
+
+Before a clone is made, reserve() sets its expected footprint aside on
+the master's datastores:
+ - 'delta_growth' MB for its delta disks
+ - twice the master's memory: once for the memory of its operational
+   snapshot, and once for the vmss file when it's suspended
+A reservation is refused with DatastoreFull if it would leave less than
+'min_space_free' GB free. With 'wait_timeout' set, reserve() first waits
+that long for other reservations to be released or for space to be freed.
+
+esx.quickCloneVM() and quickCloneMany() reserve the space of each clone
+they make, unless they're given a reservation. A clone's reservation is
+held by the tracker until esx.destroyVM() destroys it, and a Clone holds
+its own until it's destroyed, since most of that space is only used after
+the clone is made. Space a clone already uses is
+then counted twice, once in the free space and once in its reservation,
+which errs on the side of keeping 'min_space_free'.
+
+Example:
+>> reservation = getTracker(session).reserve('master')
+>> try:
+>>     esx.quickCloneVM(session,'master')
+>> finally:
+>>     reservation.release()
+"""
+
+from honeyclient.util.config import *
+from honeyclient.manager import errors,esx,metrics,updates
+import threading,time
+
+# Default settings, see HoneyClient::Manager::ESX::Capacity in honeyclient.xml
+DEFAULT_DELTA_GROWTH = 512
+DEFAULT_REFRESH_INTERVAL = 300
+DEFAULT_WAIT_TIMEOUT = 0
+
+# The properties read of each datastore
+PATHS = ["summary.name","summary.freeSpace"]
+
+MB = 1024 * 1024
+GB = 1024 * MB
+
+
+class Reservation(object):
+    """
+    Space set aside on some datastores. Release it once the clone is destroyed
+    """
+    def __init__(self,tracker,datastores,size,label=None):
+        """
+        :param tracker: the CapacityTracker it's from
+        :param datastores: the names of the datastores
+        :param size: the bytes set aside on each of them
+        :param label: (optional) what it's for, for messages
+        """
+        self.tracker = tracker
+        self.datastores = datastores
+        self.size = size
+        self.label = label
+        self.released = False
+
+    def release(self):
+        """
+        Give the space back. Does nothing if it was already released
+        """
+        self.tracker.release(self)
+
+    def __repr__(self):
+        return "<Reservation %s of %0.2f GB on %s>" % (self.label,float(self.size) / GB,
+                                                        ",".join(self.datastores))
+
+
+class CapacityTracker(object):
+    """
+    The free and reserved space of the datastores of a session
+    """
+    def __init__(self,session,min_free=None,delta_growth=None,refresh_interval=None,wait_timeout=None):
+        """
+        Settings that aren't given are read from honeyclient.xml
+
+        :param session: a session or SessionPool
+        :param min_free: (optional) the bytes that must stay free on each datastore
+        :param delta_growth: (optional) the MB a clone's delta disks are expected to use
+        :param refresh_interval: (optional) seconds after which the free space is read again
+        :param wait_timeout: (optional) seconds reserve() waits for space by default
+        """
+        self.session = session
+        if min_free is None:
+            min_free = getArg('min_space_free','HoneyClient::Manager::ESX')
+            if min_free in ('undef',''):
+                esx.croak('Cannot determine the min_space_free in honeyclient.xml',errors.ESXError)
+            min_free = int(min_free) * GB
+        self.min_free = min_free
+        section = 'HoneyClient::Manager::ESX::Capacity'
+        self.delta_growth = getIntArg('delta_growth',section,DEFAULT_DELTA_GROWTH,delta_growth)
+        self.refresh_interval = getIntArg('refresh_interval',section,DEFAULT_REFRESH_INTERVAL,refresh_interval)
+        self.wait_timeout = getIntArg('wait_timeout',section,DEFAULT_WAIT_TIMEOUT,wait_timeout)
+
+        self.__cond = threading.Condition()
+        # datastore name -> bytes
+        self.__free = {}
+        self.__reserved = {}
+        # MOR value -> datastore name
+        self.__names = {}
+        # VM name -> ([datastore names],footprint in bytes)
+        self.__masters = {}
+        # clone name -> the Reservation held for it, see hold()
+        self.__held = {}
+        # When the free space was last read, None to read it again
+        self.__refreshed = None
+        self.__filter = None
+
+    def free(self):
+        """
+        :return: {datastore name:free bytes}, as last read
+        """
+        self.__cond.acquire()
+        try:
+            return dict(self.__free)
+        finally:
+            self.__cond.release()
+
+    def reserved(self):
+        """
+        :return: {datastore name:reserved bytes}
+        """
+        self.__cond.acquire()
+        try:
+            return dict([(name,n) for name,n in self.__reserved.items() if n])
+        finally:
+            self.__cond.release()
+
+    def available(self,name):
+        """
+        :param name: a datastore name
+        :return: the bytes that can still be reserved on it (may be negative)
+        """
+        self.__cond.acquire()
+        try:
+            return self.__available(name)
+        finally:
+            self.__cond.release()
+
+    def refresh(self):
+        """
+        Read the free space of every datastore, and start watching it for
+        changes if it isn't already
+        """
+        s,records = esx.getInventoryESX(self.session,"Datastore",PATHS)
+        self.__cond.acquire()
+        try:
+            names = {}
+            for r in records:
+                name = r['summary.name']
+                names[r['mor'].get_value()] = name
+                self.__free[name] = r['summary.freeSpace'] or 0
+            watched = self.__filter is not None and names == self.__names
+            self.__names = names
+            self.__refreshed = time.time()
+            free = dict(self.__free)
+            self.__cond.notifyAll()
+        finally:
+            self.__cond.release()
+        metrics.datastoreFree(free)
+        if not watched:
+            self.__watch([r['mor'] for r in records])
+
+    def footprint(self,vm_name):
+        """
+        :param vm_name: the master VM of a clone
+        :return: the bytes a clone of it is expected to use
+        """
+        if self.__isStale():
+            self.refresh()
+        return self.__master(vm_name)[1]
+
+    def hasSpace(self,vm_name,size=None):
+        """
+        :param vm_name: the master VM
+        :param size: (optional) the bytes needed. Defaults to footprint()
+        :return: True if a clone of vm_name could be reserved right now
+        """
+        if self.__isStale():
+            self.refresh()
+        datastores,footprint = self.__master(vm_name)
+        if size is None:
+            size = footprint
+        self.__cond.acquire()
+        try:
+            for name in datastores:
+                if self.__available(name) < size:
+                    return False
+            return True
+        finally:
+            self.__cond.release()
+
+    def reserve(self,vm_name,size=None,label=None,timeout=None):
+        """
+        Set space aside for a clone on the datastores of its master
+
+        :param vm_name: the master VM
+        :param size: (optional) the bytes to set aside. Defaults to footprint()
+        :param label: (optional) what it's for, ex: the clone's name
+        :param timeout: (optional) seconds to wait for space. Defaults to 'wait_timeout'
+        :return: the Reservation
+        :raise DatastoreFull: if there isn't enough space
+        """
+        if timeout is None:
+            timeout = self.wait_timeout
+        if self.__isStale():
+            self.refresh()
+        datastores,footprint = self.__master(vm_name)
+        if size is None:
+            size = footprint
+        deadline = time.time() + timeout
+        while True:
+            if self.__isStale():
+                self.refresh()
+            self.__cond.acquire()
+            try:
+                short = [(name,self.__available(name)) for name in datastores
+                         if self.__available(name) < size]
+                if not short:
+                    for name in datastores:
+                        self.__reserved[name] = self.__reserved.get(name,0) + size
+                    reservation = Reservation(self,datastores,size,label or vm_name)
+                    reserved = dict(self.__reserved)
+                    break
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    name,available = short[0]
+                    msg = "Datastore %s has %0.2f GB available (%0.2f GB free, %0.2f GB reserved, %0.2f GB kept free), a clone of %s needs %0.2f GB" % \
+                        (name,float(available) / GB,float(self.__free.get(name,0)) / GB,
+                         float(self.__reserved.get(name,0)) / GB,float(self.min_free) / GB,
+                         vm_name,float(size) / GB)
+                    break
+                LOG.info("Waiting for space on datastore %s for a clone of %s" % (short[0][0],vm_name))
+                self.__cond.wait(min(remaining,self.refresh_interval))
+            finally:
+                self.__cond.release()
+        if short:
+            esx.croak(msg,errors.DatastoreFull,vm=vm_name)
+        for name in datastores:
+            metrics.DATASTORE_RESERVED_BYTES.set(reserved[name],datastore=name)
+        return reservation
+
+    def release(self,reservation):
+        """
+        Give a reservation's space back. The free space is read again
+        before the next reservation, to count what the clone really used
+        """
+        self.__cond.acquire()
+        try:
+            if reservation.released:
+                return
+            reservation.released = True
+            for name in reservation.datastores:
+                self.__reserved[name] = self.__reserved.get(name,0) - reservation.size
+            reserved = dict(self.__reserved)
+            self.__refreshed = None
+            self.__cond.notifyAll()
+        finally:
+            self.__cond.release()
+        for name in reservation.datastores:
+            metrics.DATASTORE_RESERVED_BYTES.set(reserved[name],datastore=name)
+
+    def hold(self,vm_name,reservation):
+        """
+        Keep a reservation for a clone until releaseVM() is called for it
+
+        :param vm_name: the name of the clone
+        :param reservation: the Reservation
+        """
+        self.__cond.acquire()
+        try:
+            previous = self.__held.get(vm_name)
+            self.__held[vm_name] = reservation
+        finally:
+            self.__cond.release()
+        if previous is not None:
+            previous.release()
+
+    def releaseVM(self,vm_name):
+        """
+        Release the reservation held for a clone, if there's one
+
+        :param vm_name: the name of the clone
+        """
+        self.__cond.acquire()
+        try:
+            reservation = self.__held.pop(vm_name,None)
+        finally:
+            self.__cond.release()
+        if reservation is not None:
+            reservation.release()
+
+    def __available(self,name):
+        return self.__free.get(name,0) - self.__reserved.get(name,0) - self.min_free
+
+    def __isStale(self):
+        refreshed = self.__refreshed
+        return refreshed is None or time.time() - refreshed > self.refresh_interval
+
+    def __master(self,vm_name):
+        """
+        :return: ([datastore names],footprint) of a master VM, read once
+        """
+        self.__cond.acquire()
+        try:
+            master = self.__masters.get(vm_name)
+        finally:
+            self.__cond.release()
+        if master is not None:
+            return master
+
+        vm = esx.getVMbyName(self.session,vm_name)
+        props = vm.getPropertiesByPaths(["datastore","config.hardware.memoryMB"])
+        memory = props.get("config.hardware.memoryMB") or 0
+        footprint = (self.delta_growth + 2 * memory) * MB
+        self.__cond.acquire()
+        try:
+            datastores = []
+            for mor in props.get("datastore") or []:
+                name = self.__names.get(mor.get_value())
+                if name is None:
+                    LOG.error("VM %s uses datastore %s, which isn't in the inventory" % \
+                              (vm_name,mor.get_value()))
+                elif name not in datastores:
+                    datastores.append(name)
+            master = (datastores,footprint)
+            self.__masters[vm_name] = master
+            return master
+        finally:
+            self.__cond.release()
+
+    def __watch(self,mors):
+        if self.__filter is not None:
+            try:
+                updates.getChannel(self.session).unwatch(self.__filter)
+            except Exception,e:
+                LOG.debug("Unable to stop watching the datastores: %s" % e)
+            self.__filter = None
+        if not mors:
+            return
+        try:
+            self.__filter = updates.getChannel(self.session).watch(
+                [(mor,["summary.freeSpace"]) for mor in mors],self.__update,self.__failed)
+        except Exception,e:
+            LOG.error("Unable to watch the datastores, their free space is read every %ss: %s" % \
+                      (self.refresh_interval,e))
+
+    def __update(self,mor,changes):
+        if not changes or not changes.has_key("summary.freeSpace"):
+            return
+        self.__cond.acquire()
+        try:
+            name = self.__names.get(mor.get_value())
+            if name is None:
+                return
+            free = changes["summary.freeSpace"] or 0
+            self.__free[name] = free
+            self.__cond.notifyAll()
+        finally:
+            self.__cond.release()
+        metrics.DATASTORE_FREE_BYTES.set(free,datastore=name)
+
+    def __failed(self,e):
+        LOG.error("Stopped watching the datastores: %s" % e)
+        self.__filter = None
+
+
+# Registry of trackers by session
+__trackers = {}
+__trackers_lock = threading.Lock()
+
+def getTracker(session):
+    """
+    Return the shared CapacityTracker of a session, creating it if needed.
+    A SessionPool gets one tracker, whichever thread asks.
+
+    :param session: a session or SessionPool
+    :return: CapacityTracker
+    """
+    __trackers_lock.acquire()
+    try:
+        tracker = __trackers.get(session)
+        if tracker is None:
+            tracker = CapacityTracker(session)
+            __trackers[session] = tracker
+        return tracker
+    finally:
+        __trackers_lock.release()
+
+def releaseVM(session,vm_name):
+    """
+    Release the reservation held for a clone by the session's tracker.
+    Doesn't create a tracker if the session has none.
+
+    :param session: a session or SessionPool
+    :param vm_name: the name of the clone
+    """
+    __trackers_lock.acquire()
+    try:
+        tracker = __trackers.get(session)
+    finally:
+        __trackers_lock.release()
+    if tracker is not None:
+        tracker.releaseVM(vm_name)
@@ -2,13 +2,14 @@
 
 #from com.vmware.vix import *
 
-from honeyclient.manager import esx
+from honeyclient.manager import capacity,errors,esx,guestnet,instrument,lifecycle,metrics,reaper,sessions
 from honeyclient.util.config import *
  
-import sys
 from datetime import datetime, timedelta
-from time import sleep
+import time
 
+# Default 'max_num_snapshots'
+DEFAULT_MAX_SNAPSHOTS = 32
 
 # DISABLED VIX CALLS FOR NOW FOR TESTING BASIC CLONE CREATION
 
@@ -74,12 +75,20 @@ class Clone(object):
         # interface.
         self.ip_address = None
     
+        # Every NIC of the cloned VM, as guestnet.Nic objects, once it
+        # has a network address.
+        self.nics = []
+
         # A variable containing the snapshot name the cloned VM.
         self.name = None
 
         # A variable reflecting the current status of the cloned VM.
         self.status = "uninitialized"
 
+        # When the status last changed, for the time spent in each state
+        # reported to honeyclient.manager.metrics.
+        self.status_changed_at = None
+
         # A variable reflecting the driver assigned to this cloned VM.
         self.driver_name = getArg("default_driver","HoneyClient::Agent")
 
@@ -97,6 +106,22 @@ class Clone(object):
         # should never be modified externally.)
         self.vm_session = None
 
+        # A SessionPool to take vm_session from. If neither is given, the
+        # shared pool for service_url and un is used.
+        self.session_pool = None
+
+        # The LifecycleEngine that follows the clone as it comes up. If none
+        # is given, the shared engine of the session is used.
+        self.lifecycle = None
+
+        # How long the clone took to reach each state the last time it was
+        # brought up, ex: {'running':4.2,'networked':61.0}
+        self.lifecycle_timings = {}
+
+        # The capacity.Reservation of the space the clone is expected to
+        # use. It's held until the clone is destroyed.
+        self.reservation = None
+
         # A Net::Stomp session object, used to interact with the 
         # HoneyClient::Manager::Firewall::Server daemon. (This internal variable
         # should never be modified externally.)
@@ -157,7 +182,11 @@ class Clone(object):
             
         if not self.guest_password:
             self.__croak("Guest Passeword was not provided")
-            
+
+        metrics.start()
+        metrics.cloneStatus(None,self.status)
+        self.status_changed_at = time.time()
+
         self.__setup()
     
 
@@ -167,19 +196,34 @@ class Clone(object):
 
         if not self.vm_session:
             
-            LOG.info("Creating a new ESX Session to %s" % self.service_url)
-            self.vm_session = esx.login(self.service_url,self.un,self.pw)
+            if not self.session_pool:
+                self.session_pool = sessions.getPool(self.service_url,self.un,self.pw)
+            self.vm_session = self.session_pool
             
             # notify drone about the new host
-            s, hostname = esx.getHostnameESX(self.vm_session)
-            s, ip = esx.getIPaddrESX(self.vm_session)
+            s, hostname = self.__esx(esx.getHostnameESX)
+            s, ip = self.__esx(esx.getIPaddrESX)
             
             LOG.info("Setup EventEmitter host with %s %s" % (hostname,ip))
 
         
-        # Check if there's enough disk space. If not, die
-        self.__check_space_available()
-        
+        # Set space aside on the datastores for the clone. It's kept until
+        # destroy(), since the delta disks grow and the vmss of a suspend is
+        # written long after the clone is made. If there isn't enough, die
+        reserved = self.reservation is None
+        if reserved:
+            self.reservation = self.__reserve_space()
+        try:
+            self.__start()
+        except:
+            if reserved:
+                self.__release_space()
+            raise
+
+    def __start(self):
+        """
+        The rest of __setup, done once space is reserved for the clone
+        """
         # Connect (or reconnect) to host via VIX, if enabled.
         #if int(getArg('vix_enable','HoneyClient::Manager::ESX::Clone')):
         #    self.vix_disconnect_vm()
@@ -189,10 +233,10 @@ class Clone(object):
         if self.bypass_firewall:
             LOG.info("TODO: Setup Firewall...")
         
-        if self.num_snapshots >= getArg('max_num_snapshots','HoneyClient::Manager::ESX'):
+        if self.num_snapshots >= getIntArg('max_num_snapshots','HoneyClient::Manager::ESX',DEFAULT_MAX_SNAPSHOTS):
             LOG.info("Suspending Clone VM. Reached the maximum number of snapshots")
             
-            s,r = esx.suspendVM(self.vm_session,self.quick_clone_vm_name)
+            s,r = self.__esx(esx.suspendVM,self.quick_clone_vm_name)
             
             self.quick_clone_vm_name = None
             self.name = None
@@ -207,17 +251,19 @@ class Clone(object):
         else:
             try:
                 self.__do_init()
-            except SystemExit:
+            except errors.ESXError:
                 # Suspend the VM and try again
                 LOG.error("Unable to init VM %s - Retrying..." % self.quick_clone_vm_name)
                 LOG.info("Suspending the VM")
+                self.num_failed_inits += 1
+                metrics.CLONE_FAILED_INITS.inc()
 
                 suspended_at = datetime.now()
                 
                 try:
-                    s,r = esx.suspendVM(self.vm_session,self.quick_clone_vm_name)
+                    s,r = self.__esx(esx.suspendVM,self.quick_clone_vm_name)
                     self.__change_status("suspended",suspended_at)
-                except SystemExit:
+                except errors.ESXError:
                     LOG.error("Unable to suspend the VM")
 
             # Commented out for testing for now...
@@ -229,138 +275,109 @@ class Clone(object):
 
     def __do_init(self):
         """
-        replaces the 'init' call in the Perl code
+        replaces the 'init' call in the Perl code. The steps of bringing up
+        the clone are followed by the lifecycle engine (see
+        honeyclient.manager.lifecycle) instead of polling. With
+        instrumentation on, the calls of the first run are traced (see
+        honeyclient.manager.instrument)
         """
+        trace = instrument.traceOnce("Clone.__do_init")
+        try:
+            self.__bring_up()
+        finally:
+            instrument.finishTrace(trace)
+
+    def __bring_up(self):
+        if not self.lifecycle:
+            self.lifecycle = lifecycle.getEngine(self.vm_session)
+
         if not self.quick_clone_vm_name or not self.name or not self.mac_address or not self.ip_address:
             LOG.info("Quick cloning master VM: %s" % self.master_vm_name)
-            s, dest_name = esx.quickCloneVM(self.vm_session,self.master_vm_name)
+            s, dest_name = self.__esx(esx.quickCloneVM,self.master_vm_name,
+                                      reservation=self.reservation)
             
             self.quick_clone_vm_name = dest_name
             self.num_snapshots += 1
+            metrics.CLONE_SNAPSHOTS.inc()
             self.__change_status("initialized")
 
-            registered = False
-            while registered:
-                s, registered = esx.isRegisteredVM(self.vm_session,self.quick_clone_vm_name)
-                if not registered:
-                    # poll for it
-                    sleep( self.retry_period )
-            
-            LOG.info("Retrieving config of clone VM")
-            s, self.vm_config = esx.getConfigVM(self.vm_session,self.quick_clone_vm_name)
-            self.__change_status("registered")
-
-            started = "no"
-            while started != 'poweredOn':
-                s, started = esx.getStateVM(self.vm_session,self.quick_clone_vm)
-                if started != 'poweredOn':
-                    sleep(self.retry_period)
-            self.__change_status('running')
-
-            LOG.info("No waiting on valid MAC/IP for clone")
-            temp_ip = None
-            while not self.ip_address or not self.mac_address:
-                s, self.mac_address = esx.getMACaddrVM(self.vm_session,self.quick_clone_vm)
-                s, temp_ip = esx.getIPaddrVM(self.vm_session,self.quick_clone_vm)
-                
-                if temp_ip and temp_ip != self.ip_address:
-                    LOG.info("Cloned VM has a new IP")
-                    
-                    # TODO: call self._deny_network()
-                    
-                    self.ip_address = temp_ip
+            # registered -> running -> networked -> operational
+            desc = getArg("operational_quick_clone_snapshot_description","HoneyClient::Manager::ESX")
+            states = lifecycle.cloneStates(self.vm_session,self.quick_clone_vm_name,desc)
+            tracker = self.lifecycle.track(self.quick_clone_vm_name,states,self.__on_state)
+            props = tracker.result()
+            self.lifecycle_timings = tracker.timings
+
+            network = guestnet.fromProperties(self.quick_clone_vm_name,props)
+            self.nics = network.nics
+            self.mac_address = network.primary().mac
+            self.ip_address = network.primary().ip()
+            s, snapname = tracker.results['operational']
+            self.name = snapname
+            self.num_snapshots += 1
+            metrics.CLONE_SNAPSHOTS.inc()
 
-                if not self.ip_address or not self.mac_address:
-                    snapname = getArg("default_quick_clone_snapshot_name","HoneyClient::Manager::ESX")
-                    self.__check_for_bsod(snapname)
-                    sleep(self.retry_period)
-                    continue
-                
-                LOG.info("TODO: allow_network")
-                LOG.info("get Agent Handle")
-                LOG.info("get Agent properties")
+            LOG.info("TODO: allow_network")
+            LOG.info("get Agent Handle")
+            LOG.info("get Agent properties")
 
-                # NEED TO CHECK HERE FOR THE AGENT AND WAIT FOR IT
-                # THIS WILL BE 'if' block
-                
-                LOG.info("Create operational snapshot of the VM")
-                desc = getArg("operational_quick_clone_snapshot_description","HoneyClient::Manager::ESX")
-                s, snapname = esx.snapshotVM(self.vm_session,self.quick_clone_vm_name,desc)
-                self.name = snapname
-                self.num_snapshots += 1
+            # NEED TO CHECK HERE FOR THE AGENT AND WAIT FOR IT
 
-                s, hostname = esx.getHostnameESX(self.vm_session)
-                s, ip = esx.getIPaddrESX(self.vm_session)
-                
-                LOG.info("TODO: notify the drone here with a message")
+            LOG.info("TODO: notify the drone here with a message")
         else:
             
             if not self.name:
                 self.__croak("Unable to start clone. No operational snapshot provided")
 
-            LOG.info("Reverting clone VM to operational snapshot")
-            
-            s = esx.revertVM(self.vm_session,self.quick_clone_vm_name,self.name)
+            LOG.info("Reverting clone VM to operational snapshot and starting it")
+            states = lifecycle.resumeStates(self.vm_session,self.quick_clone_vm_name,self.name)
+            tracker = self.lifecycle.track(self.quick_clone_vm_name,states,self.__on_state)
+            tracker.result()
+            self.lifecycle_timings = tracker.timings
+
             # Rename the snapshot
             desc = getArg("operational_quick_clone_snapshot_description","HoneyClient::Manager::ESX")
-            s, newname = esx.renameSnapshotVM(self.vm_session,self.quick_clone_vm_name,self.name,desc)
+            s, newname = self.__esx(esx.renameSnapshotVM,self.quick_clone_vm_name,self.name,None,desc)
+            LOG.info("Renamed operational snapshot of %s from %s to %s" % (self.quick_clone_vm_name,self.name,newname))
             self.name = newname
-            LOG.info("Renamed operational snapshot from %s to %s",(self.quick_clone_vm_name,self.name))
-            LOG.info("Get the VM config file")
 
-            s, self.vm_config = esx.getConfigVM(self.vm_session,self.quick_clone_vm_name)
-            LOG.info("Starting clone VM")
-            esx.startVM(self.vm_session,self.quick_clone_vm_name)
-            
-            # Wait to make sure it's running
-            running = False
-            while not running:
-                s, st = esx.getStateVM(self.vm_session,self.quick_clone_vm_name)
-                if st == 'poweredOn':
-                    running = True
-                else:
-                    sleep(self.retry_period)
-                    
-            self.__change_status("running")
+            LOG.info("Get the VM config file")
+            s, self.vm_config = self.__esx(esx.getConfigVM,self.quick_clone_vm_name)
 
             LOG.info("TODO: start agent & notify drone")
 
+    def __on_state(self,tracker,state):
+        """
+        Called by the lifecycle engine each time the clone reaches a state
+        """
+        if state == 'registered':
+            self.vm_config = tracker.props.get("config.files.vmPathName")
+        self.__change_status(state)
 
-    def __check_for_bsod(self,snapname):
-        
-        max_retry_count = int(getArg("max_retry_count","HoneyClient::Manager::ESX"))
-        if self.num_failed_inits > max_retry_count:
-
-            LOG.info("TODO: denynetwork")
-            LOG.error("Detected possible BSOD in initializing clone VM %s" % self.quick_clone_vm_name)
-
-            LOG.info("Reverting Clone VM")
-            esx.revertVM(self.vm_session,self.quick_clone_vm_name,snapname)
-            esx.startVM(self.vm_session,self.quick_clone_vm_name)
-            self.num_failed_inits = 0
-        else:
-            self.num_failed_inits += 1
-            LOG.info("Clone VM %s - had %i failed inits" % (self.quick_clone_vm_name,self.num_failed_inits))
-            
 
-    def __check_space_available(self):
+    def __esx(self,fn,*args,**kwargs):
         """
-        Check to make sure there's enough free space in the ESX datastore
-        IF NOT exit()
+        Call an esx function with the clone's session. A SessionPool logs
+        back in and tries again if the session expired (see sessions.call)
         """
-        s, free_space = esx.getDatastoreSpaceAvailable(self.vm_session,self.master_vm_name)
-        min_space_free = getArg('min_space_free','HoneyClient::Manager::ESX')
-        
-        if min_space_free == 'undef':
-            self.__croak('Cannot determine the min_space_available in honeyclient.xml')
-        
-        min_space_free = int(min_space_free) * (1024 * 1024 * 1024)
+        return sessions.call(self.vm_session,fn,*args,**kwargs)
 
-        if free_space < min_space_free:
-            store_free_space = free_space / (1024 * 1024 * 1024)
-            self.__croak("Primary datastore has low disk space: %0.2f GBs" % store_free_space)
+    def __reserve_space(self):
+        """
+        Reserve the space the clone is expected to use on the datastores of
+        the master VM (see honeyclient.manager.capacity)
+        IF NOT raise DatastoreFull
+        """
+        tracker = capacity.getTracker(self.vm_session)
+        return tracker.reserve(self.master_vm_name,label=self.quick_clone_vm_name)
 
-            
+    def __release_space(self):
+        """
+        Give the space reserved for the clone back
+        """
+        if self.reservation is not None:
+            self.reservation.release()
+            self.reservation = None
 
     # Temp REMOVE THIS LATER
     def shutdown(self):
@@ -369,13 +386,14 @@ class Clone(object):
         self.vix_disconnect_host()
         
     # Replace with croak in 'config'?
-    def __croak(self,msg):
+    def __croak(self,msg,error=errors.CloneError):
         """
-        Helper to log errors and die
+        Helper to log errors and raise them
         msg: message to log
+        error: the ESXError class to raise (default CloneError)
         """
         LOG.error(msg)
-        sys.exit(msg)
+        raise error(msg,self.quick_clone_vm_name)
 
 
     # VIX Calls...
@@ -537,7 +555,20 @@ class Clone(object):
         pass
     
     def suspend(self):
-        pass
+        """
+        Suspend the clone VM. It can be brought back with resume()
+        """
+        suspended_at = datetime.now()
+        self.__esx(esx.suspendVM,self.quick_clone_vm_name)
+        self.__change_status("suspended",suspended_at)
+
+    def resume(self):
+        """
+        Bring a suspended clone back: reverts it to its operational
+        snapshot and powers it on. If the clone has too many snapshots
+        a new quick clone is made instead.
+        """
+        self.__setup()
 
     def __change_status(self,value=None,suspended_at=None):
         if not value:
@@ -545,12 +576,20 @@ class Clone(object):
         
         if self.status == "suspicious" or \
                 self.status == "compromised" or \
-                self.status = "error" or \
+                self.status == "error" or \
                 self.status == "bug" or self.status == "deleted":
                 
                 return
 
 
+        if value != self.status:
+            now = time.time()
+            seconds = None
+            if self.status_changed_at is not None:
+                seconds = now - self.status_changed_at
+            metrics.cloneStatus(self.status,value,seconds)
+            self.status_changed_at = now
+
         self.status = value
         
         if self.quick_clone_vm_name and self.name:
@@ -560,11 +599,17 @@ class Clone(object):
     def destroy(self):
         LOG.info("TODO: denyNetwork")
         try:
-            desc = getArg("operational_quick_clone_snapshot_description","HoneyClient::Manager::ESX")
-            s, n = esx.renameSnapshotVM(self.vm_session,self.quick_clone_vm_name,self.name,"Deleted Snapshot",desc)
-            self.__change_status("deleted")
-            self.name = n
-        except SystemExit:
-            esx.suspendVM(self.vm_session,self.quick_clone_vm_name)
-            self.__change_status("error")
+            try:
+                desc = getArg("operational_quick_clone_snapshot_description","HoneyClient::Manager::ESX")
+                # Keep the old name in the new one, snapshot names have to be unique.
+                # The reaper removes these once they're old enough.
+                deleted_name = "%s %s" % (reaper.DELETED_SNAPSHOT_PREFIX,self.name)
+                s, n = self.__esx(esx.renameSnapshotVM,self.quick_clone_vm_name,self.name,deleted_name,desc)
+                self.__change_status("deleted")
+                self.name = n
+            except errors.ESXError:
+                self.__esx(esx.suspendVM,self.quick_clone_vm_name)
+                self.__change_status("error")
+        finally:
+            self.__release_space()
     
@@ -0,0 +1,195 @@
+"""
+Datastore file deletion for the esx module.
+
+Destroying a quick clone used to mean browsing its directory and then
+deleting every file, one task at a time, newest path first. ESX can delete
+a whole directory with a single DeleteDatastoreFile call, so that's tried
+first. Only a directory that can't be removed that way is browsed, and its
+files are deleted in parallel, up to 'max_concurrent_deletes', before the
+directory itself. Only the directory of the VM's vmx is deleted, see
+vmDirectories().
+
+Deleting is idempotent: a path that's already gone counts as deleted, so
+a destroy that was interrupted can simply be run again.
+
+Example:
+>> deleteDirectories(session,datacenter,["[datastore1] clone-1"])
+"""
+
+from com.vmware.vim25 import FileNotFound,FolderFileInfo,HostDatastoreBrowserSearchSpec,MethodFault, \
+    TaskInfoState
+
+from honeyclient.util.config import *
+from honeyclient.manager import errors,updates
+import os.path
+
+# Default number of files to delete at once
+DEFAULT_MAX_CONCURRENT = 8
+
+
+def vmDirectories(config):
+    """
+    Return the directories to delete with a VM: the directory of its vmx.
+    The suspend, snapshot and log directories go with it when they're
+    inside it. One outside of it is left alone, since other VMs may use it:
+    a quick clone's vmx is copied from its master, so a master with a
+    custom workingDir would otherwise lose it when a clone is destroyed.
+
+    :param config: the VM's VirtualMachineConfigInfo
+    :return: [datastore paths], empty if the vmx is at the root of a datastore
+    """
+    files = config.getFiles()
+    vmx_dir = __directory(os.path.dirname(files.getVmPathName()))
+    if vmx_dir is None:
+        return []
+    for p in [files.getSuspendDirectory(),files.getSnapshotDirectory(),files.getLogDirectory()]:
+        p = __directory(p)
+        if p and p != vmx_dir and not p.startswith(vmx_dir + "/"):
+            LOG.info("Not deleting %s, it's outside of the VM directory %s" % (p,vmx_dir))
+    return [vmx_dir]
+
+def deleteDirectories(session,datacenter,paths,max_concurrent=None):
+    """
+    Delete directories and everything in them
+
+    :param session:
+    :param datacenter: the Datacenter the datastore paths are relative to
+    :param paths: the datastore paths of the directories
+    :param max_concurrent: (optional) files to delete at once when falling
+                           back to deleting one file at a time
+    :return: a list of (path,error) for the paths that couldn't be deleted
+    """
+    paths = __unique(paths)
+    failed = __deleteAll(session,datacenter,paths,len(paths))
+    if not failed:
+        return []
+
+    # Fall back to deleting the files one by one, then the directories
+    failures = []
+    for path,error in failed:
+        LOG.info("Unable to delete %s in one call (%s), deleting its files" % (path,error))
+        try:
+            files,dirs = __listDirectory(session,datacenter,path)
+        except (MethodFault,errors.ESXError), detail:
+            failures.append((path,detail))
+            continue
+        failures.extend(__deleteAll(session,datacenter,files,max_concurrent))
+        # Deepest directories first
+        dirs.sort(lambda a,b: cmp(len(b),len(a)))
+        for d in dirs + [path]:
+            failures.extend(__deleteAll(session,datacenter,[d],1))
+    return failures
+
+def deleteFiles(session,datacenter,paths,max_concurrent=None):
+    """
+    Delete files
+
+    :param session:
+    :param datacenter: the Datacenter the datastore paths are relative to
+    :param paths: the datastore paths of the files
+    :param max_concurrent: (optional) files to delete at once
+    :return: a list of (path,error) for the paths that couldn't be deleted
+    """
+    return __deleteAll(session,datacenter,__unique(paths),max_concurrent)
+
+def __deleteAll(session,datacenter,paths,max_concurrent=None):
+    """
+    Delete paths in parallel. A path that doesn't exist counts as deleted.
+
+    :return: a list of (path,error) for the failures
+    """
+    max_concurrent = max(1,getIntArg('max_concurrent_deletes','HoneyClient::Manager::ESX',
+                                     DEFAULT_MAX_CONCURRENT,max_concurrent))
+
+    fileMgr = session.getFileManager()
+    waiter = updates.TaskSetWaiter(updates.getChannel(session))
+    pending = list(paths)
+    running = {}
+    failed = []
+    try:
+        while pending or running:
+            while pending and len(running) < max_concurrent:
+                path = pending.pop(0)
+                try:
+                    task = fileMgr.deleteDatastoreFile_Task(path,datacenter)
+                except FileNotFound:
+                    continue
+                except MethodFault, detail:
+                    failed.append((path,detail))
+                    continue
+                running[task.getMOR().get_value()] = path
+                waiter.add(task)
+
+            for task,state in waiter.wait():
+                path = running.pop(task.getMOR().get_value())
+                if state == str(TaskInfoState.success):
+                    continue
+                error = task.getTaskInfo().getError()
+                if error and isinstance(error.getFault(),FileNotFound):
+                    continue
+                failed.append((path,error))
+    finally:
+        waiter.close()
+    return failed
+
+def __listDirectory(session,datacenter,path):
+    """
+    List everything under a directory, on the datastore the path is on
+
+    :return: ([file paths],[directory paths])
+    """
+    ds_name = path[1:path.index("]")]
+    datastore = None
+    for ds in datacenter.getDatastores():
+        if ds.getName() == ds_name:
+            datastore = ds
+            break
+    if datastore is None:
+        return ([],[])
+
+    search_spec = HostDatastoreBrowserSearchSpec()
+    search_spec.setSortFoldersFirst(True)
+    task = datastore.getBrowser().searchDatastoreSubFolders_Task(path,search_spec)
+    if updates.waitForTask(session,task) != str(TaskInfoState.success):
+        error = task.getTaskInfo().getError()
+        if error and isinstance(error.getFault(),FileNotFound):
+            return ([],[])
+        # A task can fail without saying why
+        raise errors.errorForFault(error,errors.FileOperationFailed)("Unable to list %s" % path,
+                                                                       task=task,fault=error)
+
+    files = []
+    dirs = []
+    results = task.getTaskInfo().getResult()
+    if results and results.getHostDatastoreBrowserSearchResults():
+        for r in results.getHostDatastoreBrowserSearchResults():
+            folder = r.getFolderPath().rstrip("/")
+            if folder != path and folder not in dirs:
+                dirs.append(folder)
+            if r.getFile():
+                for f in r.getFile():
+                    if isinstance(f,FolderFileInfo):
+                        continue
+                    files.append("/".join([folder,f.getPath()]))
+    return (__unique(files),dirs)
+
+def __directory(path):
+    """
+    :return: the path without a trailing '/', None if it's empty or the root
+             of a datastore, which is never deleted
+    """
+    if not path:
+        return None
+    path = path.rstrip("/")
+    if not path.split("]",1)[-1].strip():
+        return None
+    return path
+
+def __unique(paths):
+    results = []
+    seen = {}
+    for p in paths:
+        if not seen.has_key(p):
+            seen[p] = True
+            results.append(p)
+    return results
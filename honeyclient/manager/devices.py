@@ -0,0 +1,121 @@
+"""
+An index of a VM's virtual devices.
+
+Copying or quick cloning a VM means, for each virtual disk, finding its
+controller to get the adapter type, and finding the matching disk on the
+clone. Each vm.getConfig() fetches the whole configuration from the server,
+so looping over the devices again inside the loop over the disks cost one
+round trip and one scan per disk. A DeviceTopology fetches the devices once
+and builds the key -> device and controller -> adapter type maps up front.
+
+Topologies are cached per session (see cache.getDeviceCache) under the VM's
+config.changeVersion, which the server changes on every reconfiguration,
+so a cached topology is only used while it's still current. Snapshot
+configurations never change, so theirs are cached for good.
+"""
+
+from com.vmware.vim25 import VirtualDisk,VirtualDiskFlatVer1BackingInfo,VirtualDiskFlatVer2BackingInfo
+
+import os.path,re
+
+# Converts a controller summary (ex: 'LSI Logic') to an adapter type (ex: 'lsiLogic')
+ADAPTER_PATTERN = re.compile(r"([A-Za-z]{3})(.*)")
+
+
+class DeviceTopology(object):
+    """
+    The virtual devices of a VM (or snapshot) indexed by key
+    """
+    def __init__(self,devices,vm_path=None,version=None):
+        """
+        :param devices: the VirtualDevices from config.hardware.device
+        :param vm_path: (optional) config.files.vmPathName
+        :param version: (optional) config.changeVersion
+        """
+        self.vm_path = vm_path
+        self.version = version
+        self.devices = {}
+        self.disks = []
+        self.__adapters = {}
+
+        if not devices:
+            return
+        for dev in devices:
+            self.devices[dev.getKey()] = dev
+            if isinstance(dev,VirtualDisk):
+                self.disks.append(dev)
+
+    def device(self,key):
+        """
+        :param key: the device key
+        :return: the VirtualDevice with the key or None
+        """
+        return self.devices.get(key)
+
+    def adapterType(self,disk):
+        """
+        Return the adapter type of the controller a disk is attached to, as
+        expected by VirtualDiskSpec.setAdapterType (ex: 'lsiLogic', 'busLogic')
+
+        :param disk: the VirtualDisk
+        :return: the adapter type or None if the controller isn't found
+        """
+        key = disk.getControllerKey()
+        if not self.__adapters.has_key(key):
+            adapter_type = None
+            ctrl = self.devices.get(key)
+            if ctrl and ctrl.getDeviceInfo():
+                # Strip whitespace and make the first 3 chars lowercase
+                m = ADAPTER_PATTERN.match("".join(ctrl.getDeviceInfo().getSummary().split()))
+                if m:
+                    adapter_type = m.group(1).lower() + m.group(2)
+            self.__adapters[key] = adapter_type
+        return self.__adapters[key]
+
+    def hasExternalDisks(self):
+        """
+        :return: True if any virtual disk isn't file based, or its file is
+                 outside the VM's directory (what a quick clone looks like)
+        """
+        vm_dirname = os.path.dirname(self.vm_path or "")
+        for dev in self.disks:
+            backing = dev.getBacking()
+            if not isFlatDisk(backing):
+                return True
+            if os.path.dirname(backing.getFileName()) != vm_dirname:
+                return True
+        return False
+
+
+def isFlatDisk(backing):
+    """
+    :param backing: the backing of a VirtualDisk
+    :return: True if the disk is a file based (flat) disk
+    """
+    return isinstance(backing,VirtualDiskFlatVer1BackingInfo) or \
+        isinstance(backing,VirtualDiskFlatVer2BackingInfo)
+
+def fromConfig(config):
+    """
+    Build a DeviceTopology from a config that's already been fetched
+
+    :param config: a VirtualMachineConfigInfo
+    :return: DeviceTopology
+    """
+    return DeviceTopology(config.getHardware().getDevice(),
+                          config.getFiles().getVmPathName(),
+                          config.getChangeVersion())
+
+def fetch(vm):
+    """
+    Fetch the devices of a VM in one round trip
+
+    :param vm: the VirtualMachine
+    :return: DeviceTopology
+    """
+    props = vm.getPropertiesByPaths(["config.hardware.device",
+                                     "config.files.vmPathName",
+                                     "config.changeVersion"])
+    return DeviceTopology(props.get("config.hardware.device"),
+                          props.get("config.files.vmPathName"),
+                          props.get("config.changeVersion"))
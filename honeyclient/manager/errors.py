@@ -0,0 +1,143 @@
+"""
+Exceptions raised by the esx, clone and pool modules.
+
+Every error is an ESXError, so callers can catch that to skip one VM and
+carry on, or catch one of the subclasses to retry a particular failure.
+Each error carries what's known about it: the VM name, the Task and the
+server fault (a MethodFault or LocalizedMethodFault) when there is one.
+
+Example:
+>> try:
+>>     esx.startVM(session,name)
+>> except errors.QuestionUnanswerable, e:
+>>     print "VM %s is stuck on: %s" % (e.vm,e)
+"""
+
+
+class ESXError(Exception):
+    """
+    Base class of all the errors
+    """
+    def __init__(self,msg,vm=None,task=None,fault=None):
+        """
+        :param msg: the error message
+        :param vm: (optional) the name of the VM
+        :param task: (optional) the Task that failed
+        :param fault: (optional) the fault returned by the server
+        """
+        Exception.__init__(self,msg)
+        self.msg = msg
+        self.vm = vm
+        self.task = task
+        self.fault = fault
+
+    def __str__(self):
+        return self.msg
+
+
+class LoginFailed(ESXError):
+    """
+    Unable to log into the server
+    """
+
+class SessionExpired(ESXError):
+    """
+    The session is no longer authenticated
+    """
+
+class VMNotFound(ESXError):
+    """
+    No VM with the given name
+    """
+
+class SnapshotNotFound(ESXError):
+    """
+    No snapshot with the given name
+    """
+
+class NameCollision(ESXError):
+    """
+    A requested VM or snapshot name is already used
+    """
+
+class InvalidVMState(ESXError):
+    """
+    The VM isn't in a state that allows the operation
+    """
+
+class TaskFailed(ESXError):
+    """
+    A task finished with an error or couldn't be followed
+    """
+    def __init__(self,msg,vm=None,task=None,fault=None):
+        if fault is None and task is not None:
+            try:
+                fault = task.getTaskInfo().getError()
+            except Exception:
+                pass
+        ESXError.__init__(self,msg,vm,task,fault)
+
+class QuestionUnanswerable(ESXError):
+    """
+    The VM asked a question we don't know how to answer
+    """
+
+class DatastoreFull(ESXError):
+    """
+    The datastore doesn't have enough free space
+    """
+
+class FileOperationFailed(ESXError):
+    """
+    Copying, deleting or browsing datastore files failed
+    """
+
+class CloneError(ESXError):
+    """
+    A clone VM couldn't be set up or driven
+    """
+
+class TimedOut(ESXError):
+    """
+    An operation didn't finish in the time it was given
+    """
+
+class Cancelled(ESXError):
+    """
+    An operation was cancelled before it finished
+    """
+
+
+# Server faults that map to a more specific error. Kept as names so this
+# module can be imported without the VI Java API.
+FAULT_ERRORS = {'NotAuthenticated':SessionExpired,
+                'InvalidLogin':LoginFailed,
+                'NoDiskSpace':DatastoreFull,
+                'FileNotFound':FileOperationFailed,
+                'InvalidPowerState':InvalidVMState,
+                'InvalidState':InvalidVMState}
+
+def errorForFault(fault,default=ESXError):
+    """
+    Pick the error class matching a server fault
+
+    :param fault: a MethodFault (or None)
+    :param default: the class to use if nothing matches
+    :return: an ESXError subclass
+    """
+    if fault is None:
+        return default
+    # Already one of ours, ex: SessionExpired from a closed update channel
+    if isinstance(fault,ESXError):
+        return fault.__class__
+    # A task's info.error is a LocalizedMethodFault wrapping the real fault
+    if hasattr(fault,'getFault'):
+        fault = fault.getFault()
+    classes = [fault.__class__]
+    while classes:
+        cls = classes.pop(0)
+        error = FAULT_ERRORS.get(cls.__name__)
+        if error:
+            return error
+        classes.extend(cls.__bases__)
+    return default
@@ -16,14 +16,12 @@ Example use from a Jython shell:
 >> for i in results: print i 
 """
 
-from java.net import URL
-import java.lang as lang
-from com.vmware.vim25 import *
-from com.vmware.vim25.mo import *
-from com.vmware.vim25.mo.util import *
-
 import os.path,re,uuid,sys,time
 from honeyclient.util.config import *
+# The VI Java API classes, and the other helpers that bind java.util.concurrent
+# and vim25 classes of their own, are imported by the functions that use them,
+# so importing esx doesn't load vijava
+from honeyclient.manager import cache,errors,snapshots
 from time import sleep
 
 
@@ -32,41 +30,87 @@ def login(service_url,un,pw):
     Login to the ESX Server and create a Session
     
     :param service_url: full URL to ESX server. ex: 'https://esx_server/sdk/'
+                        A 'sim://' URL logs into a simulated server instead,
+                        see simulator.py. ex: 'sim://localhost/sdk'
     :param un: the account username
     :param pw: the account password
     
     :return:  a 'session' object to pass to other functions
     """
+    from java.net import URL
+    from com.vmware.vim25.mo import ServiceInstance
+    from honeyclient.manager import instrument
     try:
-       return ServiceInstance(URL(service_url),un,pw,True)
+        if str(service_url).strip().lower().startswith("sim://"):
+            # The simulator is big, it's only loaded when it's used
+            from honeyclient.manager import simulator
+            session = simulator.connect(service_url,un,pw)
+        else:
+            session = ServiceInstance(URL(service_url),un,pw,True)
     except:
-        croak("Error logging into the ESX Server. Check login credentials. Exiting...")
+        croak("Error logging into the ESX Server. Check login credentials.",errors.LoginFailed)
+
+    if instrument.isEnabled():
+        instrument.instrument(session)
+
+    # Attach the VM name cache to the new session
+    cache.getCache(session,getIntArg("vm_cache_ttl","HoneyClient::Manager::ESX",cache.DEFAULT_TTL))
+    return session
 
 def logout(session):
     """
     Logout the current session
 
-    :param session: the session to close
+    :param session: the session to close. If it's a SessionPool, all
+                    of its sessions are logged out
     :return: None
     """
+    from honeyclient.manager import names,sessions,updates
+    if isinstance(session,sessions.SessionPool):
+        session.close()
+        return None
+    names.dropIndex(session)
+    snapshots.dropWatcher(session)
+    updates.closeChannel(session)
+    cache.dropCache(session)
     session.getServerConnection().logout()
     return None
 
-def isRegisteredVM(session,vm_name):
+def isRegisteredVM(session,vm_name,fresh=False):
     """
     Given the name of a VM, check if it's registered
 
     :param session:
     :param vm_name: the name of the VM
+    :param fresh: if True, skip the VM cache and search the inventory
     :return: (session,True | False) 
     """
-    rootFolder = session.getRootFolder()
-    vm = InventoryNavigator(rootFolder).searchManagedEntity("VirtualMachine",vm_name)
-    if vm:
+    if __lookupVM(session,vm_name,fresh):
         return (session,True)
     else:
         return (session,False)
 
+def invalidateVM(session,name=None):
+    """
+    Drop a VM from the session's caches. The next lookup of the VM
+    will search the inventory again.
+
+    :param session:
+    :param name: the name of the VM. If None, the whole cache is dropped
+    :return: session
+    """
+    vm_cache = __getCache(session)
+    if name is None:
+        __getSnapshotCache(session).invalidate()
+        __getDeviceCache(session).invalidate()
+    else:
+        mor = vm_cache.get(name)
+        if mor:
+            __getSnapshotCache(session).invalidate(mor.get_value())
+            __getDeviceCache(session).invalidate(mor.get_value())
+    vm_cache.invalidate(name)
+    return session
+
 def listAllRegisteredVMS(session):
     """ 
     Get a list of all registered VMs (names)
@@ -74,14 +118,87 @@ def listAllRegisteredVMS(session):
     :param session:
     :return: (session,[names])
     """
-    rootFolder = session.getRootFolder()
-    list = InventoryNavigator(rootFolder).searchManagedEntities("VirtualMachine")
-    
-    def extract_name(vm): return vm.getName()
-    results = map(extract_name,list)
+    session,records = getInventoryESX(session,"VirtualMachine",["name"])
+
+    # We have the MORs anyway, so prime the name cache with them
+    vm_cache = __getCache(session)
+    results = []
+    for r in records:
+        vm_cache.put(r['name'],r['mor'])
+        results.append(r['name'])
     
     return (session,results)
 
+def getInventoryESX(session,mo_type,props):
+    """
+    Fetch a set of properties for every managed object of the given type
+    with a single PropertyCollector request, instead of one round trip
+    per object per property.
+
+    Example:
+    >> s,vms = getInventoryESX(session,'VirtualMachine',['name','runtime.powerState'])
+    >> for vm in vms: print vm['name'], vm['runtime.powerState']
+
+    :param session:
+    :param mo_type: the managed object type. ex: 'VirtualMachine', 'HostSystem', 'Datastore'
+    :param props: a list of property paths to fetch. ex: ['name','config.files.vmPathName']
+    :return: (session,[records]) where each record is a dict of {path:value} plus
+             'mor' holding the ManagedObjectReference. Unset properties are None
+    """
+    from com.vmware.vim25 import MethodFault,ObjectSpec,PropertyFilterSpec,PropertySpec
+    from com.vmware.vim25.mo.util import PropertyCollectorUtil
+    propSpec = PropertySpec()
+    propSpec.setType(mo_type)
+    propSpec.setAll(False)
+    propSpec.setPathSet(props)
+
+    objSpec = ObjectSpec()
+    objSpec.setObj(session.getRootFolder().getMOR())
+    objSpec.setSkip(True)
+    objSpec.setSelectSet(__buildInventoryTraversal())
+
+    filterSpec = PropertyFilterSpec()
+    filterSpec.setPropSet([propSpec])
+    filterSpec.setObjectSet([objSpec])
+
+    try:
+        contents = session.getPropertyCollector().retrieveProperties([filterSpec])
+    except MethodFault, detail:
+        croak("Error retrieving %s properties. Reason: %s" % (mo_type,detail),fault=detail)
+
+    results = []
+    if not contents:
+        return (session,results)
+
+    for oc in contents:
+        record = {'mor':oc.getObj()}
+        for p in props:
+            record[p] = None
+        if oc.getPropSet():
+            for dp in oc.getPropSet():
+                record[dp.getName()] = PropertyCollectorUtil.convertProperty(dp.getVal())
+        results.append(record)
+
+    return (session,results)
+
+def getStatusAllVMS(session):
+    """
+    Get the state of every registered VM in one request. The states are
+    the same as getStateVM()
+
+    :param session:
+    :return: (session,{name:state})
+    """
+    session,records = getInventoryESX(session,"VirtualMachine",
+                                      ["name","runtime.powerState","runtime.question"])
+    results = {}
+    for r in records:
+        if r['runtime.question']:
+            results[r['name']] = 'pendingquestion'
+        else:
+            results[r['name']] = str(r['runtime.powerState'])
+    return (session,results)
+
 
 def registerVM(session,path,name):
     """
@@ -92,6 +209,8 @@ def registerVM(session,path,name):
     :param name: the desired registered name of the VM
     :return: session or die on error
     """
+    from com.vmware.vim25 import MethodFault
+    from com.vmware.vim25.mo import ComputeResource,InventoryNavigator,Task
     rootFolder = session.getRootFolder()
     data_center = InventoryNavigator(rootFolder).searchManagedEntity("Datacenter","ha-datacenter")
     hostsystem_list = InventoryNavigator(rootFolder).searchManagedEntities("HostSystem")
@@ -112,10 +231,13 @@ def registerVM(session,path,name):
             break
     try:
         task = vm_folder.registerVM_Task(path,name,False,resource.getResourcePool(),host)
-        if task.waitForMe() != Task.SUCCESS:
-            croak("Failed to register VM: %s",name)
+        if __waitForTask(session,task) != Task.SUCCESS:
+            croak("Failed to register VM: %s" % name,errors.TaskFailed,vm=name,task=task)
     except MethodFault, detail:
-        croak("Error registering the VM. Reason: %s" % detail.getMessage())
+        croak("Error registering the VM. Reason: %s" % detail.getMessage(),vm=name,fault=detail)
+
+    # The task result is the MOR of the newly registered VM
+    __getCache(session).put(name,task.getTaskInfo().getResult())
 
     return session
 
@@ -128,26 +250,30 @@ def unRegisterVM(session,name):
     :return: (session,filename of the VM) on success 
     or (session,'undef') if the VM wasn't found
     """
+    from com.vmware.vim25 import MethodFault
     vm = getVMbyName(session,name)
 
     try:
         fn = vm.getConfig().getFiles().getVmPathName()
         vm.unregisterVM()
+        __getCache(session).invalidate(name)
+        __invalidateSnapshots(session,vm)
         return (session,fn)
     
     except MethodFault,detail:
         LOG.error("Error unregistering VM: %s. Reason: %s" % (name,detail.getMessage()))
         return (session,'undef')
 
-def getStateVM(session,name):
+def getStateVM(session,name,fresh=False):
     """
     Get the current state of a given VM. Possible states are:
     'poweredOn, 'poweredOff', 'suspended', pendingquestion'.
     
     :param name: the name of the VM
+    :param fresh: if True, skip the VM cache and search the inventory
     :return: (session,state) on success or dies on error
     """
-    vm = getVMbyName(session,name)
+    vm = getVMbyName(session,name,fresh)
     state = ''
 
     # Check for possible pending questions
@@ -156,7 +282,7 @@ def getStateVM(session,name):
     elif vm.getRuntime().getPowerState():
         state = str(vm.getRuntime().getPowerState())
     else:
-        croak("Could not get execution state of %s" % name)
+        croak("Could not get execution state of %s" % name,errors.InvalidVMState,vm=name)
     
     return (session,state)
 
@@ -168,48 +294,17 @@ def startVM(session,name):
     :param name: the name of the VM
     :return: (session, True) or dies on error
     """
-    s,state = getStateVM(session,name)
-    if state == 'poweredOn':
-        return (session,True)
-
-    if state == 'pendingquestion':
-        session = answerVM(session,name)
-        session,state = getStateVM(session,name)
-    
-    vm = getVMbyName(session,name)
-    task = vm.powerOnVM_Task(None)
-
-    # Note: uses our 'pool' wrapper to check for pending questions
-    flag = __poll_task_for_question(task,session,name)
-    if flag == Task.SUCCESS:
-        return (session,True)
-    else:
-        croak("Could not start VM %s" % name)
+    return startVM_async(session,name).result()
 
 def stopVM(session,name):
     """
-    Stop a VM by name
+    Stop a VM by name. A suspended VM is started first.
 
     :param session:
     :param name: the name of the VM
     :return: (session, True) or dies on error
     """
-    s,state = getStateVM(session,name)
-    if state == 'poweredOff':
-        return (session,True)
-
-    # If the thing is suspended you need to start it
-    # first to stop it.
-    if state == 'suspended':
-        startVM(session,name)
-
-    vm = getVMbyName(session,name)
-    task = vm.powerOffVM_Task()
-    flag = __poll_task_for_question(task,session,name)
-    if flag == Task.SUCCESS:
-        return (session,True)
-    else:
-        croak("Could not stop the VM: %s" % name)
+    return stopVM_async(session,name).result()
         
 
 def rebootVM(session,name):
@@ -226,7 +321,7 @@ def rebootVM(session,name):
         vm.rebootGuest()
         return (session,True)
     except:
-        croak("Reboot failed for VM: %s!" % name)
+        croak("Reboot failed for VM: %s!" % name,vm=name)
 
 def suspendVM(session,name):
     """
@@ -236,20 +331,7 @@ def suspendVM(session,name):
     :param name: the name of the VM
     :return: (session,True) or die on error
     """
-    s,state = getStateVM(session,name)
-    if state == 'suspended':
-        return (session,True)
-
-    if state == 'poweredOff':
-        croak("Cannot suspend a poweredOff VM. VM name: %s" % name)
-
-    vm = getVMbyName(session,name)
-    task = vm.suspendVM_Task()
-    flag = __poll_task_for_question(task,session,name)
-    if flag == Task.SUCCESS:
-        return (session,True)
-    else:
-        croak("Failed to suspend VM: %s" % name)
+    return suspendVM_async(session,name).result()
 
 def resetVM(session,name):
     """
@@ -259,14 +341,215 @@ def resetVM(session,name):
     :param name: the name of the VM
     :return (session,True) or die on error
     """
-    vm = getVMbyName(session,name)
+    return resetVM_async(session,name).result()
 
-    task = vm.resetVM_Task()
-    flag = __poll_task_for_question(task,session,name)
-    if flag == Task.SUCCESS:
-        return (session,True)
-    else:
-        croak("Failed to reset VM: %s" % name)
+
+# The power state each operation of powerMany() leaves a VM in
+POWER_TARGETS = {'start':'poweredOn',
+                 'stop':'poweredOff',
+                 'suspend':'suspended',
+                 'reset':'poweredOn'}
+
+def powerMany(session,vm_names,op,max_concurrent=None,timeout=None):
+    """
+    Start, stop, suspend or reset many VMs at once. The VMs are looked up
+    with one inventory request, the ones already in the target state are
+    skipped, and the tasks run concurrently, up to max_concurrent, followed
+    by one TaskSetWaiter. Questions asked by any of the VMs are answered
+    from one watch on all of them. A VM that fails doesn't stop the others.
+
+    :param session:
+    :param vm_names: the names of the VMs
+    :param op: 'start', 'stop', 'suspend' or 'reset'
+    :param max_concurrent: (OPTIONAL) tasks to run at once. Default 'max_concurrent_power_ops'
+    :param timeout: (OPTIONAL) seconds after which the tasks still running are cancelled
+
+    :return: (session,batch.BatchResult) with an OpResult per VM, named after the VM.
+             The result of a VM is its new power state, or 'unchanged' if it was
+             already in it
+    """
+    from com.vmware.vim25.mo import Task,VirtualMachine
+    from honeyclient.manager import batch,futures,updates
+    if not POWER_TARGETS.has_key(op):
+        croak("Unknown power operation: %s" % op)
+    max_concurrent = max(1,getIntArg("max_concurrent_power_ops","HoneyClient::Manager::ESX",8,max_concurrent))
+
+    started = time.time()
+    deadline = None
+    if timeout is not None:
+        deadline = started + timeout
+
+    session,records = getInventoryESX(session,"VirtualMachine",["name","runtime.powerState"])
+    vm_cache = __getCache(session)
+    by_name = {}
+    for r in records:
+        vm_cache.put(r['name'],r['mor'])
+        by_name[r['name']] = r
+
+    results = []
+    pending = []
+    for name in vm_names:
+        result = batch.OpResult(name)
+        result.started = started
+        results.append(result)
+        r = by_name.get(name)
+        if r is None:
+            result.error = errors.VMNotFound("VM name: %s not found" % name,vm=name)
+            continue
+        state = str(r['runtime.powerState'])
+        steps = __powerSteps(op,state)
+        if steps is None:
+            result.error = errors.InvalidVMState("Cannot %s a %s VM. VM name: %s" % (op,state,name),vm=name)
+            continue
+        if not steps:
+            result.result = 'unchanged'
+            result.elapsed = 0.0
+            continue
+        pending.append((result,VirtualMachine(session.getServerConnection(),r['mor']),steps))
+
+    if not pending:
+        return (session,batch.BatchResult(results,time.time() - started))
+
+    # Answer the questions of every VM from one filter
+    channel = updates.getChannel(session)
+    running = {}
+    unanswerable = {}
+    vms = {}
+    for result,vm,steps in pending:
+        vms[vm.getMOR().get_value()] = (result,vm)
+
+    def answer(result,vm,question):
+        try:
+            __answerQuestion(vm,result.name,question)
+        except errors.ESXError, e:
+            unanswerable[result.name] = e
+            for task,r,v,s in running.values():
+                if r is result:
+                    try:
+                        task.cancelTask()
+                    except Exception, detail:
+                        LOG.debug("Unable to cancel the task of %s: %s" % (result.name,detail))
+
+    def question(mor,changes):
+        if changes and changes.get("runtime.question"):
+            result,vm = vms[mor.get_value()]
+            LOG.info("VM %s has a pending question" % result.name)
+            futures.submit(answer,result,vm,changes["runtime.question"])
+
+    pfilter = channel.watch([(vm.getMOR(),["runtime.question"]) for result,vm,steps in pending],question)
+    waiter = updates.TaskSetWaiter(channel)
+    try:
+        while pending or running:
+            while pending and len(running) < max_concurrent:
+                result,vm,steps = pending.pop(0)
+                task = __startPowerStep(vm,result,steps[0])
+                if task is None:
+                    continue
+                running[task.getMOR().get_value()] = (task,result,vm,steps)
+                waiter.add(task)
+
+            remaining = None
+            if deadline is not None:
+                remaining = deadline - time.time()
+            if remaining is not None and remaining <= 0:
+                done = []
+            else:
+                done = waiter.wait(remaining)
+
+            if not done and deadline is not None and time.time() >= deadline:
+                __timeoutPowerTasks(running,pending,op,timeout)
+                break
+
+            for task,state in done:
+                task,result,vm,steps = running.pop(task.getMOR().get_value())
+                if state != Task.SUCCESS:
+                    result.error = unanswerable.get(result.name) or \
+                        errors.TaskFailed("Could not %s VM %s" % (op,result.name),result.name,task)
+                    result.elapsed = time.time() - result.started
+                    continue
+                steps = steps[1:]
+                if steps:
+                    # The next step of the same VM takes the slot right away
+                    pending.insert(0,(result,vm,steps))
+                    continue
+                result.result = POWER_TARGETS[op]
+                result.elapsed = time.time() - result.started
+    finally:
+        waiter.close()
+        channel.unwatch(pfilter)
+
+    outcome = batch.BatchResult(results,time.time() - started)
+    for r in outcome.failed():
+        LOG.error("Unable to %s VM %s: %s" % (op,r.name,r.error))
+    LOG.info("%s of %d VMs: %s" % (op,len(vm_names),outcome.summary()))
+    return (session,outcome)
+
+def __powerSteps(op,state):
+    """
+    The power tasks that take a VM from its state to the target of an operation
+
+    :param op: the powerMany() operation
+    :param state: the VM's power state
+    :return: a list of 'powerOn', 'powerOff', 'suspend' or 'reset', empty if
+             there's nothing to do, None if the VM can't be taken there
+    """
+    if op == 'start':
+        if state == 'poweredOn':
+            return []
+        return ['powerOn']
+    if op == 'stop':
+        if state == 'poweredOff':
+            return []
+        # If the thing is suspended you need to start it
+        # first to stop it.
+        if state == 'suspended':
+            return ['powerOn','powerOff']
+        return ['powerOff']
+    if op == 'suspend':
+        if state == 'suspended':
+            return []
+        if state == 'poweredOff':
+            return None
+        return ['suspend']
+    if op == 'reset':
+        if state != 'poweredOn':
+            return None
+        return ['reset']
+    return None
+
+def __startPowerStep(vm,result,step):
+    """
+    Start one power task of powerMany()
+
+    :return: the Task, or None if it couldn't be started (the error is in result)
+    """
+    from com.vmware.vim25 import MethodFault
+    try:
+        if step == 'powerOn':
+            return vm.powerOnVM_Task(None)
+        if step == 'powerOff':
+            return vm.powerOffVM_Task()
+        if step == 'suspend':
+            return vm.suspendVM_Task()
+        return vm.resetVM_Task()
+    except MethodFault, detail:
+        result.error = errors.errorForFault(detail,errors.TaskFailed)(
+            "Could not %s VM %s. Reason: %s" % (step,result.name,detail),result.name,fault=detail)
+        result.elapsed = time.time() - result.started
+        return None
+
+def __timeoutPowerTasks(running,pending,op,timeout):
+    """
+    Cancel what's left of powerMany() once its timeout is up
+    """
+    for task,result,vm,steps in running.values():
+        try:
+            task.cancelTask()
+        except Exception, e:
+            LOG.debug("Unable to cancel the task of %s: %s" % (result.name,e))
+        result.error = errors.TimedOut("Could not %s VM %s in %ss" % (op,result.name,timeout),result.name,task)
+    for result,vm,steps in pending:
+        result.error = errors.TimedOut("Could not %s VM %s in %ss" % (op,result.name,timeout),result.name)
 
 
 def fullCloneVM(session,srcname,dstname=None):
@@ -288,82 +571,131 @@ def fullCloneVM(session,srcname,dstname=None):
         croak("Error cloning the VM: srcname wasn't specified")
 
     if not dstname:
-        # Create a UUID for the name and check that if doesn't exist 
-        while(True):
-            dstname = __generateVMID()
-            # First check to see it's NOT a registered VM name
-            # if it does match an existing name, keep trying with another name
-            s,registeredVal = isRegisteredVM(session,dstname)
-            if not registeredVal:
-                # Next, check there are NO snapshots with the same name
-                if not __isSnapshotByName(session,dstname):
-                    # If we didn't find the name in all the snapshots, we're done
-                    break
-        
+        dstname = __generateName(session)
     else:
-        s,valVM = isRegisteredVM(session,dstname)
-        if valVM:
-            croak("The dest_name %s matches a registered VM. Please use another name" % dstname)
-        if __isSnapshotByName(session,dstname):
-            croak("The dest_name %s matches and existing VM Snapshot name. Please use another name" % dstname)
+        __reserveName(session,dstname,"dest_name")
 
-    s,src_state = getStateVM(session,srcname)
-    
-    # Check to make the VM is either powered off or suspended. If it's not in either
-    # of these states try to suspend it
-    if src_state == 'poweredOn':
-        suspendVM(session,srcname)
+    try:
         s,src_state = getStateVM(session,srcname)
 
+        # Check to make the VM is either powered off or suspended. If it's not in either
+        # of these states try to suspend it
         if src_state == 'poweredOn':
-            # If we can't suspend the VM die...
-            croak("Cannot perform a fullclone of VM %s - the VM is not suspended or off" % srcname)
-    
-    session,vmxfile = fullCopyVM(session,srcname,dstname)
+            suspendVM(session,srcname)
+            s,src_state = getStateVM(session,srcname)
 
-    registerVM(session,vmxfile,dstname)
-    
-    startVM(session,dstname)
+            if src_state == 'poweredOn':
+                # If we can't suspend the VM die...
+                croak("Cannot perform a fullclone of VM %s - the VM is not suspended or off" % srcname,
+                      errors.InvalidVMState,vm=srcname)
 
-    if src_state == 'suspended':
-        resetVM(session,dstname)
+        session,vmxfile = fullCopyVM(session,srcname,dstname)
+
+        registerVM(session,vmxfile,dstname)
+
+        startVM(session,dstname)
+
+        if src_state == 'suspended':
+            resetVM(session,dstname)
+    except:
+        __releaseName(session,dstname)
+        raise
 
     return (session,dstname)
     
 
-def quickCloneVM(session,srcname,dstname=None):
+def quickCloneVM(session,srcname,dstname=None,reservation=None):
     """
-    Creates a differential clone of the specified VM.
+    Creates a differential clone of the specified VM. The space the clone is
+    expected to use is reserved first (see honeyclient.manager.capacity), and
+    held until the clone is destroyed by destroyVM().
 
     :param session:
     :param srcname: the name of the VM to clone
     :param dstname: (OPTIONAL) the name of the clone. If not specified UUID name will be generated  
                     for the dstname
+    :param reservation: (OPTIONAL) a capacity.Reservation the caller already holds
+                        for the clone, and releases itself
 
-    :return: (session,dstname) or die on error
+    :return: (session,dstname) or die on error, DatastoreFull if there isn't room for it
     """
     if not srcname:
         croak("Error cloning the VM: srcname wasn't specified")
 
     if not dstname:
-        # Create a UUID for the name and check that if doesn't exist 
-        while(True):
-            dstname = __generateVMID()
-            # First check to see it's NOT a registered VM name
-            # if it does match an existing name, keep trying with another name
-            s,r = isRegisteredVM(session,dstname)
-            if not r:
-                # Next, check there are NO snapshots with the same name
-                if not __isSnapshotByName(session,dstname):
-                    # If we didn't find the name in all the snapshots, we're done
-                    break
+        dstname = __generateName(session)
     else:
-        s,r = isRegisteredVM(session,dstname)
-        if r:
-            croak("The dest_name %s matches and existing VM. Please use another name" % dstname)
-        if __isSnapshotByName(session,dstname):
-            croak("The dest_name %s matches and existing VM Snapshot name. Please use another name" % dstname)
+        __reserveName(session,dstname,"dest_name")
+
+    try:
+        src_vm,src_state = __prepareQuickCloneMaster(session,srcname)
+        return __quickCloneReserved(session,src_vm,srcname,src_state,dstname,reservation)
+    except:
+        __releaseName(session,dstname)
+        raise
+
+def quickCloneMany(session,srcname,count,max_workers=None,per_host=None,per_datastore=None):
+    """
+    Create several differential clones of the specified VM at once. The master
+    VM is checked and prepared once, then the clones are made in parallel on a
+    thread pool. Each clone reserves its space before it's made, like
+    quickCloneVM(), so clones that don't fit fail with DatastoreFull.
+
+    :param session:
+    :param srcname: the name of the VM to clone
+    :param count: the number of clones to make
+    :param max_workers: (OPTIONAL) clones to make at once. Default 'max_concurrent_clones'
+    :param per_host: (OPTIONAL) clones to make at once on the master's host.
+                     Default 'max_clones_per_host'
+    :param per_datastore: (OPTIONAL) clones to make at once on each of the master's
+                          datastores. Default 'max_clones_per_datastore'
 
+    :return: (session,batch.BatchResult) with an OpResult per clone, named after the
+             clone. Failed clones are reported in the result rather than dying
+    """
+    from honeyclient.manager import batch
+    if not srcname:
+        croak("Error cloning the VM: srcname wasn't specified")
+
+    max_workers = getIntArg("max_concurrent_clones","HoneyClient::Manager::ESX",4,max_workers)
+    per_host = getIntArg("max_clones_per_host","HoneyClient::Manager::ESX",4,per_host)
+    per_datastore = getIntArg("max_clones_per_datastore","HoneyClient::Manager::ESX",2,per_datastore)
+
+    src_vm,src_state = __prepareQuickCloneMaster(session,srcname)
+
+    host_key = ('host',src_vm.getRuntime().getHost().get_value())
+    limits = {host_key:per_host}
+    keys = [host_key]
+    for ds in src_vm.getDatastores():
+        ds_key = ('datastore',ds.getName())
+        limits[ds_key] = per_datastore
+        keys.append(ds_key)
+
+    jobs = []
+    for i in range(count):
+        dstname = __generateName(session)
+        jobs.append(batch.BatchJob(dstname,__quickCloneReserved,
+                                   (session,src_vm,srcname,src_state,dstname),keys=keys))
+
+    LOG.info("Quick cloning %s %d times, %d at a time" % (srcname,count,max_workers))
+    result = batch.runBatch(jobs,max_workers,limits)
+    for failed in result.failed():
+        __releaseName(session,failed.name)
+    LOG.info("Quick cloned %s: %s" % (srcname,result.summary()))
+
+    return (session,result)
+
+def __prepareQuickCloneMaster(session,srcname):
+    """
+    Get the master VM ready to be quick cloned: make sure it's suspended or
+    off, has no snapshots, and carries the master annotation.
+
+    :param session:
+    :param srcname: the name of the master VM
+    :return: (src_vm,src_state) or die on error
+    """
+    from com.vmware.vim25 import MethodFault,VirtualMachineConfigSpec
+    from com.vmware.vim25.mo import Task
     s,src_state = getStateVM(session,srcname)
     
     # Check to make the VM is either powered off or suspended. If it's not in either
@@ -374,30 +706,69 @@ def quickCloneVM(session,srcname,dstname=None):
 
         if src_state == 'poweredOn':
             # If we can't suspend the VM die...
-            croak("Cannot perform a quickclone of VM %s - the VM is not suspended or off" % srcname)
+            croak("Cannot perform a quickclone of VM %s - the VM is not suspended or off" % srcname,
+                  errors.InvalidVMState,vm=srcname)
     
     src_vm = getVMbyName(session,srcname)
 
     if src_vm.getSnapshot():
-        croak('Cannot quick clone it has snapshots for %s. Delete the snapshots and try again' % srcname)
-
-    LOG.debug("Quick cloning %s to %s" % (srcname,dstname))
-
-    # Make the copy
-    session,vmxfile = quickCopyVM(session,srcname,dstname)
+        croak('Cannot quick clone it has snapshots for %s. Delete the snapshots and try again' % srcname,
+              errors.InvalidVMState,vm=srcname)
 
     configSpec = VirtualMachineConfigSpec()
     configSpec.setAnnotation(getArg("default_quick_clone_master_annotation","honeyclient::manager::esx"))
     
     try:
         task = src_vm.reconfigVM_Task(configSpec) 
-        if not task.waitForMe() == Task.SUCCESS:
-            msg = "Error copying %s to %s" % (srcname,dstname)
-            croak(msg)
+        if not __waitForTask(session,task) == Task.SUCCESS:
+            croak("Error setting the master annotation on %s" % srcname,errors.TaskFailed,vm=srcname,task=task)
     except MethodFault,detail:
-        msg = "Error copying %s to %s Reason: %s" % (srcname,dstname,detail)
-        croak(msg)
-    
+        croak("Error setting the master annotation on %s Reason: %s" % (srcname,detail),vm=srcname,fault=detail)
+
+    return (src_vm,src_state)
+
+def __quickCloneReserved(session,src_vm,srcname,src_state,dstname,reservation=None):
+    """
+    __quickCloneFromMaster() with the space of the clone reserved. Unless
+    the caller gave a reservation, it's released if the clone fails, and
+    held by the session's CapacityTracker until destroyVM() otherwise.
+
+    :return: (session,dstname) or die on error
+    """
+    from honeyclient.manager import capacity
+    if reservation is not None:
+        return __quickCloneFromMaster(session,src_vm,srcname,src_state,dstname)
+
+    tracker = capacity.getTracker(session)
+    reservation = tracker.reserve(srcname,label=dstname)
+    try:
+        result = __quickCloneFromMaster(session,src_vm,srcname,src_state,dstname)
+    except:
+        reservation.release()
+        raise
+    tracker.hold(dstname,reservation)
+    return result
+
+def __quickCloneFromMaster(session,src_vm,srcname,src_state,dstname):
+    """
+    Make one quick clone of a master VM prepared by __prepareQuickCloneMaster()
+
+    :param session:
+    :param src_vm: the master VirtualMachine
+    :param srcname: the name of the master VM
+    :param src_state: the state of the master VM
+    :param dstname: the name of the clone
+    :return: (session,dstname) or die on error
+    """
+    from com.vmware.vim25 import MethodFault,OptionValue,VirtualDeviceConfigSpec, \
+        VirtualDeviceConfigSpecOperation,VirtualMachineConfigSpec
+    from com.vmware.vim25.mo import Task
+    from honeyclient.manager import devices
+    LOG.debug("Quick cloning %s to %s" % (srcname,dstname))
+
+    # Make the copy
+    session,vmxfile = quickCopyVM(session,srcname,dstname)
+
     # register the VM
     registerVM(session,vmxfile,dstname)
 
@@ -408,27 +779,25 @@ def quickCloneVM(session,srcname,dstname=None):
     # update the corresponding virtual disk on the destination VM.
     dconfigSpec = VirtualMachineConfigSpec()
     vm_device_specs = []
-    for dev in src_vm.getConfig().getHardware().getDevice():
-         if isinstance(dev,VirtualDisk):
+    # The clone was just registered, there's nothing cached for it
+    dst_topology = devices.fetch(dst_vm)
+    for dev in __getTopology(session,src_vm).disks:
+        if not devices.isFlatDisk(dev.getBacking()):
+            croak("Error copying %s to %s. Unsupported disk format." % (srcname, dstname),errors.CloneError,vm=srcname)
+        
+        dest_dev = dst_topology.device(dev.getKey())
+        if dest_dev is None:
+            croak("Error copying %s to %s. The clone has no disk with key %s" % (srcname,dstname,dev.getKey()),
+                  errors.CloneError,vm=dstname)
 
-            vdsk_fmt = dev.getBacking()
-            if not isinstance(vdsk_fmt,VirtualDiskFlatVer1BackingInfo) and not isinstance(vdsk_fmt,VirtualDiskFlatVer2BackingInfo):
-                croak("Error copying %s to %s. Unsupported disk format." % (srcname, dst_name))
-            
-            dest_dev = None
-            for devA in dst_vm.getConfig().getHardware().getDevice():
-                if devA.getKey() == dev.getKey():
-                    dest_dev = devA
-                    break
-
-            # Modify the backing VMDK filename for this virtual disk.
-            dest_dev.getBacking().setFileName(dev.getBacking().getFileName())
-            
-            # Create a virtual device config spec for this virtual disk. 
-            vm_device_spec = VirtualDeviceConfigSpec()
-            vm_device_spec.setDevice(dest_dev)
-            vm_device_spec.setOperation(VirtualDeviceConfigSpecOperation.edit)
-            vm_device_specs.append(vm_device_spec)
+        # Modify the backing VMDK filename for this virtual disk.
+        dest_dev.getBacking().setFileName(dev.getBacking().getFileName())
+        
+        # Create a virtual device config spec for this virtual disk. 
+        vm_device_spec = VirtualDeviceConfigSpec()
+        vm_device_spec.setDevice(dest_dev)
+        vm_device_spec.setOperation(VirtualDeviceConfigSpecOperation.edit)
+        vm_device_specs.append(vm_device_spec)
 
     dconfigSpec.setDeviceChange(vm_device_specs)
     dconfigSpec.setAnnotation("Type: Quick Cloned VM\n Master VM: " + srcname)
@@ -440,10 +809,10 @@ def quickCloneVM(session,srcname,dstname=None):
     # Now, reconfigure the destination VM's configuration accordingly.
     try:
         taskA = dst_vm.reconfigVM_Task(dconfigSpec) 
-        if not taskA.waitForMe() == Task.SUCCESS:
-            croak("Failed to reconfig the dest VM for a quickCopy")
+        if not __waitForTask(session,taskA) == Task.SUCCESS:
+            croak("Failed to reconfig the dest VM for a quickCopy",errors.TaskFailed,vm=dstname,task=taskA)
     except MethodFault,detail:
-        croak("Failed to reconfig the dest VM for a quickCopy. Reason: %s",detail)
+        croak("Failed to reconfig the dest VM for a quickCopy. Reason: %s" % detail,vm=dstname,fault=detail)
     
     # Now make a snapshot
     snapname = getArg("default_quick_clone_snapshot_name","honeyclient::manager::esx")
@@ -476,59 +845,16 @@ def isQuickCloneVM(session,name):
     """
     vm = getVMbyName(session,name)
 
-    # Helper function that searches all the backing files of each virtual
-    # disk and determines if any of them are located outside the VM's main
-    # directory.
-    # 
-    # Inputs: the VM config
-    # Outputs: true if the VM is a quick clone; false otherwise
-    def isBackingQuickClone(config):
-        vm_dirname = os.path.dirname(config.getFiles().getVmPathName())
-
-        for dev in config.getHardware().getDevice():
-            if isinstance(dev,VirtualDisk):
-                vdsk_fmt = dev.getBacking()
-                if not isinstance(vdsk_fmt,VirtualDiskFlatVer1BackingInfo) and not isinstance(vdsk_fmt,VirtualDiskFlatVer2BackingInfo):
-                    # If the disk format isn't file-based, then it's definately a
-                    # quick clone.
-                    return True
-                
-                backing_dirname = os.path.dirname(dev.getBacking().getFileName())
-                if vm_dirname != backing_dirname:
-                    # If the backing directory is different than the VM's
-                    # directory, then it's a quick clone.
-                    return True
-        return False
-    
-    if isBackingQuickClone(vm.getConfig()):
+    # A VM is a quick clone if any virtual disk isn't file based, or its
+    # backing file is outside the VM's main directory.
+    if __getTopology(session,vm).hasExternalDisks():
         return (session,True)
 
-    # Helper function that searches all the snapshots of a VM and determines
-    # if any of the backing virtual disks are located outside the VM's main
-    # directory.
-    # 
-    # Inputs: snapshot_list
-    # Outputs: true if the VM is a quick clone; false otherwise
-    def findQuickCloneSnapshots(snap_list):
-        for item in snap_list:
-
-            oh_snap = item.getSnapshot()
-
-            snap_view = MorUtil.createExactManagedObject(session.getServerConnection(),oh_snap)
-
-            if isBackingQuickClone(snap_view.getConfig()):
-                return True
-            
-            # If we have children, check them...
-            chillin = item.getChildSnapshotList()
-            if chillin and findQuickCloneSnapshots(chillin):
-                return True
-
-        return False
-
-    snapInfo = vm.getSnapshot()
-    if snapInfo and snapInfo.getRootSnapshotList() and findQuickCloneSnapshots(snapInfo.getRootSnapshotList()):
-        return (session,True)
+    # Check if any of the backing virtual disks of the snapshots are
+    # located outside the VM's main directory.
+    for node in __getSnapshotIndex(session,vm).nodes:
+        if __getSnapshotTopology(session,node.mor).hasExternalDisks():
+            return (session,True)
     
     return (session,False)
 
@@ -559,10 +885,9 @@ def getHostnameESX(session):
     :return: (session,hostname) on success or (session,None) if hostname is not found
     """
     hostname = None
-    rootFolder = session.getRootFolder()
-    list = InventoryNavigator(rootFolder).searchManagedEntities("HostSystem")
-    if list:
-        hostname = list[0].getSummary().getConfig().getName()
+    s,records = getInventoryESX(session,"HostSystem",["summary.config.name"])
+    if records:
+        hostname = records[0]['summary.config.name']
         
     return (session,hostname)
 
@@ -575,10 +900,9 @@ def getIPaddrESX(session):
     :return (session,ip) on success or (session,None) if the IP address is not found
     """
     ip = None
-    rootFolder = session.getRootFolder()
-    list = InventoryNavigator(rootFolder).searchManagedEntities("HostSystem")
-    if list:
-        nics = list[0].getConfig().getNetwork().getVnic()
+    s,records = getInventoryESX(session,"HostSystem",["config.network.vnic"])
+    if records:
+        nics = records[0]['config.network.vnic']
         if nics:
            ip =  nics[0].getSpec().getIp().getIpAddress()
     
@@ -638,33 +962,24 @@ def getConfigVM(session,name):
         return (session,"undef")
 
 
-def destroyVM(session,vmname):
+def destroyVM(session,vmname,background=False):
     """
-    Destroy a registered VM
+    Destroy a registered VM. A running VM is stopped first.
     
     :param session:
     :param vmname: the name of the VM
-    :return the session on success or dies on failure
-    """
-    s,state = getStateVM(session,vmname)
-    
-    if state == 'poweredOn':
-        #stop it
-        stopVM(session,vmname)
-    
-    if isQuickCloneVM(s,vmname):
-        __delete_filesVM(s,vmname)
-        return s
-        
-    vm = getVMbyName(session,vmname)
-    try:
-        task = vm.destroy_Task()
-        if not task.waitForMe() == Task.SUCCESS:
-            croak("Error destroying VM: %s" % vmname)
-    except:
-        croak("Error destroying VM: %s" % vmname)
-
-    return session
+    :param background: if True, return right away with the futures.Future
+                       of destroyVM_async(). Errors are also logged
+    :return the session on success or dies on failure. With background set,
+            a futures.Future for the session
+    """
+    future = destroyVM_async(session,vmname)
+    if background:
+        def logError(f):
+            if f.error() is not None:
+                LOG.error("Background destroy of VM %s failed: %s" % (vmname,f.error()))
+        return future.addCallback(logError)
+    return future.result()
 
 def snapshotVM(session,name,snapshot_name=None,desc=None,ignore_collisions=False):
     """
@@ -678,37 +993,7 @@ def snapshotVM(session,name,snapshot_name=None,desc=None,ignore_collisions=False
                               (default False)
     :return (session,snapshot name) on success or die on failure
     """
-    vm = getVMbyName(session,name)
-
-    if not desc:
-        desc = snapshot_name
-
-    if not snapshot_name:
-        # Create a UUID for the name and check that if doesn't exist 
-        while(True):
-            snapshot_name = __generateVMID()
-            # First check to see it's NOT a registered VM name
-            # if it does match an existing name, keep trying with another name
-            s,r = isRegisteredVM(session,snapshot_name)
-            if not r:
-                # Next, check there are NO snapshots with the same name
-                if not __isSnapshotByName(session,snapshot_name):
-                    # If we didn't find the name in all the snapshots, we're done
-                    break
-    elif not ignore_collisions:
-        s,r1 = isRegisteredVM(session,snapshot_name)
-        if r1:
-            croak("The dest_name %s matches an existing VM. Please use another name" % snapshot_name)
-        if __isSnapshotByName(session,snapshot_name):
-            croak("The dest_name %s matches an existing VM Snapshot name. Please use another name" % snapshot_name)
-    try:
-        task = vm.createSnapshot_Task(snapshot_name,desc,True,True)
-        if task.waitForMe() == Task.SUCCESS:
-            return (session,snapshot_name)
-        else:
-            croak("Unable to take a snapshot of VM %s" % name)
-    except MethodFault, detail:
-        croak("failed to create snapshot. Reason: %s" % detail.getMessage())
+    return snapshotVM_async(session,name,snapshot_name,desc,ignore_collisions).result()
 
 def getAllSnapshotsVM(session,name):
     """
@@ -725,23 +1010,28 @@ def getAllSnapshotsVM(session,name):
     results = {}
 
     vm = getVMbyName(session,name)
-    
-    snapInfo = vm.getSnapshot()
-    if not snapInfo:
-        return (session,results)
 
-    snapTree = snapInfo.getRootSnapshotList()
-    for node in snapTree:
-        childTree = []
-        name = node.getName()
-        children = node.getChildSnapshotList()
-        if children:
-            for c in children:
-                childTree.append(c.getName())
-        results[name] = childTree
+    for node in __getSnapshotIndex(session,vm).roots:
+        results[node.name] = [c.name for c in node.children]
     
     return (session,results)
-                                 
+
+def getSnapshotTreeVM(session,name):
+    """
+      Return every snapshot of a given VM, at any depth
+
+      :param session:
+      :param name: the name of the VM
+
+      :return (session,[{}]) a list of snapshots in depth first order. Each is a dict of
+              'name', 'parent' (name or None), 'children' (names), 'depth' (0 for roots),
+              'created' (the create time) and 'description'.
+              If the VM doesn't have any snapshots, returns an empty list
+    """
+    vm = getVMbyName(session,name)
+    results = [node.toDict() for node in __getSnapshotIndex(session,vm).nodes]
+    return (session,results)
+
     
 def revertVM(session,vmname,snapshot_name):
     """ 
@@ -752,24 +1042,7 @@ def revertVM(session,vmname,snapshot_name):
     :snapshot_name: The name of the snapshot to revert to
     :return: session on success or die on error
     """
-
-    if not vmname:
-        croak("Missing VM name")
-
-    if not snapshot_name:
-        croak("Missing Snapshot name to revert to")
-
-    vm = getVMbyName(session,vmname)
-    vmsnap = __getSnapshotInTree(vm, snapshot_name)
-
-    if not vmsnap:
-        croak("Could not revert VM %s back to snapshot %s" % (vmname,snapshot_name)) 
-
-    task = vmsnap.revertToSnapshot_Task(None)
-    if task.waitForMe() == Task.SUCCESS:
-        return session
-    else:
-        croak("Could not revert VM %s back to snapshot %s" % (vmname,snapshot_name)) 
+    return revertVM_async(session,vmname,snapshot_name).result()
 
 
 def renameSnapshotVM(session,vmname,old_name,new_name=None,desc=None):
@@ -789,23 +1062,9 @@ def renameSnapshotVM(session,vmname,old_name,new_name=None,desc=None):
         croak("You must specifiy the old name of the snapshot you want to rename!")
 
     if not new_name:
-        # Create a UUID for the name and check that if doesn't exist 
-        while(True):
-            new_name = __generateVMID()
-            # First check to see it's NOT a registered VM name
-            # if it does match an existing name, keep trying with another name
-            s,r = isRegisteredVM(session,new_name)
-            if not r:
-                # Next, check there are NO snapshots with the same name
-                if not __isSnapshotByName(session,new_name):
-                    # If we didn't find the name in all the snapshots, we're done
-                    break
+        new_name = __generateName(session)
     else:
-        s,r = isRegisteredVM(session,new_name)
-        if r:
-            croak("The new_name %s matches and existing VM. Please use another name" % new_name)
-        if __isSnapshotByName(session,new_name):
-            croak("The new_name %s matches and existing VM Snapshot name. Please use another name" % new_name)
+        __reserveName(session,new_name,"new_name")
 
     if not desc:
         desc = new_name
@@ -822,14 +1081,21 @@ def renameSnapshotVM(session,vmname,old_name,new_name=None,desc=None):
     #oh_snap = snapshot_tree.getSnapshot()
     #snapshot = MorUtil.createExactManagedObject(session.getServerConnection(),oh_snap)
 
-    snapshot = __getSnapshotInTree(vm,old_name)
-
-    if not snapshot:
-        croak("Cannot rename a snapshot for VM %s no snapshot found with name %s" % (vmname,old_name))
     try:
-        snapshot.renameSnapshot(new_name,desc)
+        snapshot = __getSnapshotInTree(session,vm,old_name)
+
+        if not snapshot:
+            croak("Cannot rename a snapshot for VM %s no snapshot found with name %s" % (vmname,old_name),
+                  errors.SnapshotNotFound,vm=vmname)
+        try:
+            snapshot.renameSnapshot(new_name,desc)
+        except:
+            __invalidateSnapshots(session,vm)
+            croak("Error encountered renaming the snapshot",vm=vmname)
     except:
-        croak("Error encountered renaming the snapshot")
+        __releaseName(session,new_name)
+        raise
+    __invalidateSnapshots(session,vm)
     
     return (session,new_name)
     
@@ -845,38 +1111,323 @@ def removeSnapshotVM(session,name,snapshot_name,removeChild=True):
     :param removeChild: Should I remove children on a snapshot?  Default: True
     :return session on success or die on failure
     """
-    vm = getVMbyName(session,name)
-    
-    vmsnap = __getSnapshotInTree(vm, snapshot_name)
-    if not vmsnap:
-        croak("Could not remove snapshot %s for VM %s" % (snapshot_name,vmname))
-        
-    task = vmsnap.removeSnapshot_Task(removeChild);
-
-    if task.waitForMe() == Task.SUCCESS:
-        return session
-    else:
-        croak("Could not remove snapshot %s for VM %s" % (snapshot_name,vmname))
+    return removeSnapshotVM_async(session,name,snapshot_name,removeChild).result()
 
 
-""" Helper methods below """
+""" Non-blocking variants """
 
-def answerVM(session,name):
+def startVM_async(session,name,timeout=None):
     """
-    Tries to answer question posed by the server
-    
+    Start a VM by name without waiting for it. Errors found before the
+    task is started are raised right away, the others by the future.
+
     :param session:
     :param name: the name of the VM
-    :return: session or die on error
+    :param timeout: (optional) seconds after which the task is cancelled
+    :return: a futures.Future for (session, True)
     """
-    powerState = "undef"
-    s, powerState = getStateVM(session,name)
-    if not powerState == 'pendingquestion':
-        return session
+    from com.vmware.vim25.mo import Task
+    from honeyclient.manager import futures
+    s,state = getStateVM(session,name)
+    if state == 'poweredOn':
+        return futures.completed((session,True))
 
-    vm = getVMbyName(session,name)
-    question = vm.getRuntime().getQuestion()
-    questionId = question.getId()
+    if state == 'pendingquestion':
+        session = answerVM(session,name)
+
+    vm = getVMbyName(session,name)
+    task = vm.powerOnVM_Task(None)
+
+    def finish(state):
+        if state != Task.SUCCESS:
+            croak("Could not start VM %s" % name,errors.TaskFailed,vm=name,task=task)
+        return (session,True)
+    return __taskFuture(session,task,vm,name,finish,"start of %s" % name,timeout)
+
+def stopVM_async(session,name,timeout=None):
+    """
+    Stop a VM by name without waiting for it. A suspended VM is started first.
+
+    :param session:
+    :param name: the name of the VM
+    :param timeout: (optional) seconds after which a task is cancelled
+    :return: a futures.Future for (session, True)
+    """
+    from com.vmware.vim25.mo import Task
+    from honeyclient.manager import futures
+    s,state = getStateVM(session,name)
+    if state == 'poweredOff':
+        return futures.completed((session,True))
+
+    # If the thing is suspended you need to start it
+    # first to stop it.
+    if state == 'suspended':
+        return startVM_async(session,name,timeout).then(lambda r: stopVM_async(session,name,timeout))
+
+    vm = getVMbyName(session,name)
+    task = vm.powerOffVM_Task()
+
+    def finish(state):
+        if state != Task.SUCCESS:
+            croak("Could not stop the VM: %s" % name,errors.TaskFailed,vm=name,task=task)
+        return (session,True)
+    return __taskFuture(session,task,vm,name,finish,"stop of %s" % name,timeout)
+
+def suspendVM_async(session,name,timeout=None):
+    """
+    Suspend a VM without waiting for it
+
+    :param session:
+    :param name: the name of the VM
+    :param timeout: (optional) seconds after which the task is cancelled
+    :return: a futures.Future for (session, True)
+    """
+    from com.vmware.vim25.mo import Task
+    from honeyclient.manager import futures
+    s,state = getStateVM(session,name)
+    if state == 'suspended':
+        return futures.completed((session,True))
+
+    if state == 'poweredOff':
+        croak("Cannot suspend a poweredOff VM. VM name: %s" % name,errors.InvalidVMState,vm=name)
+
+    vm = getVMbyName(session,name)
+    task = vm.suspendVM_Task()
+
+    def finish(state):
+        if state != Task.SUCCESS:
+            croak("Failed to suspend VM: %s" % name,errors.TaskFailed,vm=name,task=task)
+        return (session,True)
+    return __taskFuture(session,task,vm,name,finish,"suspend of %s" % name,timeout)
+
+def resetVM_async(session,name,timeout=None):
+    """
+    Reset (cold boot) the VM without waiting for it
+
+    :param session:
+    :param name: the name of the VM
+    :param timeout: (optional) seconds after which the task is cancelled
+    :return: a futures.Future for (session, True)
+    """
+    from com.vmware.vim25.mo import Task
+    vm = getVMbyName(session,name)
+    task = vm.resetVM_Task()
+
+    def finish(state):
+        if state != Task.SUCCESS:
+            croak("Failed to reset VM: %s" % name,errors.TaskFailed,vm=name,task=task)
+        return (session,True)
+    return __taskFuture(session,task,vm,name,finish,"reset of %s" % name,timeout)
+
+def revertVM_async(session,vmname,snapshot_name,timeout=None):
+    """
+    Revert back to a previous snapshot without waiting for it
+
+    :param session:
+    :param vmname: The name of the root VM
+    :param snapshot_name: The name of the snapshot to revert to
+    :param timeout: (optional) seconds after which the task is cancelled
+    :return: a futures.Future for the session
+    """
+    from com.vmware.vim25.mo import Task
+    if not vmname:
+        croak("Missing VM name")
+
+    if not snapshot_name:
+        croak("Missing Snapshot name to revert to")
+
+    vm = getVMbyName(session,vmname)
+    vmsnap = __getSnapshotInTree(session,vm,snapshot_name)
+
+    if not vmsnap:
+        croak("Could not revert VM %s back to snapshot %s" % (vmname,snapshot_name),
+              errors.SnapshotNotFound,vm=vmname)
+
+    task = vmsnap.revertToSnapshot_Task(None)
+
+    def finish(state):
+        # The tree is the same, but the current snapshot has moved
+        __invalidateSnapshots(session,vm)
+        if state != Task.SUCCESS:
+            croak("Could not revert VM %s back to snapshot %s" % (vmname,snapshot_name),
+                  errors.TaskFailed,vm=vmname,task=task)
+        return session
+    return __taskFuture(session,task,None,vmname,finish,"revert of %s" % vmname,timeout)
+
+def snapshotVM_async(session,name,snapshot_name=None,desc=None,ignore_collisions=False,timeout=None):
+    """
+    Create a snapshot of an existing VM without waiting for it
+
+    :param session:
+    :param name: the name of the VM to snapshot
+    :param snapshot_name: the name of the snapshot
+    :param desc: a description of the snapshot
+    :param ignore_collisions: whether to check for existing VMs and snapshots with the same name
+                              (default False)
+    :param timeout: (optional) seconds after which the task is cancelled
+    :return: a futures.Future for (session, snapshot name)
+    """
+    from com.vmware.vim25 import MethodFault
+    from com.vmware.vim25.mo import Task
+    vm = getVMbyName(session,name)
+
+    if not desc:
+        desc = snapshot_name
+
+    reserved = True
+    if not snapshot_name:
+        snapshot_name = __generateName(session)
+    elif not ignore_collisions:
+        __reserveName(session,snapshot_name,"dest_name")
+    else:
+        reserved = False
+    try:
+        task = vm.createSnapshot_Task(snapshot_name,desc,True,True)
+    except MethodFault, detail:
+        if reserved:
+            __releaseName(session,snapshot_name)
+        croak("failed to create snapshot. Reason: %s" % detail.getMessage(),vm=name,fault=detail)
+
+    def finish(state):
+        __invalidateSnapshots(session,vm)
+        if state != Task.SUCCESS:
+            croak("Unable to take a snapshot of VM %s" % name,errors.TaskFailed,vm=name,task=task)
+        return (session,snapshot_name)
+
+    def releaseName(f):
+        if reserved and f.error() is not None:
+            __releaseName(session,snapshot_name)
+    future = __taskFuture(session,task,None,name,finish,"snapshot of %s" % name,timeout)
+    return future.addCallback(releaseName)
+
+def removeSnapshotVM_async(session,name,snapshot_name,removeChild=True,timeout=None):
+    """
+    Remove a given snapshot by name without waiting for it
+
+    :param session:
+    :param name: is the name of the VM
+    :param snapshot_name: is the name of the snapshot
+    :param removeChild: Should I remove children on a snapshot?  Default: True
+    :param timeout: (optional) seconds after which the task is cancelled
+    :return: a futures.Future for the session
+    """
+    from com.vmware.vim25.mo import Task
+    vm = getVMbyName(session,name)
+
+    vmsnap = __getSnapshotInTree(session,vm,snapshot_name)
+    if not vmsnap:
+        croak("Could not remove snapshot %s for VM %s" % (snapshot_name,name),
+              errors.SnapshotNotFound,vm=name)
+
+    task = vmsnap.removeSnapshot_Task(removeChild)
+
+    def finish(state):
+        __invalidateSnapshots(session,vm)
+        if state != Task.SUCCESS:
+            croak("Could not remove snapshot %s for VM %s" % (snapshot_name,name),
+                  errors.TaskFailed,vm=name,task=task)
+        return session
+    return __taskFuture(session,task,None,name,finish,"removal of snapshot %s of %s" % (snapshot_name,name),timeout)
+
+def destroyVM_async(session,vmname,timeout=None):
+    """
+    Destroy a registered VM without waiting for it. A running VM is stopped
+    first. The files of a quick clone are deleted on the futures thread pool.
+
+    :param session:
+    :param vmname: the name of the VM
+    :param timeout: (optional) seconds after which a task is cancelled
+    :return: a futures.Future for the session
+    """
+    s,state = getStateVM(session,vmname)
+    if state == 'poweredOn':
+        return stopVM_async(session,vmname,timeout).then(lambda r: __destroyVM_async(session,vmname,timeout))
+    return __destroyVM_async(session,vmname,timeout)
+
+def __destroyVM_async(session,vmname,timeout):
+    """
+    The part of destroyVM_async() once the VM is off
+    """
+    from com.vmware.vim25 import MethodFault
+    from com.vmware.vim25.mo import Task
+    from honeyclient.manager import futures
+    s,quick = isQuickCloneVM(session,vmname)
+    if quick:
+        return futures.submit(__delete_filesVM,session,vmname).then(
+            lambda r: __destroyed(session,vmname))
+
+    vm = getVMbyName(session,vmname)
+    try:
+        task = vm.destroy_Task()
+    except MethodFault, detail:
+        croak("Error destroying VM: %s" % vmname,vm=vmname,fault=detail)
+
+    def finish(state):
+        if state != Task.SUCCESS:
+            croak("Error destroying VM: %s" % vmname,errors.TaskFailed,vm=vmname,task=task)
+        __getCache(session).invalidate(vmname)
+        __invalidateSnapshots(session,vm)
+        return __destroyed(session,vmname)
+    return __taskFuture(session,task,None,vmname,finish,"destroy of %s" % vmname,timeout)
+
+def __destroyed(session,vmname):
+    """
+    Release the space held for a VM that was destroyed
+
+    :return: the session
+    """
+    from honeyclient.manager import capacity
+    capacity.releaseVM(session,vmname)
+    return session
+
+def __taskFuture(session,task,vm,vmname,finish,label,timeout):
+    """
+    Follow a task with a futures.TaskFuture. Questions asked by the VM, if
+    one is given, are answered with answerVM().
+
+    :return: the TaskFuture
+    """
+    from honeyclient.manager import futures
+    on_question = None
+    if vm:
+        def on_question(question):
+            LOG.info("VM %s has a pending question" % vmname)
+            answerVM(session,vmname)
+    return futures.TaskFuture(session,task,vm,on_question,finish,label,timeout)
+
+
+""" Helper methods below """
+
+def answerVM(session,name):
+    """
+    Tries to answer question posed by the server
+    
+    :param session:
+    :param name: the name of the VM
+    :return: session or die on error
+    """
+    powerState = "undef"
+    s, powerState = getStateVM(session,name)
+    if not powerState == 'pendingquestion':
+        return session
+
+    vm = getVMbyName(session,name)
+    __answerQuestion(vm,name,vm.getRuntime().getQuestion())
+        
+    time.sleep(2)
+        
+    return session
+
+def __answerQuestion(vm,name,question):
+    """
+    Answer a question the VM is asking, if it's one we know
+
+    :param vm: the VirtualMachine
+    :param name: the name of the VM
+    :param question: the VirtualMachineQuestionInfo
+    :return: None or die
+    """
+    questionId = question.getId()
     questionMsg = question.getText().strip().split(":")[0]
 
     #lista = question.getChoice().getChoiceInfo()
@@ -889,114 +1440,219 @@ def answerVM(session,name):
     elif questionMsg == 'msg.disk.adapterMismatch':
         choice = "0"
     else:
-        croak("Encountered unknown question for VM  %s" % name)
+        croak("Encountered unknown question for VM  %s" % name,errors.QuestionUnanswerable,vm=name)
 
     # NOW answer the VM
     try:
         vm.answerVM(questionId,choice)
     except Exception, e:
-        croak("Error answering question on VM %r" % e)
-        
-    time.sleep(2)
-        
-    return session
+        croak("Error answering question on VM %r" % e,errors.QuestionUnanswerable,vm=name)
         
 
-def getVMbyName(session,name):
+def getVMbyName(session,name,fresh=False):
     """
     Return the VirtualMachine object for a VM by name. If the VM is NOT
-    found, log the error and exit the process
+    found, log the error and raise VMNotFound. Lookups are cached per
+    session (see honeyclient.manager.cache)
     
     :param session:
     :param name: the name of the VM
+    :param fresh: if True, skip the VM cache and search the inventory
     :return: the VM or die
     """
-    rootFolder = session.getRootFolder()
-    vm = InventoryNavigator(rootFolder).searchManagedEntity("VirtualMachine",name)
+    vm = __lookupVM(session,name,fresh)
 
     if vm:
         return vm
     else:
-        croak("VM name: %s not found" % name)
+        croak("VM name: %s not found" % name,errors.VMNotFound,vm=name)
 
-def __isSnapshotByName(session,snapshot_name):
+def __lookupVM(session,name,fresh=False):
     """
-    Searches for a snapshot by name in a given VM
-    
+    Find a VM by name, using the session cache unless 'fresh' is set.
+    Only VMs that are found are cached.
+
     :param session:
-    :param snapshot_name: the name of the snapshot
-    :return: True if a snapshot is found
-    """
-    list = InventoryNavigator(session.getRootFolder()).searchManagedEntities("VirtualMachine")
-    for vm in list:
-        snShot = vm.getSnapshot()
-        if snShot:
-            snapTree = snShot.getRootSnapshotList()
-            if snapTree:
-                if __findByNameInSnapshotTree(snapTree,snapshot_name): 
-                    return True
-    return False
-                                          
-def __findByNameInSnapshotTree(snapTree,name):
-    """
-    Only used by __isSnapshotByName()
-    """
-    for node in snapTree:
-        if name == node.getName():
-            return True
-        else:
-            childTree = node.getChildSnapshotList()
-            if childTree and len(childTree) > 0:
-                found = __findByNameInSnapshotTree(childTree,name)
-                if found: return True
-    return False
+    :param name: the name of the VM
+    :param fresh: if True, skip the VM cache and search the inventory
+    :return: the VirtualMachine or None
+    """
+    from com.vmware.vim25.mo import InventoryNavigator,VirtualMachine
+    vm_cache = __getCache(session)
+    if not fresh:
+        mor = vm_cache.get(name)
+        if mor:
+            return VirtualMachine(session.getServerConnection(),mor)
+
+    rootFolder = session.getRootFolder()
+    vm = InventoryNavigator(rootFolder).searchManagedEntity("VirtualMachine",name)
+    if vm:
+        vm_cache.put(name,vm.getMOR())
+    else:
+        vm_cache.invalidate(name)
+    return vm
 
+def __getCache(session):
+    """
+    Return the VM cache for the session. The cache is normally created
+    by login() with the 'vm_cache_ttl' from honeyclient.xml
+
+    :param session:
+    :return: cache.VMCache
+    """
+    from honeyclient.manager import sessions
+    return cache.getCache(sessions.resolveSession(session))
+
+def __getSnapshotCache(session):
+    """
+    Return the cache of SnapshotIndexes for the session
 
-def __getSnapshotInTree(vm,snapname):
+    :param session:
+    :return: cache.VMCache
+    """
+    from honeyclient.manager import sessions
+    return cache.getSnapshotCache(sessions.resolveSession(session))
+
+def __buildInventoryTraversal():
+    """
+    Build the traversal specs used by getInventoryESX() to walk from the
+    root folder down to every VM, host and datastore. This is the same walk
+    as PropertyCollectorUtil.buildFullTraversal() plus Datacenter -> datastore
+
+    :return: [SelectionSpec]
+    """
+    from com.vmware.vim25 import SelectionSpec,TraversalSpec
+    def selection(name):
+        spec = SelectionSpec()
+        spec.setName(name)
+        return spec
+
+    def traversal(name,type,path,selects):
+        spec = TraversalSpec()
+        spec.setName(name)
+        spec.setType(type)
+        spec.setPath(path)
+        spec.setSkip(False)
+        spec.setSelectSet(map(selection,selects))
+        return spec
+
+    return [traversal("visitFolders","Folder","childEntity",
+                      ["visitFolders","dcToHf","dcToVmf","dcToDs","crToH","crToRp","rpToVm"]),
+            traversal("dcToVmf","Datacenter","vmFolder",["visitFolders"]),
+            traversal("dcToHf","Datacenter","hostFolder",["visitFolders"]),
+            traversal("dcToDs","Datacenter","datastore",[]),
+            traversal("crToH","ComputeResource","host",[]),
+            traversal("crToRp","ComputeResource","resourcePool",["rpToRp","rpToVm"]),
+            traversal("rpToRp","ResourcePool","resourcePool",["rpToRp","rpToVm"]),
+            traversal("rpToVm","ResourcePool","vm",[])]
+
+def __getSnapshotInTree(session,vm,snapname):
     """
     Find and return a snapshot by name
     
+    :param session:
     :param vm: the vm to search
     :param snapname: then name of the snapshot
     :return: snapshot on success or None
     """
+    from com.vmware.vim25.mo import VirtualMachineSnapshot
     if not vm:
         croak("Missing VM need to find snapshot")
 
     if not snapname:
         croak("Missing snapshot name needed to find the snapshot")
         
-    snap = vm.getSnapshot()
-    if not snap:
-        return None
-
-    snapTree = snap.getRootSnapshotList()
-    if snapTree:
-        mor = __findSnapshotInTree(snapTree,snapname)
-        if mor:
-            return VirtualMachineSnapshot(vm.getServerConnection(), mor)
+    node = __getSnapshotIndex(session,vm).find(snapname)
+    if not node:
+        # It may have just been taken or renamed through another session,
+        # before the change reached the watcher
+        node = __getSnapshotIndex(session,vm,True).find(snapname)
+    if node:
+        return VirtualMachineSnapshot(vm.getServerConnection(),node.mor)
     
     return None
 
-def __findSnapshotInTree(snapshot_list, snapshot_name):
+def __getDeviceCache(session):
     """
-    Does a recursive search into the snapshop tree finds the first snapshot
-    
-    :param snapshot_list: the snapshot list
-    :param snapshotname: the name of the snapshot
-    :return: the snapshot if found or None
+    Return the cache of DeviceTopologies for the session
+
+    :param session:
+    :return: cache.VMCache
     """
-    for node in snapshot_list:
-        if snapshot_name == node.getName():
-            return node.getSnapshot()
-        else:
-            # check the children
-            childTree = node.getChildSnapshotList()
-            if childTree:
-                mor = __findSnapshotInTree(childTree, snapshot_name)
-                if mor:
-                    return mor
-    return None
+    from honeyclient.manager import sessions
+    return cache.getDeviceCache(sessions.resolveSession(session))
+
+def __getTopology(session,vm):
+    """
+    Return the DeviceTopology of the VM. A cached topology is used as long
+    as the VM's config.changeVersion hasn't changed.
+
+    :param session:
+    :param vm: the VirtualMachine
+    :return: devices.DeviceTopology
+    """
+    from honeyclient.manager import devices
+    dev_cache = __getDeviceCache(session)
+    key = vm.getMOR().get_value()
+    topology = dev_cache.get(key)
+    if topology is not None and topology.version == vm.getPropertyByPath("config.changeVersion"):
+        return topology
+    topology = devices.fetch(vm)
+    dev_cache.put(key,topology)
+    return topology
+
+def __getSnapshotTopology(session,mor):
+    """
+    Return the DeviceTopology of a snapshot. A snapshot's config never
+    changes, so it's fetched once.
+
+    :param session:
+    :param mor: the ManagedObjectReference of the VirtualMachineSnapshot
+    :return: devices.DeviceTopology
+    """
+    from com.vmware.vim25.mo.util import MorUtil
+    from honeyclient.manager import devices
+    dev_cache = __getDeviceCache(session)
+    key = "snapshot-" + mor.get_value()
+    topology = dev_cache.get(key)
+    if topology is None:
+        snap_view = MorUtil.createExactManagedObject(session.getServerConnection(),mor)
+        topology = devices.fromConfig(snap_view.getConfig())
+        dev_cache.put(key,topology)
+    return topology
+
+def __getSnapshotIndex(session,vm,fresh=False):
+    """
+    Return the SnapshotIndex of the VM. A cached index is kept current by
+    the session's SnapshotWatcher, so changes made through other sessions
+    are seen without asking the server each time. The snapshot operations
+    in this module also invalidate it.
+
+    :param session:
+    :param vm: the VirtualMachine
+    :param fresh: if True, skip the cache
+    :return: snapshots.SnapshotIndex
+    """
+    return __getSnapshotWatcher(session).get(vm,fresh)
+
+def __invalidateSnapshots(session,vm):
+    """
+    Drop the cached SnapshotIndex of the VM
+
+    :param session:
+    :param vm: the VirtualMachine
+    """
+    __getSnapshotWatcher(session).invalidate(vm)
+
+def __getSnapshotWatcher(session):
+    """
+    Return the SnapshotWatcher for the session
+
+    :param session:
+    :return: snapshots.SnapshotWatcher
+    """
+    from honeyclient.manager import sessions
+    return snapshots.getWatcher(sessions.resolveSession(session))
 
 
 def __generateVMID():
@@ -1006,20 +1662,81 @@ def __generateVMID():
     """
     return uuid.uuid4().hex
 
+def __generateName(session):
+    """
+    Generate a name for a new VM or snapshot that doesn't match any registered
+    VM or snapshot, and reserve it so no other thread can take it. If
+    'verify_generated_names' is 0 in honeyclient.xml the uuid is used as is.
 
-def fullCopyVM(session,src_name,dst_name):
+    :param session:
+    :return: the name
+    """
+    from honeyclient.manager import names
+    verify = getArg("verify_generated_names","HoneyClient::Manager::ESX")
+    if verify != 'undef' and not int(verify):
+        return __generateVMID()
+
+    index = names.getIndex(session)
+    while(True):
+        name = __generateVMID()
+        if index.reserve(name):
+            return name
+
+def __reserveName(session,name,label):
+    """
+    Check a caller supplied name doesn't match a registered VM or snapshot and
+    reserve it. Dies if the name is taken.
+
+    :param session:
+    :param name: the name to check
+    :param label: what to call the name in error messages
+    :return: None or die
+    """
+    from honeyclient.manager import names
+    index = names.getIndex(session)
+    if index.isVM(name):
+        croak("The %s %s matches an existing VM. Please use another name" % (label,name),
+              errors.NameCollision)
+    if index.isSnapshot(name):
+        croak("The %s %s matches an existing VM Snapshot name. Please use another name" % (label,name),
+              errors.NameCollision)
+    if not index.reserve(name):
+        croak("The %s %s is already in use. Please use another name" % (label,name),
+              errors.NameCollision)
+
+def __releaseName(session,name):
+    """
+    Drop the reservation of a name taken by __reserveName() or __generateName(),
+    once the operation it was for has failed
+
+    :param session:
+    :param name: the name
+    """
+    from honeyclient.manager import names
+    names.getIndex(session).release(name)
+
+
+def fullCopyVM(session,src_name,dst_name,max_concurrent=None,with_report=False):
     """
     Make a *complete* copy of the VM and it's associated files.
 
+    All the copies (virtual disks, nvram, vmss and vmx) are planned first and
+    then run at the same time, up to 'max_concurrent_copies'. If one fails,
+    whatever was already copied is deleted again.
+
     :param session:  the session object
     :param src_name: the name of the VM to copy
     :param dst_name: the new directory name to copy the VM to
+    :param max_concurrent: (optional) copies to run at once
+    :param with_report: if True, also return the transfer.CopyReport, with
+                        the size and duration of each copy
     
-    :return: The fullpath to the copied VMX or die on error
+    :return: (session,path to the copied VMX) or die on error.
+             (session,path,report) if with_report is set
     """
-    # Regular expression used for converting the adapter type
-    adapterPattern = re.compile(r"([A-Za-z]{3})(.*)")
-    
+    from com.vmware.vim25 import MethodFault,VirtualDiskSpec
+    from com.vmware.vim25.mo import InventoryNavigator
+    from honeyclient.manager import devices,transfer
     rootFolder = session.getRootFolder()
     data_center = InventoryNavigator(rootFolder).searchManagedEntity("Datacenter","ha-datacenter")
     #print "Datacenter: %r" % data_center
@@ -1027,13 +1744,14 @@ def fullCopyVM(session,src_name,dst_name):
     fileMgr = session.getFileManager()
     #print "FileMgr: %r" % fileMgr
 
-    vdiskMgr = session.getVirtualDiskManager()
-    
     if not fileMgr:
-      croak("FileManager not available. Cannot copy the VM")
+      croak("FileManager not available. Cannot copy the VM",errors.FileOperationFailed,vm=src_name)
     
     # Now get the VirtualMachine we're copying
     vm = getVMbyName(session,src_name)
+    config = vm.getConfig()
+    topology = devices.fromConfig(config)
+    file_sizes,disk_sizes = transfer.fileSizes(vm)
 
     # Get the name of the datastore that holds the source VM
     # We assume the source VM is located on only one datastore.
@@ -1043,119 +1761,65 @@ def fullCopyVM(session,src_name,dst_name):
     basePath = "["+datastore_name+"] " + dst_name
     #print "BasePath %s" % basePath
 
-    try:
-        fileMgr.makeDirectory(basePath,data_center,True)
-    except MethodFault, detail:
-        croak("Problem making a directory for the VM copy: %s" % detail)
-        
-    # Loop over all devices attached to the src VM
-    for dev in vm.getConfig().getHardware().getDevice():
-        if isinstance(dev,VirtualDisk):
-            
-            key = dev.getControllerKey()
-            #print "Controller key %r" % key
-            vdsk_fmt = dev.getBacking()
-
-            if not isinstance(vdsk_fmt,VirtualDiskFlatVer1BackingInfo) and not isinstance(vdsk_fmt,VirtualDiskFlatVer2BackingInfo):
-                croak("Error copying %s to %s. Unsupported disk format." % (src_name, dst_name))
-
-            # Now get the filename for it
-            source_vmdk = vdsk_fmt.getFileName()
-            #print "Source vmdk is %s" % source_vmdk
-            dest_vmdk = basePath + "/" + os.path.basename(source_vmdk)
-            #print "Dest VMDK is %s" % dest_vmdk
-
-            # We *have* to loop over all the devices again discover 
-            # the SCSI Adapter type by matching on the controller key
-            for dev in vm.getConfig().getHardware().getDevice():
-                if dev.getKey() == key:
-                    adapter_type = dev.getDeviceInfo().getSummary()
-                    # Strip whitespace
-                    adapter_type1 = "".join(adapter_type.split())
-                    # parse the name on the first 3 characters
-                    m = adapterPattern.match(adapter_type1)
-                    # make the first 3 chars lowercase
-                    adapterType = m.group(1).lower() + m.group(2)
-                    break
-                
-            diskSpec = VirtualDiskSpec()
-            
-            esx_version = session.getAboutInfo().getVersion()
-            if esx_version > "4.0.0":
-                diskSpec.setDiskType("preallocated")
-            else:
-                diskSpec.setDiskType("")
+    esx_version = session.getAboutInfo().getVersion()
 
-            diskSpec.setAdapterType(adapterType)
+    # --- Plan the copies ---
+    ops = []
 
-            # Finally lets copy the virtual disk. Any errors should exit the process
-            try:
-                task = vdiskMgr.copyVirtualDisk_Task(source_vmdk,data_center,dest_vmdk,data_center,diskSpec,True)
-                if not task.waitForMe() == Task.SUCCESS:
-                    croak("Error copying the virtualdisk to destination")
-            except MethodFault, detail:
-                croak("Error copying the virtualdisk to destination. Reason: %s" % detail)
-                
-    # --- Copy the other files associated with the source VM. ---
-    # Get the nvram/vmss files associated with the source VM and construct
-    # the nvram/vmss files associated with the destination VM.
-    source_nvram = None
-    dest_nvram = None
-    source_vmss = None
-    dest_vmss = None
+    # Loop over all the virtual disks attached to the src VM
+    for dev in topology.disks:
+        vdsk_fmt = dev.getBacking()
 
-    # For some reason, the nvram key is set to the "vmname.nvram" EVEN
-    # if the nvram file DOES NOT exist! So we need to gracefully handle the error
-    # and continue on 
-    for entry in vm.getConfig().getExtraConfig():
-        # Note: getValue() is an Object
-        #print "Entry: K: %s  V: %s" % (entry.getKey(),str(entry.getValue()))
-        k = entry.getKey()
-        v = str(entry.getValue())
-        if k == "nvram" and v != "":
-            source_nvram = os.path.dirname(vm.getConfig().getFiles().getVmPathName()) + "/" + v
-            #print "Source nvram: %s" % source_nvram
-            dest_nvram = basePath + "/" + v
-        if k == "checkpoint.vmState" and v != "":
-            source_vmss = vm.getConfig().getFiles().getSuspendDirectory() + "/" +  v
-            #print "Source vmss: %s" % source_vmss
-            dest_vmss = basePath +  "/" +  v
-        if source_nvram and dest_nvram and source_vmss and dest_vmss:
-            break
-    
-    source_vmx = vm.getConfig().getFiles().getVmPathName()
-    dest_vmx = basePath + "/" + os.path.basename(source_vmx)
+        if not devices.isFlatDisk(vdsk_fmt):
+            croak("Error copying %s to %s. Unsupported disk format." % (src_name, dst_name),
+                  errors.FileOperationFailed,vm=src_name)
 
-    if source_nvram and dest_nvram:
-        # Attempt to gracefully handle errors.  If the copy fails, we can still continue
-        try:
-            taskA = fileMgr.copyDatastoreFile_Task(source_nvram,data_center,dest_nvram,data_center,True)
-            if not taskA.waitForMe() == Task.SUCCESS:
-                LOG.error("Error copying the NVRAM file(s) to destination")
-        except MethodFault,detail:
-            LOG.error("Skipping the nvram file...")
+        # Now get the filename for it
+        source_vmdk = vdsk_fmt.getFileName()
+        #print "Source vmdk is %s" % source_vmdk
+        dest_vmdk = basePath + "/" + os.path.basename(source_vmdk)
+        #print "Dest VMDK is %s" % dest_vmdk
+
+        # The SCSI Adapter type of the controller the disk is on
+        adapterType = topology.adapterType(dev)
+        if not adapterType:
+            croak("Error copying %s to %s. No controller found for disk %s" % (src_name,dst_name,source_vmdk),
+                  errors.FileOperationFailed,vm=src_name)
+            
+        diskSpec = VirtualDiskSpec()
         
-    if source_vmss and dest_vmss:
-        # Attempt to gracefully handle errors.  If the copy fails, we can still continue
-        try:
-            taskB = fileMgr.copyDatastoreFile_Task(source_vmss,data_center,dest_vmss,data_center,True)
-            if not taskB.waitForMe() == Task.SUCCESS:
-                LOG.error("Error copying the VMSS file to destination")
-        except MethodFault,detail:
-             LOG.error("Skipping the vmss file...")
+        if esx_version > "4.0.0":
+            diskSpec.setDiskType("preallocated")
+        else:
+            diskSpec.setDiskType("")
+
+        diskSpec.setAdapterType(adapterType)
+
+        ops.append(transfer.CopyOp('disk',source_vmdk,dest_vmdk,True,diskSpec,
+                                   disk_sizes.get(dev.getKey())))
+            
+    # --- Copy the other files associated with the source VM. ---
+    # The nvram and vmss copies are optional, if they fail we can still continue
+    ops.extend(__planConfigFiles(vm,config,basePath,file_sizes,False))
 
     try:
-        taskC = fileMgr.copyDatastoreFile_Task(source_vmx,data_center,dest_vmx,data_center,True)
-        if not taskC.waitForMe() == Task.SUCCESS:
-            croak("Error copying the VMX file to destination. Some other files may have already been copied")
+        fileMgr.makeDirectory(basePath,data_center,True)
     except MethodFault, detail:
-        croak("Error copying the VMX file to destination. Some other files may have already been copied")
-    
+        croak("Problem making a directory for the VM copy: %s" % detail,errors.FileOperationFailed,
+              vm=src_name,fault=detail)
+
+    report = __runCopies(session,data_center,ops,basePath,max_concurrent,src_name,
+                         "Error copying the VM files to destination")
+    LOG.info("Full copy of %s to %s: %s" % (src_name,dst_name,report.summary()))
+
+    dest_vmx = ops[-1].dst
+    if with_report:
+        return (session,dest_vmx,report)
     return (session,dest_vmx)
 
 
 
-def quickCopyVM(session,src_name,dst_name):
+def quickCopyVM(session,src_name,dst_name,max_concurrent=None):
     """
     Make a quick copy of the VM and it's associated files. This mainly differs from
     the full copy by not copying the VMDK file(s)
@@ -1163,19 +1827,24 @@ def quickCopyVM(session,src_name,dst_name):
     session:  the session object
     src_name: the name of the VM to copy
     dst_name: the new directory name to copy the VM to
+    max_concurrent: (optional) copies to run at once
     
     returns: The fullpath to the copied VMX file
     """
+    from com.vmware.vim25 import MethodFault
+    from com.vmware.vim25.mo import InventoryNavigator
+    from honeyclient.manager import transfer
     rootFolder = session.getRootFolder()
     data_center = InventoryNavigator(rootFolder).searchManagedEntity("Datacenter","ha-datacenter")
     
     fileMgr = session.getFileManager()
     
     if not fileMgr:
-      croak("FileManager not available. Cannot do a quick copy")
+      croak("FileManager not available. Cannot do a quick copy",errors.FileOperationFailed,vm=src_name)
     
     # Now get the VirtualMachine we're copying
     vm = getVMbyName(session,src_name)
+    file_sizes,disk_sizes = transfer.fileSizes(vm)
 
     # Get the name of the datastore that holds the source VM
     # We assume the source VM is located on only one datastore.
@@ -1184,11 +1853,33 @@ def quickCopyVM(session,src_name,dst_name):
 
     basePath = "["+datastore_name+"] " + dst_name
 
+    ops = __planConfigFiles(vm,vm.getConfig(),basePath,file_sizes,True)
+
     try:
         fileMgr.makeDirectory(basePath,data_center,True)
     except MethodFault, detail:
-        croak("Problem making a directory for the copy: %s" % detail)
+        croak("Problem making a directory for the copy: %s" % detail,errors.FileOperationFailed,
+              vm=src_name,fault=detail)
 
+    report = __runCopies(session,data_center,ops,basePath,max_concurrent,src_name,
+                         "Error copying the VM files to destination")
+    LOG.debug("Quick copy of %s to %s: %s" % (src_name,dst_name,report.summary()))
+    
+    return (session,ops[-1].dst)
+
+def __planConfigFiles(vm,config,basePath,file_sizes,required):
+    """
+    Plan the copies of the nvram, vmss and vmx files of a VM. The vmx is
+    always last and always required.
+
+    :param vm: the VirtualMachine
+    :param config: the VM's config
+    :param basePath: the destination directory
+    :param file_sizes: {path:bytes} from transfer.fileSizes()
+    :param required: whether the nvram and vmss copies are required
+    :return: [transfer.CopyOp]
+    """
+    from honeyclient.manager import transfer
     source_nvram = None
     dest_nvram = None
     source_vmss = None
@@ -1197,153 +1888,117 @@ def quickCopyVM(session,src_name,dst_name):
     # For some reason, the nvram key is set to the "vmname.nvram" EVEN
     # if the nvram file DOES NOT exist! So we need to gracefully handle the error
     # and continue on 
-    for entry in vm.getConfig().getExtraConfig():
+    for entry in config.getExtraConfig():
         # Note: getValue() is an Object
         k = entry.getKey()
         v = str(entry.getValue())
         if k == "nvram" and v != "":
-            source_nvram = os.path.dirname(vm.getConfig().getFiles().getVmPathName()) + "/" + v
+            source_nvram = os.path.dirname(config.getFiles().getVmPathName()) + "/" + v
             dest_nvram = basePath + "/" + v
         if k == "checkpoint.vmState" and v != "":
-            source_vmss = vm.getConfig().getFiles().getSuspendDirectory() + "/" +  v
+            source_vmss = config.getFiles().getSuspendDirectory() + "/" +  v
             dest_vmss = basePath +  "/" +  v
         if source_nvram and dest_nvram and source_vmss and dest_vmss:
             break
-    
-    source_vmx = vm.getConfig().getFiles().getVmPathName()
+
+    source_vmx = config.getFiles().getVmPathName()
     dest_vmx = basePath + "/" + os.path.basename(source_vmx)
 
+    ops = []
     if source_nvram and dest_nvram:
-        # Attempt to gracefully handle errors.  If the copy fails, we can still continue
-        try:
-            taskA = fileMgr.copyDatastoreFile_Task(source_nvram,data_center,dest_nvram,data_center,True)
-            if not taskA.waitForMe() == Task.SUCCESS:
-                croak("Error copying the NVRAM file(s) to destination")
-        except MethodFault,detail:
-            # Catch the exception and ignore it
-            croak('Skipping the nvram file...')
-
+        ops.append(transfer.CopyOp('file',source_nvram,dest_nvram,required,
+                                   size=file_sizes.get(source_nvram)))
     if source_vmss and dest_vmss:
-        # Attempt to gracefully handle errors.  If the copy fails, we can still continue
-        try:
-            taskB = fileMgr.copyDatastoreFile_Task(source_vmss,data_center,dest_vmss,data_center,True)
-            if not taskB.waitForMe() == Task.SUCCESS:
-                croak("Error copying the VMSS file to destination")
-        except MethodFault,detail:
-             croak("Skipping the vmss file...")
+        ops.append(transfer.CopyOp('file',source_vmss,dest_vmss,required,
+                                   size=file_sizes.get(source_vmss)))
+    ops.append(transfer.CopyOp('file',source_vmx,dest_vmx,True,size=file_sizes.get(source_vmx)))
+    return ops
+
+def __runCopies(session,data_center,ops,basePath,max_concurrent,src_name,msg):
+    """
+    Run planned copies. On failure, delete what was copied and the
+    destination directory, then die.
 
+    :return: transfer.CopyReport
+    """
+    from com.vmware.vim25 import MethodFault
+    from honeyclient.manager import transfer
     try:
-        taskC = fileMgr.copyDatastoreFile_Task(source_vmx,data_center,dest_vmx,data_center,True)
-        if not taskC.waitForMe() == Task.SUCCESS:
-            croak("Error copying the VMX file to destination")
+        report = transfer.runCopies(session,data_center,ops,max_concurrent)
     except MethodFault, detail:
-        croak('Error copying the VMX file!')
-    
-    return (session,dest_vmx)
+        croak("%s. Reason: %s" % (msg,detail),errors.FileOperationFailed,vm=src_name,fault=detail)
+
+    if not report.ok():
+        transfer.rollback(session,data_center,report.ops)
+        try:
+            task = session.getFileManager().deleteDatastoreFile_Task(basePath,data_center)
+            __waitForTask(session,task)
+        except MethodFault, detail:
+            LOG.error("Unable to remove %s: %s" % (basePath,detail))
+        op = report.cause
+        croak("%s: %s. Reason: %s" % (msg,op.src,op.error),errors.FileOperationFailed,
+              vm=src_name,task=op.task,fault=op.error)
+    return report
 
 
-def croak(msg):
+def croak(msg,error=None,vm=None,task=None,fault=None):
     """
-    Helper method for logging an Error and exiting
+    Helper method for logging an Error and raising it
 
     :param msg: the message to log
+    :param error: (optional) the ESXError class to raise. If not given, it's
+                  picked from the fault (see errors.errorForFault)
+    :param vm: (optional) the name of the VM
+    :param task: (optional) the Task that failed
+    :param fault: (optional) the fault returned by the server
     """
     LOG.error(msg)
-    sys.exit(msg)
+    if error is None:
+        error = errors.errorForFault(fault)
+    raise error(msg,vm,task,fault)
 
 
 def __delete_filesVM(session,name):
     """
-    Unregister and delete all files associated with a given VM
+    Unregister and delete all files associated with a given VM. The VM's
+    directory is removed with one recursive delete, falling back to
+    deleting its files in parallel (see honeyclient.manager.deletion).
     
     :param session:
     :param name: the name of the VM
     :return: True on succes or die
     """
+    from com.vmware.vim25.mo import InventoryNavigator
+    from honeyclient.manager import deletion
     # Must get this info BEFORE unregistering the VM
-    vm = getVMbyName(session,name)
-    datastore_list = vm.getDatastores()
-    vm_dirname = os.path.dirname(vm.getConfig().getFiles().getVmPathName())
+    vm = getVMbyName(session,name,True)
+    directories = deletion.vmDirectories(vm.getConfig())
 
     session,config = unRegisterVM(session,name)
     
-    fileMgr = session.getFileManager()
     datacenter_view = InventoryNavigator(session.getRootFolder()).searchManagedEntity("Datacenter","ha-datacenter")
 
-    file_list = []
-    for data_storage in datastore_list:
-        browser = data_storage.getBrowser()
-            
-        file_list.append(vm_dirname)
-        
-        search_spec = HostDatastoreBrowserSearchSpec()
-        search_spec.setSortFoldersFirst(True)
-        
-        task = browser.searchDatastoreSubFolders_Task(vm_dirname,search_spec)
-        if task.waitForMe() == Task.SUCCESS:
-            results = task.getTaskInfo().getResult().getHostDatastoreBrowserSearchResults()
-            
-            for r in results:
-                folder = r.getFolderPath()
-                for f in r.getFile():
-                    file_list.append( "/".join([folder,f.getPath()]) )
-        else:
-            croak("SubFolder search failed!")
-            
-        reversed_list = sorted(file_list,reverse=True)
-
-        for i in reversed_list:
-            task1 = fileMgr.deleteDatastoreFile_Task(i,datacenter_view)
-            if not task1.waitForMe() == Task.SUCCESS:
-                croak("Unable to delete all of the VM files for VM (%s)" % name)
+    failed = deletion.deleteDirectories(session,datacenter_view,directories)
+    if failed:
+        path,error = failed[0]
+        croak("Unable to delete all of the VM files for VM (%s): %s %s" % (name,path,error),
+              errors.FileOperationFailed,vm=name,fault=error)
                 
     return True
 
 
-
-def __poll_task_for_question(t,session,vmname):
+def __waitForTask(session,task):
     """
-    Checks for questions from ESX. This is a wrapper for the task object. It polls 
-    the task and periodically checks for questions.
+    Wait for a task to finish. Used in place of task.waitForMe(), which
+    would do its own WaitForUpdates on the session and cancel ours.
 
-    :param t: the task
-    :param session: the session
-    :params vmname: The VM name
-    :return: the state of the task or die
+    :param session:
+    :param task: the task
+    :return: the state of the task. Compare with Task.SUCCESS
     """
-    tState = None
-    tries = 0 
-    maxTries= 3
-    problem = None
-
-    while tState == None or tState == str(TaskInfoState.running) or tState == str(TaskInfoState.queued):
-        tState = None
-        problem = None
-        tries=0
-
-        while tState == None:
-            tries += 1
-            
-            if tries > maxTries:
-                # Break out of the inner while
-                croak("task poller reach max tries!")
-
-            try:
-                tState = str(t.getTaskInfo().getState())
-            except Exception, e:
-                problem = e
-
-        if tState == str(TaskInfoState.running):
-            sleep(2)
-            
-            # Check if the VM is stuck
-            s, st = getStateVM(session,vmname)
-            
-            if st == 'pendingquestion':
-                print("We have a pending question!")
-                answerVM(session,vmname)
-        else:
-            sleep(1)
-
-    return str(tState)
-
+    from honeyclient.manager import updates
+    try:
+        return updates.waitForTask(session,task)
+    except Exception, e:
+        croak("Error waiting on task: %s" % e,errors.errorForFault(e,errors.TaskFailed),
+              task=task,fault=e)
@@ -0,0 +1,565 @@
+"""
+Futures for the long running esx operations.
+
+startVM, stopVM, snapshotVM and friends block the calling thread until
+their task finishes, so one thread could only drive one VM at a time. Their
+_async variants (ex: esx.startVM_async) start the task and return a Future
+right away. A TaskFuture watches its task, and the VM's pending questions,
+on the session's UpdateChannel, so any number of outstanding operations
+share the one WaitForUpdates loop. When the task finishes, the rest of the
+operation (answering questions, invalidating caches, turning a failure
+into an ESXError) runs on a small shared thread pool.
+
+Futures compose: then() runs a function on the result, allOf() waits for
+every future of a list and anyOf() for the first one to succeed. result()
+and wait() take a timeout, and an operation can be given a deadline after
+which its task is cancelled. cancel() asks the server to cancel the task.
+
+Example:
+>> fs = [esx.startVM_async(session,name) for name in clones]
+>> allOf(fs).result(600)
+>> f = esx.suspendVM_async(session,name).then(lambda r: esx.revertVM_async(session,name,snap))
+>> f.result()
+"""
+
+from java.lang import Runnable,Thread
+from java.util.concurrent import Executors,ThreadFactory,TimeUnit
+from com.vmware.vim25 import TaskInfoState
+
+from honeyclient.util.config import *
+from honeyclient.manager import errors,metrics,updates
+import threading,time
+
+# Default number of threads finishing operations and running callbacks
+DEFAULT_THREADS = 4
+
+
+class Future(object):
+    """
+    The result of an operation that may not have finished yet
+    """
+    def __init__(self,label=None):
+        """
+        :param label: (optional) what the operation is, for messages
+        """
+        self.label = label
+        self.__cond = threading.Condition()
+        self.__done = False
+        self.__result = None
+        self.__error = None
+        self.__callbacks = []
+        self.__cancel_hook = None
+
+    def done(self):
+        """
+        :return: True if the operation finished, failed or was cancelled
+        """
+        return self.__done
+
+    def cancelled(self):
+        """
+        :return: True if the operation was cancelled or timed out
+        """
+        return isinstance(self.__error,(errors.Cancelled,errors.TimedOut))
+
+    def wait(self,timeout=None):
+        """
+        Block until the operation is done
+
+        :param timeout: (optional) seconds to wait
+        :return: True if it's done, False on timeout
+        """
+        deadline = None
+        if timeout is not None:
+            deadline = time.time() + timeout
+        self.__cond.acquire()
+        try:
+            while not self.__done:
+                if deadline is None:
+                    self.__cond.wait()
+                else:
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        break
+                    self.__cond.wait(remaining)
+            return self.__done
+        finally:
+            self.__cond.release()
+
+    def result(self,timeout=None):
+        """
+        Block until the operation is done and return its result
+
+        :param timeout: (optional) seconds to wait. The operation keeps going
+                        if it doesn't finish in time
+        :return: the result, or raise the operation's error, or TimedOut
+        """
+        if not self.wait(timeout):
+            raise errors.TimedOut("%s didn't finish in %s seconds" % (self.__name(),timeout))
+        if self.__error is not None:
+            raise self.__error
+        return self.__result
+
+    def error(self,timeout=None):
+        """
+        Block until the operation is done and return its error
+
+        :param timeout: (optional) seconds to wait
+        :return: the exception or None if the operation worked
+        """
+        if not self.wait(timeout):
+            raise errors.TimedOut("%s didn't finish in %s seconds" % (self.__name(),timeout))
+        return self.__error
+
+    def addCallback(self,fn):
+        """
+        Call fn(future) once the operation is done, right away if it already is.
+        It's called from the thread that finishes the operation.
+
+        :param fn: the callback
+        :return: the future
+        """
+        self.__cond.acquire()
+        try:
+            if not self.__done:
+                self.__callbacks.append(fn)
+                return self
+        finally:
+            self.__cond.release()
+        self.__call(fn)
+        return self
+
+    def then(self,fn):
+        """
+        Chain another step: once this succeeds, fn(result) is called. If fn
+        returns a Future, the new future follows it, so operations can be
+        run one after the other. Errors skip fn and are passed along.
+
+        :param fn: the next step
+        :return: a Future for the result of fn
+        """
+        chained = Future(self.label)
+        stage = [self]
+
+        def proceed(f):
+            error = f.error()
+            if error is not None:
+                chained.setError(error)
+                return
+            try:
+                value = fn(f.result())
+            except Exception, e:
+                chained.setError(e)
+                return
+            if isinstance(value,Future):
+                stage[0] = value
+                value.addCallback(chained.follow)
+            else:
+                chained.setResult(value)
+
+        # Cancelling the chain cancels whichever step is running
+        chained.setCancelHook(lambda: stage[0].cancel())
+        self.addCallback(proceed)
+        return chained
+
+    def follow(self,other):
+        """
+        Finish the same way as another, finished, future
+
+        :param other: the Future
+        """
+        error = other.error()
+        if error is not None:
+            self.setError(error)
+        else:
+            self.setResult(other.result())
+
+    def cancel(self):
+        """
+        Cancel the operation. The server may not be able to stop a task
+        that's already running, but the future fails with Cancelled either way.
+
+        :return: True if the future was cancelled, False if it was already done
+        """
+        return self.abort(errors.Cancelled("%s was cancelled" % self.__name()))
+
+    def abort(self,error):
+        """
+        Stop the operation and fail the future with the given error
+
+        :param error: the ESXError
+        :return: False if the future was already done
+        """
+        self.__cond.acquire()
+        try:
+            if self.__done:
+                return False
+            hook = self.__cancel_hook
+            self.__cancel_hook = None
+        finally:
+            self.__cond.release()
+        if hook:
+            try:
+                hook()
+            except Exception, e:
+                LOG.debug("Unable to cancel %s: %s" % (self.__name(),e))
+        return self.setError(error)
+
+    def setCancelHook(self,fn):
+        """
+        :param fn: called with no arguments when the future is cancelled
+        """
+        self.__cancel_hook = fn
+
+    def setResult(self,value):
+        """
+        Finish the operation. Only the first setResult() or setError() counts.
+
+        :return: True if this finished the future
+        """
+        return self.__finish(value,None)
+
+    def setError(self,error):
+        """
+        Fail the operation. Only the first setResult() or setError() counts.
+
+        :return: True if this finished the future
+        """
+        return self.__finish(None,error)
+
+    def __finish(self,value,error):
+        self.__cond.acquire()
+        try:
+            if self.__done:
+                return False
+            self.__done = True
+            self.__result = value
+            self.__error = error
+            self.__cancel_hook = None
+            callbacks = self.__callbacks
+            self.__callbacks = []
+            self.__cond.notifyAll()
+        finally:
+            self.__cond.release()
+        for fn in callbacks:
+            self.__call(fn)
+        return True
+
+    def __call(self,fn):
+        try:
+            fn(self)
+        except Exception, e:
+            LOG.error("Error in the callback of %s: %s" % (self.__name(),e))
+
+    def __name(self):
+        return self.label or "the operation"
+
+    def __repr__(self):
+        state = "pending"
+        if self.__done:
+            state = "done"
+            if self.__error is not None:
+                state = "failed: %s" % self.__error
+        return "<Future %s %s>" % (self.__name(),state)
+
+
+class TaskFuture(Future):
+    """
+    A Future that follows a vSphere Task through the session's UpdateChannel
+    """
+    def __init__(self,session,task,vm=None,on_question=None,finish=None,label=None,timeout=None):
+        """
+        :param session:
+        :param task: the Task
+        :param vm: (optional) the VirtualMachine to watch for questions
+        :param on_question: (optional) called as on_question(question) when the VM asks one
+        :param finish: (optional) called as finish(state) when the task is done,
+                       its return value is the result of the future and what it
+                       raises is the error. Defaults to the state on success
+                       and TaskFailed otherwise
+        :param label: (optional) what the operation is, for messages
+        :param timeout: (optional) seconds after which the task is cancelled
+                        and the future fails with TimedOut
+        """
+        Future.__init__(self,label)
+        self.task = task
+        self.state = None
+        # What the task does, ex: 'VirtualMachine.powerOn'
+        self.name = None
+        self.started = time.time()
+        self.__finish_fn = finish
+        self.__on_question = on_question
+        self.__answering = False
+        self.__lock = threading.Lock()
+        self.__filter = None
+        self.__closed = False
+        self.__channel = updates.getChannel(session)
+
+        self.setCancelHook(self.__cancelTask)
+        objects = [(task.getMOR(),["info.state","info.descriptionId"])]
+        if vm and on_question:
+            objects.append((vm.getMOR(),["runtime.question"]))
+        pfilter = self.__channel.watch(objects,self.__update,self.__failed)
+        self.__lock.acquire()
+        try:
+            # The task may have finished while the filter was being created
+            if not self.__closed:
+                self.__filter = pfilter
+                pfilter = None
+        finally:
+            self.__lock.release()
+        if pfilter:
+            self.__channel.unwatch(pfilter)
+
+        if timeout is not None:
+            schedule(timeout,self.__timedOut)
+
+    def __update(self,mor,changes):
+        if not changes:
+            return
+        if changes.get("info.descriptionId"):
+            self.name = str(changes["info.descriptionId"])
+        if changes.has_key("info.state"):
+            state = str(changes["info.state"])
+            if state in updates.DONE_STATES and self.state is None:
+                self.state = state
+                metrics.taskDone(self.name,state,time.time() - self.started)
+                submit(self.__complete,state)
+                return
+        if changes.get("runtime.question") and self.__on_question:
+            self.__lock.acquire()
+            try:
+                if self.__answering:
+                    return
+                self.__answering = True
+            finally:
+                self.__lock.release()
+            submit(self.__answer,changes["runtime.question"])
+
+    def __answer(self,question):
+        try:
+            try:
+                self.__on_question(question)
+            except Exception, e:
+                # The task can't go on without an answer
+                self.abort(e)
+        finally:
+            self.__lock.acquire()
+            try:
+                self.__answering = False
+            finally:
+                self.__lock.release()
+
+    def __complete(self,state):
+        self.__close()
+        if self.done():
+            # Cancelled or timed out meanwhile
+            return
+        if self.__finish_fn is None:
+            if state == str(TaskInfoState.success):
+                self.setResult(state)
+            else:
+                self.setError(errors.TaskFailed("%s failed" % (self.label or "The task"),task=self.task))
+            return
+        try:
+            value = self.__finish_fn(state)
+        except Exception, e:
+            self.setError(e)
+            return
+        self.setResult(value)
+
+    def __failed(self,e):
+        self.__close()
+        self.setError(errors.errorForFault(e,errors.TaskFailed)("Error waiting on %s: %s" % \
+                                                                (self.label or "the task",e),
+                                                                task=self.task,fault=e))
+
+    def __timedOut(self):
+        if self.state is None and not self.done():
+            metrics.taskDone(self.name,None,time.time() - self.started)
+        self.abort(errors.TimedOut("%s was cancelled, it didn't finish in time" % (self.label or "The task"),
+                                   task=self.task))
+
+    def __cancelTask(self):
+        self.__close()
+        self.task.cancelTask()
+
+    def __close(self):
+        self.__lock.acquire()
+        try:
+            self.__closed = True
+            pfilter = self.__filter
+            self.__filter = None
+        finally:
+            self.__lock.release()
+        if pfilter:
+            self.__channel.unwatch(pfilter)
+
+
+def completed(value):
+    """
+    :return: a Future that has already succeeded with value
+    """
+    f = Future()
+    f.setResult(value)
+    return f
+
+def failed(error):
+    """
+    :return: a Future that has already failed with error
+    """
+    f = Future()
+    f.setError(error)
+    return f
+
+def allOf(futures):
+    """
+    Wait for every future. Named so it doesn't hide the all() builtin.
+
+    :param futures: a list of Future
+    :return: a Future for the list of their results, in the same order. It
+             fails with the first error, without waiting for the others
+    """
+    futures = list(futures)
+    combined = Future("%d operations" % len(futures))
+    results = [None] * len(futures)
+    remaining = [len(futures)]
+    lock = threading.Lock()
+    if not futures:
+        combined.setResult(results)
+        return combined
+
+    def one(i):
+        def done(f):
+            error = f.error()
+            if error is not None:
+                combined.setError(error)
+                return
+            lock.acquire()
+            try:
+                results[i] = f.result()
+                remaining[0] -= 1
+                last = remaining[0] == 0
+            finally:
+                lock.release()
+            if last:
+                combined.setResult(results)
+        return done
+
+    combined.setCancelHook(lambda: [f.cancel() for f in futures])
+    for i in range(len(futures)):
+        futures[i].addCallback(one(i))
+    return combined
+
+def anyOf(futures):
+    """
+    Wait for the first future to succeed. Named so it doesn't hide the any() builtin.
+
+    :param futures: a list of Future
+    :return: a Future for the first future that succeeded. It fails with the
+             last error if they all fail
+    """
+    futures = list(futures)
+    combined = Future("any of %d operations" % len(futures))
+    remaining = [len(futures)]
+    lock = threading.Lock()
+    if not futures:
+        combined.setError(errors.ESXError("anyOf() needs at least one future"))
+        return combined
+
+    def done(f):
+        error = f.error()
+        if error is None:
+            combined.setResult(f)
+            return
+        lock.acquire()
+        try:
+            remaining[0] -= 1
+            last = remaining[0] == 0
+        finally:
+            lock.release()
+        if last:
+            combined.setError(error)
+
+    combined.setCancelHook(lambda: [f.cancel() for f in futures])
+    for f in futures:
+        f.addCallback(done)
+    return combined
+
+
+class _Call(Runnable):
+    """
+    Runs fn(*args,**kwargs) on an executor thread, into a Future if given one
+    """
+    def __init__(self,fn,args,kwargs,future=None):
+        self.fn = fn
+        self.args = args
+        self.kwargs = kwargs
+        self.future = future
+
+    def run(self):
+        try:
+            value = self.fn(*self.args,**self.kwargs)
+        except Exception, e:
+            if self.future is None:
+                LOG.error("Error in %s: %s" % (self.fn.__name__,e))
+            else:
+                self.future.setError(e)
+            return
+        if self.future is not None:
+            if isinstance(value,Future):
+                value.addCallback(self.future.follow)
+            else:
+                self.future.setResult(value)
+
+
+class _DaemonThreads(ThreadFactory):
+    """
+    The executors' threads shouldn't keep the JVM running
+    """
+    def __init__(self,name):
+        self.name = name
+
+    def newThread(self,runnable):
+        t = Thread(runnable,self.name)
+        t.setDaemon(True)
+        return t
+
+
+__executor = None
+__scheduler = None
+__executor_lock = threading.Lock()
+
+def __executors():
+    global __executor,__scheduler
+    __executor_lock.acquire()
+    try:
+        if __executor is None:
+            threads = getIntArg('future_threads','HoneyClient::Manager::ESX',DEFAULT_THREADS)
+            __executor = Executors.newFixedThreadPool(max(1,threads),_DaemonThreads("esx-futures"))
+            __scheduler = Executors.newScheduledThreadPool(1,_DaemonThreads("esx-futures-timer"))
+        return (__executor,__scheduler)
+    finally:
+        __executor_lock.release()
+
+def submit(fn,*args,**kwargs):
+    """
+    Run fn(*args,**kwargs) on the shared thread pool. Use it for the steps
+    of an operation that have no task to follow.
+
+    :param fn: the function
+    :return: a Future for what fn returns. If fn returns a Future, the
+             result is the result of that future
+    """
+    future = Future(getattr(fn,'__name__',None))
+    __executors()[0].execute(_Call(fn,args,kwargs,future))
+    return future
+
+def schedule(delay,fn,*args,**kwargs):
+    """
+    Run fn(*args,**kwargs) on the shared thread pool after delay seconds
+
+    :param delay: seconds to wait
+    :param fn: the function
+    """
+    __executors()[1].schedule(_Call(fn,args,kwargs),long(delay * 1000),TimeUnit.MILLISECONDS)
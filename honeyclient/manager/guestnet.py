@@ -0,0 +1,295 @@
+"""
+Guest network readiness for clone VMs.
+
+A clone is usable once VMware Tools in the guest reports a NIC with both a
+MAC and a real IP address. Clone init used to find that out by calling
+getMACaddrVM and getIPaddrVM every retry_period, each an inventory search
+plus a guest.net round trip, and only looking at the first NIC.
+
+A GuestNetWatcher subscribes to guest.net and guest.toolsRunningStatus of
+any number of VMs on the session's UpdateChannel and resolves a Future per
+VM, or calls a callback, the moment a NIC is ready. Every NIC is exposed as
+a Nic. Link-local addresses (169.254/16, fe80::/10), which a guest assigns
+itself before DHCP answers, don't count.
+
+Example:
+>> watcher = GuestNetWatcher(session)
+>> fs = [watcher.watch(name) for name in clones]
+>> for network in futures.allOf(fs).result(600):
+>>     print network.vm_name, network.primary().mac, network.primary().ip
+"""
+
+from honeyclient.util.config import *
+from honeyclient.manager import errors,esx,futures,updates
+import threading
+
+# The properties a GuestNetwork is built from
+PATHS = ["guest.net","guest.toolsRunningStatus"]
+
+# guest.toolsRunningStatus once VMware Tools is up
+TOOLS_RUNNING = "guestToolsRunning"
+
+
+class Nic(object):
+    """
+    One virtual NIC as seen by the guest
+    """
+    def __init__(self,mac,ips=None,network=None,connected=True):
+        """
+        :param mac: the MAC address
+        :param ips: the IP addresses, link-local ones are left out
+        :param network: the name of the port group
+        :param connected: whether the NIC is connected
+        """
+        self.mac = mac
+        self.ips = ips or []
+        self.network = network
+        self.connected = connected
+
+    def ip(self):
+        """
+        :return: the first address, IPv4 ones first, or None
+        """
+        for ip in self.ips:
+            if ":" not in ip:
+                return ip
+        if self.ips:
+            return self.ips[0]
+        return None
+
+    def ready(self):
+        """
+        :return: True if the NIC has a MAC and an address
+        """
+        return bool(self.mac and self.ips)
+
+    def __repr__(self):
+        return "<Nic %s %s>" % (self.mac,",".join(self.ips))
+
+
+class GuestNetwork(object):
+    """
+    The network of a VM as reported by VMware Tools
+    """
+    def __init__(self,vm_name,nics=None,tools_status=None):
+        """
+        :param vm_name: the name of the VM
+        :param nics: [Nic]
+        :param tools_status: guest.toolsRunningStatus
+        """
+        self.vm_name = vm_name
+        self.nics = nics or []
+        self.tools_status = tools_status
+
+    def ready(self):
+        """
+        :return: True if Tools is running (or doesn't say) and a NIC is ready
+        """
+        if self.tools_status is not None and self.tools_status != TOOLS_RUNNING:
+            return False
+        return self.primary() is not None
+
+    def primary(self):
+        """
+        :return: the first ready Nic, or None
+        """
+        for nic in self.nics:
+            if nic.ready():
+                return nic
+        return None
+
+    def __repr__(self):
+        return "<GuestNetwork %s %s %s>" % (self.vm_name,self.tools_status,self.nics)
+
+
+def isLinkLocal(ip):
+    """
+    :param ip: an IPv4 or IPv6 address
+    :return: True for addresses that aren't usable: link-local, unspecified
+    """
+    ip = ip.strip().lower()
+    if not ip or ip in ["0.0.0.0","::"]:
+        return True
+    if ip.startswith("169.254."):
+        return True
+    if ":" in ip:
+        # fe80::/10
+        head = ip.split(":",1)[0]
+        if len(head) == 4 and head[:2] == "fe" and head[2] in "89ab":
+            return True
+    return False
+
+def fromGuest(vm_name,guest_nics,tools_status=None):
+    """
+    Build a GuestNetwork from the value of guest.net
+
+    :param vm_name: the name of the VM
+    :param guest_nics: a list of GuestNicInfo (may be None)
+    :param tools_status: (optional) the value of guest.toolsRunningStatus
+    :return: GuestNetwork
+    """
+    nics = []
+    if guest_nics:
+        for info in guest_nics:
+            ips = [ip for ip in (info.getIpAddress() or []) if not isLinkLocal(ip)]
+            connected = info.getConnected()
+            if connected is None:
+                connected = True
+            nics.append(Nic(info.getMacAddress(),ips,info.getNetwork(),connected))
+    if tools_status is not None:
+        tools_status = str(tools_status)
+    return GuestNetwork(vm_name,nics,tools_status)
+
+def fromProperties(vm_name,props):
+    """
+    Build a GuestNetwork from {path:value} holding PATHS
+
+    :return: GuestNetwork
+    """
+    return fromGuest(vm_name,props.get("guest.net"),props.get("guest.toolsRunningStatus"))
+
+
+class _Watch(object):
+    """
+    One VM being watched
+    """
+    def __init__(self,vm_name,future,callback):
+        self.vm_name = vm_name
+        self.future = future
+        self.callback = callback
+        self.props = {}
+        self.channel = None
+        self.pfilter = None
+
+
+class GuestNetWatcher(object):
+    """
+    Resolves a Future per VM once its guest network is ready
+    """
+    def __init__(self,session):
+        """
+        :param session: a session or SessionPool
+        """
+        self.session = session
+        self.__lock = threading.Lock()
+        self.__watches = {}
+
+    def watch(self,vm_name,callback=None,timeout=None):
+        """
+        Start watching a VM. Watching a VM already being watched returns the
+        same Future.
+
+        :param vm_name: the name of the VM
+        :param callback: (optional) called as callback(network) from the
+                         channel thread once the network is ready
+        :param timeout: (optional) seconds after which the future fails with TimedOut
+        :return: a futures.Future for the GuestNetwork
+        """
+        self.__lock.acquire()
+        try:
+            w = self.__watches.get(vm_name)
+            if w is not None:
+                return w.future
+            future = futures.Future("network of %s" % vm_name)
+            w = _Watch(vm_name,future,callback)
+            self.__watches[vm_name] = w
+        finally:
+            self.__lock.release()
+        future.setCancelHook(lambda: self.__stop(w))
+
+        try:
+            vm = esx.getVMbyName(self.session,vm_name)
+            w.channel = updates.getChannel(self.session)
+            pfilter = w.channel.watch([(vm.getMOR(),PATHS)],
+                                      lambda mor,changes: self.__update(w,changes),
+                                      lambda e: self.__failed(w,e))
+        except errors.ESXError, e:
+            self.__stop(w)
+            future.setError(e)
+            return future
+
+        self.__lock.acquire()
+        try:
+            if not future.done():
+                w.pfilter = pfilter
+                pfilter = None
+        finally:
+            self.__lock.release()
+        if pfilter:
+            w.channel.unwatch(pfilter)
+
+        if timeout is not None:
+            futures.schedule(timeout,future.abort,
+                             errors.TimedOut("VM %s got no network address in %ss" % (vm_name,timeout),vm_name))
+        return future
+
+    def watchMany(self,vm_names,callback=None,timeout=None):
+        """
+        Watch several VMs
+
+        :return: [futures.Future] in the same order
+        """
+        return [self.watch(name,callback,timeout) for name in vm_names]
+
+    def network(self,vm_name):
+        """
+        :return: the last GuestNetwork reported for a watched VM, or None
+        """
+        self.__lock.acquire()
+        try:
+            w = self.__watches.get(vm_name)
+            if w is None:
+                return None
+            return fromProperties(vm_name,w.props)
+        finally:
+            self.__lock.release()
+
+    def close(self):
+        """
+        Stop watching every VM. Futures that aren't done are cancelled
+        """
+        self.__lock.acquire()
+        try:
+            watches = self.__watches.values()
+        finally:
+            self.__lock.release()
+        for w in watches:
+            w.future.cancel()
+            self.__stop(w)
+
+    def __update(self,w,changes):
+        if changes is None:
+            self.__stop(w)
+            w.future.setError(errors.VMNotFound("VM %s went away" % w.vm_name,w.vm_name))
+            return
+        self.__lock.acquire()
+        try:
+            w.props.update(changes)
+            network = fromProperties(w.vm_name,w.props)
+        finally:
+            self.__lock.release()
+        if not network.ready():
+            return
+        self.__stop(w)
+        if w.future.setResult(network) and w.callback:
+            try:
+                w.callback(network)
+            except Exception, e:
+                LOG.error("Error in the network callback of %s: %s" % (w.vm_name,e))
+
+    def __failed(self,w,e):
+        self.__stop(w)
+        w.future.setError(errors.errorForFault(e,errors.ESXError)(
+            "Lost track of the network of %s: %s" % (w.vm_name,e),w.vm_name,fault=e))
+
+    def __stop(self,w):
+        self.__lock.acquire()
+        try:
+            if self.__watches.get(w.vm_name) is w:
+                del self.__watches[w.vm_name]
+            pfilter = w.pfilter
+            w.pfilter = None
+        finally:
+            self.__lock.release()
+        if pfilter:
+            w.channel.unwatch(pfilter)
@@ -0,0 +1,481 @@
+"""
+Counts and times every call esx.py makes to the ESX server.
+
+Many of the round trips are hidden: vm.getConfig(), vm.getRuntime() and the
+other getters of the VI Java API each fetch a property from the server, and
+a loop over them can make hundreds of calls. When instrumentation is on,
+esx.login() puts an InstrumentedService in front of the session's
+VimPortType, so every remote method goes through it. Each call is timed and
+attributed to:
+
+ - the esx.py function it was made from (the outermost one on the stack,
+   ex: 'quickCloneVM' rather than the 'getVMbyName' it calls), or to the
+   module and function for calls made elsewhere, ex: 'updates.run'
+ - the VM that function was given, found in its arguments
+ - the properties fetched, for retrieveProperties
+
+Instrumentation is off unless 'enabled' is set in the
+HoneyClient::Manager::ESX::Instrumentation section of honeyclient.xml, or
+enable() is called before logging in. When it's off no session is wrapped,
+so it costs nothing.
+
+Example:
+>> instrument.enable()
+>> session = esx.login(url,un,pw)
+>> esx.quickCloneVM(session,'master')
+>> print instrument.getStats().report()
+
+A trace records every call, in order, while it runs. Clone writes a trace
+of its first __do_init to 'trace_file' when one is set. Calls made by
+other threads during a trace (ex: other clones) are in it too, with the
+name of their thread.
+"""
+
+from java.lang import Class
+from java.lang.reflect import Modifier
+from com.vmware.vim25 import VimPortType
+
+from honeyclient.util import jsonutil
+from honeyclient.util.config import *
+import bisect,sys,threading,time
+
+# Upper bounds (in seconds) of the histogram buckets. The last bucket has no bound
+BUCKETS = [0.001,0.0025,0.005,0.01,0.025,0.05,0.1,0.25,0.5,1.0,2.5,5.0,10.0,30.0,60.0]
+
+# Arguments of the esx functions that name a VM, in the order they're looked for
+VM_ARGUMENTS = ('name','vmname','srcname','vm_name','dstname')
+
+# The module whose functions the calls are attributed to
+ESX_MODULE = 'honeyclient.manager.esx'
+
+
+class Histogram(object):
+    """
+    Call durations, counted in the BUCKETS
+    """
+    def __init__(self):
+        self.counts = [0] * (len(BUCKETS) + 1)
+        self.count = 0
+        self.errors = 0
+        self.total = 0.0
+        self.min = None
+        self.max = None
+
+    def add(self,seconds,error=False):
+        self.counts[bisect.bisect_left(BUCKETS,seconds)] += 1
+        self.count += 1
+        self.total += seconds
+        if error:
+            self.errors += 1
+        if self.min is None or seconds < self.min:
+            self.min = seconds
+        if self.max is None or seconds > self.max:
+            self.max = seconds
+
+    def percentile(self,p):
+        """
+        :param p: the percentile, ex: 95
+        :return: the upper bound of the bucket holding the percentile, or the
+                 largest duration seen if it's in the last bucket. None if empty
+        """
+        if not self.count:
+            return None
+        rank = p / 100.0 * self.count
+        seen = 0
+        for i in range(len(BUCKETS)):
+            seen += self.counts[i]
+            if seen >= rank:
+                return min(BUCKETS[i],self.max)
+        return self.max
+
+    def toDict(self):
+        mean = None
+        if self.count:
+            mean = self.total / self.count
+        buckets = {}
+        for i in range(len(self.counts)):
+            if self.counts[i]:
+                bound = "+Inf"
+                if i < len(BUCKETS):
+                    bound = str(BUCKETS[i])
+                buckets[bound] = self.counts[i]
+        return {'count':self.count,'errors':self.errors,'total':self.total,'mean':mean,
+                'min':self.min,'max':self.max,'p50':self.percentile(50),
+                'p95':self.percentile(95),'p99':self.percentile(99),'buckets':buckets}
+
+
+class Trace(object):
+    """
+    Every call made while the trace runs, in order
+    """
+    def __init__(self,name):
+        self.name = name
+        self.started = time.time()
+        self.stopped = None
+        self.events = []
+
+    def stop(self):
+        if self.stopped is None:
+            self.stopped = time.time()
+            getStats().removeTrace(self)
+
+    def toDict(self):
+        return {'name':self.name,
+                'started':time.strftime("%Y-%m-%dT%H:%M:%S",time.localtime(self.started)),
+                'elapsed':(self.stopped or time.time()) - self.started,
+                'calls':len(self.events),
+                'events':self.events}
+
+    def format(self):
+        """
+        :return: the trace as text, one call per line
+        """
+        lines = ["Trace of %s: %d calls in %0.3fs" % (self.name,len(self.events),
+                                                     (self.stopped or time.time()) - self.started)]
+        for e in self.events:
+            line = "%9.3f %8.3fs %-16s %-24s %-28s %s" % (e['at'],e['seconds'],e['thread'][:16],
+                                                           e['op'],e['method'],e['vm'] or '')
+            if e['props']:
+                line += " [%s]" % ",".join(e['props'])
+            if e['error']:
+                line += " ERROR: %s" % e['error']
+            lines.append(line)
+        return "\n".join(lines)
+
+    def dump(self,path):
+        """
+        Write the trace to a JSON file
+        """
+        f = open(path,"w")
+        try:
+            f.write(jsonutil.dumps(self.toDict(),2))
+        finally:
+            f.close()
+
+
+class Stats(object):
+    """
+    The histograms of the calls made through instrumented sessions
+    """
+    def __init__(self):
+        self.__lock = threading.Lock()
+        self.__traces = []
+        self.reset()
+
+    def reset(self):
+        self.__lock.acquire()
+        try:
+            # (operation,remote method) -> Histogram
+            self.calls = {}
+            # (operation,property path) -> number of fetches
+            self.properties = {}
+            # VM name -> number of calls
+            self.vms = {}
+        finally:
+            self.__lock.release()
+
+    def record(self,op,vm,method,props,seconds,error):
+        self.__lock.acquire()
+        try:
+            h = self.calls.get((op,method))
+            if h is None:
+                h = self.calls[(op,method)] = Histogram()
+            h.add(seconds,error is not None)
+            for path in props:
+                self.properties[(op,path)] = self.properties.get((op,path),0) + 1
+            if vm:
+                self.vms[vm] = self.vms.get(vm,0) + 1
+            if self.__traces:
+                event = {'at':0.0,'seconds':seconds,'thread':threading.currentThread().getName(),
+                         'op':op,'vm':vm,'method':method,'props':props,'error':None}
+                if error is not None:
+                    event['error'] = str(error)
+                now = time.time()
+                for trace in self.__traces:
+                    e = dict(event)
+                    e['at'] = now - seconds - trace.started
+                    trace.events.append(e)
+        finally:
+            self.__lock.release()
+
+    def startTrace(self,name):
+        """
+        :param name: what's being traced, ex: 'Clone.__do_init'
+        :return: a Trace. Call its stop() when done
+        """
+        trace = Trace(name)
+        self.__lock.acquire()
+        try:
+            self.__traces.append(trace)
+        finally:
+            self.__lock.release()
+        return trace
+
+    def removeTrace(self,trace):
+        self.__lock.acquire()
+        try:
+            if trace in self.__traces:
+                self.__traces.remove(trace)
+        finally:
+            self.__lock.release()
+
+    def callCount(self,method=None):
+        """
+        :param method: (optional) a remote method, ex: 'retrieveProperties'
+        :return: the number of calls made to it, or to all of them
+        """
+        self.__lock.acquire()
+        try:
+            return sum([h.count for (op,m),h in self.calls.items() if method is None or m == method])
+        finally:
+            self.__lock.release()
+
+    def byOperation(self):
+        """
+        :return: {operation:Histogram} of all the remote calls of each operation
+        """
+        return self.__merge(0)
+
+    def byMethod(self):
+        """
+        :return: {remote method:Histogram}
+        """
+        return self.__merge(1)
+
+    def __merge(self,index):
+        self.__lock.acquire()
+        try:
+            merged = {}
+            for key,h in self.calls.items():
+                m = merged.get(key[index])
+                if m is None:
+                    m = merged[key[index]] = Histogram()
+                for i in range(len(h.counts)):
+                    m.counts[i] += h.counts[i]
+                m.count += h.count
+                m.errors += h.errors
+                m.total += h.total
+                if h.count:
+                    m.min = min([v for v in (m.min,h.min) if v is not None])
+                    m.max = max(m.max,h.max)
+            return merged
+        finally:
+            self.__lock.release()
+
+    def toDict(self):
+        """
+        :return: everything recorded, ex: to write as JSON
+        """
+        self.__lock.acquire()
+        try:
+            calls = []
+            for (op,method),h in self.calls.items():
+                d = h.toDict()
+                d['operation'] = op
+                d['method'] = method
+                calls.append(d)
+            properties = [{'operation':op,'path':path,'count':n}
+                          for (op,path),n in self.properties.items()]
+            vms = dict(self.vms)
+        finally:
+            self.__lock.release()
+        return {'calls':calls,'properties':properties,'vms':vms}
+
+    def report(self):
+        """
+        :return: a table of the calls of each operation, the slowest first
+        """
+        lines = ["%-28s %-30s %7s %9s %8s %8s" % ("operation","method","calls","total","p50","p95")]
+        self.__lock.acquire()
+        try:
+            items = self.calls.items()
+        finally:
+            self.__lock.release()
+        items.sort(lambda a,b: cmp(b[1].total,a[1].total))
+        for (op,method),h in items:
+            lines.append("%-28s %-30s %7d %8.3fs %7.3fs %7.3fs" %
+                         (op,method,h.count,h.total,h.percentile(50),h.percentile(95)))
+        return "\n".join(lines)
+
+
+__stats = Stats()
+__enabled = None
+__traced = {}
+__lock = threading.Lock()
+
+def getStats():
+    """
+    :return: the Stats every instrumented session records into
+    """
+    return __stats
+
+def isEnabled():
+    """
+    :return: True if esx.login() instruments the sessions it creates
+    """
+    global __enabled
+    if __enabled is None:
+        __enabled = getArg('enabled','HoneyClient::Manager::ESX::Instrumentation') in ('1','true','yes')
+    return __enabled
+
+def enable(on=True):
+    """
+    Turn instrumentation on or off for the sessions created from now on
+    """
+    global __enabled
+    __enabled = bool(on)
+
+def instrument(session):
+    """
+    Put an InstrumentedService in front of a session. Does nothing if it
+    already has one.
+
+    :param session: a ServiceInstance
+    :return: the session
+    """
+    _addForwarders()
+    conn = session.getServerConnection()
+    service = conn.getVimService()
+    if not isinstance(service,InstrumentedService):
+        field = conn.getClass().getDeclaredField("vimService")
+        field.setAccessible(True)
+        field.set(conn,InstrumentedService(service))
+    return session
+
+def startTrace(name):
+    """
+    Start a trace if instrumentation is on
+
+    :param name: what's being traced, ex: 'Clone.__do_init'
+    :return: a Trace or None
+    """
+    if not isEnabled():
+        return None
+    return __stats.startTrace(name)
+
+def traceOnce(name):
+    """
+    Start a trace of the first run of something, if instrumentation is on
+    and a 'trace_file' is set
+
+    :param name: what's being traced, ex: 'Clone.__do_init'
+    :return: a Trace or None. Pass it to finishTrace() when done
+    """
+    if not isEnabled():
+        return None
+    path = getArg('trace_file','HoneyClient::Manager::ESX::Instrumentation')
+    if path in ('undef',''):
+        return None
+    __lock.acquire()
+    try:
+        if __traced.has_key(name):
+            return None
+        __traced[name] = True
+    finally:
+        __lock.release()
+    return __stats.startTrace(name)
+
+def finishTrace(trace):
+    """
+    Stop a trace started by traceOnce() and write it to 'trace_file'
+
+    :param trace: the Trace or None
+    """
+    if trace is None:
+        return
+    trace.stop()
+    path = getArg('trace_file','HoneyClient::Manager::ESX::Instrumentation')
+    try:
+        trace.dump(path)
+        LOG.info("Wrote the trace of %s (%d calls) to %s" % (trace.name,len(trace.events),path))
+    except IOError,e:
+        LOG.error("Unable to write the trace of %s to %s: %s" % (trace.name,path,e))
+
+def _caller():
+    """
+    :return: (operation,VM name) of the code making a call
+    """
+    frame = sys._getframe(1)
+    found = None
+    other = None
+    while frame is not None:
+        module = frame.f_globals.get('__name__','')
+        if module == ESX_MODULE:
+            found = frame
+        elif other is None and module.startswith('honeyclient.') and module != __name__:
+            other = frame
+        frame = frame.f_back
+    if found is None:
+        if other is None:
+            return ('other',None)
+        return ("%s.%s" % (other.f_globals['__name__'].split('.')[-1],other.f_code.co_name),None)
+    vm = None
+    for arg in VM_ARGUMENTS:
+        value = found.f_locals.get(arg)
+        if isinstance(value,basestring):
+            vm = value
+            break
+    return (found.f_code.co_name,vm)
+
+def _paths(specs):
+    """
+    :return: the property paths asked for by PropertyFilterSpecs
+    """
+    paths = []
+    for spec in specs or []:
+        for prop in spec.getPropSet() or []:
+            for path in prop.getPathSet() or []:
+                if path not in paths:
+                    paths.append(path)
+    return paths
+
+
+class InstrumentedService(VimPortType):
+    """
+    A VimPortType that times every call and passes it on to the one it wraps
+    """
+    def __init__(self,service):
+        VimPortType.__init__(self,service.getWsc())
+        self.service = service
+
+    def _call(self,method,args):
+        op,vm = _caller()
+        props = []
+        if method == "retrieveProperties" and len(args) > 1:
+            props = _paths(args[1])
+        start = time.time()
+        error = None
+        try:
+            try:
+                return getattr(self.service,method)(*args)
+            except:
+                error = sys.exc_info()[1]
+                raise
+        finally:
+            getStats().record(op,vm,method,props,time.time() - start,error)
+
+def _forward(method):
+    def call(self,*args):
+        return self._call(method,args)
+    call.__name__ = method
+    return call
+
+__forwarding = False
+
+def _addForwarders():
+    """
+    Give InstrumentedService every remote method of the VI API, ex:
+    retrieveProperties, powerOnVM_Task. Done by the first instrument(),
+    so importing this module doesn't reflect over the API
+    """
+    global __forwarding
+    __lock.acquire()
+    try:
+        if __forwarding:
+            return
+        for method in Class.forName("com.vmware.vim25.ws.VimStub").getDeclaredMethods():
+            if Modifier.isPublic(method.getModifiers()) and method.getName() != "getWsc":
+                setattr(InstrumentedService,method.getName(),_forward(method.getName()))
+        __forwarding = True
+    finally:
+        __lock.release()
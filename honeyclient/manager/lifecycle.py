@@ -0,0 +1,508 @@
+"""
+A lifecycle engine for clone VMs.
+
+Bringing up a clone used to mean a busy loop per step: sleep retry_period,
+search the inventory for the VM, look at its state, IP or MAC, and try
+again. Here each step of the lifecycle is declared as a State: the VM
+properties it depends on, the condition on them that means the state is
+reached, an optional action started on entering it and how long it may
+take. A Tracker follows one VM through a list of states, with one
+PropertyFilter on the session's UpdateChannel, so a state is reached the
+moment the server reports the change.
+
+One LifecycleEngine thread evaluates every tracker it's given, so a
+single thread can bring up any number of clones at once. A Tracker is a
+futures.Future, so the caller can block on one clone or combine many with
+futures.allOf(). The engine records how long each state took, per clone
+and overall, see metrics().
+
+Example:
+>> engine = getEngine(session)
+>> t = engine.track(name,cloneStates(session,name))
+>> props = t.result()
+>> print t.timings, engine.metrics()
+"""
+
+from honeyclient.util.config import *
+from honeyclient.manager import errors,esx,futures,guestnet,metrics,updates
+import threading,time
+
+
+class State(object):
+    """
+    One declared step of a VM's lifecycle
+    """
+    def __init__(self,name,paths=None,ready=None,enter=None,timeout=None,on_timeout=None,retries=0):
+        """
+        :param name: the name of the state, ex: 'running'
+        :param paths: the VM property paths ready() looks at
+        :param ready: (optional) called as ready(props) with the current
+                      {path:value}, returns True once the state is reached
+        :param enter: (optional) called as enter(tracker) when the state becomes
+                      the next one to reach. May return a futures.Future, which
+                      must succeed before the state is reached
+        :param timeout: (optional) seconds the state may take
+        :param on_timeout: (optional) called as on_timeout(tracker) when the state
+                           times out and retries are left. May return a Future.
+                           The state is then given another timeout
+        :param retries: how many times on_timeout can be used
+        """
+        self.name = name
+        self.paths = paths or []
+        self.ready = ready
+        self.enter = enter
+        self.timeout = timeout
+        self.on_timeout = on_timeout
+        self.retries = retries
+
+    def __repr__(self):
+        return "<State %s>" % self.name
+
+
+class Tracker(futures.Future):
+    """
+    One VM going through a list of states. The result is the final
+    {path:value} of the watched properties
+    """
+    def __init__(self,engine,vm_name,vm,states,listener=None):
+        futures.Future.__init__(self,"lifecycle of %s" % vm_name)
+        self.engine = engine
+        self.vm_name = vm_name
+        self.vm = vm
+        self.states = states
+        self.listener = listener
+        self.props = {}
+        self.results = {}
+        self.timings = {}
+        self.index = 0
+        self.started = time.time()
+        self.state_started = self.started
+        self.deadline = None
+        self.action = None
+        self.entered = False
+        self.attempts = 0
+        self.dirty = True
+        self.channel = None
+        self.pfilter = None
+
+    def current(self):
+        """
+        :return: the State being waited for, None once done
+        """
+        if self.index < len(self.states):
+            return self.states[self.index]
+        return None
+
+    def reached(self):
+        """
+        :return: the name of the last state reached, None if none yet
+        """
+        if self.index == 0:
+            return None
+        return self.states[self.index - 1].name
+
+
+class LifecycleEngine(object):
+    """
+    Drives Trackers from one thread, woken up by property changes,
+    finished actions and timeouts
+    """
+    def __init__(self,session):
+        """
+        :param session: a session or SessionPool
+        """
+        self.session = session
+        self.__trackers = []
+        self.__metrics = {}
+        self.__cond = threading.Condition()
+        self.__thread = None
+
+    def track(self,vm_name,states,listener=None):
+        """
+        Start following a VM through a list of states
+
+        :param vm_name: the name of the VM
+        :param states: a list of State, in the order they're reached
+        :param listener: (optional) called as listener(tracker,state_name) from
+                         the engine thread each time a state is reached
+        :return: Tracker
+        """
+        vm = esx.getVMbyName(self.session,vm_name,True)
+        tracker = Tracker(self,vm_name,vm,states,listener)
+        tracker.setCancelHook(lambda: self.__drop(tracker))
+
+        paths = []
+        for state in states:
+            for p in state.paths:
+                if p not in paths:
+                    paths.append(p)
+
+        self.__cond.acquire()
+        try:
+            self.__trackers.append(tracker)
+            self.__start()
+        finally:
+            self.__cond.release()
+
+        if paths:
+            def update(mor,changes):
+                self.__update(tracker,changes)
+            def failed(e):
+                self.__fail(tracker,errors.errorForFault(e,errors.CloneError)(
+                    "Lost track of VM %s: %s" % (vm_name,e),vm_name,fault=e))
+            # Keep the channel the filter was made on so it's removed from
+            # that one. If the session logs back in, that channel is closed
+            # and the tracker fails with SessionExpired.
+            tracker.channel = updates.getChannel(self.session)
+            tracker.pfilter = tracker.channel.watch([(vm.getMOR(),paths)],update,failed)
+            if tracker.done():
+                self.__unwatch(tracker)
+        else:
+            self.poke(tracker)
+        return tracker
+
+    def poke(self,tracker):
+        """
+        Have the engine look at a tracker again
+        """
+        self.__cond.acquire()
+        try:
+            tracker.dirty = True
+            self.__cond.notifyAll()
+        finally:
+            self.__cond.release()
+
+    def metrics(self):
+        """
+        :return: {state name:{'count','timeouts','mean','min','max'}} with the
+                 seconds it took to reach each state, over every tracker
+        """
+        results = {}
+        self.__cond.acquire()
+        try:
+            for name,m in self.__metrics.items():
+                mean = 0.0
+                if m['count']:
+                    mean = m['total'] / m['count']
+                results[name] = {'count':m['count'],'timeouts':m['timeouts'],
+                                 'mean':mean,'min':m['min'],'max':m['max']}
+        finally:
+            self.__cond.release()
+        return results
+
+    def pending(self):
+        """
+        :return: the Trackers that aren't done
+        """
+        self.__cond.acquire()
+        try:
+            return list(self.__trackers)
+        finally:
+            self.__cond.release()
+
+    def __start(self):
+        if self.__thread is not None:
+            return
+        self.__thread = threading.Thread(target=self.__run,name="clone-lifecycle")
+        self.__thread.setDaemon(True)
+        self.__thread.start()
+
+    def __run(self):
+        while True:
+            self.__cond.acquire()
+            try:
+                while True:
+                    if not self.__trackers:
+                        self.__thread = None
+                        return
+                    now = time.time()
+                    ready = [t for t in self.__trackers if t.dirty or (t.deadline and t.deadline <= now)]
+                    if ready:
+                        break
+                    deadlines = [t.deadline for t in self.__trackers if t.deadline]
+                    if deadlines:
+                        self.__cond.wait(max(0.01,min(deadlines) - now))
+                    else:
+                        self.__cond.wait()
+                for t in ready:
+                    t.dirty = False
+            finally:
+                self.__cond.release()
+
+            for t in ready:
+                try:
+                    self.__advance(t)
+                except Exception, e:
+                    self.__fail(t,e)
+
+    def __advance(self,tracker):
+        while not tracker.done():
+            state = tracker.current()
+            if state is None:
+                self.__finish(tracker)
+                return
+
+            if not tracker.entered:
+                tracker.entered = True
+                tracker.state_started = time.time()
+                if state.timeout:
+                    tracker.deadline = tracker.state_started + state.timeout
+                if state.enter:
+                    self.__setAction(tracker,state.enter(tracker))
+
+            if tracker.action is not None:
+                if not tracker.action.done():
+                    break
+                error = tracker.action.error()
+                if error is not None:
+                    self.__fail(tracker,error)
+                    return
+                tracker.results[state.name] = tracker.action.result()
+                tracker.action = None
+
+            if state.ready:
+                self.__cond.acquire()
+                try:
+                    props = dict(tracker.props)
+                finally:
+                    self.__cond.release()
+                if not state.ready(props):
+                    break
+
+            self.__reached(tracker,state)
+
+        if tracker.deadline and tracker.deadline <= time.time() and not tracker.done():
+            self.__timedOut(tracker,tracker.current())
+
+    def __reached(self,tracker,state):
+        now = time.time()
+        elapsed = now - tracker.state_started
+        tracker.timings[state.name] = elapsed
+        tracker.index += 1
+        tracker.entered = False
+        tracker.deadline = None
+        tracker.attempts = 0
+        self.__record(state.name,elapsed,False)
+        LOG.info("VM %s is %s after %0.2fs" % (tracker.vm_name,state.name,elapsed))
+        if tracker.listener:
+            try:
+                tracker.listener(tracker,state.name)
+            except Exception, e:
+                LOG.error("Error in the lifecycle listener of %s: %s" % (tracker.vm_name,e))
+
+    def __timedOut(self,tracker,state):
+        if tracker.attempts < state.retries and state.on_timeout:
+            tracker.attempts += 1
+            LOG.info("VM %s isn't %s after %ds, retrying (%d of %d)" % \
+                     (tracker.vm_name,state.name,state.timeout,tracker.attempts,state.retries))
+            tracker.deadline = time.time() + state.timeout
+            self.__setAction(tracker,state.on_timeout(tracker))
+            return
+        self.__record(state.name,time.time() - tracker.state_started,True)
+        if tracker.action is not None:
+            tracker.action.cancel()
+        self.__fail(tracker,errors.TimedOut("VM %s didn't become %s in %ds" % \
+                                            (tracker.vm_name,state.name,state.timeout),tracker.vm_name))
+
+    def __setAction(self,tracker,action):
+        if not isinstance(action,futures.Future):
+            tracker.action = None
+            return
+        tracker.action = action
+        action.addCallback(lambda f: self.poke(tracker))
+
+    def __update(self,tracker,changes):
+        if changes is None:
+            self.__fail(tracker,errors.VMNotFound("VM %s went away" % tracker.vm_name,tracker.vm_name))
+            return
+        self.__cond.acquire()
+        try:
+            tracker.props.update(changes)
+            tracker.dirty = True
+            self.__cond.notifyAll()
+        finally:
+            self.__cond.release()
+
+    def __finish(self,tracker):
+        self.__drop(tracker)
+        self.__cond.acquire()
+        try:
+            props = dict(tracker.props)
+        finally:
+            self.__cond.release()
+        LOG.info("VM %s went through its lifecycle in %0.2fs" % (tracker.vm_name,time.time() - tracker.started))
+        tracker.setResult(props)
+
+    def __fail(self,tracker,error):
+        self.__drop(tracker)
+        if tracker.setError(error):
+            LOG.error("Lifecycle of VM %s stopped at %s: %s" % \
+                      (tracker.vm_name,tracker.current(),error))
+
+    def __drop(self,tracker):
+        self.__cond.acquire()
+        try:
+            if tracker in self.__trackers:
+                self.__trackers.remove(tracker)
+            self.__cond.notifyAll()
+        finally:
+            self.__cond.release()
+        self.__unwatch(tracker)
+
+    def __unwatch(self,tracker):
+        self.__cond.acquire()
+        try:
+            pfilter = tracker.pfilter
+            tracker.pfilter = None
+        finally:
+            self.__cond.release()
+        if pfilter:
+            tracker.channel.unwatch(pfilter)
+
+    def __record(self,name,elapsed,timed_out):
+        self.__cond.acquire()
+        try:
+            m = self.__metrics.get(name)
+            if m is None:
+                m = {'count':0,'timeouts':0,'total':0.0,'min':None,'max':None}
+                self.__metrics[name] = m
+            if timed_out:
+                m['timeouts'] += 1
+                return
+            m['count'] += 1
+            m['total'] += elapsed
+            if m['min'] is None or elapsed < m['min']:
+                m['min'] = elapsed
+            if m['max'] is None or elapsed > m['max']:
+                m['max'] = elapsed
+        finally:
+            self.__cond.release()
+
+
+def isRegistered(props):
+    """
+    :return: True once the VM has a configuration
+    """
+    return props.get("config.files.vmPathName") is not None
+
+def isRunning(props):
+    """
+    :return: True once the VM is powered on
+    """
+    return str(props.get("runtime.powerState")) == 'poweredOn'
+
+def primaryNic(props):
+    """
+    :param props: {path:value} including guestnet.PATHS
+    :return: (mac,ip) of the VM's first NIC with an address that isn't
+             link-local, (None,None) if there's none
+    """
+    nic = guestnet.fromProperties(None,props).primary()
+    if nic is None:
+        return (None,None)
+    return (nic.mac,nic.ip())
+
+def isNetworked(props):
+    """
+    :return: True once VMware Tools is running and a NIC has a MAC and an
+             address that isn't link-local
+    """
+    return guestnet.fromProperties(None,props).ready()
+
+def cloneStates(session,vm_name,snapshot_desc=None,initial_snapshot=None):
+    """
+    The lifecycle of a new quick clone, as left by esx.quickCloneVM():
+    registered -> running -> networked -> operational. On entering
+    'operational' the operational snapshot is taken, its (session,name) is
+    in tracker.results['operational']. If the VM doesn't get a network
+    address in time (ex: it blue screened) it's reverted to its initial
+    snapshot and started again.
+
+    Timeouts are read from honeyclient.xml, ex: 'networked_timeout'.
+
+    :param session:
+    :param vm_name: the name of the clone
+    :param snapshot_desc: (optional) the description of the operational snapshot
+    :param initial_snapshot: (optional) the snapshot to revert to on a network timeout
+    :return: [State]
+    """
+    if snapshot_desc is None:
+        snapshot_desc = getArg("operational_quick_clone_snapshot_description","HoneyClient::Manager::ESX")
+    if initial_snapshot is None:
+        initial_snapshot = getArg("default_quick_clone_snapshot_name","HoneyClient::Manager::ESX")
+
+    def reset(tracker):
+        LOG.error("Detected possible BSOD in initializing clone VM %s" % vm_name)
+        metrics.CLONE_BSOD_RESETS.inc()
+        return esx.revertVM_async(session,vm_name,initial_snapshot).then(
+            lambda s: esx.startVM_async(session,vm_name))
+
+    def snapshot(tracker):
+        return esx.snapshotVM_async(session,vm_name,None,snapshot_desc)
+
+    return [State('registered',["config.files.vmPathName"],isRegistered,
+                  timeout=stateTimeout('registered')),
+            State('running',["runtime.powerState"],isRunning,
+                  timeout=stateTimeout('running')),
+            State('networked',guestnet.PATHS,isNetworked,
+                  timeout=stateTimeout('networked'),on_timeout=reset,
+                  retries=getIntArg('max_network_resets','HoneyClient::Manager::ESX::Clone',
+                                    DEFAULT_NETWORK_RESETS)),
+            State('operational',enter=snapshot,timeout=stateTimeout('operational'))]
+
+def resumeStates(session,vm_name,snapshot_name):
+    """
+    The lifecycle of a clone brought back from its operational snapshot:
+    reverted and started -> running
+
+    :param session:
+    :param vm_name: the name of the clone
+    :param snapshot_name: the operational snapshot
+    :return: [State]
+    """
+    def revert(tracker):
+        return esx.revertVM_async(session,vm_name,snapshot_name).then(
+            lambda s: esx.startVM_async(session,vm_name))
+
+    return [State('running',["runtime.powerState"],isRunning,enter=revert,
+                  timeout=stateTimeout('running'))]
+
+
+# Default seconds each state may take, see '<state>_timeout' in honeyclient.xml
+DEFAULT_TIMEOUTS = {'registered':60,
+                    'running':300,
+                    'networked':300,
+                    'operational':600}
+
+# Default number of times a clone is reset when it doesn't get an address
+DEFAULT_NETWORK_RESETS = 3
+
+def stateTimeout(name):
+    """
+    :param name: the name of the state
+    :return: the timeout of the state from '<name>_timeout' in honeyclient.xml
+    """
+    return getIntArg("%s_timeout" % name,'HoneyClient::Manager::ESX::Clone',DEFAULT_TIMEOUTS.get(name))
+
+
+# Registry of engines by session
+__engines = {}
+__engines_lock = threading.Lock()
+
+def getEngine(session):
+    """
+    Return the shared LifecycleEngine for a session, creating it if needed.
+    A SessionPool gets one engine, whichever thread asks.
+
+    :param session: a session or SessionPool
+    :return: LifecycleEngine
+    """
+    __engines_lock.acquire()
+    try:
+        engine = __engines.get(session)
+        if engine is None:
+            engine = LifecycleEngine(session)
+            __engines[session] = engine
+        return engine
+    finally:
+        __engines_lock.release()
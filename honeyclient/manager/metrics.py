@@ -0,0 +1,481 @@
+"""
+Counters, gauges and timers of the clones and the ESX tasks, exported in
+the Prometheus text format.
+
+Clone reports each change of status (how many clones are in each state
+and how long they spent in the one they left), its failed initializations
+and the snapshots it takes. The lifecycle engine reports the clones
+reverted because they never got a network (BSOD), the capacity tracker
+the free and reserved space of the datastores, and esx.py every task it
+waits on, with its result and how long it took.
+
+The metrics are served over HTTP and/or written to a file, as set in the
+HoneyClient::Manager::ESX::Metrics section of honeyclient.xml. Both are
+started by start(), which Clone calls; other programs can call it too.
+
+Example:
+>> metrics.start()
+>> print metrics.getRegistry().render()
+>> curl http://localhost:9390/metrics
+
+The clones are counted per process: a process that made 10 clones and
+destroyed them reports honeyclient_clones{state="deleted"} 10.
+"""
+
+from honeyclient.util.config import *
+import BaseHTTPServer,os,threading,time
+
+# Upper bounds (in seconds) of the timer buckets. The last bucket has no bound
+BUCKETS = [0.1,0.5,1.0,2.5,5.0,10.0,30.0,60.0,120.0,300.0,600.0,1800.0]
+
+# Default settings, see HoneyClient::Manager::ESX::Metrics in honeyclient.xml
+DEFAULT_HTTP_ADDRESS = "127.0.0.1"
+DEFAULT_FILE_INTERVAL = 15
+
+# The content type of the Prometheus text format
+CONTENT_TYPE = "text/plain; version=0.0.4"
+
+
+def formatValue(value):
+    """
+    :return: a sample value as Prometheus writes it
+    """
+    if isinstance(value,float):
+        if value != value:
+            return "NaN"
+        if value - value != 0:
+            if value > 0:
+                return "+Inf"
+            return "-Inf"
+        return repr(value)
+    return str(value)
+
+def formatLabels(names,values,extra=None):
+    """
+    :param names: the label names
+    :param values: their values, in the same order
+    :param extra: (optional) one more (name,value), ex: ('le','0.5')
+    :return: ex: '{state="running"}', or '' without labels
+    """
+    pairs = zip(names,values)
+    if extra:
+        pairs.append(extra)
+    if not pairs:
+        return ""
+    escaped = []
+    for name,value in pairs:
+        value = str(value).replace("\\","\\\\").replace('"','\\"').replace("\n","\\n")
+        escaped.append('%s="%s"' % (name,value))
+    return "{%s}" % ",".join(escaped)
+
+
+class Metric(object):
+    """
+    A named metric, with one value per combination of its labels
+    """
+    TYPE = None
+
+    def __init__(self,name,help,labels=()):
+        """
+        :param name: ex: 'honeyclient_clones'
+        :param help: what it measures
+        :param labels: (optional) the names of its labels, ex: ('state',)
+        """
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self._lock = threading.Lock()
+        self._values = {}
+
+    def _key(self,labels):
+        """
+        :return: the values of the labels, in order
+        :raise ValueError: if labels aren't the ones of the metric
+        """
+        if len(labels) != len(self.labels):
+            raise ValueError("%s takes the labels %s, not %s" % (self.name,self.labels,labels.keys()))
+        try:
+            return tuple([str(labels[name]) for name in self.labels])
+        except KeyError:
+            raise ValueError("%s takes the labels %s, not %s" % (self.name,self.labels,labels.keys()))
+
+    def _change(self,labels,fn):
+        key = self._key(labels)
+        self._lock.acquire()
+        try:
+            self._values[key] = fn(self._values.get(key,0))
+        finally:
+            self._lock.release()
+
+    def value(self,**labels):
+        """
+        :return: the value for the labels, 0 if it was never set
+        """
+        key = self._key(labels)
+        self._lock.acquire()
+        try:
+            return self._values.get(key,0)
+        finally:
+            self._lock.release()
+
+    def samples(self):
+        """
+        :return: [(name,label text,value)] to render
+        """
+        self._lock.acquire()
+        try:
+            items = self._values.items()
+        finally:
+            self._lock.release()
+        items.sort()
+        return [(self.name,formatLabels(self.labels,key),value) for key,value in items]
+
+    def render(self):
+        """
+        :return: the lines of the metric in the Prometheus text format
+        """
+        lines = ["# HELP %s %s" % (self.name,self.help.replace("\\","\\\\").replace("\n","\\n")),
+                 "# TYPE %s %s" % (self.name,self.TYPE)]
+        for name,labels,value in self.samples():
+            lines.append("%s%s %s" % (name,labels,formatValue(value)))
+        return lines
+
+
+class Counter(Metric):
+    """
+    A count that only goes up, ex: the number of failed inits
+    """
+    TYPE = "counter"
+
+    def inc(self,amount=1,**labels):
+        if amount < 0:
+            raise ValueError("A counter can't go down: %s" % self.name)
+        self._change(labels,lambda v: v + amount)
+
+
+class Gauge(Metric):
+    """
+    A value that goes up and down, ex: the free space of a datastore
+    """
+    TYPE = "gauge"
+
+    def set(self,value,**labels):
+        self._change(labels,lambda v: value)
+
+    def inc(self,amount=1,**labels):
+        self._change(labels,lambda v: v + amount)
+
+    def dec(self,amount=1,**labels):
+        self._change(labels,lambda v: v - amount)
+
+
+class Timer(Metric):
+    """
+    Durations, counted in the BUCKETS. Rendered as a Prometheus histogram
+    """
+    TYPE = "histogram"
+
+    def observe(self,seconds,**labels):
+        def add(h):
+            if not h:
+                h = {'counts':[0] * (len(BUCKETS) + 1),'count':0,'sum':0.0}
+            i = 0
+            while i < len(BUCKETS) and seconds > BUCKETS[i]:
+                i += 1
+            h['counts'][i] += 1
+            h['count'] += 1
+            h['sum'] += seconds
+            return h
+        self._change(labels,add)
+
+    def time(self,fn,*args,**kwargs):
+        """
+        Call fn and observe how long it took, even if it raised. Takes no labels
+        """
+        start = time.time()
+        try:
+            return fn(*args,**kwargs)
+        finally:
+            self.observe(time.time() - start)
+
+    def value(self,**labels):
+        """
+        :return: (count,sum) of the durations observed for the labels
+        """
+        h = Metric.value(self,**labels)
+        if not h:
+            return (0,0.0)
+        return (h['count'],h['sum'])
+
+    def samples(self):
+        self._lock.acquire()
+        try:
+            items = [(key,dict(h,counts=list(h['counts']))) for key,h in self._values.items()]
+        finally:
+            self._lock.release()
+        items.sort()
+        samples = []
+        for key,h in items:
+            seen = 0
+            for i in range(len(BUCKETS)):
+                seen += h['counts'][i]
+                samples.append((self.name + "_bucket",
+                                formatLabels(self.labels,key,('le',str(BUCKETS[i]))),seen))
+            samples.append((self.name + "_bucket",formatLabels(self.labels,key,('le',"+Inf")),h['count']))
+            samples.append((self.name + "_sum",formatLabels(self.labels,key),h['sum']))
+            samples.append((self.name + "_count",formatLabels(self.labels,key),h['count']))
+        return samples
+
+
+class Registry(object):
+    """
+    The metrics to export, in the order they were made
+    """
+    def __init__(self):
+        self.__lock = threading.Lock()
+        self.__metrics = []
+        self.__byName = {}
+
+    def counter(self,name,help,labels=()):
+        return self.__get(Counter,name,help,labels)
+
+    def gauge(self,name,help,labels=()):
+        return self.__get(Gauge,name,help,labels)
+
+    def timer(self,name,help,labels=()):
+        return self.__get(Timer,name,help,labels)
+
+    def get(self,name):
+        """
+        :return: the metric called name, or None
+        """
+        return self.__byName.get(name)
+
+    def __get(self,cls,name,help,labels):
+        """
+        :return: the metric called name, made if needed
+        :raise ValueError: if there's already a metric of another kind with that name
+        """
+        self.__lock.acquire()
+        try:
+            metric = self.__byName.get(name)
+            if metric is None:
+                metric = cls(name,help,labels)
+                self.__metrics.append(metric)
+                self.__byName[name] = metric
+            elif metric.__class__ is not cls or metric.labels != tuple(labels):
+                raise ValueError("Metric %s already exists as a %s with labels %s" % \
+                                 (name,metric.TYPE,metric.labels))
+            return metric
+        finally:
+            self.__lock.release()
+
+    def render(self):
+        """
+        :return: every metric in the Prometheus text format
+        """
+        self.__lock.acquire()
+        try:
+            metrics = list(self.__metrics)
+        finally:
+            self.__lock.release()
+        lines = []
+        for metric in metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+    def write(self,path):
+        """
+        Write the metrics to a file. A temporary file is renamed over it, so
+        a reader never sees a partial file
+        """
+        tmp = "%s.tmp" % path
+        f = open(tmp,"w")
+        try:
+            f.write(self.render())
+        finally:
+            f.close()
+        if os.path.exists(path):
+            # Renaming over a file fails on Windows
+            os.remove(path)
+        os.rename(tmp,path)
+
+
+class _Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """
+    Serves the registry on GET / and GET /metrics
+    """
+    def do_GET(self):
+        if self.path.split("?")[0] not in ("/","/metrics"):
+            self.send_error(404)
+            return
+        body = self.server.registry.render()
+        self.send_response(200)
+        self.send_header("Content-Type",CONTENT_TYPE)
+        self.send_header("Content-Length",str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self,format,*args):
+        LOG.debug("Metrics: %s %s" % (self.client_address[0],format % args))
+
+
+class MetricsServer(object):
+    """
+    Exports a registry over HTTP and/or to a file, from daemon threads
+    """
+    def __init__(self,registry,port=None,address=DEFAULT_HTTP_ADDRESS,path=None,
+                 interval=DEFAULT_FILE_INTERVAL):
+        """
+        :param registry: the Registry to export
+        :param port: (optional) the port to serve it on. 0 picks a free one
+        :param address: (optional) the address to listen on
+        :param path: (optional) the file to write it to
+        :param interval: (optional) seconds between writes of the file
+        """
+        self.registry = registry
+        self.port = port
+        self.address = address
+        self.path = path
+        self.interval = interval
+        self.__httpd = None
+        self.__stopped = threading.Event()
+
+    def start(self):
+        if self.port is not None:
+            self.__httpd = BaseHTTPServer.HTTPServer((self.address,self.port),_Handler)
+            self.__httpd.registry = self.registry
+            self.port = self.__httpd.server_address[1]
+            self.__thread("esx-metrics-http",self.__httpd.serve_forever)
+            LOG.info("Serving metrics on http://%s:%d/metrics" % (self.address,self.port))
+        if self.path:
+            # Write it right away, so the file is there as soon as we're started
+            self.__write()
+            self.__thread("esx-metrics-file",self.__writeLoop)
+            LOG.info("Writing metrics to %s every %ss" % (self.path,self.interval))
+
+    def stop(self):
+        """
+        Stop writing the file. The HTTP server stops with the process
+        """
+        self.__stopped.set()
+        if self.__httpd:
+            self.__httpd.socket.close()
+
+    def __thread(self,name,target):
+        thread = threading.Thread(target=target,name=name)
+        thread.setDaemon(True)
+        thread.start()
+
+    def __writeLoop(self):
+        while True:
+            self.__stopped.wait(self.interval)
+            if self.__stopped.isSet():
+                return
+            self.__write()
+
+    def __write(self):
+        try:
+            self.registry.write(self.path)
+        except (IOError,OSError),e:
+            LOG.error("Unable to write the metrics to %s: %s" % (self.path,e))
+
+
+__registry = Registry()
+__server = None
+__lock = threading.Lock()
+
+CLONES = __registry.gauge("honeyclient_clones","The number of clones in each state",("state",))
+CLONE_STATE_SECONDS = __registry.timer("honeyclient_clone_state_seconds",
+                                       "How long clones stayed in each state",("state",))
+CLONE_FAILED_INITS = __registry.counter("honeyclient_clone_failed_inits_total",
+                                        "Clones that couldn't be initialized and were suspended")
+CLONE_BSOD_RESETS = __registry.counter("honeyclient_clone_bsod_resets_total",
+                                       "Clones reverted and restarted because they never got a network")
+CLONE_SNAPSHOTS = __registry.counter("honeyclient_clone_snapshots_total",
+                                     "Snapshots taken of clones, including the quick clone's first")
+DATASTORE_FREE_BYTES = __registry.gauge("honeyclient_datastore_free_bytes",
+                                        "The free space of each datastore, when last checked",
+                                        ("datastore",))
+DATASTORE_RESERVED_BYTES = __registry.gauge("honeyclient_datastore_reserved_bytes",
+                                            "The space of each datastore reserved for clones being made",
+                                            ("datastore",))
+ESX_TASKS = __registry.counter("honeyclient_esx_tasks_total",
+                               "The ESX tasks waited on, by task and result",("task","result"))
+ESX_TASK_SECONDS = __registry.timer("honeyclient_esx_task_seconds",
+                                    "How long ESX tasks took, from when they were waited on",("task",))
+
+def getRegistry():
+    """
+    :return: the Registry the clone and ESX metrics are in
+    """
+    return __registry
+
+def start():
+    """
+    Start exporting the registry as set in honeyclient.xml, if it isn't
+    already. Does nothing if neither 'http_port' nor 'file' is set.
+
+    :return: the MetricsServer or None
+    """
+    global __server
+    __lock.acquire()
+    try:
+        if __server is not None:
+            return __server
+        section = 'HoneyClient::Manager::ESX::Metrics'
+        port = getArg('http_port',section)
+        path = getArg('file',section)
+        if port in ('undef',''):
+            port = None
+        else:
+            port = int(port)
+        if path in ('undef',''):
+            path = None
+        if port is None and path is None:
+            return None
+        address = getArg('http_address',section)
+        if address in ('undef',''):
+            address = DEFAULT_HTTP_ADDRESS
+        interval = getArg('file_interval',section)
+        if interval in ('undef',''):
+            interval = DEFAULT_FILE_INTERVAL
+        server = MetricsServer(__registry,port,address,path,float(interval))
+        server.start()
+        __server = server
+        return server
+    finally:
+        __lock.release()
+
+def cloneStatus(old,new,seconds=None):
+    """
+    A clone went from one status to another
+
+    :param old: the status it left, or None for a new clone
+    :param new: its new status
+    :param seconds: (optional) how long it was in the old one
+    """
+    if old is not None:
+        CLONES.dec(state=old)
+        if seconds is not None:
+            CLONE_STATE_SECONDS.observe(seconds,state=old)
+    CLONES.inc(state=new)
+
+def taskDone(task,state,seconds):
+    """
+    An ESX task that was waited on finished
+
+    :param task: what it was, ex: 'VirtualMachine.powerOn', or None if unknown
+    :param state: its final state, ex: 'success', or None if the wait timed out
+    :param seconds: how long it was waited on
+    """
+    task = task or "unknown"
+    ESX_TASKS.inc(task=task,result=state or "timeout")
+    ESX_TASK_SECONDS.observe(seconds,task=task)
+
+def datastoreFree(stores):
+    """
+    :param stores: {datastore name:free bytes}, as returned by esx.getDatastoreSpaceAvailableVM()
+    """
+    for name,free in stores.items():
+        DATASTORE_FREE_BYTES.set(free,datastore=name)
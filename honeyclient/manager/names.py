@@ -0,0 +1,295 @@
+"""
+An in-memory index of VM and snapshot names, used when generating names for
+clones and snapshots.
+
+Checking a new name used to mean searching the inventory for a VM with that
+name and then walking the snapshot tree of every VM. The NameIndex is loaded
+once per session with a single PropertyCollector request over a ContainerView
+of all VMs, and is kept up to date from the session's UpdateChannel. Lookups
+are dictionary lookups.
+
+reserve() checks and claims a name under one lock, so two threads in the same
+process cloning at the same time can't pick the same name. A reservation is
+dropped once the name shows up in the inventory, on release(), or after
+'reservation_ttl' seconds.
+"""
+
+from com.vmware.vim25 import ObjectSpec,PropertyFilterSpec,PropertySpec,TraversalSpec
+
+from honeyclient.util.config import *
+from honeyclient.manager import sessions,updates
+import threading,time
+
+# Number of seconds a reservation is held if the name never shows up
+DEFAULT_RESERVATION_TTL = 600
+
+
+class NameIndex(object):
+    """
+    Counts of the VM names and snapshot names in the inventory, plus the
+    names reserved by this process
+    """
+    def __init__(self,reservation_ttl=DEFAULT_RESERVATION_TTL):
+        self.reservation_ttl = reservation_ttl
+        self.__vms = {}
+        self.__vm_names = {}
+        self.__snapshot_names = {}
+        self.__reserved = {}
+        self.__lock = threading.RLock()
+
+    def isVM(self,name):
+        """
+        :return: True if a registered VM has the name
+        """
+        return self.__vm_names.has_key(name)
+
+    def isSnapshot(self,name):
+        """
+        :return: True if any snapshot of any VM has the name
+        """
+        return self.__snapshot_names.has_key(name)
+
+    def isReserved(self,name):
+        """
+        :return: True if the name is reserved by this process
+        """
+        self.__lock.acquire()
+        try:
+            self.__expire()
+            return self.__reserved.has_key(name)
+        finally:
+            self.__lock.release()
+
+    def contains(self,name):
+        """
+        :return: True if the name is used by a VM, snapshot or reservation
+        """
+        return self.isVM(name) or self.isSnapshot(name) or self.isReserved(name)
+
+    def reserve(self,name):
+        """
+        Claim a name if nothing is using it
+
+        :param name: the name
+        :return: True if the name was reserved, False if it's taken
+        """
+        self.__lock.acquire()
+        try:
+            if self.contains(name):
+                return False
+            self.__reserved[name] = time.time()
+            return True
+        finally:
+            self.__lock.release()
+
+    def release(self,name):
+        """
+        Drop a reservation
+
+        :param name: the name
+        """
+        self.__lock.acquire()
+        try:
+            if self.__reserved.has_key(name):
+                del self.__reserved[name]
+        finally:
+            self.__lock.release()
+
+    def updateVM(self,key,name=None,snapshot_names=None):
+        """
+        Record the name and/or snapshot names of a VM
+
+        :param key: a unique key for the VM (the MOR value)
+        :param name: the name of the VM, None to leave it unchanged
+        :param snapshot_names: a list of snapshot names, None to leave them unchanged
+        """
+        self.__lock.acquire()
+        try:
+            old_name,old_snaps = self.__vms.get(key,(None,[]))
+            if name is None:
+                name = old_name
+            if snapshot_names is None:
+                snapshot_names = old_snaps
+
+            self.__remove(key)
+            self.__vms[key] = (name,snapshot_names)
+            if name:
+                self.__add(self.__vm_names,name)
+            for n in snapshot_names:
+                self.__add(self.__snapshot_names,n)
+        finally:
+            self.__lock.release()
+
+    def removeVM(self,key):
+        """
+        Forget a VM and its snapshots
+
+        :param key: the key given to updateVM()
+        """
+        self.__lock.acquire()
+        try:
+            self.__remove(key)
+        finally:
+            self.__lock.release()
+
+    def __remove(self,key):
+        if not self.__vms.has_key(key):
+            return
+        name,snaps = self.__vms[key]
+        del self.__vms[key]
+        if name:
+            self.__drop(self.__vm_names,name)
+        for n in snaps:
+            self.__drop(self.__snapshot_names,n)
+
+    def __add(self,counts,name):
+        counts[name] = counts.get(name,0) + 1
+        # The name is in the inventory now, the reservation did its job
+        if self.__reserved.has_key(name):
+            del self.__reserved[name]
+
+    def __drop(self,counts,name):
+        n = counts.get(name,0) - 1
+        if n > 0:
+            counts[name] = n
+        elif counts.has_key(name):
+            del counts[name]
+
+    def __expire(self):
+        if self.reservation_ttl < 0:
+            return
+        now = time.time()
+        for name,stamp in self.__reserved.items():
+            if now - stamp > self.reservation_ttl:
+                del self.__reserved[name]
+
+
+def snapshotNames(snapshot_info):
+    """
+    Return the names of all the snapshots in a VirtualMachineSnapshotInfo
+
+    :param snapshot_info: the value of a VM's 'snapshot' property (may be None)
+    :return: [names]
+    """
+    results = []
+    if not snapshot_info:
+        return results
+
+    def walk(tree):
+        if not tree:
+            return
+        for node in tree:
+            results.append(node.getName())
+            walk(node.getChildSnapshotList())
+
+    walk(snapshot_info.getRootSnapshotList())
+    return results
+
+
+class InventoryNameIndex(NameIndex):
+    """
+    A NameIndex loaded from, and kept in sync with, the VMs of a session
+    """
+    def __init__(self,session,reservation_ttl=DEFAULT_RESERVATION_TTL):
+        NameIndex.__init__(self,reservation_ttl)
+        self.session = session
+        self.__filter = None
+
+        self.__view = session.getViewManager().createContainerView(session.getRootFolder(),
+                                                                   ["VirtualMachine"],True)
+        spec = self.__buildSpec()
+
+        # Load everything now, then let the channel keep us current
+        contents = session.getPropertyCollector().retrieveProperties([spec])
+        if contents:
+            for oc in contents:
+                changes = {}
+                if oc.getPropSet():
+                    for dp in oc.getPropSet():
+                        changes[dp.getName()] = dp.getVal()
+                self.__update(oc.getObj(),changes)
+
+        self.__filter = updates.getChannel(session).watchSpec(spec,self.__update,None,False)
+
+    def close(self):
+        """
+        Stop tracking the inventory
+        """
+        if self.__filter:
+            updates.getChannel(self.session).unwatch(self.__filter)
+            self.__filter = None
+        try:
+            self.__view.destroyView()
+        except Exception, e:
+            LOG.debug("Unable to destroy the VM view: %s" % e)
+
+    def __buildSpec(self):
+        traversal = TraversalSpec()
+        traversal.setName("traverseView")
+        traversal.setType("ContainerView")
+        traversal.setPath("view")
+        traversal.setSkip(False)
+
+        objSpec = ObjectSpec()
+        objSpec.setObj(self.__view.getMOR())
+        objSpec.setSkip(True)
+        objSpec.setSelectSet([traversal])
+
+        propSpec = PropertySpec()
+        propSpec.setType("VirtualMachine")
+        propSpec.setAll(False)
+        propSpec.setPathSet(["name","snapshot"])
+
+        spec = PropertyFilterSpec()
+        spec.setPropSet([propSpec])
+        spec.setObjectSet([objSpec])
+        return spec
+
+    def __update(self,mor,changes):
+        key = mor.get_value()
+        if changes is None:
+            self.removeVM(key)
+            return
+        snaps = None
+        if changes.has_key("snapshot"):
+            snaps = snapshotNames(changes["snapshot"])
+        self.updateVM(key,changes.get("name"),snaps)
+
+
+# Registry of indexes by session
+__indexes = {}
+__indexes_lock = threading.Lock()
+
+def getIndex(session):
+    """
+    Return the name index of the session, loading it if needed
+
+    :param session: the session returned by esx.login() or a SessionPool
+    :return: InventoryNameIndex
+    """
+    session = sessions.resolveSession(session)
+    __indexes_lock.acquire()
+    try:
+        index = __indexes.get(session)
+        if index is None:
+            index = InventoryNameIndex(session)
+            __indexes[session] = index
+        return index
+    finally:
+        __indexes_lock.release()
+
+def dropIndex(session):
+    """
+    Stop and remove the name index of the session. Called on logout.
+
+    :param session: the session returned by esx.login()
+    """
+    __indexes_lock.acquire()
+    try:
+        index = __indexes.get(session)
+        if index is None:
+            return
+        del __indexes[session]
+    finally:
+        __indexes_lock.release()
+    index.close()
@@ -0,0 +1,281 @@
+"""
+A pool of pre-built clone VMs.
+
+Building a Clone runs the whole quick clone pipeline (copy, reconfigure,
+register, snapshot, power on, wait for the network, operational snapshot)
+and can take minutes. The ClonePool does that work ahead of time in a
+background thread, keeping 'size' clones suspended at their operational
+snapshot. checkout() then only has to revert the clone and power it on.
+
+Example:
+>> pool = ClonePool(4,service_url=url,un=un,pw=pw,guest_username=gu,guest_password=gp)
+>> pool.start()
+>> clone = pool.checkout()
+>> ... drive the clone ...
+>> pool.checkin(clone)
+>> pool.stop()
+"""
+
+from honeyclient.manager import capacity,errors,esx,sessions
+from honeyclient.manager.clone import Clone,DEFAULT_MAX_SNAPSHOTS
+from honeyclient.util.config import *
+
+import threading,time
+
+# Default number of clones to keep ready
+DEFAULT_POOL_SIZE = 2
+
+# Statuses of a clone that's up: a new clone ends up operational, a
+# resumed one running
+RUNNING_STATUSES = ["running","operational"]
+
+# Statuses of a clone that should never be handed out again
+BAD_STATUSES = ["suspicious","compromised","error","bug","deleted"]
+
+
+class ClonePool(object):
+    """
+    Keeps a number of clones built and suspended at their operational
+    snapshot, refilling in the background as they're handed out
+    """
+    def __init__(self,size=None,retry_period=30,**clone_args):
+        """
+        :param size: the number of clones to keep ready. Defaults to
+                     'clone_pool_size' in honeyclient.xml
+        :param retry_period: seconds to wait before building again after a
+                             failure, or while the datastore is low on space
+        :param clone_args: passed to Clone() for each new clone. If 'vm_session'
+                           isn't given, the shared SessionPool for the server is used
+        """
+        self.size = getIntArg('clone_pool_size','HoneyClient::Manager::ESX::Clone',DEFAULT_POOL_SIZE,size)
+        self.retry_period = retry_period
+        self.clone_args = clone_args
+
+        if not self.clone_args.get('vm_session'):
+            self.clone_args['vm_session'] = sessions.getPool(clone_args.get('service_url'),
+                                                             clone_args.get('un'),
+                                                             clone_args.get('pw'))
+        self.session = self.clone_args['vm_session']
+        self.master_vm_name = self.clone_args.get('master_vm_name',
+                                                  getArg('master_vm_name','HoneyClient::Manager::ESX'))
+
+        self.__ready = []
+        self.__building = 0
+        self.__running = False
+        self.__thread = None
+        self.__cond = threading.Condition()
+
+    def start(self):
+        """
+        Start filling the pool in the background
+        """
+        self.__cond.acquire()
+        try:
+            if self.__running:
+                return
+            self.__running = True
+        finally:
+            self.__cond.release()
+        self.__thread = threading.Thread(target=self.__fill,name="clone-pool")
+        self.__thread.setDaemon(True)
+        self.__thread.start()
+
+    def stop(self,destroy=False):
+        """
+        Stop filling the pool. Waits for the clone being built, if any,
+        which is then destroyed.
+
+        :param destroy: if True, also destroy the clones that are ready
+        """
+        self.__cond.acquire()
+        try:
+            self.__running = False
+            self.__cond.notifyAll()
+        finally:
+            self.__cond.release()
+
+        thread = self.__thread
+        if thread is not None and thread is not threading.currentThread():
+            thread.join()
+        self.__thread = None
+
+        if destroy:
+            self.__cond.acquire()
+            try:
+                clones = self.__ready
+                self.__ready = []
+            finally:
+                self.__cond.release()
+            for clone in clones:
+                self.__discard(clone)
+
+    def available(self):
+        """
+        :return: the number of clones ready to be checked out
+        """
+        return len(self.__ready)
+
+    def checkout(self,timeout=None):
+        """
+        Take a clone from the pool, reverted to its operational snapshot
+        and running.
+
+        :param timeout: (optional) seconds to wait for a clone to be ready
+        :return: a running Clone or None on timeout
+        """
+        deadline = None
+        if timeout is not None:
+            deadline = time.time() + timeout
+
+        while True:
+            self.__cond.acquire()
+            try:
+                while not self.__ready:
+                    if deadline is None:
+                        self.__cond.wait()
+                    else:
+                        remaining = deadline - time.time()
+                        if remaining <= 0:
+                            return None
+                        self.__cond.wait(remaining)
+                clone = self.__ready.pop(0)
+                # Wake the filler, there's room now
+                self.__cond.notifyAll()
+            finally:
+                self.__cond.release()
+
+            try:
+                clone.resume()
+            except errors.ESXError:
+                LOG.error("Unable to resume clone %s" % clone.quick_clone_vm_name)
+            if clone.status in RUNNING_STATUSES:
+                return clone
+            self.__discard(clone)
+
+    def checkin(self,clone,reuse=True):
+        """
+        Give a clone back to the pool.
+
+        :param clone: the Clone from checkout()
+        :param reuse: if True and the clone is healthy, it's suspended and put
+                      back in the pool, unless the pool is stopped or already
+                      full. Otherwise it's destroyed and replaced
+        """
+        if reuse and self.__reusable(clone) and self.__hasRoom():
+            try:
+                clone.suspend()
+                if self.__put(clone):
+                    return
+            except errors.ESXError:
+                LOG.error("Unable to suspend clone %s" % clone.quick_clone_vm_name)
+        self.__discard(clone)
+
+    def __reusable(self,clone):
+        if clone.status in BAD_STATUSES:
+            return False
+        return clone.num_snapshots < getIntArg('max_num_snapshots','HoneyClient::Manager::ESX',
+                                               DEFAULT_MAX_SNAPSHOTS)
+
+    def __hasRoom(self):
+        return self.__running and len(self.__ready) < self.size
+
+    def __put(self,clone):
+        # Returns False if the pool was stopped or filled up in the meantime
+        self.__cond.acquire()
+        try:
+            if not self.__hasRoom():
+                return False
+            self.__ready.append(clone)
+            self.__cond.notifyAll()
+            return True
+        finally:
+            self.__cond.release()
+
+    def __discard(self,clone):
+        try:
+            clone.destroy()
+        except errors.ESXError:
+            LOG.error("Unable to destroy clone %s" % clone.quick_clone_vm_name)
+
+        # The pool made the VM, so it goes too. The reaper only collects
+        # unregistered directories and deleted snapshots, not registered VMs
+        name = clone.quick_clone_vm_name
+        if not name:
+            return
+        try:
+            sessions.call(clone.vm_session,esx.destroyVM,name)
+        except errors.ESXError:
+            LOG.error("Unable to destroy the VM of clone %s" % name)
+
+    def __fill(self):
+        while True:
+            self.__cond.acquire()
+            try:
+                while self.__running and len(self.__ready) + self.__building >= self.size:
+                    self.__cond.wait()
+                if not self.__running:
+                    return
+                self.__building += 1
+            finally:
+                self.__cond.release()
+
+            clone = None
+            keep = False
+            try:
+                if self.__has_space():
+                    clone = self.__build()
+            finally:
+                self.__cond.acquire()
+                try:
+                    self.__building -= 1
+                    # Nobody takes clones from a stopped pool
+                    keep = clone is not None and self.__running
+                    if keep:
+                        self.__ready.append(clone)
+                    self.__cond.notifyAll()
+                finally:
+                    self.__cond.release()
+
+            if clone is None:
+                self.__pause()
+            elif not keep:
+                LOG.info("The pool was stopped, destroying clone %s" % clone.quick_clone_vm_name)
+                self.__discard(clone)
+
+    def __pause(self):
+        # Wait retry_period before building again, unless the pool is stopped
+        self.__cond.acquire()
+        try:
+            if self.__running:
+                self.__cond.wait(self.retry_period)
+        finally:
+            self.__cond.release()
+
+    def __has_space(self):
+        try:
+            if capacity.getTracker(self.session).hasSpace(self.master_vm_name):
+                return True
+        except errors.ESXError:
+            return False
+        LOG.error("Not building clones, the datastore doesn't have room for another one")
+        return False
+
+    def __build(self):
+        LOG.info("Building a clone for the pool (%d ready)" % len(self.__ready))
+        try:
+            clone = Clone(**self.clone_args)
+        except errors.ESXError:
+            LOG.error("Unable to build a clone for the pool")
+            return None
+
+        if clone.status not in RUNNING_STATUSES:
+            self.__discard(clone)
+            return None
+
+        try:
+            clone.suspend()
+        except errors.ESXError:
+            LOG.error("Unable to suspend clone %s" % clone.quick_clone_vm_name)
+            self.__discard(clone)
+            return None
+        return clone
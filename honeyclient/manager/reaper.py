@@ -0,0 +1,542 @@
+"""
+Garbage collection of orphaned clone directories and stale snapshots.
+
+A worker that dies in the middle of a quick clone leaves its half copied
+directory on the datastore, and a clone that's unregistered but never
+deleted leaves all of its files behind. Clone.destroy() only renames the
+operational snapshot to 'Deleted Snapshot ...'. Nothing ever cleaned any of
+that up, so the free space the clones need slowly
+went away and every datastore browse got slower.
+
+The Reaper compares what's on the datastores (one searchDatastoreSubFolders
+per datastore) with what the registered VMs use (one PropertyCollector
+request). A top level directory is an orphan when no registered VM has
+files or disks in it, nothing in it changed for 'min_age' seconds, and it's
+one of ours: its vmx is annotated 'Type: Quick Cloned VM', or it has no vmx
+at all and a generated (VMID) name, which is what an interrupted copy looks
+like. Directories with the master annotation, or with any other vmx, are
+never touched. Deleted snapshots older than 'min_age' on quick clones are
+removed too.
+
+Orphans are deleted 'batch_size' at a time with a pause of 'batch_pause'
+seconds between batches, so the reaper doesn't swamp the datastore while
+clones are being built.
+
+Example:
+>> report = Reaper(session).reapOnce()
+>> print report.summary()
+>> reaper = Reaper(session)
+>> reaper.start()
+"""
+
+from java.io import BufferedReader,InputStreamReader
+from java.net import URI
+from com.vmware.vim25 import FileQueryFlags,FolderFileInfo,HostDatastoreBrowserSearchSpec,TaskInfoState
+from com.vmware.vim25.mo import InventoryNavigator
+
+from honeyclient.util.config import *
+from honeyclient.manager import deletion,devices,errors,esx,sessions,updates
+import re,threading,time
+
+# Default settings, see HoneyClient::Manager::ESX::Reaper in honeyclient.xml
+DEFAULT_PERIOD = 3600
+DEFAULT_MIN_AGE = 86400
+DEFAULT_BATCH_SIZE = 4
+DEFAULT_BATCH_PAUSE = 30
+
+# Clone.destroy() renames the operational snapshot to this, plus the old name
+DELETED_SNAPSHOT_PREFIX = "Deleted Snapshot"
+
+# The annotation __quickCloneFromMaster() puts on every quick clone
+QUICK_CLONE_ANNOTATION = "Type: Quick Cloned VM"
+
+# The names __generateVMID() makes
+GENERATED_NAME = re.compile(r"^[0-9a-f]{32}$")
+
+# A line of a vmx file. ex: annotation = "Type: Quick Cloned VM|0A Master VM: x"
+VMX_LINE = re.compile(r'^\s*([A-Za-z0-9_.:]+)\s*=\s*"(.*)"\s*$')
+
+
+class Orphan(object):
+    """
+    A top level datastore directory that no registered VM uses
+    """
+    def __init__(self,path,size=0,modified=None,has_vmx=False):
+        """
+        :param path: the datastore path. ex: '[datastore1] 0a1b...'
+        :param size: the total size of its files in bytes
+        :param modified: the newest modification time of its files (seconds since the epoch)
+        :param has_vmx: True if it has a .vmx file
+        """
+        self.path = path
+        self.size = size
+        self.modified = modified
+        self.has_vmx = has_vmx
+        self.vmx = None
+        self.reason = None
+        self.deleted = False
+        self.error = None
+
+    def age(self,now=None):
+        """
+        :return: seconds since anything in the directory changed, or None if unknown
+        """
+        if self.modified is None:
+            return None
+        if now is None:
+            now = time.time()
+        return now - self.modified
+
+    def __repr__(self):
+        return "<Orphan %s %d bytes %s>" % (self.path,self.size,self.reason)
+
+
+class ReapReport(object):
+    """
+    The outcome of one Reaper pass
+    """
+    def __init__(self,dry_run=False):
+        """
+        :param dry_run: True if nothing was deleted. snapshots then lists the
+                        snapshots that would have been removed
+        """
+        self.dry_run = dry_run
+        self.orphans = []
+        self.kept = []
+        self.snapshots = []
+        self.failures = []
+        self.elapsed = 0.0
+
+    def reclaimed(self):
+        """
+        :return: the bytes freed by the deleted directories
+        """
+        total = 0
+        for o in self.orphans:
+            if o.deleted:
+                total += o.size
+        return total
+
+    def size(self):
+        """
+        :return: the total size of the orphans found
+        """
+        total = 0
+        for o in self.orphans:
+            total += o.size
+        return total
+
+    def deleted(self):
+        """
+        :return: the Orphans that were deleted
+        """
+        return [o for o in self.orphans if o.deleted]
+
+    def summary(self):
+        """
+        :return: a one line summary
+        """
+        if self.dry_run:
+            return "%d orphans found (%0.1f MB), %d directories kept, %d snapshots found in %0.2fs" % \
+                (len(self.orphans),self.size() / (1024.0 * 1024),len(self.kept),
+                 len(self.snapshots),self.elapsed)
+        return "%d orphans deleted (%0.1f MB reclaimed), %d directories kept, %d snapshots removed, %d failures in %0.2fs" % \
+            (len(self.deleted()),self.reclaimed() / (1024.0 * 1024),len(self.kept),
+             len(self.snapshots),len(self.failures),self.elapsed)
+
+
+class Reaper(object):
+    """
+    Finds and deletes orphaned clones, once with reapOnce() or every
+    'period' seconds in a background thread
+    """
+    def __init__(self,session,period=None,min_age=None,batch_size=None,batch_pause=None,dry_run=False):
+        """
+        :param session: a session or SessionPool
+        :param period: (optional) seconds between passes when started
+        :param min_age: (optional) seconds a directory or deleted snapshot
+                        must be left alone before it's reaped
+        :param batch_size: (optional) directories or snapshots deleted at once
+        :param batch_pause: (optional) seconds to wait between batches
+        :param dry_run: if True, only report what would be deleted
+        """
+        self.session = session
+        section = 'HoneyClient::Manager::ESX::Reaper'
+        self.period = getIntArg('period',section,DEFAULT_PERIOD,period)
+        self.min_age = getIntArg('min_age',section,DEFAULT_MIN_AGE,min_age)
+        self.batch_size = max(1,getIntArg('batch_size',section,DEFAULT_BATCH_SIZE,batch_size))
+        self.batch_pause = getIntArg('batch_pause',section,DEFAULT_BATCH_PAUSE,batch_pause)
+        self.dry_run = dry_run
+        self.last_report = None
+
+        master = getArg('default_quick_clone_master_annotation','HoneyClient::Manager::ESX')
+        self.master_annotation = ""
+        if master != 'undef':
+            self.master_annotation = master.strip().splitlines()[0].strip()
+
+        self.__running = False
+        self.__thread = None
+        self.__cond = threading.Condition()
+
+    def start(self):
+        """
+        Reap every 'period' seconds in the background
+        """
+        self.__cond.acquire()
+        try:
+            if self.__running:
+                return
+            self.__running = True
+        finally:
+            self.__cond.release()
+        self.__thread = threading.Thread(target=self.__loop,name="esx-reaper")
+        self.__thread.setDaemon(True)
+        self.__thread.start()
+
+    def stop(self):
+        """
+        Stop the background thread after the current batch
+        """
+        self.__cond.acquire()
+        try:
+            self.__running = False
+            self.__cond.notifyAll()
+        finally:
+            self.__cond.release()
+        if self.__thread and self.__thread is not threading.currentThread():
+            self.__thread.join()
+        self.__thread = None
+
+    def reapOnce(self):
+        """
+        Run one pass: find the orphans and stale snapshots and delete them
+
+        :return: ReapReport
+        """
+        started = time.time()
+        report = ReapReport(self.dry_run)
+        session = self.session
+
+        s,vms = esx.getInventoryESX(session,"VirtualMachine",
+                                    ["name","config.files","config.annotation",
+                                     "config.hardware.device","snapshot"])
+        datacenter = InventoryNavigator(session.getRootFolder()).searchManagedEntity("Datacenter","ha-datacenter")
+
+        used = self.__usedDirectories(vms)
+        for orphan in self.__findDirectories(session,datacenter,used,report):
+            if self.__isOurs(session,orphan):
+                report.orphans.append(orphan)
+            else:
+                report.kept.append(orphan)
+
+        snapshots = self.__findSnapshots(vms)
+
+        LOG.info("Reaper found %d orphaned directories and %d deleted snapshots" % \
+                 (len(report.orphans),len(snapshots)))
+        if self.dry_run:
+            report.snapshots = snapshots
+        else:
+            self.__deleteDirectories(session,datacenter,report)
+            self.__removeSnapshots(session,snapshots,report)
+
+        report.elapsed = time.time() - started
+        self.last_report = report
+        LOG.info("Reaper: %s" % report.summary())
+        return report
+
+    def __loop(self):
+        while self.__isRunning():
+            try:
+                self.reapOnce()
+            except errors.ESXError, e:
+                LOG.error("Reaper pass failed: %s" % e)
+            self.__cond.acquire()
+            try:
+                if self.__running:
+                    self.__cond.wait(self.period)
+            finally:
+                self.__cond.release()
+
+    def __isRunning(self):
+        self.__cond.acquire()
+        try:
+            return self.__running
+        finally:
+            self.__cond.release()
+
+    def __pause(self):
+        """
+        Wait between batches. Returns False if the reaper was stopped meanwhile.
+        """
+        if self.__thread is None:
+            time.sleep(self.batch_pause)
+            return True
+        self.__cond.acquire()
+        try:
+            if self.__running:
+                self.__cond.wait(self.batch_pause)
+            return self.__running
+        finally:
+            self.__cond.release()
+
+    def __usedDirectories(self,vms):
+        """
+        :return: {top level directory:True} for everything a registered VM uses,
+                 including the directories of the disks it's backed by
+        """
+        used = {}
+        for vm in vms:
+            files = vm['config.files']
+            if files:
+                for p in [files.getVmPathName(),files.getSuspendDirectory(),
+                          files.getSnapshotDirectory(),files.getLogDirectory()]:
+                    if p:
+                        used[topDirectory(p)] = True
+
+            for disk in devices.DeviceTopology(vm['config.hardware.device']).disks:
+                backing = disk.getBacking()
+                while backing is not None:
+                    if hasattr(backing,'getFileName') and backing.getFileName():
+                        used[topDirectory(backing.getFileName())] = True
+                    # Older API versions don't have the parent of a delta disk
+                    if not hasattr(backing,'getParent'):
+                        break
+                    backing = backing.getParent()
+        return used
+
+    def __findDirectories(self,session,datacenter,used,report):
+        """
+        Browse every datastore and return the top level directories that
+        aren't used and haven't changed for min_age seconds
+
+        :return: [Orphan]
+        """
+        results = []
+        now = time.time()
+        for datastore in datacenter.getDatastores():
+            ds_name = datastore.getName()
+            try:
+                dirs = self.__browse(session,datastore)
+            except Exception, e:
+                LOG.error("Reaper unable to browse [%s]: %s" % (ds_name,e))
+                report.failures.append(("[%s]" % ds_name,e))
+                continue
+            for orphan in dirs:
+                if used.has_key(orphan.path):
+                    continue
+                age = orphan.age(now)
+                if age is None or age < self.min_age:
+                    continue
+                results.append(orphan)
+        return results
+
+    def __browse(self,session,datastore):
+        """
+        List the files of a datastore grouped by top level directory
+
+        :return: [Orphan] with the size, newest modification and vmx of each
+        """
+        flags = FileQueryFlags()
+        flags.setFileSize(True)
+        flags.setModification(True)
+        flags.setFileType(True)
+        flags.setFileOwner(False)
+        search_spec = HostDatastoreBrowserSearchSpec()
+        search_spec.setDetails(flags)
+
+        root = "[%s]" % datastore.getName()
+        task = datastore.getBrowser().searchDatastoreSubFolders_Task(root,search_spec)
+        if updates.waitForTask(session,task) != str(TaskInfoState.success):
+            raise errors.FileOperationFailed("Unable to browse %s" % root,task=task,
+                                             fault=task.getTaskInfo().getError())
+
+        dirs = {}
+        results = task.getTaskInfo().getResult()
+        if not results or not results.getHostDatastoreBrowserSearchResults():
+            return []
+        for r in results.getHostDatastoreBrowserSearchResults():
+            folder = r.getFolderPath().rstrip("/")
+            top = topDirectory(folder)
+            if not r.getFile():
+                continue
+            for f in r.getFile():
+                if isinstance(f,FolderFileInfo):
+                    if top is None:
+                        # A top level directory, even an empty one
+                        path = "%s %s" % (root,f.getPath())
+                        if not dirs.has_key(path):
+                            dirs[path] = Orphan(path)
+                        _touch(dirs[path],f)
+                    continue
+                if top is None:
+                    # Files in the root of the datastore are left alone
+                    continue
+                if not dirs.has_key(top):
+                    dirs[top] = Orphan(top)
+                orphan = dirs[top]
+                orphan.size += f.getFileSize() or 0
+                _touch(orphan,f)
+                if f.getPath().endswith(".vmx") and folder == top:
+                    orphan.has_vmx = True
+                    orphan.vmx = "/".join([folder,f.getPath()])
+        return dirs.values()
+
+    def __isOurs(self,session,orphan):
+        """
+        Decide if an unused directory is a clone we can delete, and why
+        """
+        name = orphan.path.split("]",1)[-1].strip()
+        if not orphan.has_vmx:
+            if GENERATED_NAME.match(name):
+                orphan.reason = "partial copy"
+                return True
+            orphan.reason = "no vmx"
+            return False
+
+        try:
+            annotation = readAnnotation(session,orphan.vmx)
+        except Exception, e:
+            LOG.error("Reaper unable to read %s: %s" % (orphan.vmx,e))
+            orphan.reason = "unreadable vmx"
+            return False
+        if self.master_annotation and annotation.startswith(self.master_annotation):
+            orphan.reason = "master VM"
+            return False
+        if annotation.startswith(QUICK_CLONE_ANNOTATION):
+            orphan.reason = "unregistered quick clone"
+            return True
+        orphan.reason = "not a clone"
+        return False
+
+    def __findSnapshots(self,vms):
+        """
+        :return: [(vm name,snapshot name)] for the deleted snapshots older
+                 than min_age on quick clones
+        """
+        results = []
+        now = time.time()
+        for vm in vms:
+            annotation = vm['config.annotation'] or ""
+            if not annotation.startswith(QUICK_CLONE_ANNOTATION):
+                continue
+            for node in _walkSnapshots(vm['snapshot']):
+                if not node.getName().startswith(DELETED_SNAPSHOT_PREFIX):
+                    continue
+                created = node.getCreateTime()
+                if created is None or now - created.getTimeInMillis() / 1000.0 < self.min_age:
+                    continue
+                results.append((vm['name'],node.getName()))
+        return results
+
+    def __deleteDirectories(self,session,datacenter,report):
+        orphans = list(report.orphans)
+        while orphans:
+            batch = orphans[:self.batch_size]
+            orphans = orphans[self.batch_size:]
+            by_path = {}
+            for o in batch:
+                by_path[o.path] = o
+                o.deleted = True
+            for path,error in deletion.deleteDirectories(session,datacenter,by_path.keys()):
+                o = by_path.get(path)
+                if o is None:
+                    # A file or sub directory of one of the orphans
+                    o = by_path.get(topDirectory(path))
+                if o is not None:
+                    o.deleted = False
+                    o.error = error
+                report.failures.append((path,error))
+            for o in batch:
+                if o.deleted:
+                    LOG.info("Reaper deleted %s (%s, %d bytes)" % (o.path,o.reason,o.size))
+            if orphans and not self.__pause():
+                return
+
+    def __removeSnapshots(self,session,snapshots,report):
+        count = 0
+        for vm_name,snap_name in snapshots:
+            if count and count % self.batch_size == 0 and not self.__pause():
+                return
+            count += 1
+            try:
+                esx.removeSnapshotVM(session,vm_name,snap_name,False)
+            except errors.ESXError, e:
+                LOG.error("Reaper unable to remove snapshot %s of %s: %s" % (snap_name,vm_name,e))
+                report.failures.append(("%s/%s" % (vm_name,snap_name),e))
+                continue
+            LOG.info("Reaper removed snapshot %s of %s" % (snap_name,vm_name))
+            report.snapshots.append((vm_name,snap_name))
+
+
+def topDirectory(path):
+    """
+    Return the top level directory of a datastore path
+
+    :param path: ex: '[datastore1] clone-1/clone-1.vmx'
+    :return: ex: '[datastore1] clone-1', or None for the root of the datastore
+    """
+    if not path.startswith("[") or "]" not in path:
+        return None
+    ds,rest = path[1:].split("]",1)
+    rest = rest.strip().strip("/")
+    if not rest:
+        return None
+    return "[%s] %s" % (ds,rest.split("/",1)[0])
+
+def readAnnotation(session,vmx_path):
+    """
+    Read the annotation of a VM that isn't registered, from its vmx file.
+    The file is downloaded over the server's /folder HTTP interface using
+    the session's cookie.
+
+    :param session: a session or SessionPool
+    :param vmx_path: the datastore path of the vmx file
+    :return: the annotation, "" if there is none
+    """
+    session = sessions.resolveSession(session)
+    conn = session.getServerConnection()
+    base = conn.getUrl()
+    ds_name = vmx_path[1:vmx_path.index("]")]
+    rel = vmx_path.split("]",1)[1].strip()
+    url = URI(base.getProtocol(),None,base.getHost(),base.getPort(),"/folder/" + rel,
+              "dcPath=ha-datacenter&dsName=" + ds_name,None).toURL()
+
+    http = url.openConnection()
+    http.setRequestProperty("Cookie",conn.getVimService().getWsc().getCookie())
+    reader = BufferedReader(InputStreamReader(http.getInputStream()))
+    try:
+        while True:
+            line = reader.readLine()
+            if line is None:
+                return ""
+            m = VMX_LINE.match(line)
+            if m and m.group(1).lower() == "annotation":
+                # Newlines are stored as |0A
+                return m.group(2).replace("|0A","\n").replace("|22",'"').replace("|7C","|")
+    finally:
+        reader.close()
+
+def _walkSnapshots(snapshot_info):
+    """
+    :param snapshot_info: the value of a VM's 'snapshot' property
+    :return: every VirtualMachineSnapshotTree in the tree
+    """
+    results = []
+    if not snapshot_info:
+        return results
+    pending = list(snapshot_info.getRootSnapshotList() or [])
+    while pending:
+        node = pending.pop(0)
+        results.append(node)
+        pending.extend(node.getChildSnapshotList() or [])
+    return results
+
+def _touch(orphan,f):
+    """
+    Keep the newest modification time of a directory's files
+    """
+    if f.getModification() is None:
+        return
+    modified = f.getModification().getTimeInMillis() / 1000.0
+    if orphan.modified is None or modified > orphan.modified:
+        orphan.modified = modified
@@ -0,0 +1,392 @@
+"""
+A pool of logged in ESX sessions, shared by everything talking to the same
+server as the same user.
+
+esx.login() creates a new ServiceInstance for each caller, and nothing kept
+those sessions alive: after 'session_timeout' seconds of inactivity ESX
+expires them and the next call fails with NotAuthenticated. A SessionPool
+holds up to 'size' ServiceInstances for one (service_url, user), pings the
+idle ones with the cheap currentTime() call so they don't expire, and logs
+back in on the same ServiceInstance when one has expired anyway. Logging
+back in on the same object keeps every ManagedObject, cache and registry
+that refers to it valid.
+
+Threads can check a session out for their own use, or simply pass the pool
+to any esx function in place of a session. In that case each thread is
+given one of the pool's sessions and keeps using it.
+
+Only call() logs back in and tries again when a session expired between
+two pings. An esx function given the pool directly fails with
+SessionExpired instead, since it can't be restarted halfway through.
+
+Example:
+>> pool = getPool('https://esx/sdk','root','secret')
+>> s,names = call(pool,esx.listAllRegisteredVMS)
+>> session = pool.checkout()
+>> try:
+>>     esx.startVM(session,name)
+>> finally:
+>>     pool.checkin(session)
+"""
+
+from com.vmware.vim25 import NotAuthenticated
+
+from honeyclient.util.config import *
+from honeyclient.manager import errors
+import threading,time
+
+# Default number of sessions in a pool
+DEFAULT_POOL_SIZE = 4
+
+# Default ESX session_timeout (in seconds)
+DEFAULT_SESSION_TIMEOUT = 900
+
+
+class _Member(object):
+    """
+    A session in the pool and its bookkeeping
+    """
+    def __init__(self,instance):
+        self.instance = instance
+        self.last_used = time.time()
+        self.checked_out = False
+        self.threads = 0
+        self.lock = threading.Lock()
+
+
+class SessionPool(object):
+    """
+    Up to 'size' sessions to one server as one user, kept alive in the
+    background. Can be used anywhere a session returned by esx.login() is.
+    """
+    def __init__(self,service_url,un,pw,size=None,keepalive=None):
+        """
+        :param service_url: full URL to ESX server. ex: 'https://esx_server/sdk/'
+        :param un: the account username
+        :param pw: the account password
+        :param size: (optional) the max number of sessions. Defaults to
+                     'session_pool_size' in honeyclient.xml
+        :param keepalive: (optional) seconds a session can be idle before it's
+                          pinged. Defaults to half of 'session_timeout'
+        """
+        self.service_url = service_url
+        self.un = un
+        self.pw = pw
+        self.size = max(1,getIntArg('session_pool_size','HoneyClient::Manager::ESX',DEFAULT_POOL_SIZE,size))
+        if keepalive is None:
+            keepalive = getIntArg('session_timeout','HoneyClient::Manager::ESX',DEFAULT_SESSION_TIMEOUT) / 2
+        self.keepalive = keepalive
+
+        self.__members = []
+        self.__bound = {}
+        self.__closed = False
+        self.__cond = threading.Condition()
+
+        # Log in once now so bad credentials show up right away
+        self.__cond.acquire()
+        try:
+            self.__members.append(self.__login())
+        finally:
+            self.__cond.release()
+
+        self.__thread = threading.Thread(target=self.__keepalive,name="esx-session-keepalive")
+        self.__thread.setDaemon(True)
+        self.__thread.start()
+
+    def __getattr__(self,name):
+        # Only called for attributes the pool doesn't have: hand them to the
+        # calling thread's session, so the pool works as a ServiceInstance
+        if name.startswith('_'):
+            raise AttributeError(name)
+        return getattr(self.current(),name)
+
+    def current(self):
+        """
+        Return the session used by the calling thread when the pool is passed
+        in place of a session. A thread keeps the same session until the pool
+        is closed. Sessions are shared between threads once the pool is full.
+
+        :return: a ServiceInstance
+        """
+        thread = threading.currentThread()
+        self.__cond.acquire()
+        try:
+            self.__check_open()
+            member = self.__bound.get(thread)
+            if member is None:
+                self.__prune()
+                member = self.__least_used(False)
+                if (member is None or member.threads) and len(self.__members) < self.size:
+                    member = self.__login()
+                    self.__members.append(member)
+                elif member is None:
+                    # Everything is checked out, share one anyway
+                    member = self.__least_used(True)
+                member.threads += 1
+                self.__bound[thread] = member
+        finally:
+            self.__cond.release()
+        return self.__use(member)
+
+    def checkout(self,timeout=None):
+        """
+        Take a session for the exclusive use of the caller. While it's checked
+        out, passing the pool as a session from this thread also uses it.
+
+        :param timeout: (optional) seconds to wait for a free session
+        :return: a ServiceInstance or None on timeout
+        """
+        deadline = None
+        if timeout is not None:
+            deadline = time.time() + timeout
+
+        thread = threading.currentThread()
+        self.__cond.acquire()
+        try:
+            while True:
+                self.__check_open()
+                member = None
+                for m in self.__members:
+                    if not m.checked_out:
+                        member = m
+                        break
+                if member is None and len(self.__members) < self.size:
+                    member = self.__login()
+                    self.__members.append(member)
+                if member:
+                    break
+                if deadline is None:
+                    self.__cond.wait()
+                else:
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        return None
+                    self.__cond.wait(remaining)
+
+            member.checked_out = True
+            old = self.__bound.get(thread)
+            if old:
+                old.threads -= 1
+            member.threads += 1
+            self.__bound[thread] = member
+        finally:
+            self.__cond.release()
+        return self.__use(member)
+
+    def checkin(self,session):
+        """
+        Give back a session from checkout()
+
+        :param session: the ServiceInstance
+        """
+        thread = threading.currentThread()
+        self.__cond.acquire()
+        try:
+            member = self.__find(session)
+            if member is None:
+                return
+            member.checked_out = False
+            if self.__bound.get(thread) is member:
+                member.threads -= 1
+                del self.__bound[thread]
+            self.__cond.notifyAll()
+        finally:
+            self.__cond.release()
+
+    def call(self,fn,*args,**kwargs):
+        """
+        Call an esx function with the pool as its session, logging back in
+        and trying once more if the session had expired. This is the only
+        way of using the pool that does.
+
+        :param fn: the esx function, ex: esx.startVM
+        :param args: the arguments after the session
+        :return: whatever fn returns
+        """
+        try:
+            return fn(self,*args,**kwargs)
+        except (errors.SessionExpired,NotAuthenticated):
+            LOG.info("ESX session to %s expired, logging in again" % self.service_url)
+            self.relogin(self.current())
+            return fn(self,*args,**kwargs)
+
+    def relogin(self,session):
+        """
+        Log a session back in, keeping the same ServiceInstance
+
+        :param session: a ServiceInstance of the pool
+        """
+        member = self.__find(session)
+        if member is None:
+            return
+        self.__relogin(member)
+
+    def close(self):
+        """
+        Stop the keepalive thread and log out every session
+        """
+        self.__cond.acquire()
+        try:
+            if self.__closed:
+                return
+            self.__closed = True
+            members = self.__members
+            self.__members = []
+            self.__bound.clear()
+            self.__cond.notifyAll()
+        finally:
+            self.__cond.release()
+
+        from honeyclient.manager import esx
+        for member in members:
+            try:
+                esx.logout(member.instance)
+            except Exception, e:
+                LOG.debug("Unable to log out of %s: %s" % (self.service_url,e))
+        dropPool(self)
+
+    def __login(self):
+        from honeyclient.manager import esx
+        LOG.info("Creating a new ESX Session to %s" % self.service_url)
+        return _Member(esx.login(self.service_url,self.un,self.pw))
+
+    def __relogin(self,member):
+        from honeyclient.manager import names,updates
+        member.lock.acquire()
+        try:
+            try:
+                member.instance.getSessionManager().login(self.un,self.pw,None)
+            except Exception, e:
+                raise errors.LoginFailed("Error logging back into %s: %s" % (self.service_url,e),fault=e)
+            member.last_used = time.time()
+            # Property filters die with the old server session, they'll be
+            # created again the next time they're needed
+            names.dropIndex(member.instance)
+            updates.closeChannel(member.instance)
+        finally:
+            member.lock.release()
+
+    def __use(self,member):
+        now = time.time()
+        if now - member.last_used > self.keepalive:
+            self.__ping(member)
+        member.last_used = now
+        return member.instance
+
+    def __ping(self,member):
+        try:
+            member.instance.currentTime()
+        except NotAuthenticated:
+            LOG.info("ESX session to %s expired, logging in again" % self.service_url)
+            self.__relogin(member)
+        member.last_used = time.time()
+
+    def __keepalive(self):
+        while True:
+            time.sleep(max(1,self.keepalive / 2))
+            self.__cond.acquire()
+            try:
+                if self.__closed:
+                    return
+                members = list(self.__members)
+            finally:
+                self.__cond.release()
+            for member in members:
+                if time.time() - member.last_used > self.keepalive:
+                    try:
+                        self.__ping(member)
+                    except Exception, e:
+                        LOG.error("Keepalive failed for %s: %s" % (self.service_url,e))
+
+    def __find(self,session):
+        for m in self.__members:
+            if m.instance is session:
+                return m
+        return None
+
+    def __least_used(self,checked_out):
+        best = None
+        for m in self.__members:
+            if m.checked_out and not checked_out:
+                continue
+            if best is None or m.threads < best.threads:
+                best = m
+        return best
+
+    def __prune(self):
+        # Forget threads that have finished
+        for thread,member in self.__bound.items():
+            if not thread.isAlive():
+                member.threads -= 1
+                del self.__bound[thread]
+
+    def __check_open(self):
+        if self.__closed:
+            raise errors.SessionExpired("The session pool for %s is closed" % self.service_url)
+
+
+def call(session,fn,*args,**kwargs):
+    """
+    Call an esx function with a session, which may be a SessionPool. A
+    pool logs back in and tries once more if the session expired, see
+    SessionPool.call()
+
+    :param session: a ServiceInstance or SessionPool
+    :param fn: the esx function, ex: esx.startVM
+    :param args: the arguments after the session
+    :return: whatever fn returns
+    """
+    if isinstance(session,SessionPool):
+        return session.call(fn,*args,**kwargs)
+    return fn(session,*args,**kwargs)
+
+def resolveSession(session):
+    """
+    Return the ServiceInstance to use for a session argument, which may be a
+    SessionPool. Used by the per-session registries.
+
+    :param session: a ServiceInstance or SessionPool
+    :return: a ServiceInstance
+    """
+    if isinstance(session,SessionPool):
+        return session.current()
+    return session
+
+
+# Registry of pools by (service_url, user)
+__pools = {}
+__pools_lock = threading.Lock()
+
+def getPool(service_url,un,pw,size=None):
+    """
+    Return the shared SessionPool for a server and user, creating it if needed
+
+    :param service_url: full URL to ESX server
+    :param un: the account username
+    :param pw: the account password
+    :param size: (optional) the max number of sessions for a new pool
+    :return: SessionPool
+    """
+    __pools_lock.acquire()
+    try:
+        pool = __pools.get((service_url,un))
+        if pool is None:
+            pool = SessionPool(service_url,un,pw,size)
+            __pools[(service_url,un)] = pool
+        return pool
+    finally:
+        __pools_lock.release()
+
+def dropPool(pool):
+    """
+    Remove a pool from the registry. Called by SessionPool.close().
+
+    :param pool: the SessionPool
+    """
+    __pools_lock.acquire()
+    try:
+        key = (pool.service_url,pool.un)
+        if __pools.get(key) is pool:
+            del __pools[key]
+    finally:
+        __pools_lock.release()
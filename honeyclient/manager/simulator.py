@@ -0,0 +1,2604 @@
+"""
+An in-process stand-in for a VMware ESX server, so that esx.py, clone.py
+and the benchmarks can run without one.
+
+The simulator sits where the SOAP client does: _SimService is a VimPortType
+whose methods are answered from an inventory kept in memory, instead of
+being sent to a server. Everything above it is the real VI Java API, so
+InventoryNavigator, the PropertyCollector, the managed object classes and
+the update channels work unchanged, and so does every function in esx.py.
+
+esx.login() uses the simulator for URLs starting with 'sim://'. Sessions
+for the same host share the same inventory:
+
+>> session = esx.login('sim://localhost/sdk','root','')
+>> session = esx.login('sim://bench/sdk?vms=500&latency=0.005','root','')
+
+The query string overrides the defaults from the
+HoneyClient::Manager::ESX::Simulator section of honeyclient.xml:
+
+ vm_names    VMs that always exist, comma separated (the test VM)
+ vms         number of extra VMs, named sim-vm-0001, sim-vm-0002 ...
+ datastores  number of datastores, named datastore1, datastore2 ...
+ capacity    size of each datastore, in GB
+ disk_size   size of the disk of each VM, in MB
+ memory      memory of each VM, in MB
+ latency     seconds added to every call
+ jitter      fraction by which every delay randomly varies
+ task_time   seconds every task takes
+ boot_time   seconds from power on until the guest has a network
+ copy_rate   MB/s of the file and disk copies, 0 for instant copies
+ bsod_rate   fraction of boots that never get a network
+ version     the ESX version reported
+ seed        seed of the random generator
+ user, password  when set, the only credentials accepted
+
+What's simulated: one host with its datastores, VMs and network, the
+PropertyCollector with traversal specs and WaitForUpdates, container views,
+tasks, power operations, questions, snapshots, the FileManager, the
+VirtualDiskManager and the datastore browser. A VM's vmx is a record kept
+in the datastore, so copying, registering and quick cloning a VM behave
+like they do on a server: a copied VM asks whether it was moved or copied,
+and a copied vmx points at disks that aren't there until it's reconfigured.
+Deleting a snapshot doesn't consolidate its disks. The methods that aren't
+simulated fail like a server that can't be reached.
+
+Tests get at the server behind a URL with getServer(): callCount() tells
+how many calls each method got, ask() makes a VM ask a question and
+expireSessions() logs every session out.
+"""
+
+from java.lang import Long,String
+from java.net import URL
+from java.util import Calendar
+from com.vmware.vim25 import *
+from com.vmware.vim25.mo import ServerConnection,ServiceInstance
+
+from honeyclient.util.config import *
+import copy,fnmatch,heapq,jarray,os.path,random,re,sys,threading,time,uuid
+from collections import deque
+
+# Default settings, see HoneyClient::Manager::ESX::Simulator in honeyclient.xml
+DEFAULTS = {'vm_names':'',
+            'vms':0,
+            'datastores':1,
+            'capacity':500,
+            'disk_size':4096,
+            'memory':256,
+            'latency':0.0,
+            'jitter':0.0,
+            'task_time':0.01,
+            'boot_time':0.05,
+            'copy_rate':0.0,
+            'bsod_rate':0.0,
+            'version':'4.0.0',
+            'seed':0,
+            'user':'',
+            'password':''}
+
+# The number of finished tasks kept, like the server's recent tasks
+TASK_HISTORY = 1000
+
+# Keys of the virtual devices of every VM
+CONTROLLER_KEY = 1000
+DISK_KEY = 2000
+NIC_KEY = 4000
+
+# Sizes of the files that aren't disks or memory
+DESCRIPTOR_SIZE = 1024
+DELTA_SIZE = 16 * 1024 * 1024
+VMX_SIZE = 2560
+NVRAM_SIZE = 8684
+LOG_SIZE = 65536
+VMSN_SIZE = 32768
+
+MB = 1024 * 1024
+GB = 1024 * MB
+
+# The question a copied VM asks when it's powered on
+UUID_QUESTION = "msg.uuid.moved:The virtual machine may have been moved or copied.\n" \
+                "In order to configure certain management and networking features, " \
+                "VMware ESX needs to know which.\n\n" \
+                "Did you move this virtual machine, or did you copy it?\n" \
+                "If you don't know, answer \"I copied it\"."
+UUID_CHOICES = [("0","Cancel"),("1","I _moved it"),("2","I _copied it")]
+
+# Returned by task work that finishes later, ex: when a question is answered
+PENDING = object()
+
+# ex: 'Ubuntu_Test_VM-000002.vmdk'
+DELTA_DISK = re.compile(r"-\d{6}\.vmdk$")
+
+
+def isSimulated(service_url):
+    """
+    :param service_url: the URL given to esx.login()
+    :return: True if it's the URL of a simulated server
+    """
+    return str(service_url).strip().lower().startswith("sim://")
+
+def parseURL(service_url):
+    """
+    Split a simulator URL into its host and settings
+
+    :param service_url: ex: 'sim://localhost/sdk?vms=10&latency=0.01'
+    :return: (host,{setting:value})
+    """
+    rest = service_url.strip()[len("sim://"):]
+    query = ""
+    if "?" in rest:
+        rest,query = rest.split("?",1)
+    host = rest.split("/")[0] or "localhost"
+
+    options = {}
+    for name,default in DEFAULTS.items():
+        options[name] = default
+        arg = getArg(name,"HoneyClient::Manager::ESX::Simulator")
+        if arg != 'undef':
+            options[name] = __convert(name,arg)
+
+    for pair in query.split("&"):
+        if not pair:
+            continue
+        if "=" not in pair:
+            raise ValueError("Bad simulator setting: %s" % pair)
+        name,value = pair.split("=",1)
+        if not DEFAULTS.has_key(name):
+            raise ValueError("Unknown simulator setting: %s" % name)
+        options[name] = __convert(name,value)
+    return (host,options)
+
+def __convert(name,value):
+    """
+    Convert a setting to the type of its default
+    """
+    value = str(value).strip()
+    if isinstance(DEFAULTS[name],str):
+        return value
+    return type(DEFAULTS[name])(value)
+
+
+__servers = {}
+__servers_lock = threading.Lock()
+
+def getServer(service_url):
+    """
+    Return the simulated server behind a URL, creating it on first use.
+    The settings of the URL that creates it are the ones used.
+
+    :param service_url: ex: 'sim://localhost/sdk'
+    :return: SimServer
+    """
+    host,options = parseURL(service_url)
+    __servers_lock.acquire()
+    try:
+        server = __servers.get(host)
+        if server is None:
+            server = SimServer(host,options)
+            __servers[host] = server
+        return server
+    finally:
+        __servers_lock.release()
+
+def dropServer(service_url):
+    """
+    Forget the simulated server behind a URL. The next login gets a new one.
+
+    :param service_url: ex: 'sim://localhost/sdk'
+    """
+    host,options = parseURL(service_url)
+    __servers_lock.acquire()
+    try:
+        server = __servers.pop(host,None)
+    finally:
+        __servers_lock.release()
+    if server is not None:
+        server.stop()
+
+def connect(service_url,un,pw):
+    """
+    Log into a simulated server
+
+    :param service_url: ex: 'sim://localhost/sdk'
+    :param un: the account username
+    :param pw: the account password
+    :return: a ServiceInstance, like ServiceInstance(url,un,pw,True) returns
+    """
+    server = getServer(service_url)
+    service = _SimService(server)
+    conn = ServerConnection(URL(server.url),service,None)
+    si = ServiceInstance(conn)
+    __setField(conn,"serviceInstance",si)
+    user_session = si.getSessionManager().login(un,pw,None)
+    __setField(conn,"userSession",user_session)
+    return si
+
+def __setField(obj,name,value):
+    """
+    Set a private field of a Java object
+    """
+    field = obj.getClass().getDeclaredField(name)
+    field.setAccessible(True)
+    field.set(obj,value)
+
+
+def splitPath(path):
+    """
+    :param path: a datastore path. ex: '[datastore1] vm/vm.vmx'
+    :return: (datastore name,relative path). ex: ('datastore1','vm/vm.vmx')
+    """
+    path = path.strip()
+    if not path.startswith("[") or "]" not in path:
+        return (None,path)
+    end = path.index("]")
+    return (path[1:end],path[end+1:].strip().strip("/"))
+
+def joinPath(ds_name,rel):
+    """
+    :return: the datastore path of rel. ex: '[datastore1] vm/vm.vmx'
+    """
+    if not rel:
+        return "[%s]" % ds_name
+    return "[%s] %s" % (ds_name,rel)
+
+def extentOf(path):
+    """
+    :param path: the descriptor of a virtual disk. ex: '[ds] vm/vm.vmdk'
+    :return: the file holding its data. ex: '[ds] vm/vm-flat.vmdk'
+    """
+    if DELTA_DISK.search(path):
+        return path[:-len(".vmdk")] + "-delta.vmdk"
+    return path[:-len(".vmdk")] + "-flat.vmdk"
+
+def _fault(cls,**fields):
+    """
+    Make a fault to raise. ex: _fault(FileNotFound,file='[ds] x')
+    """
+    fault = cls()
+    for name,value in fields.items():
+        getattr(fault,"set" + name[0].upper() + name[1:])(value)
+    return fault
+
+def _mor(mo_type,value):
+    mor = ManagedObjectReference()
+    mor.setType(mo_type)
+    mor.set_value(value)
+    return mor
+
+def _mors(entities):
+    return jarray.array([e.mor for e in entities],ManagedObjectReference)
+
+def _calendar(seconds):
+    cal = Calendar.getInstance()
+    cal.setTimeInMillis(long(seconds * 1000))
+    return cal
+
+def _property(obj,name,path):
+    """
+    Read one step of a property path from a data object
+    """
+    cap = name[0].upper() + name[1:]
+    for prefix in ("get","is"):
+        getter = getattr(obj,prefix + cap,None)
+        if getter is not None:
+            return getter()
+    raise _fault(InvalidProperty,name=path)
+
+def _same(a,b):
+    return a is b or (a is not None and b is not None and a == b)
+
+def _linkLocal(mac):
+    """
+    :return: the IPv6 link-local address of a MAC
+    """
+    b = mac.split(":")
+    return "fe80::%02x%s:%sff:fe%s:%s%s" % (int(b[0],16) ^ 2,b[1],b[2],b[3],b[4],b[5])
+
+
+class _File(object):
+    """
+    A file on a simulated datastore. A vmx file's content is its record
+    """
+    def __init__(self,size,content=None):
+        self.size = long(size)
+        self.content = content
+        self.modified = time.time()
+
+
+class _Entity(object):
+    """
+    A managed object of the simulated server. props holds the values of
+    its properties and revs counts the changes of each, so property filters
+    only compare what changed. links holds the entities a property refers
+    to, which the traversal specs follow.
+    """
+    TYPE = None
+    SUPERTYPES = ()
+    PROPERTIES = ()
+    CHILDREN = ()
+
+    def __init__(self,server,key,mo_type=None,properties=None,children=None):
+        if mo_type is not None:
+            self.TYPE = mo_type
+        if properties is not None:
+            self.PROPERTIES = tuple(properties)
+        if children is not None:
+            self.CHILDREN = tuple(children)
+        self.server = server
+        self.key = key
+        self.mor = _mor(self.TYPE,key)
+        self.props = {}
+        self.revs = {}
+        self.links = {}
+
+    def set(self,prop,value):
+        self.props[prop] = value
+        self.revs[prop] = self.revs.get(prop,0) + 1
+        self.server.changed()
+
+    def link(self,prop,entities):
+        """
+        Set a property that refers to other entities
+
+        :param entities: an entity, a list of entities or None
+        """
+        if entities is None:
+            refs = []
+            value = None
+        elif isinstance(entities,list):
+            refs = list(entities)
+            value = None
+            if refs:
+                value = _mors(refs)
+        else:
+            refs = [entities]
+            value = entities.mor
+        self.links[prop] = refs
+        self.server.topology += 1
+        self.set(prop,value)
+
+    def isA(self,mo_type):
+        return mo_type == self.TYPE or mo_type in self.SUPERTYPES
+
+    def has(self,path):
+        return path.split(".")[0] in self.PROPERTIES
+
+    def rev(self,prop):
+        return self.revs.get(prop,0)
+
+    def get(self,prop):
+        return self.props.get(prop)
+
+    def refs(self,prop):
+        return self.links.get(prop,[])
+
+    def children(self):
+        """
+        :return: the entities a container view looks into
+        """
+        found = []
+        for prop in self.CHILDREN:
+            found.extend(self.refs(prop))
+        return found
+
+    def resolve(self,path):
+        """
+        :param path: a property path. ex: 'config.files.vmPathName'
+        :return: its value or None
+        """
+        parts = path.split(".")
+        if parts[0] not in self.PROPERTIES:
+            raise _fault(InvalidProperty,name=path)
+        value = self.get(parts[0])
+        for part in parts[1:]:
+            if value is None:
+                return None
+            value = _property(value,part,path)
+        return value
+
+    def displayName(self):
+        return self.props.get("name")
+
+
+class _Managed(_Entity):
+    """
+    A folder, datacenter, compute resource, host, resource pool or network
+    """
+    SUPERTYPES = ("ManagedEntity",)
+
+    def __init__(self,server,mo_type,key,name,properties,children=()):
+        _Entity.__init__(self,server,key,mo_type,("name","parent") + tuple(properties),children)
+        self.set("name",name)
+
+
+class _Datastore(_Entity):
+    """
+    A datastore and its files. Paths are relative to the datastore.
+    """
+    TYPE = "Datastore"
+    SUPERTYPES = ("ManagedEntity",)
+    PROPERTIES = ("name","parent","info","summary","browser","host","vm")
+
+    def __init__(self,server,key,name,capacity):
+        _Entity.__init__(self,server,key)
+        self.name = name
+        self.capacity = long(capacity)
+        self.used = 0L
+        self.files = {}
+        self.dirs = {}
+        self.set("name",name)
+        self.publish()
+
+    def publish(self):
+        free = self.capacity - self.used
+        url = "/vmfs/volumes/" + self.name
+        info = DatastoreInfo()
+        info.setName(self.name)
+        info.setUrl(url)
+        info.setFreeSpace(free)
+        info.setMaxFileSize(256L * GB)
+        info.setTimestamp(_calendar(time.time()))
+        self.set("info",info)
+
+        summary = DatastoreSummary()
+        summary.setDatastore(self.mor)
+        summary.setName(self.name)
+        summary.setUrl(url)
+        summary.setCapacity(self.capacity)
+        summary.setFreeSpace(free)
+        summary.setAccessible(True)
+        summary.setType("VMFS")
+        self.set("summary",summary)
+
+    def path(self,rel):
+        return joinPath(self.name,rel)
+
+    def exists(self,rel):
+        return rel == "" or self.files.has_key(rel) or self.dirs.has_key(rel)
+
+    def isDir(self,rel):
+        return rel == "" or self.dirs.has_key(rel)
+
+    def file(self,rel):
+        f = self.files.get(rel)
+        if f is None:
+            raise _fault(FileNotFound,file=self.path(rel))
+        return f
+
+    def write(self,rel,size,content=None):
+        """
+        Create or replace a file
+
+        :return: the _File
+        """
+        parent = os.path.dirname(rel)
+        if not self.isDir(parent):
+            raise _fault(FileNotFound,file=self.path(parent))
+        if self.dirs.has_key(rel):
+            raise _fault(FileAlreadyExists,file=self.path(rel))
+        old = self.files.get(rel)
+        grow = long(size)
+        if old is not None:
+            grow -= old.size
+        if grow > self.capacity - self.used:
+            raise _fault(NoDiskSpace,file=self.path(rel),datastore=self.name)
+        f = _File(size,content)
+        self.files[rel] = f
+        self.used += grow
+        if parent:
+            self.dirs[parent] = f.modified
+        self.publish()
+        return f
+
+    def makeDir(self,rel,parents):
+        if self.exists(rel):
+            raise _fault(FileAlreadyExists,file=self.path(rel))
+        parent = os.path.dirname(rel)
+        if not self.isDir(parent):
+            if not parents or self.files.has_key(parent):
+                raise _fault(FileNotFound,file=self.path(parent))
+            self.makeDir(parent,parents)
+        self.dirs[rel] = time.time()
+
+    def remove(self,rel):
+        """
+        Delete a file, or a directory and everything in it
+        """
+        if self.files.has_key(rel):
+            self.used -= self.files.pop(rel).size
+        elif rel and self.dirs.has_key(rel):
+            prefix = rel + "/"
+            for name in self.files.keys():
+                if name.startswith(prefix):
+                    self.used -= self.files.pop(name).size
+            for name in self.dirs.keys():
+                if name == rel or name.startswith(prefix):
+                    del self.dirs[name]
+        else:
+            raise _fault(FileNotFound,file=self.path(rel))
+        self.publish()
+
+    def listing(self,rel):
+        """
+        :return: ([file names],[directory names]) directly in a directory
+        """
+        prefix = ""
+        if rel:
+            prefix = rel + "/"
+        files = [n[len(prefix):] for n in self.files.keys()
+                 if n.startswith(prefix) and "/" not in n[len(prefix):]]
+        dirs = [n[len(prefix):] for n in self.dirs.keys()
+                if n.startswith(prefix) and n != rel and "/" not in n[len(prefix):]]
+        files.sort()
+        dirs.sort()
+        return (files,dirs)
+
+    def subdirs(self,rel):
+        """
+        :return: every directory under a directory
+        """
+        prefix = ""
+        if rel:
+            prefix = rel + "/"
+        found = [n for n in self.dirs.keys() if n.startswith(prefix) and n != rel]
+        found.sort()
+        return found
+
+
+class _View(_Entity):
+    """
+    A ContainerView. Its 'view' is worked out from the inventory when read.
+    """
+    TYPE = "ContainerView"
+    SUPERTYPES = ("ManagedObjectView","View")
+    PROPERTIES = ("container","type","recursive","view")
+
+    def __init__(self,server,key,container,types,recursive):
+        _Entity.__init__(self,server,key)
+        self.container = container
+        self.types = list(types or [])
+        self.recursive = bool(recursive)
+        self.__members = None
+        self.__topology = None
+        self.set("container",container.mor)
+        if self.types:
+            self.set("type",jarray.array(self.types,String))
+        self.set("recursive",self.recursive)
+
+    def members(self):
+        if self.__topology != self.server.topology:
+            found = []
+            seen = {}
+            queue = list(self.container.children())
+            while queue:
+                entity = queue.pop(0)
+                if seen.has_key(entity.key):
+                    continue
+                seen[entity.key] = True
+                if not self.types or [t for t in self.types if entity.isA(t)]:
+                    found.append(entity)
+                if self.recursive:
+                    queue.extend(entity.children())
+            self.__members = found
+            self.__topology = self.server.topology
+        return self.__members
+
+    def rev(self,prop):
+        if prop == "view":
+            return self.server.topology
+        return _Entity.rev(self,prop)
+
+    def get(self,prop):
+        if prop == "view":
+            members = self.members()
+            if members:
+                return _mors(members)
+            return None
+        return _Entity.get(self,prop)
+
+    def refs(self,prop):
+        if prop == "view":
+            return self.members()
+        return _Entity.refs(self,prop)
+
+
+class _Task(_Entity):
+    """
+    A task. Its TaskInfo is rebuilt on every change.
+    """
+    TYPE = "Task"
+    PROPERTIES = ("info",)
+
+    def __init__(self,server,key,name,entity):
+        _Entity.__init__(self,server,key)
+        self.name = name
+        self.entity = entity
+        self.state = "running"
+        self.result = None
+        self.error = None
+        self.cancelled = False
+        self.queued = time.time()
+        self.completed = None
+        self.publish()
+
+    def done(self):
+        return self.state in ("success","error")
+
+    def succeed(self,result=None):
+        self.state = "success"
+        self.result = result
+        self.__finish()
+
+    def fail(self,fault):
+        error = LocalizedMethodFault()
+        error.setFault(fault)
+        error.setLocalizedMessage(fault.getClass().getSimpleName())
+        self.state = "error"
+        self.error = error
+        self.__finish()
+
+    def __finish(self):
+        self.completed = time.time()
+        self.publish()
+        self.server.retire(self)
+
+    def publish(self):
+        info = TaskInfo()
+        info.setKey(self.key)
+        info.setTask(self.mor)
+        info.setName(self.name.split(".")[-1])
+        info.setDescriptionId(self.name)
+        if self.entity is not None:
+            info.setEntity(self.entity.mor)
+            info.setEntityName(self.entity.displayName())
+        info.setState(getattr(TaskInfoState,self.state))
+        info.setCancelled(self.cancelled)
+        info.setCancelable(True)
+        info.setQueueTime(_calendar(self.queued))
+        info.setStartTime(_calendar(self.queued))
+        if self.completed:
+            info.setCompleteTime(_calendar(self.completed))
+        info.setResult(self.result)
+        info.setError(self.error)
+        self.set("info",info)
+
+
+class _Snapshot(_Entity):
+    """
+    A snapshot of a VM. It keeps the VM's disks, settings and, for memory
+    snapshots, its guest network as they were.
+    """
+    TYPE = "VirtualMachineSnapshot"
+    PROPERTIES = ("config","childSnapshot")
+
+    def __init__(self,server,key,vm,name,description,memory,quiesced):
+        _Entity.__init__(self,server,key)
+        vm.snapshot_ids += 1
+        self.id = vm.snapshot_ids
+        self.vm = vm
+        self.name = name
+        self.description = description
+        self.quiesced = bool(quiesced)
+        self.created = time.time()
+        self.memory = memory
+        if memory:
+            self.state = "poweredOn"
+        elif vm.power == "suspended":
+            self.state = "suspended"
+        else:
+            self.state = "poweredOff"
+        self.net = vm.net
+        self.disks = copy.deepcopy(vm.disks)
+        self.extra = dict(vm.extra)
+        self.annotation = vm.annotation
+        self.vmsn = "%s/%s-Snapshot%d.vmsn" % (vm.directory,vm.base,self.id)
+        self.parent = None
+        self.children = []
+
+    def displayName(self):
+        return self.name
+
+    def subtree(self):
+        found = [self]
+        for child in self.children:
+            found.extend(child.subtree())
+        return found
+
+    def publish(self):
+        self.set("config",self.vm.buildConfig(self.disks,self.extra,self.annotation,"1"))
+        self.link("childSnapshot",self.children)
+
+    def tree(self):
+        node = VirtualMachineSnapshotTree()
+        node.setSnapshot(self.mor)
+        node.setVm(self.vm.mor)
+        node.setName(self.name)
+        node.setDescription(self.description)
+        node.setId(self.id)
+        node.setCreateTime(_calendar(self.created))
+        node.setState(getattr(VirtualMachinePowerState,self.state))
+        node.setQuiesced(self.quiesced)
+        if self.children:
+            node.setChildSnapshotList(jarray.array([c.tree() for c in self.children],
+                                                   VirtualMachineSnapshotTree))
+        return node
+
+
+class _VM(_Entity):
+    """
+    A virtual machine. Its settings come from the record kept in its vmx
+    file, and are written back to it on every change.
+    """
+    TYPE = "VirtualMachine"
+    SUPERTYPES = ("ManagedEntity",)
+    PROPERTIES = ("name","parent","resourcePool","datastore","network","runtime","config",
+                  "guest","summary","snapshot","rootSnapshot","layoutEx")
+
+    def __init__(self,server,key,name,path,record):
+        _Entity.__init__(self,server,key)
+        self.name = name
+        self.path = path
+        ds_name,rel = splitPath(path)
+        self.directory = joinPath(ds_name,os.path.dirname(rel))
+        self.base = os.path.splitext(os.path.basename(rel))[0]
+
+        self.uuid = record['uuid']
+        self.memory = record['memory']
+        self.cpus = record['cpus']
+        self.guest_id = record['guestId']
+        self.guest_name = record['guestFullName']
+        self.annotation = record['annotation']
+        self.extra = dict(record['extra'])
+        self.nics = copy.deepcopy(record['nics'])
+        self.disks = copy.deepcopy(record['disks'])
+        for disk in self.disks:
+            if not disk['file'].startswith("["):
+                disk['file'] = self.directory + "/" + disk['file']
+        self.copied = record['origin'] != path
+
+        self.power = "poweredOff"
+        self.boot_time = None
+        self.generation = 0
+        self.tools = False
+        self.net = None
+        self.ip = server.newAddress()
+        self.question = None
+        self.on_answer = None
+        self.roots = []
+        self.current = None
+        self.snapshot_ids = 0
+        self.changes = 0
+
+    def displayName(self):
+        return self.name
+
+    def record(self):
+        """
+        :return: what's kept in the vmx file
+        """
+        disks = copy.deepcopy(self.disks)
+        for disk in disks:
+            if os.path.dirname(disk['file']) == self.directory:
+                disk['file'] = os.path.basename(disk['file'])
+        return {'name':self.name,
+                'uuid':self.uuid,
+                'memory':self.memory,
+                'cpus':self.cpus,
+                'guestId':self.guest_id,
+                'guestFullName':self.guest_name,
+                'annotation':self.annotation,
+                'extra':dict(self.extra),
+                'nics':copy.deepcopy(self.nics),
+                'disks':disks,
+                'origin':self.path}
+
+    def save(self):
+        self.server.write(self.path,VMX_SIZE,self.record())
+
+    def disk(self,key):
+        for disk in self.disks:
+            if disk['key'] == key:
+                return disk
+        return None
+
+    def nic(self,key):
+        for nic in self.nics:
+            if nic['key'] == key:
+                return nic
+        return None
+
+    def snapshots(self):
+        found = []
+        for root in self.roots:
+            found.extend(root.subtree())
+        return found
+
+    def regenerate(self):
+        """
+        Give the VM a new identity, what answering 'I copied it' does
+        """
+        self.uuid = str(uuid.uuid4())
+        for nic in self.nics:
+            nic['mac'] = self.server.newMac()
+
+    # --- Power ---
+
+    def boot(self,delay=None):
+        """
+        Power on. The guest gets its network after boot_time, unless it
+        crashes on the way.
+        """
+        self.power = "poweredOn"
+        self.boot_time = time.time()
+        self.generation += 1
+        self.tools = False
+        self.net = None
+        self.publishRuntime()
+        self.publishGuest()
+        if self.server.crashes():
+            LOG.debug("Simulator: %s crashed while booting" % self.name)
+            return
+        if delay is None:
+            delay = self.server.options['boot_time']
+        self.server.later(delay,self.networkUp,self.generation)
+
+    def restore(self,net):
+        """
+        Power on with the guest running, as saved in a memory snapshot
+        """
+        if net is None:
+            self.boot()
+            return
+        self.power = "poweredOn"
+        self.boot_time = time.time()
+        self.generation += 1
+        self.tools = True
+        self.net = net
+        self.publishRuntime()
+        self.publishGuest()
+
+    def networkUp(self,generation):
+        if generation != self.generation or self.power != "poweredOn":
+            return
+        self.tools = True
+        self.net = self.buildNet()
+        self.publishGuest()
+
+    def halt(self,state="poweredOff"):
+        self.power = state
+        self.boot_time = None
+        self.generation += 1
+        self.tools = False
+        self.net = None
+        self.publishRuntime()
+        self.publishGuest()
+
+    def ask(self,text,choices,callback=None):
+        """
+        Make the VM ask a question
+
+        :param text: the question. ex: 'msg.uuid.moved:...'
+        :param choices: [(key,label)]
+        :param callback: called with the key of the answer
+        """
+        info = VirtualMachineQuestionInfo()
+        info.setId(self.server.newId("question"))
+        info.setText(text)
+        descriptions = []
+        for key,label in choices:
+            d = ElementDescription()
+            d.setKey(key)
+            d.setLabel(label)
+            d.setSummary(label)
+            descriptions.append(d)
+        option = ChoiceOption()
+        option.setChoiceInfo(jarray.array(descriptions,ElementDescription))
+        option.setDefaultIndex(0)
+        info.setChoice(option)
+        self.question = info
+        self.on_answer = callback
+        self.publishRuntime()
+
+    def answer(self,question_id,choice):
+        if self.question is None or str(self.question.getId()) != str(question_id):
+            raise _fault(InvalidArgument,invalidProperty="questionId")
+        keys = [str(c.getKey()) for c in self.question.getChoice().getChoiceInfo()]
+        if str(choice) not in keys:
+            raise _fault(InvalidArgument,invalidProperty="answerChoice")
+        callback = self.on_answer
+        self.question = None
+        self.on_answer = None
+        self.publishRuntime()
+        if callback is not None:
+            callback(str(choice))
+
+    # --- Properties ---
+
+    def publish(self):
+        self.publishConfig()
+        self.publishRuntime()
+        self.publishGuest()
+        self.publishSnapshots()
+        self.publishLayout()
+
+    def publishConfig(self):
+        self.changes += 1
+        self.set("name",self.name)
+        self.set("config",self.buildConfig(self.disks,self.extra,self.annotation,str(self.changes)))
+        datastores = []
+        for path in [self.path] + [d['file'] for d in self.disks]:
+            ds = self.server.datastoreOf(path)
+            if ds is not None and ds not in datastores:
+                datastores.append(ds)
+        self.link("datastore",datastores)
+        self.publishSummary()
+
+    def publishRuntime(self):
+        runtime = VirtualMachineRuntimeInfo()
+        runtime.setHost(self.server.host.mor)
+        runtime.setConnectionState(VirtualMachineConnectionState.connected)
+        runtime.setPowerState(getattr(VirtualMachinePowerState,self.power))
+        runtime.setQuestion(self.question)
+        if self.boot_time:
+            runtime.setBootTime(_calendar(self.boot_time))
+        self.set("runtime",runtime)
+        self.publishSummary()
+
+    def publishGuest(self):
+        guest = GuestInfo()
+        if self.tools:
+            guest.setToolsRunningStatus("guestToolsRunning")
+            guest.setToolsStatus(VirtualMachineToolsStatus.toolsOk)
+            guest.setGuestState("running")
+        else:
+            guest.setToolsRunningStatus("guestToolsNotRunning")
+            guest.setToolsStatus(VirtualMachineToolsStatus.toolsNotRunning)
+            guest.setGuestState("notRunning")
+        guest.setNet(self.net)
+        if self.net:
+            guest.setIpAddress(self.ip)
+            guest.setHostName(self.name.lower())
+        self.set("guest",guest)
+
+    def publishSummary(self):
+        if not self.props.has_key("config") or not self.props.has_key("runtime"):
+            return
+        config = VirtualMachineConfigSummary()
+        config.setName(self.name)
+        config.setTemplate(False)
+        config.setVmPathName(self.path)
+        config.setMemorySizeMB(self.memory)
+        config.setNumCpu(self.cpus)
+        config.setNumEthernetCards(len(self.nics))
+        config.setNumVirtualDisks(len(self.disks))
+        config.setUuid(self.uuid)
+        config.setGuestId(self.guest_id)
+        config.setGuestFullName(self.guest_name)
+        config.setAnnotation(self.annotation)
+        summary = VirtualMachineSummary()
+        summary.setVm(self.mor)
+        summary.setRuntime(self.props["runtime"])
+        summary.setConfig(config)
+        self.set("summary",summary)
+
+    def publishSnapshots(self):
+        if not self.roots:
+            self.set("snapshot",None)
+            self.link("rootSnapshot",None)
+            return
+        info = VirtualMachineSnapshotInfo()
+        if self.current is not None:
+            info.setCurrentSnapshot(self.current.mor)
+        info.setRootSnapshotList(jarray.array([r.tree() for r in self.roots],
+                                              VirtualMachineSnapshotTree))
+        self.set("snapshot",info)
+        self.link("rootSnapshot",self.roots)
+
+    def publishLayout(self):
+        files = []
+        keys = {}
+        def add(path,kind):
+            if not keys.has_key(path):
+                info = VirtualMachineFileLayoutExFileInfo()
+                info.setKey(len(files))
+                info.setName(path)
+                info.setType(kind)
+                info.setSize(long(self.server.sizeOf(path)))
+                keys[path] = len(files)
+                files.append(info)
+            return keys[path]
+
+        add(self.path,"config")
+        if self.extra.get("nvram"):
+            add(self.directory + "/" + self.extra["nvram"],"nvram")
+        if self.extra.get("checkpoint.vmState"):
+            add(self.directory + "/" + self.extra["checkpoint.vmState"],"suspend")
+        if self.server.exists(self.directory + "/vmware.log"):
+            add(self.directory + "/vmware.log","log")
+
+        disks = []
+        for disk in self.disks:
+            chain = []
+            for path in [disk['file']] + disk['parents']:
+                unit = VirtualMachineFileLayoutExDiskUnit()
+                unit.setFileKey(jarray.array([add(path,"diskDescriptor"),
+                                              add(extentOf(path),"diskExtent")],'i'))
+                chain.insert(0,unit)
+            layout = VirtualMachineFileLayoutExDiskLayout()
+            layout.setKey(disk['key'])
+            layout.setChain(jarray.array(chain,VirtualMachineFileLayoutExDiskUnit))
+            disks.append(layout)
+
+        for snap in self.snapshots():
+            if self.server.exists(snap.vmsn):
+                add(snap.vmsn,"snapshotData")
+
+        layout = VirtualMachineFileLayoutEx()
+        layout.setFile(jarray.array(files,VirtualMachineFileLayoutExFileInfo))
+        if disks:
+            layout.setDisk(jarray.array(disks,VirtualMachineFileLayoutExDiskLayout))
+        layout.setTimestamp(_calendar(time.time()))
+        self.set("layoutEx",layout)
+
+    def buildConfig(self,disks,extra,annotation,version):
+        config = VirtualMachineConfigInfo()
+        config.setName(self.name)
+        config.setChangeVersion(version)
+        config.setModified(_calendar(time.time()))
+        config.setGuestId(self.guest_id)
+        config.setGuestFullName(self.guest_name)
+        config.setVersion("vmx-07")
+        config.setUuid(self.uuid)
+        config.setTemplate(False)
+        config.setAnnotation(annotation)
+
+        files = VirtualMachineFileInfo()
+        files.setVmPathName(self.path)
+        files.setSnapshotDirectory(self.directory)
+        files.setSuspendDirectory(self.directory)
+        files.setLogDirectory(self.directory)
+        config.setFiles(files)
+
+        hardware = VirtualHardware()
+        hardware.setNumCPU(self.cpus)
+        hardware.setMemoryMB(self.memory)
+        hardware.setDevice(self.buildDevices(disks))
+        config.setHardware(hardware)
+
+        options = []
+        keys = extra.keys()
+        keys.sort()
+        for key in keys:
+            option = OptionValue()
+            option.setKey(key)
+            option.setValue(extra[key])
+            options.append(option)
+        config.setExtraConfig(jarray.array(options,OptionValue))
+        return config
+
+    def buildDevices(self,disks):
+        devices = []
+        controller = VirtualLsiLogicController()
+        controller.setKey(CONTROLLER_KEY)
+        controller.setDeviceInfo(self.__description("SCSI controller 0","LSI Logic"))
+        controller.setBusNumber(0)
+        controller.setSharedBus(VirtualSCSISharing.noSharing)
+        controller.setDevice(jarray.array([d['key'] for d in disks],'i'))
+        devices.append(controller)
+
+        for d in disks:
+            backing = self.__backing(d['file'],d['parents'])
+            disk = VirtualDisk()
+            disk.setKey(d['key'])
+            disk.setDeviceInfo(self.__description("Hard disk %d" % (d['unit'] + 1),
+                                                  "%d KB" % d['kb']))
+            disk.setBacking(backing)
+            disk.setControllerKey(d['controller'])
+            disk.setUnitNumber(d['unit'])
+            disk.setCapacityInKB(long(d['kb']))
+            devices.append(disk)
+
+        for i in range(len(self.nics)):
+            nic = self.nics[i]
+            backing = VirtualEthernetCardNetworkBackingInfo()
+            backing.setDeviceName(nic['network'])
+            backing.setNetwork(self.server.network.mor)
+            card = VirtualE1000()
+            card.setKey(nic['key'])
+            card.setDeviceInfo(self.__description("Network adapter %d" % (i + 1),nic['network']))
+            card.setBacking(backing)
+            card.setAddressType("generated")
+            card.setMacAddress(nic['mac'])
+            connect = VirtualDeviceConnectInfo()
+            connect.setStartConnected(True)
+            connect.setConnected(self.power == "poweredOn")
+            connect.setAllowGuestControl(True)
+            card.setConnectable(connect)
+            devices.append(card)
+        return jarray.array(devices,VirtualDevice)
+
+    def buildNet(self):
+        nics = []
+        for i in range(len(self.nics)):
+            nic = self.nics[i]
+            ips = [_linkLocal(nic['mac'])]
+            if i == 0:
+                ips.insert(0,self.ip)
+            info = GuestNicInfo()
+            info.setNetwork(nic['network'])
+            info.setMacAddress(nic['mac'])
+            info.setConnected(True)
+            info.setDeviceConfigId(nic['key'])
+            info.setIpAddress(jarray.array(ips,String))
+            nics.append(info)
+        return jarray.array(nics,GuestNicInfo)
+
+    def __backing(self,path,parents):
+        backing = VirtualDiskFlatVer2BackingInfo()
+        backing.setFileName(path)
+        backing.setDiskMode("persistent")
+        backing.setThinProvisioned(False)
+        ds = self.server.datastoreOf(path)
+        if ds is not None:
+            backing.setDatastore(ds.mor)
+        if parents:
+            backing.setParent(self.__backing(parents[0],parents[1:]))
+        return backing
+
+    def __description(self,label,summary):
+        d = Description()
+        d.setLabel(label)
+        d.setSummary(summary)
+        return d
+
+
+class _Session(object):
+    """
+    A login on the simulated server, with its property filters
+    """
+    def __init__(self,server):
+        self.server = server
+        self.key = None
+        self.user = None
+        self.filters = []
+        self.cancelled = False
+        self.version = 0
+
+    def check(self):
+        if self.key is None:
+            raise _fault(NotAuthenticated)
+
+    def login(self,user):
+        self.key = str(uuid.uuid4())
+        self.user = user
+        self.filters = []
+        if self not in self.server.sessions:
+            self.server.sessions.append(self)
+        now = _calendar(time.time())
+        session = UserSession()
+        session.setKey(self.key)
+        session.setUserName(user)
+        session.setFullName(user)
+        session.setLoginTime(now)
+        session.setLastActiveTime(now)
+        session.setLocale("en")
+        session.setMessageLocale("en")
+        return session
+
+    def logout(self):
+        self.expire()
+        if self in self.server.sessions:
+            self.server.sessions.remove(self)
+
+    def expire(self):
+        self.key = None
+        for f in self.filters:
+            self.server.remove(f)
+        self.filters = []
+        self.server.changed()
+
+    def createFilter(self,spec,partial):
+        # Fails now on missing objects and bad properties
+        self.server.collect(spec,True)
+        f = _Filter(self.server,self.server.newId("session[%s]" % self.key),self,spec,partial)
+        self.server.add(f)
+        self.filters.append(f)
+        return f
+
+    def destroyFilter(self,f):
+        if f in self.filters:
+            self.filters.remove(f)
+        self.server.remove(f)
+
+    def cancel(self):
+        self.cancelled = True
+        self.server.changed()
+
+    def waitForUpdates(self,block):
+        """
+        :param block: if True, wait until something changed
+        :return: UpdateSet, or None if nothing changed and block isn't set
+        """
+        while True:
+            self.check()
+            if self.cancelled:
+                self.cancelled = False
+                raise _fault(RequestCanceled)
+            updates = []
+            for f in self.filters:
+                update = f.update()
+                if update is not None:
+                    updates.append(update)
+            if updates:
+                break
+            if not block:
+                return None
+            self.server.cond.wait()
+
+        self.version += 1
+        update_set = UpdateSet()
+        update_set.setVersion(str(self.version))
+        update_set.setFilterSet(jarray.array(updates,PropertyFilterUpdate))
+        return update_set
+
+
+class _Filter(_Entity):
+    """
+    A PropertyFilter. It remembers what it reported of every object, so
+    each update only holds what changed since.
+    """
+    TYPE = "PropertyFilter"
+    PROPERTIES = ("spec","partialUpdates")
+
+    def __init__(self,server,key,session,spec,partial):
+        _Entity.__init__(self,server,key)
+        self.session = session
+        self.spec = spec
+        self.reported = {}
+        self.__objects = None
+        self.__topology = None
+        self.set("spec",spec)
+        self.set("partialUpdates",bool(partial))
+
+    def update(self):
+        """
+        :return: PropertyFilterUpdate, or None if nothing changed
+        """
+        server = self.server
+        if self.__topology != server.topology:
+            self.__objects = server.collect(self.spec,False)
+            self.__topology = server.topology
+
+        updates = []
+        seen = {}
+        for entity,paths in self.__objects:
+            seen[entity.key] = True
+            if self.reported.has_key(entity.key):
+                kind = ObjectUpdateKind.modify
+                known = self.reported[entity.key][1]
+            else:
+                kind = ObjectUpdateKind.enter
+                known = {}
+                self.reported[entity.key] = (entity.mor,known)
+
+            changes = []
+            for path in paths:
+                rev = entity.rev(path.split(".")[0])
+                old = known.get(path)
+                if old is not None and old[0] == rev:
+                    continue
+                value = entity.resolve(path)
+                if old is None or not _same(old[1],value):
+                    if value is not None:
+                        changes.append(self.__change(path,PropertyChangeOp.assign,value))
+                    elif old is not None and old[1] is not None:
+                        changes.append(self.__change(path,PropertyChangeOp.remove,None))
+                known[path] = (rev,value)
+
+            if changes or kind == ObjectUpdateKind.enter:
+                updates.append(self.__objectUpdate(kind,entity.mor,changes))
+
+        for key in self.reported.keys():
+            if not seen.has_key(key):
+                mor,known = self.reported.pop(key)
+                updates.append(self.__objectUpdate(ObjectUpdateKind.leave,mor,[]))
+
+        if not updates:
+            return None
+        update = PropertyFilterUpdate()
+        update.setFilter(self.mor)
+        update.setObjectSet(jarray.array(updates,ObjectUpdate))
+        return update
+
+    def __change(self,path,op,value):
+        change = PropertyChange()
+        change.setName(path)
+        change.setOp(op)
+        change.setVal(value)
+        return change
+
+    def __objectUpdate(self,kind,mor,changes):
+        update = ObjectUpdate()
+        update.setKind(kind)
+        update.setObj(mor)
+        if changes:
+            update.setChangeSet(jarray.array(changes,PropertyChange))
+        return update
+
+
+class _Scheduler(object):
+    """
+    Runs the delayed work of a simulated server (finishing tasks, booting
+    guests) on a background thread
+    """
+    def __init__(self,name):
+        self.__cond = threading.Condition()
+        self.__queue = []
+        self.__seq = 0
+        self.__running = True
+        self.__thread = threading.Thread(target=self.__loop,name=name)
+        self.__thread.setDaemon(True)
+        self.__thread.start()
+
+    def schedule(self,delay,fn,*args):
+        self.__cond.acquire()
+        try:
+            self.__seq += 1
+            heapq.heappush(self.__queue,(time.time() + max(delay,0),self.__seq,fn,args))
+            self.__cond.notifyAll()
+        finally:
+            self.__cond.release()
+
+    def stop(self):
+        self.__cond.acquire()
+        try:
+            self.__running = False
+            self.__cond.notifyAll()
+        finally:
+            self.__cond.release()
+
+    def __loop(self):
+        while True:
+            self.__cond.acquire()
+            try:
+                while self.__running:
+                    if not self.__queue:
+                        self.__cond.wait()
+                        continue
+                    wait = self.__queue[0][0] - time.time()
+                    if wait <= 0:
+                        break
+                    self.__cond.wait(wait)
+                if not self.__running:
+                    return
+                due,seq,fn,args = heapq.heappop(self.__queue)
+            finally:
+                self.__cond.release()
+            try:
+                fn(*args)
+            except:
+                LOG.error("Simulator: %s failed: %s" % (fn,sys.exc_info()[1]))
+
+
+class SimServer(object):
+    """
+    A simulated ESX server: its inventory, sessions and delayed work.
+    Everything is guarded by one lock, 'cond' is signalled on every change.
+    """
+    def __init__(self,host,options):
+        self.host_name = host
+        self.options = options
+        self.url = "https://%s:1/sdk" % host
+        self.lock = threading.RLock()
+        self.cond = threading.Condition(self.lock)
+        self.random = random.Random(options['seed'])
+        self.entities = {}
+        self.sessions = []
+        self.topology = 0
+        self.calls = {}
+        self.__ids = {}
+        self.__macs = 0
+        self.__addresses = 0
+        self.__finished = deque()
+        self.__scheduler = _Scheduler("esx-simulator")
+        self.lock.acquire()
+        try:
+            self.__build()
+        finally:
+            self.lock.release()
+
+    def stop(self):
+        self.__scheduler.stop()
+        self.expireSessions()
+
+    # --- For tests and benchmarks ---
+
+    def callCount(self,method=None):
+        """
+        :param method: (optional) ex: 'retrieveProperties'
+        :return: the number of calls made to the method, or to all of them
+        """
+        self.lock.acquire()
+        try:
+            if method is None:
+                return sum(self.calls.values())
+            return self.calls.get(method,0)
+        finally:
+            self.lock.release()
+
+    def resetCalls(self):
+        self.lock.acquire()
+        try:
+            self.calls = {}
+        finally:
+            self.lock.release()
+
+    def ask(self,name,text,choices=None):
+        """
+        Make a VM ask a question. ex: ask('vm1','msg.disk.adapterMismatch:...')
+
+        :param choices: [(key,label)], by default one 'OK' choice
+        """
+        self.lock.acquire()
+        try:
+            self.vm(name).ask(text,choices or [("0","OK")])
+        finally:
+            self.lock.release()
+
+    def expireSessions(self):
+        """
+        Log every session out, like the server does when it restarts
+        """
+        self.lock.acquire()
+        try:
+            for session in list(self.sessions):
+                session.expire()
+        finally:
+            self.lock.release()
+
+    def vm(self,name):
+        """
+        :return: the _VM named name or None
+        """
+        self.lock.acquire()
+        try:
+            for vm in self.vms():
+                if vm.name == name:
+                    return vm
+            return None
+        finally:
+            self.lock.release()
+
+    def vms(self):
+        return [e for e in self.entities.values() if isinstance(e,_VM)]
+
+    def createVM(self,name,datastore=None):
+        """
+        Make a VM with its files on a datastore and register it
+
+        :param name: the name of the VM and of its directory
+        :param datastore: (optional) the name of the datastore
+        :return: the _VM
+        """
+        self.lock.acquire()
+        try:
+            ds = self.datastores[0]
+            if datastore is not None:
+                ds = self.datastore(datastore)
+            size = self.options['disk_size'] * MB
+            ds.makeDir(name,False)
+            ds.write(name + "/" + name + ".vmdk",DESCRIPTOR_SIZE)
+            ds.write(name + "/" + name + "-flat.vmdk",size)
+            ds.write(name + "/" + name + ".nvram",NVRAM_SIZE)
+            ds.write(name + "/vmware.log",LOG_SIZE)
+            path = ds.path(name + "/" + name + ".vmx")
+            record = {'name':name,
+                      'uuid':str(uuid.uuid4()),
+                      'memory':self.options['memory'],
+                      'cpus':1,
+                      'guestId':"ubuntuGuest",
+                      'guestFullName':"Ubuntu Linux (32-bit)",
+                      'annotation':"",
+                      'extra':{'nvram':name + ".nvram"},
+                      'nics':[{'key':NIC_KEY,'mac':self.newMac(),'network':self.network.displayName()}],
+                      'disks':[{'key':DISK_KEY,'controller':CONTROLLER_KEY,'unit':0,
+                                'file':name + ".vmdk",'parents':[],'kb':size / 1024}],
+                      'origin':path}
+            self.write(path,VMX_SIZE,record)
+            return self.__addVM(name,path,copy.deepcopy(record))
+        finally:
+            self.lock.release()
+
+    # --- Inventory ---
+
+    def __build(self):
+        o = self.options
+        about = AboutInfo()
+        about.setName("VMware ESX")
+        about.setFullName("VMware ESX %s build-171294" % o['version'])
+        about.setVendor("VMware, Inc.")
+        about.setVersion(o['version'])
+        about.setBuild("171294")
+        about.setOsType("vmnix-x86")
+        about.setProductLineId("esx")
+        about.setApiType("HostAgent")
+        about.setApiVersion(".".join(o['version'].split(".")[:2]))
+        self.about = about
+
+        self.root = self.add(_Managed(self,"Folder","ha-folder-root","ha-folder-root",
+                                      ["childEntity","childType"],["childEntity"]))
+        dc = self.add(_Managed(self,"Datacenter","ha-datacenter","ha-datacenter",
+                               ["vmFolder","hostFolder","datastore","network"],
+                               ["vmFolder","hostFolder","datastore","network"]))
+        self.vm_folder = self.add(_Managed(self,"Folder","ha-folder-vm","vm",
+                                           ["childEntity","childType"],["childEntity"]))
+        host_folder = self.add(_Managed(self,"Folder","ha-folder-host","host",
+                                        ["childEntity","childType"],["childEntity"]))
+        compute = self.add(_Managed(self,"ComputeResource","ha-compute-res",self.host_name,
+                                    ["host","resourcePool","datastore","network"],
+                                    ["host","resourcePool"]))
+        self.host = self.add(_Managed(self,"HostSystem","ha-host",self.host_name,
+                                      ["summary","config","vm","datastore","network"]))
+        self.pool = self.add(_Managed(self,"ResourcePool","ha-root-pool","Resources",
+                                      ["owner","resourcePool","vm"],["resourcePool","vm"]))
+        self.network = self.add(_Managed(self,"Network","HaNetwork-VM Network","VM Network",
+                                         ["host","vm"]))
+        self.browser = self.add(_Entity(self,"ha-host-datastorebrowser","HostDatastoreBrowser",
+                                        ["datastore"]))
+        self.datastores = []
+        for i in range(o['datastores']):
+            ds = self.add(_Datastore(self,"ds-%d" % (i + 1),"datastore%d" % (i + 1),
+                                     long(o['capacity']) * GB))
+            ds.link("browser",self.browser)
+            ds.link("host",[self.host])
+            ds.link("parent",dc)
+            self.datastores.append(ds)
+        managers = {}
+        for mo_type,key in [("PropertyCollector","ha-property-collector"),
+                            ("ViewManager","ViewManager"),
+                            ("SessionManager","ha-sessionmgr"),
+                            ("FileManager","ha-nfc-file-manager"),
+                            ("VirtualDiskManager","ha-vdiskmanager")]:
+            managers[mo_type] = self.add(_Entity(self,key,mo_type,[]))
+
+        self.root.link("childEntity",[dc])
+        self.root.set("childType",jarray.array(["Datacenter"],String))
+        dc.link("parent",self.root)
+        dc.link("vmFolder",self.vm_folder)
+        dc.link("hostFolder",host_folder)
+        dc.link("datastore",self.datastores)
+        dc.link("network",[self.network])
+        self.vm_folder.link("parent",dc)
+        self.vm_folder.set("childType",jarray.array(["Folder","VirtualMachine"],String))
+        host_folder.link("parent",dc)
+        host_folder.link("childEntity",[compute])
+        host_folder.set("childType",jarray.array(["Folder","ComputeResource"],String))
+        compute.link("parent",host_folder)
+        compute.link("host",[self.host])
+        compute.link("resourcePool",self.pool)
+        compute.link("datastore",self.datastores)
+        compute.link("network",[self.network])
+        self.host.link("parent",compute)
+        self.host.link("datastore",self.datastores)
+        self.host.link("network",[self.network])
+        self.pool.link("parent",compute)
+        self.pool.link("owner",compute)
+        self.network.link("parent",dc)
+        self.network.link("host",[self.host])
+        self.browser.link("datastore",self.datastores)
+        self.__publishHost()
+
+        content = ServiceContent()
+        content.setRootFolder(self.root.mor)
+        content.setPropertyCollector(managers["PropertyCollector"].mor)
+        content.setViewManager(managers["ViewManager"].mor)
+        content.setSessionManager(managers["SessionManager"].mor)
+        content.setFileManager(managers["FileManager"].mor)
+        content.setVirtualDiskManager(managers["VirtualDiskManager"].mor)
+        content.setAbout(about)
+        self.content = content
+
+        names = [n.strip() for n in o['vm_names'].split(",") if n.strip()]
+        for i in range(o['vms']):
+            names.append("sim-vm-%04d" % (i + 1))
+        for i in range(len(names)):
+            self.createVM(names[i],self.datastores[i % len(self.datastores)].name)
+
+    def __publishHost(self):
+        ip = self.host_name
+        if not re.match(r"^\d+\.\d+\.\d+\.\d+$",ip):
+            ip = "10.0.0.1"
+        config_summary = HostConfigSummary()
+        config_summary.setName(self.host_name)
+        config_summary.setPort(443)
+        config_summary.setProduct(self.about)
+        config_summary.setVmotionEnabled(False)
+        summary = HostListSummary()
+        summary.setHost(self.host.mor)
+        summary.setConfig(config_summary)
+        summary.setRebootRequired(False)
+        self.host.set("summary",summary)
+
+        ip_config = HostIpConfig()
+        ip_config.setDhcp(False)
+        ip_config.setIpAddress(ip)
+        ip_config.setSubnetMask("255.255.255.0")
+        spec = HostVirtualNicSpec()
+        spec.setIp(ip_config)
+        spec.setMac("00:50:56:40:00:01")
+        spec.setPortgroup("Management Network")
+        vnic = HostVirtualNic()
+        vnic.setDevice("vmk0")
+        vnic.setKey("key-vim.host.VirtualNic-vmk0")
+        vnic.setPortgroup("Management Network")
+        vnic.setSpec(spec)
+        network = HostNetworkInfo()
+        network.setVnic(jarray.array([vnic],HostVirtualNic))
+        config = HostConfigInfo()
+        config.setHost(self.host.mor)
+        config.setProduct(self.about)
+        config.setNetwork(network)
+        self.host.set("config",config)
+
+    def add(self,entity):
+        self.entities[entity.key] = entity
+        self.topology += 1
+        self.changed()
+        return entity
+
+    def remove(self,entity):
+        if self.entities.pop(entity.key,None) is not None:
+            self.topology += 1
+            self.changed()
+
+    def lookup(self,mor,mo_type=None):
+        """
+        :return: the entity of a ManagedObjectReference
+        """
+        entity = None
+        if mor is not None:
+            entity = self.entities.get(mor.get_value())
+        if entity is None:
+            raise _fault(ManagedObjectNotFound,obj=mor)
+        if mo_type is not None and not entity.isA(mo_type):
+            raise _fault(NotSupported)
+        return entity
+
+    def datastore(self,name):
+        for ds in self.datastores:
+            if ds.name == name:
+                return ds
+        raise _fault(InvalidDatastore,name=name)
+
+    def datastoreOf(self,path):
+        ds_name,rel = splitPath(path)
+        for ds in self.datastores:
+            if ds.name == ds_name:
+                return ds
+        return None
+
+    def changed(self):
+        """
+        Wake up everyone waiting for updates. The lock must be held.
+        """
+        self.cond.notifyAll()
+
+    def newId(self,prefix):
+        n = self.__ids.get(prefix,0) + 1
+        self.__ids[prefix] = n
+        return "%s%d" % (prefix,n)
+
+    def newMac(self):
+        self.__macs += 1
+        n = self.__macs
+        return "00:50:56:%02x:%02x:%02x" % ((n >> 16) & 0x3f,(n >> 8) & 0xff,n & 0xff)
+
+    def newAddress(self):
+        self.__addresses += 1
+        n = self.__addresses + 1
+        return "10.%d.%d.%d" % ((n >> 16) & 0xff,(n >> 8) & 0xff,n & 0xff)
+
+    def __linkVMs(self):
+        vms = self.vms()
+        vms.sort(lambda a,b: cmp(int(a.key[3:]),int(b.key[3:])))
+        self.vm_folder.link("childEntity",vms)
+        self.pool.link("vm",vms)
+        self.host.link("vm",vms)
+        self.network.link("vm",vms)
+        for ds in self.datastores:
+            ds.link("vm",[vm for vm in vms if ds in vm.refs("datastore")])
+
+    def __addVM(self,name,path,record):
+        vm = _VM(self,self.newId("vm-"),name,path,record)
+        state = vm.extra.get("checkpoint.vmState")
+        if state and self.exists(vm.directory + "/" + state):
+            vm.power = "suspended"
+        self.add(vm)
+        vm.link("parent",self.vm_folder)
+        vm.link("resourcePool",self.pool)
+        vm.link("network",[self.network])
+        vm.publish()
+        self.__linkVMs()
+        return vm
+
+    def __dropVM(self,vm):
+        for snap in vm.snapshots():
+            self.remove(snap)
+        self.remove(vm)
+        self.__linkVMs()
+
+    # --- Files ---
+
+    def resolvePath(self,path):
+        """
+        :return: (_Datastore,relative path)
+        """
+        ds_name,rel = splitPath(path)
+        if ds_name is None:
+            raise _fault(FileNotFound,file=path)
+        return (self.datastore(ds_name),rel)
+
+    def exists(self,path):
+        ds = self.datastoreOf(path)
+        return ds is not None and ds.exists(splitPath(path)[1])
+
+    def sizeOf(self,path):
+        ds = self.datastoreOf(path)
+        if ds is None:
+            return 0
+        f = ds.files.get(splitPath(path)[1])
+        if f is None:
+            return 0
+        return f.size
+
+    def write(self,path,size,content=None):
+        ds,rel = self.resolvePath(path)
+        return ds.write(rel,size,content)
+
+    def delete(self,path,missing_ok=False):
+        ds,rel = self.resolvePath(path)
+        if missing_ok and not ds.exists(rel):
+            return
+        ds.remove(rel)
+
+    def copyTime(self,size):
+        """
+        :return: the seconds a copy of size bytes takes
+        """
+        rate = self.options['copy_rate']
+        if rate <= 0:
+            return 0.0
+        return float(size) / (rate * MB)
+
+    # --- Timing ---
+
+    def delay(self,seconds):
+        """
+        :return: seconds, varied by the jitter
+        """
+        if seconds <= 0:
+            return 0.0
+        jitter = self.options['jitter']
+        if not jitter:
+            return seconds
+        self.lock.acquire()
+        try:
+            return max(0.0,seconds * (1.0 + self.random.uniform(-jitter,jitter)))
+        finally:
+            self.lock.release()
+
+    def crashes(self):
+        """
+        :return: True if a boot should never get a network
+        """
+        rate = self.options['bsod_rate']
+        return rate > 0 and self.random.random() < rate
+
+    def count(self,method):
+        self.lock.acquire()
+        try:
+            self.calls[method] = self.calls.get(method,0) + 1
+        finally:
+            self.lock.release()
+
+    def later(self,seconds,fn,*args):
+        """
+        Call fn(*args) with the lock held after about 'seconds'
+        """
+        self.__scheduler.schedule(self.delay(seconds),self.__locked,fn,args)
+
+    def __locked(self,fn,args):
+        self.lock.acquire()
+        try:
+            fn(*args)
+        finally:
+            self.lock.release()
+
+    # --- Tasks ---
+
+    def startTask(self,name,entity,work,args=(),duration=0.0):
+        """
+        Start a task that calls work(task,*args) when it's done. work returns
+        the task result, PENDING if it finishes the task itself later, or
+        raises a fault.
+
+        :return: the Task's ManagedObjectReference
+        """
+        task = self.add(_Task(self,self.newId("task-"),name,entity))
+        self.later(self.options['task_time'] + duration,self.__runTask,task,work,args)
+        return task.mor
+
+    def __runTask(self,task,work,args):
+        if task.done():
+            return
+        try:
+            result = work(task,*args)
+        except MethodFault, fault:
+            task.fail(fault)
+            return
+        if result is not PENDING:
+            task.succeed(result)
+
+    def retire(self,task):
+        self.__finished.append(task)
+        while len(self.__finished) > TASK_HISTORY:
+            self.remove(self.__finished.popleft())
+
+    def cancelTask(self,task):
+        if task.done():
+            raise _fault(InvalidState)
+        task.cancelled = True
+        for vm in self.vms():
+            if vm.on_answer is not None and getattr(vm.on_answer,"task",None) is task:
+                vm.question = None
+                vm.on_answer = None
+                vm.publishRuntime()
+        task.fail(_fault(RequestCanceled))
+
+    # --- PropertyCollector ---
+
+    def collect(self,spec,strict):
+        """
+        Work out which objects and properties a PropertyFilterSpec selects
+
+        :param strict: if True, missing objects and unknown properties
+                       are faults, otherwise missing objects are left out
+        :return: [(entity,[paths])]
+        """
+        named = {}
+        def index(selects):
+            for s in selects or []:
+                if isinstance(s,TraversalSpec) and s.getName() and not named.has_key(s.getName()):
+                    named[s.getName()] = s
+                    index(s.getSelectSet())
+        for obj_spec in spec.getObjectSet() or []:
+            index(obj_spec.getSelectSet())
+
+        found = []
+        selected = {}
+        visited = {}
+        def visit(entity,selects,skip):
+            if not skip and not selected.has_key(entity.key):
+                selected[entity.key] = True
+                found.append(entity)
+            for s in selects or []:
+                traversal = s
+                if not isinstance(s,TraversalSpec):
+                    traversal = named.get(s.getName())
+                if traversal is None:
+                    continue
+                mark = (entity.key,traversal.getName() or id(traversal))
+                if visited.has_key(mark) or not entity.isA(traversal.getType()):
+                    continue
+                visited[mark] = True
+                for child in entity.refs(traversal.getPath()):
+                    visit(child,traversal.getSelectSet(),traversal.getSkip())
+
+        for obj_spec in spec.getObjectSet() or []:
+            mor = obj_spec.getObj()
+            entity = self.entities.get(mor.get_value())
+            if entity is None:
+                if strict:
+                    raise _fault(ManagedObjectNotFound,obj=mor)
+                continue
+            visit(entity,obj_spec.getSelectSet(),obj_spec.getSkip())
+
+        results = []
+        for entity in found:
+            paths = []
+            matched = False
+            for prop_spec in spec.getPropSet() or []:
+                if not entity.isA(prop_spec.getType()):
+                    continue
+                matched = True
+                if prop_spec.getAll():
+                    wanted = entity.PROPERTIES
+                else:
+                    wanted = prop_spec.getPathSet() or []
+                for path in wanted:
+                    if strict and not entity.has(path):
+                        raise _fault(InvalidProperty,name=path)
+                    if path not in paths:
+                        paths.append(path)
+            if matched:
+                results.append((entity,paths))
+        return results
+
+    def retrieve(self,specs):
+        """
+        :return: ObjectContent[] or None
+        """
+        contents = []
+        for spec in specs:
+            for entity,paths in self.collect(spec,True):
+                props = []
+                for path in paths:
+                    value = entity.resolve(path)
+                    if value is not None:
+                        dp = DynamicProperty()
+                        dp.setName(path)
+                        dp.setVal(value)
+                        props.append(dp)
+                oc = ObjectContent()
+                oc.setObj(entity.mor)
+                if props:
+                    oc.setPropSet(jarray.array(props,DynamicProperty))
+                contents.append(oc)
+        if not contents:
+            return None
+        return jarray.array(contents,ObjectContent)
+
+    def createView(self,container,types,recursive):
+        return self.add(_View(self,self.newId("session[view]"),container,types,recursive))
+
+    # --- VirtualMachine ---
+
+    def registerVM(self,task,path,name):
+        ds,rel = self.resolvePath(path)
+        f = ds.file(rel)
+        if not isinstance(f.content,dict):
+            raise _fault(InvalidArgument,invalidProperty="path")
+        for vm in self.vms():
+            if vm.path == path:
+                raise _fault(AlreadyExists,name=path)
+        if not name:
+            name = f.content['name']
+        other = self.vm(name)
+        if other is not None:
+            raise _fault(DuplicateName,name=name,object=other.mor)
+        return self.__addVM(name,path,copy.deepcopy(f.content)).mor
+
+    def unregisterVM(self,vm):
+        if vm.power == "poweredOn":
+            raise _fault(InvalidPowerState,requestedState=VirtualMachinePowerState.poweredOff,
+                         existingState=VirtualMachinePowerState.poweredOn)
+        self.__dropVM(vm)
+
+    def destroyVM(self,task,vm):
+        self.unregisterVM(vm)
+        for disk in vm.disks:
+            self.delete(disk['file'],True)
+            self.delete(extentOf(disk['file']),True)
+        self.delete(vm.directory,True)
+
+    def powerOn(self,task,vm):
+        if vm.power == "poweredOn":
+            raise _fault(InvalidPowerState,requestedState=VirtualMachinePowerState.poweredOn,
+                         existingState=VirtualMachinePowerState.poweredOn)
+        for disk in vm.disks:
+            for path in [disk['file']] + disk['parents']:
+                if not self.exists(path):
+                    raise _fault(FileNotFound,file=path)
+        if vm.copied:
+            action = vm.extra.get("uuid.action")
+            if action in ("create","keep"):
+                self.__identify(vm,action == "create")
+            else:
+                def answered(choice):
+                    if task.done():
+                        return
+                    if choice == "0":
+                        task.fail(_fault(InvalidState))
+                        return
+                    self.__identify(vm,choice == "2")
+                    self.__start(vm)
+                    task.succeed()
+                answered.task = task
+                vm.ask(UUID_QUESTION,UUID_CHOICES,answered)
+                return PENDING
+        self.__start(vm)
+
+    def __identify(self,vm,new):
+        if new:
+            vm.regenerate()
+        vm.copied = False
+        vm.save()
+        vm.publishConfig()
+
+    def __start(self,vm):
+        state = vm.extra.pop("checkpoint.vmState",None)
+        if vm.power == "suspended" and state:
+            self.delete(vm.directory + "/" + state,True)
+            vm.save()
+            vm.publishConfig()
+            vm.publishLayout()
+            vm.boot(self.options['boot_time'] / 4)
+        else:
+            vm.boot()
+
+    def powerOff(self,task,vm):
+        if vm.power == "poweredOff":
+            raise _fault(InvalidPowerState,requestedState=VirtualMachinePowerState.poweredOff,
+                         existingState=VirtualMachinePowerState.poweredOff)
+        state = vm.extra.pop("checkpoint.vmState",None)
+        if state:
+            self.delete(vm.directory + "/" + state,True)
+            vm.save()
+            vm.publishConfig()
+            vm.publishLayout()
+        vm.halt()
+
+    def suspend(self,task,vm):
+        if vm.power != "poweredOn":
+            raise _fault(InvalidPowerState,requestedState=VirtualMachinePowerState.suspended,
+                         existingState=getattr(VirtualMachinePowerState,vm.power))
+        state = vm.base + ".vmss"
+        self.write(vm.directory + "/" + state,vm.memory * MB)
+        vm.extra["checkpoint.vmState"] = state
+        vm.save()
+        vm.halt("suspended")
+        vm.publishConfig()
+        vm.publishLayout()
+
+    def reset(self,task,vm):
+        if vm.power != "poweredOn":
+            raise _fault(InvalidPowerState,requestedState=VirtualMachinePowerState.poweredOn,
+                         existingState=getattr(VirtualMachinePowerState,vm.power))
+        vm.boot()
+
+    def rebootGuest(self,vm):
+        if vm.power != "poweredOn" or not vm.tools:
+            raise _fault(ToolsUnavailable)
+        vm.boot()
+
+    def shutdownGuest(self,vm):
+        if vm.power != "poweredOn" or not vm.tools:
+            raise _fault(ToolsUnavailable)
+        generation = vm.generation
+        def down():
+            if vm.generation == generation:
+                vm.halt()
+        self.later(self.options['boot_time'],down)
+
+    def answer(self,vm,question_id,choice):
+        vm.answer(question_id,choice)
+
+    def reconfigure(self,task,vm,spec):
+        name = spec.getName()
+        if name and name != vm.name:
+            other = self.vm(name)
+            if other is not None:
+                raise _fault(DuplicateName,name=name,object=other.mor)
+            vm.name = name
+        if spec.getAnnotation() is not None:
+            vm.annotation = spec.getAnnotation()
+        if spec.getMemoryMB():
+            vm.memory = int(spec.getMemoryMB())
+        if spec.getNumCPUs():
+            vm.cpus = int(spec.getNumCPUs())
+        for option in spec.getExtraConfig() or []:
+            value = option.getValue()
+            if value is None or str(value) == "":
+                vm.extra.pop(option.getKey(),None)
+            else:
+                vm.extra[option.getKey()] = str(value)
+        for change in spec.getDeviceChange() or []:
+            self.__changeDevice(vm,change)
+        vm.save()
+        vm.publishConfig()
+        vm.publishLayout()
+        self.__linkVMs()
+
+    def __changeDevice(self,vm,change):
+        op = str(change.getOperation())
+        device = change.getDevice()
+        disk = vm.disk(device.getKey())
+        nic = vm.nic(device.getKey())
+        if op == "edit" and disk is not None:
+            backing = device.getBacking()
+            disk['file'] = backing.getFileName()
+            parents = []
+            parent = getattr(backing,"getParent",lambda: None)()
+            while parent is not None:
+                parents.append(parent.getFileName())
+                parent = parent.getParent()
+            disk['parents'] = parents
+            if device.getCapacityInKB():
+                disk['kb'] = long(device.getCapacityInKB())
+        elif op == "edit" and nic is not None:
+            if device.getMacAddress():
+                nic['mac'] = device.getMacAddress()
+        elif op == "remove" and disk is not None:
+            vm.disks.remove(disk)
+        elif op == "remove" and nic is not None:
+            vm.nics.remove(nic)
+        else:
+            raise _fault(NotSupported)
+
+    # --- Snapshots ---
+
+    def createSnapshot(self,task,vm,name,description,memory,quiesce):
+        if vm.question is not None:
+            raise _fault(InvalidState)
+        memory = bool(memory) and vm.power == "poweredOn"
+        snap = _Snapshot(self,self.newId("snapshot-"),vm,name,description,memory,quiesce)
+        size = VMSN_SIZE
+        if memory:
+            size += vm.memory * MB
+        self.write(snap.vmsn,size)
+        for disk in vm.disks:
+            self.__newDelta(vm,disk)
+
+        snap.parent = vm.current
+        if snap.parent is not None:
+            snap.parent.children.append(snap)
+        else:
+            vm.roots.append(snap)
+        vm.current = snap
+        self.add(snap)
+        snap.publish()
+        if snap.parent is not None:
+            snap.parent.publish()
+        vm.save()
+        vm.publishConfig()
+        vm.publishSnapshots()
+        vm.publishLayout()
+        return snap.mor
+
+    def __newDelta(self,vm,disk):
+        """
+        Put a new delta disk in the VM's directory on top of a disk
+        """
+        name = os.path.splitext(os.path.basename(disk['file']))[0]
+        name = re.sub(r"-\d{6}$","",name)
+        n = 1
+        while True:
+            path = "%s/%s-%06d.vmdk" % (vm.directory,name,n)
+            if not self.exists(path):
+                break
+            n += 1
+        self.write(path,DESCRIPTOR_SIZE)
+        self.write(extentOf(path),DELTA_SIZE)
+        disk['parents'] = [disk['file']] + disk['parents']
+        disk['file'] = path
+
+    def revertToSnapshot(self,task,snap,suppress_power_on):
+        vm = snap.vm
+        if vm.question is not None:
+            raise _fault(InvalidState)
+        # The current deltas go, unless a snapshot still uses them
+        kept = {}
+        for s in vm.snapshots():
+            for disk in s.disks:
+                for path in [disk['file']] + disk['parents']:
+                    kept[path] = True
+        for disk in vm.disks:
+            if not kept.has_key(disk['file']) and DELTA_DISK.search(disk['file']):
+                self.delete(disk['file'],True)
+                self.delete(extentOf(disk['file']),True)
+
+        vm.disks = copy.deepcopy(snap.disks)
+        vm.extra = dict(snap.extra)
+        vm.annotation = snap.annotation
+        for disk in vm.disks:
+            self.__newDelta(vm,disk)
+        vm.current = snap
+        vm.save()
+
+        if snap.state == "poweredOn" and not suppress_power_on:
+            vm.restore(snap.net)
+        elif snap.state == "poweredOn":
+            vm.halt("suspended")
+        else:
+            vm.halt(snap.state)
+        vm.publishConfig()
+        vm.publishSnapshots()
+        vm.publishLayout()
+
+    def revertToCurrent(self,task,vm,suppress_power_on):
+        if vm.current is None:
+            raise _fault(InvalidState)
+        return self.revertToSnapshot(task,vm.current,suppress_power_on)
+
+    def removeSnapshot(self,task,snap,remove_children):
+        vm = snap.vm
+        siblings = vm.roots
+        if snap.parent is not None:
+            siblings = snap.parent.children
+        index = siblings.index(snap)
+        if remove_children:
+            gone = snap.subtree()
+            siblings[index:index + 1] = []
+        else:
+            gone = [snap]
+            siblings[index:index + 1] = snap.children
+            for child in snap.children:
+                child.parent = snap.parent
+        for s in gone:
+            self.delete(s.vmsn,True)
+            self.remove(s)
+        if vm.current in gone:
+            vm.current = snap.parent
+        if snap.parent is not None:
+            snap.parent.publish()
+        vm.publishSnapshots()
+        vm.publishLayout()
+
+    def removeAllSnapshots(self,task,vm):
+        for root in list(vm.roots):
+            self.removeSnapshot(task,root,True)
+
+    def renameSnapshot(self,snap,name,description):
+        if name:
+            snap.name = name
+        if description is not None:
+            snap.description = description
+        snap.vm.publishSnapshots()
+
+    # --- FileManager, VirtualDiskManager and datastore browser ---
+
+    def makeDirectory(self,path,parents):
+        ds,rel = self.resolvePath(path)
+        ds.makeDir(rel,parents)
+
+    def deleteFile(self,task,path):
+        self.delete(path)
+
+    def copyFile(self,task,src,dst,force):
+        sds,srel = self.resolvePath(src)
+        f = sds.file(srel)
+        dds,drel = self.resolvePath(dst)
+        if dds.exists(drel) and (not force or dds.isDir(drel)):
+            raise _fault(FileAlreadyExists,file=dst)
+        dds.write(drel,f.size,copy.deepcopy(f.content))
+
+    def moveFile(self,task,src,dst,force):
+        self.copyFile(task,src,dst,force)
+        self.delete(src)
+
+    def copyDisk(self,task,src,dst,spec,force):
+        if spec is not None and spec.getAdapterType() not in ("ide","busLogic","lsiLogic"):
+            raise _fault(InvalidArgument,invalidProperty="adapterType")
+        sds,srel = self.resolvePath(src)
+        sds.file(srel)
+        if self.exists(dst) and not force:
+            raise _fault(FileAlreadyExists,file=dst)
+        self.write(dst,DESCRIPTOR_SIZE)
+        self.write(extentOf(dst),self.sizeOf(extentOf(src)))
+
+    def deleteDisk(self,task,path):
+        self.delete(path)
+        self.delete(extentOf(path),True)
+
+    def search(self,task,path,spec,recursive):
+        ds,rel = self.resolvePath(path)
+        if not ds.isDir(rel):
+            raise _fault(FileNotFound,file=path)
+        patterns = []
+        details = None
+        if spec is not None:
+            patterns = list(spec.getMatchPattern() or [])
+            details = spec.getDetails()
+
+        folders = [rel]
+        if recursive:
+            folders.extend(ds.subdirs(rel))
+        results = []
+        for folder in folders:
+            files,dirs = ds.listing(folder)
+            infos = []
+            for name in dirs:
+                info = FolderFileInfo()
+                info.setPath(name)
+                infos.append(info)
+            for name in files:
+                if patterns and not [p for p in patterns if fnmatch.fnmatch(name,p)]:
+                    continue
+                f = ds.files[(folder and folder + "/" or "") + name]
+                info = FileInfo()
+                info.setPath(name)
+                if details is not None and _property(details,"fileSize","fileSize"):
+                    info.setFileSize(Long(f.size))
+                if details is not None and _property(details,"modification","modification"):
+                    info.setModification(_calendar(f.modified))
+                infos.append(info)
+            result = HostDatastoreBrowserSearchResults()
+            result.setDatastore(ds.mor)
+            result.setFolderPath(ds.path(folder))
+            if infos:
+                result.setFile(jarray.array(infos,FileInfo))
+            results.append(result)
+
+        if not recursive:
+            return results[0]
+        found = ArrayOfHostDatastoreBrowserSearchResults()
+        found.setHostDatastoreBrowserSearchResults(jarray.array(results,HostDatastoreBrowserSearchResults))
+        return found
+
+
+class _SimService(VimPortType):
+    """
+    The VimPortType of a session on a simulated server. Every method
+    counts the call, waits the latency and checks the session is logged
+    in, then does the work with the server's lock held.
+    """
+    def __init__(self,server):
+        VimPortType.__init__(self,server.url,False)
+        self.server = server
+        self.session = _Session(server)
+
+    def __enter(self,method,auth=True):
+        server = self.server
+        server.count(method)
+        delay = server.delay(server.options['latency'])
+        if delay > 0:
+            time.sleep(delay)
+        if auth:
+            self.session.check()
+        server.lock.acquire()
+
+    def __exit(self):
+        self.server.lock.release()
+
+    def __task(self,method,_this,mo_type,name,work,args=(),duration=None):
+        """
+        Start a task on the entity of _this. work gets (task,entity,*args).
+        duration, if given, is called with the entity for the extra
+        seconds the task takes.
+        """
+        self.__enter(method)
+        try:
+            entity = self.server.lookup(_this,mo_type)
+            seconds = 0.0
+            if duration is not None:
+                seconds = duration(entity)
+            return self.server.startTask(name,entity,work,(entity,) + tuple(args),seconds)
+        finally:
+            self.__exit()
+
+    # --- ServiceInstance, SessionManager ---
+
+    def retrieveServiceContent(self,_this):
+        self.__enter("retrieveServiceContent",False)
+        try:
+            return self.server.content
+        finally:
+            self.__exit()
+
+    def currentTime(self,_this):
+        self.__enter("currentTime")
+        try:
+            return _calendar(time.time())
+        finally:
+            self.__exit()
+
+    def login(self,_this,userName,password,locale):
+        self.__enter("login",False)
+        try:
+            options = self.server.options
+            if options['user'] and (userName != options['user'] or password != options['password']):
+                raise _fault(InvalidLogin)
+            return self.session.login(userName)
+        finally:
+            self.__exit()
+
+    def logout(self,_this):
+        self.__enter("logout")
+        try:
+            self.session.logout()
+        finally:
+            self.__exit()
+
+    # --- PropertyCollector, ViewManager ---
+
+    def retrieveProperties(self,_this,specSet):
+        self.__enter("retrieveProperties")
+        try:
+            return self.server.retrieve(specSet)
+        finally:
+            self.__exit()
+
+    def createFilter(self,_this,spec,partialUpdates):
+        self.__enter("createFilter")
+        try:
+            return self.session.createFilter(spec,partialUpdates).mor
+        finally:
+            self.__exit()
+
+    def destroyPropertyFilter(self,_this):
+        self.__enter("destroyPropertyFilter")
+        try:
+            self.session.destroyFilter(self.server.lookup(_this))
+        finally:
+            self.__exit()
+
+    def waitForUpdates(self,_this,version):
+        self.__enter("waitForUpdates")
+        try:
+            return self.session.waitForUpdates(True)
+        finally:
+            self.__exit()
+
+    def checkForUpdates(self,_this,version):
+        self.__enter("checkForUpdates")
+        try:
+            return self.session.waitForUpdates(False)
+        finally:
+            self.__exit()
+
+    def cancelWaitForUpdates(self,_this):
+        self.__enter("cancelWaitForUpdates")
+        try:
+            self.session.cancel()
+        finally:
+            self.__exit()
+
+    def createContainerView(self,_this,container,type,recursive):
+        self.__enter("createContainerView")
+        try:
+            return self.server.createView(self.server.lookup(container),type,recursive).mor
+        finally:
+            self.__exit()
+
+    def destroyView(self,_this):
+        self.__enter("destroyView")
+        try:
+            self.server.remove(self.server.lookup(_this,"ContainerView"))
+        finally:
+            self.__exit()
+
+    # --- Folder, VirtualMachine ---
+
+    def registerVM_Task(self,_this,path,name,asTemplate,pool,host):
+        return self.__task("registerVM_Task",_this,"Folder","Folder.registerVm",
+                           lambda task,folder: self.server.registerVM(task,path,name))
+
+    def unregisterVM(self,_this):
+        self.__enter("unregisterVM")
+        try:
+            self.server.unregisterVM(self.server.lookup(_this,"VirtualMachine"))
+        finally:
+            self.__exit()
+
+    def destroy_Task(self,_this):
+        return self.__task("destroy_Task",_this,"VirtualMachine","VirtualMachine.destroy",
+                           self.server.destroyVM)
+
+    def powerOnVM_Task(self,_this,host):
+        return self.__task("powerOnVM_Task",_this,"VirtualMachine","VirtualMachine.powerOn",
+                           self.server.powerOn)
+
+    def powerOffVM_Task(self,_this):
+        return self.__task("powerOffVM_Task",_this,"VirtualMachine","VirtualMachine.powerOff",
+                           self.server.powerOff)
+
+    def suspendVM_Task(self,_this):
+        return self.__task("suspendVM_Task",_this,"VirtualMachine","VirtualMachine.suspend",
+                           self.server.suspend)
+
+    def resetVM_Task(self,_this):
+        return self.__task("resetVM_Task",_this,"VirtualMachine","VirtualMachine.reset",
+                           self.server.reset)
+
+    def rebootGuest(self,_this):
+        self.__enter("rebootGuest")
+        try:
+            self.server.rebootGuest(self.server.lookup(_this,"VirtualMachine"))
+        finally:
+            self.__exit()
+
+    def shutdownGuest(self,_this):
+        self.__enter("shutdownGuest")
+        try:
+            self.server.shutdownGuest(self.server.lookup(_this,"VirtualMachine"))
+        finally:
+            self.__exit()
+
+    def answerVM(self,_this,questionId,answerChoice):
+        self.__enter("answerVM")
+        try:
+            self.server.answer(self.server.lookup(_this,"VirtualMachine"),questionId,answerChoice)
+        finally:
+            self.__exit()
+
+    def reconfigVM_Task(self,_this,spec):
+        return self.__task("reconfigVM_Task",_this,"VirtualMachine","VirtualMachine.reconfigure",
+                           self.server.reconfigure,(spec,))
+
+    # --- Snapshots ---
+
+    def createSnapshot_Task(self,_this,name,description,memory,quiesce):
+        return self.__task("createSnapshot_Task",_this,"VirtualMachine","VirtualMachine.createSnapshot",
+                           self.server.createSnapshot,(name,description,memory,quiesce))
+
+    def revertToCurrentSnapshot_Task(self,_this,host,suppressPowerOn=None):
+        return self.__task("revertToCurrentSnapshot_Task",_this,"VirtualMachine",
+                           "VirtualMachine.revertToCurrentSnapshot",
+                           self.server.revertToCurrent,(suppressPowerOn,))
+
+    def removeAllSnapshots_Task(self,_this):
+        return self.__task("removeAllSnapshots_Task",_this,"VirtualMachine",
+                           "VirtualMachine.removeAllSnapshots",self.server.removeAllSnapshots)
+
+    def revertToSnapshot_Task(self,_this,host,suppressPowerOn=None):
+        return self.__task("revertToSnapshot_Task",_this,"VirtualMachineSnapshot",
+                           "VirtualMachineSnapshot.revert",
+                           self.server.revertToSnapshot,(suppressPowerOn,))
+
+    def removeSnapshot_Task(self,_this,removeChildren):
+        return self.__task("removeSnapshot_Task",_this,"VirtualMachineSnapshot",
+                           "VirtualMachineSnapshot.remove",
+                           self.server.removeSnapshot,(removeChildren,))
+
+    def renameSnapshot(self,_this,name,description):
+        self.__enter("renameSnapshot")
+        try:
+            self.server.renameSnapshot(self.server.lookup(_this,"VirtualMachineSnapshot"),name,description)
+        finally:
+            self.__exit()
+
+    # --- Task ---
+
+    def cancelTask(self,_this):
+        self.__enter("cancelTask")
+        try:
+            self.server.cancelTask(self.server.lookup(_this,"Task"))
+        finally:
+            self.__exit()
+
+    # --- FileManager, VirtualDiskManager, HostDatastoreBrowser ---
+
+    def makeDirectory(self,_this,name,datacenter,createParentDirectories):
+        self.__enter("makeDirectory")
+        try:
+            self.server.makeDirectory(name,createParentDirectories)
+        finally:
+            self.__exit()
+
+    def deleteDatastoreFile_Task(self,_this,name,datacenter):
+        return self.__task("deleteDatastoreFile_Task",_this,"FileManager",
+                           "FileManager.deleteFile",
+                           lambda task,manager: self.server.deleteFile(task,name))
+
+    def copyDatastoreFile_Task(self,_this,sourceName,sourceDatacenter,
+                               destinationName,destinationDatacenter,force):
+        return self.__task("copyDatastoreFile_Task",_this,"FileManager","FileManager.copyFile",
+                           lambda task,manager: self.server.copyFile(task,sourceName,destinationName,force),
+                           duration=lambda manager: self.server.copyTime(self.server.sizeOf(sourceName)))
+
+    def moveDatastoreFile_Task(self,_this,sourceName,sourceDatacenter,
+                               destinationName,destinationDatacenter,force):
+        return self.__task("moveDatastoreFile_Task",_this,"FileManager","FileManager.moveFile",
+                           lambda task,manager: self.server.moveFile(task,sourceName,destinationName,force))
+
+    def copyVirtualDisk_Task(self,_this,sourceName,sourceDatacenter,destName,destDatacenter,
+                             destSpec,force):
+        return self.__task("copyVirtualDisk_Task",_this,"VirtualDiskManager",
+                           "VirtualDiskManager.copyVirtualDisk",
+                           lambda task,manager: self.server.copyDisk(task,sourceName,destName,destSpec,force),
+                           duration=lambda manager: self.server.copyTime(self.server.sizeOf(extentOf(sourceName))))
+
+    def deleteVirtualDisk_Task(self,_this,name,datacenter):
+        return self.__task("deleteVirtualDisk_Task",_this,"VirtualDiskManager",
+                           "VirtualDiskManager.deleteVirtualDisk",
+                           lambda task,manager: self.server.deleteDisk(task,name))
+
+    def searchDatastore_Task(self,_this,datastorePath,searchSpec):
+        return self.__task("searchDatastore_Task",_this,"HostDatastoreBrowser",
+                           "HostDatastoreBrowser.search",
+                           lambda task,browser: self.server.search(task,datastorePath,searchSpec,False))
+
+    def searchDatastoreSubFolders_Task(self,_this,datastorePath,searchSpec):
+        return self.__task("searchDatastoreSubFolders_Task",_this,"HostDatastoreBrowser",
+                           "HostDatastoreBrowser.searchSubFolders",
+                           lambda task,browser: self.server.search(task,datastorePath,searchSpec,True))
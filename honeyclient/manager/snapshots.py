@@ -0,0 +1,250 @@
+"""
+An index over a VM's snapshot tree.
+
+revertVM, renameSnapshotVM and removeSnapshotVM all need to turn a snapshot
+name into a snapshot MOR. Rather than fetching the tree and walking it on
+every call, the tree is fetched once and flattened into a SnapshotIndex,
+which is cached per session (see cache.getSnapshotCache). A SnapshotWatcher
+watches the 'snapshot' property of each cached VM on the session's
+UpdateChannel, so a snapshot taken, removed or renamed through another
+session (ex: another member of a SessionPool) replaces the cached index
+without a round trip each time the index is used. The esx snapshot
+operations also drop the index once their task is done.
+
+Snapshot names don't have to be unique. Like the old recursive search,
+find() returns the first match in depth first order.
+"""
+
+import threading
+
+
+class SnapshotNode(object):
+    """
+    One snapshot in the tree
+    """
+    def __init__(self,name,mor,parent,depth,created=None,description=None):
+        self.name = name
+        self.mor = mor
+        self.parent = parent
+        self.depth = depth
+        self.created = created
+        self.description = description
+        self.children = []
+
+    def toDict(self):
+        """
+        :return: the node as a plain dict, with parent/children as names
+        """
+        parent = None
+        if self.parent:
+            parent = self.parent.name
+        return {'name':self.name,
+                'parent':parent,
+                'children':[c.name for c in self.children],
+                'depth':self.depth,
+                'created':self.created,
+                'description':self.description}
+
+
+class SnapshotIndex(object):
+    """
+    A flattened VirtualMachineSnapshotInfo
+    """
+    def __init__(self,snapshot_info):
+        """
+        :param snapshot_info: the value of the VM's 'snapshot' property (may be None)
+        """
+        self.roots = []
+        self.nodes = []
+        self.current = None
+        self.__by_name = {}
+
+        if not snapshot_info:
+            return
+
+        self.current = snapshot_info.getCurrentSnapshot()
+        tree = snapshot_info.getRootSnapshotList()
+        if tree:
+            for item in tree:
+                self.roots.append(self.__add(item,None,0))
+
+    def __add(self,item,parent,depth):
+        node = SnapshotNode(item.getName(),item.getSnapshot(),parent,depth,
+                            item.getCreateTime(),item.getDescription())
+        self.nodes.append(node)
+        if not self.__by_name.has_key(node.name):
+            self.__by_name[node.name] = node
+
+        children = item.getChildSnapshotList()
+        if children:
+            for child in children:
+                node.children.append(self.__add(child,node,depth + 1))
+        return node
+
+    def find(self,name):
+        """
+        :param name: the name of the snapshot
+        :return: the first SnapshotNode with the name or None
+        """
+        return self.__by_name.get(name)
+
+    def __contains__(self,name):
+        return self.__by_name.has_key(name)
+
+    def __len__(self):
+        return len(self.nodes)
+
+
+def fetch(vm):
+    """
+    Fetch the snapshot tree of a VM
+
+    :param vm: the VirtualMachine
+    :return: SnapshotIndex
+    """
+    return SnapshotIndex(vm.getPropertyByPath("snapshot"))
+
+
+class SnapshotWatcher(object):
+    """
+    Keeps the SnapshotIndexes in a session's snapshot cache current. The
+    first time an index is fetched, the VM's 'snapshot' property is watched
+    on the session's UpdateChannel, and every change to it replaces (or
+    drops) the cached index.
+    """
+    def __init__(self,session,snap_cache):
+        """
+        :param session: the session returned by esx.login()
+        :param snap_cache: the session's snapshot cache (see cache.getSnapshotCache)
+        """
+        self.session = session
+        self.cache = snap_cache
+        self.__filters = {}
+        self.__lock = threading.Lock()
+
+    def get(self,vm,fresh=False):
+        """
+        Return the SnapshotIndex of the VM, fetching it on a cache miss
+
+        :param vm: the VirtualMachine
+        :param fresh: if True, skip the cache
+        :return: SnapshotIndex
+        """
+        key = vm.getMOR().get_value()
+        if not fresh:
+            index = self.cache.get(key)
+            if index is not None:
+                return index
+        # Watch before fetching, so a change made in between isn't missed
+        self.__watch(vm.getMOR())
+        index = fetch(vm)
+        self.cache.put(key,index)
+        return index
+
+    def invalidate(self,vm):
+        """
+        Drop the cached SnapshotIndex of the VM
+
+        :param vm: the VirtualMachine
+        """
+        self.cache.invalidate(vm.getMOR().get_value())
+
+    def close(self):
+        """
+        Stop watching every VM
+        """
+        from honeyclient.manager import updates
+        self.__lock.acquire()
+        try:
+            filters = self.__filters.values()
+            self.__filters.clear()
+        finally:
+            self.__lock.release()
+        if not filters:
+            return
+        channel = updates.getChannel(self.session)
+        for pfilter in filters:
+            channel.unwatch(pfilter)
+
+    def __watch(self,mor):
+        from honeyclient.manager import updates
+        key = mor.get_value()
+        self.__lock.acquire()
+        try:
+            if self.__filters.has_key(key):
+                return
+            self.__filters[key] = updates.getChannel(self.session).watch([(mor,["snapshot"])],
+                                                                        self.__update,
+                                                                        self.__failed)
+        finally:
+            self.__lock.release()
+
+    def __update(self,mor,changes):
+        key = mor.get_value()
+        if changes is None:
+            # The VM is gone
+            self.cache.invalidate(key)
+            self.__lock.acquire()
+            try:
+                pfilter = self.__filters.pop(key,None)
+            finally:
+                self.__lock.release()
+            if pfilter:
+                from honeyclient.manager import updates
+                updates.getChannel(self.session).unwatch(pfilter)
+        elif changes.has_key("snapshot"):
+            self.cache.put(key,SnapshotIndex(changes["snapshot"]))
+        else:
+            # A partial update of the tree, fetch it again when needed
+            self.cache.invalidate(key)
+
+    def __failed(self,e):
+        # The channel died, so nothing is watched anymore and the cached
+        # indexes can't be trusted
+        self.__lock.acquire()
+        try:
+            keys = self.__filters.keys()
+            self.__filters.clear()
+        finally:
+            self.__lock.release()
+        for key in keys:
+            self.cache.invalidate(key)
+
+
+# Registry of watchers by session
+__watchers = {}
+__watchers_lock = threading.Lock()
+
+def getWatcher(session):
+    """
+    Return the SnapshotWatcher of the session, creating it if needed
+
+    :param session: the session returned by esx.login()
+    :return: SnapshotWatcher
+    """
+    from honeyclient.manager import cache
+    __watchers_lock.acquire()
+    try:
+        watcher = __watchers.get(session)
+        if watcher is None:
+            watcher = SnapshotWatcher(session,cache.getSnapshotCache(session))
+            __watchers[session] = watcher
+        return watcher
+    finally:
+        __watchers_lock.release()
+
+def dropWatcher(session):
+    """
+    Stop and remove the SnapshotWatcher of the session. Called on logout.
+
+    :param session: the session returned by esx.login()
+    """
+    __watchers_lock.acquire()
+    try:
+        watcher = __watchers.get(session)
+        if watcher is None:
+            return
+        del __watchers[session]
+    finally:
+        __watchers_lock.release()
+    watcher.close()
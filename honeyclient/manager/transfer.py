@@ -0,0 +1,277 @@
+"""
+Concurrent datastore copies for the esx module.
+
+fullCopyVM used to copy each virtual disk, then the nvram, vmss and vmx
+files, one at a time, waiting for each task before starting the next. The
+copies don't depend on each other, so here they're planned up front as a
+list of CopyOps and started together, up to a limit, with one TaskSetWaiter
+following all of the tasks. If a required copy fails, the copies that are
+still running are cancelled and everything already copied is deleted again.
+
+Each CopyOp records the size of its source (when the server reports it) and
+how long the copy took, and runCopies() returns a CopyReport of them.
+
+Example:
+>> ops = [CopyOp('disk',src_vmdk,dst_vmdk,spec=disk_spec),CopyOp('file',src_vmx,dst_vmx)]
+>> report = runCopies(session,datacenter,ops,4)
+>> if not report.ok(): rollback(session,datacenter,report.ops)
+"""
+
+from com.vmware.vim25 import MethodFault,TaskInfoState
+
+from honeyclient.util.config import *
+from honeyclient.manager import updates
+import time
+
+# Default number of copies to run at once
+DEFAULT_MAX_CONCURRENT = 4
+
+
+class CopyOp(object):
+    """
+    One file or virtual disk to copy
+    """
+    def __init__(self,kind,src,dst,required=True,spec=None,size=None):
+        """
+        :param kind: 'disk' to copy with the VirtualDiskManager, 'file' for the FileManager
+        :param src: the datastore path of the source
+        :param dst: the datastore path of the destination
+        :param required: if False, a failed copy is logged but doesn't fail the plan
+        :param spec: the VirtualDiskSpec for a 'disk' copy
+        :param size: (optional) the size of the source in bytes
+        """
+        self.kind = kind
+        self.src = src
+        self.dst = dst
+        self.required = required
+        self.spec = spec
+        self.size = size
+        self.task = None
+        self.state = None
+        self.error = None
+        self.started = None
+        self.elapsed = None
+
+    def ok(self):
+        """
+        :return: True if the copy finished successfully
+        """
+        return self.state == str(TaskInfoState.success)
+
+    def __repr__(self):
+        size = "?"
+        if self.size is not None:
+            size = "%d" % self.size
+        elapsed = "-"
+        if self.elapsed is not None:
+            elapsed = "%0.2fs" % self.elapsed
+        return "<CopyOp %s %s -> %s %s bytes %s %s>" % (self.kind,self.src,self.dst,
+                                                         size,elapsed,self.state)
+
+
+class CopyReport(object):
+    """
+    The outcome of runCopies()
+    """
+    def __init__(self,ops,elapsed,cause=None):
+        """
+        :param ops: the CopyOps
+        :param elapsed: how long the copies took
+        :param cause: the required CopyOp whose failure stopped the copies
+        """
+        self.ops = ops
+        self.elapsed = elapsed
+        self.cause = cause
+
+    def ok(self):
+        """
+        :return: True if every required copy worked
+        """
+        for op in self.ops:
+            if op.required and not op.ok():
+                return False
+        return True
+
+    def failed(self):
+        """
+        :return: the CopyOps that didn't finish successfully
+        """
+        return [op for op in self.ops if not op.ok()]
+
+    def bytes(self):
+        """
+        :return: the total size of the copied sources that have a known size
+        """
+        total = 0
+        for op in self.ops:
+            if op.ok() and op.size:
+                total += op.size
+        return total
+
+    def summary(self):
+        """
+        :return: a one line summary
+        """
+        rate = 0.0
+        if self.elapsed:
+            rate = self.bytes() / self.elapsed / (1024.0 * 1024)
+        return "%d copies (%d failed), %0.1f MB in %0.2fs (%0.1f MB/s)" % \
+            (len(self.ops),len(self.failed()),self.bytes() / (1024.0 * 1024),self.elapsed,rate)
+
+
+def fileSizes(vm):
+    """
+    Return the sizes of a VM's files, as reported by its layoutEx property.
+    Servers older than 4.0 don't have it, then nothing is returned.
+
+    :param vm: the VirtualMachine
+    :return: ({path:bytes},{disk device key:bytes})
+    """
+    files = {}
+    disks = {}
+    try:
+        layout = vm.getLayoutEx()
+    except Exception, e:
+        LOG.debug("No file layout for the VM: %s" % e)
+        return (files,disks)
+    if not layout or not layout.getFile():
+        return (files,disks)
+
+    by_key = {}
+    for f in layout.getFile():
+        files[f.getName()] = f.getSize()
+        by_key[f.getKey()] = f.getSize()
+
+    if layout.getDisk():
+        for disk in layout.getDisk():
+            total = 0
+            if disk.getChain():
+                for unit in disk.getChain():
+                    for key in unit.getFileKey():
+                        total += by_key.get(key,0)
+            disks[disk.getKey()] = total
+    return (files,disks)
+
+def runCopies(session,datacenter,ops,max_concurrent=None):
+    """
+    Run the copies, up to max_concurrent at a time. Stops starting new copies
+    and cancels the running ones as soon as a required copy fails.
+
+    :param session:
+    :param datacenter: the Datacenter the datastore paths are relative to
+    :param ops: a list of CopyOp
+    :param max_concurrent: (optional) copies to run at once. Defaults to
+                           'max_concurrent_copies' in honeyclient.xml
+    :return: CopyReport
+    """
+    max_concurrent = max(1,getIntArg('max_concurrent_copies','HoneyClient::Manager::ESX',
+                                     DEFAULT_MAX_CONCURRENT,max_concurrent))
+
+    fileMgr = session.getFileManager()
+    vdiskMgr = session.getVirtualDiskManager()
+
+    waiter = updates.TaskSetWaiter(updates.getChannel(session))
+    pending = list(ops)
+    running = {}
+    failed = False
+    cause = None
+    cancelled = False
+    started = time.time()
+    try:
+        while running or (pending and not failed):
+            while pending and not failed and len(running) < max_concurrent:
+                op = pending.pop(0)
+                op.started = time.time()
+                try:
+                    if op.kind == 'disk':
+                        op.task = vdiskMgr.copyVirtualDisk_Task(op.src,datacenter,op.dst,
+                                                                datacenter,op.spec,True)
+                    else:
+                        op.task = fileMgr.copyDatastoreFile_Task(op.src,datacenter,op.dst,
+                                                                 datacenter,True)
+                except MethodFault, detail:
+                    if __failed(op,detail) and not failed:
+                        failed = True
+                        cause = op
+                    continue
+                running[op.task.getMOR().get_value()] = op
+                waiter.add(op.task)
+
+            if failed and not cancelled:
+                for op in running.values():
+                    __cancel(op)
+                cancelled = True
+
+            for task,state in waiter.wait():
+                op = running.pop(task.getMOR().get_value())
+                op.state = state
+                op.elapsed = time.time() - op.started
+                if op.ok():
+                    LOG.debug("Copied %s to %s in %0.2fs" % (op.src,op.dst,op.elapsed))
+                elif __failed(op,task.getTaskInfo().getError()) and not failed:
+                    failed = True
+                    cause = op
+    finally:
+        waiter.close()
+
+    return CopyReport(ops,time.time() - started,cause)
+
+def rollback(session,datacenter,ops):
+    """
+    Delete the destinations of the copies that worked. Errors are logged,
+    this is already cleaning up after a failure.
+
+    :param session:
+    :param datacenter: the Datacenter the datastore paths are relative to
+    :param ops: a list of CopyOp
+    """
+    fileMgr = session.getFileManager()
+    vdiskMgr = session.getVirtualDiskManager()
+    waiter = updates.TaskSetWaiter(updates.getChannel(session))
+    deleting = {}
+    try:
+        for op in ops:
+            if not op.ok():
+                continue
+            try:
+                if op.kind == 'disk':
+                    task = vdiskMgr.deleteVirtualDisk_Task(op.dst,datacenter)
+                else:
+                    task = fileMgr.deleteDatastoreFile_Task(op.dst,datacenter)
+            except MethodFault, detail:
+                LOG.error("Unable to delete %s: %s" % (op.dst,detail))
+                continue
+            deleting[task.getMOR().get_value()] = op
+            waiter.add(task)
+
+        while waiter.pending():
+            for task,state in waiter.wait():
+                if state != str(TaskInfoState.success):
+                    op = deleting[task.getMOR().get_value()]
+                    LOG.error("Unable to delete %s: %s" % (op.dst,task.getTaskInfo().getError()))
+    finally:
+        waiter.close()
+
+def __failed(op,error):
+    """
+    Record a failed copy
+
+    :return: True if the failure should stop the plan
+    """
+    op.error = error
+    if op.state is None:
+        op.state = str(TaskInfoState.error)
+    if op.started and op.elapsed is None:
+        op.elapsed = time.time() - op.started
+    if op.required:
+        LOG.error("Error copying %s to %s: %s" % (op.src,op.dst,error))
+        return True
+    LOG.error("Skipping %s, the copy failed: %s" % (op.src,error))
+    return False
+
+def __cancel(op):
+    try:
+        op.task.cancelTask()
+    except Exception, e:
+        # It may have finished already
+        LOG.debug("Unable to cancel the copy of %s: %s" % (op.src,e))
@@ -0,0 +1,539 @@
+"""
+Property change notifications for the esx module.
+
+Each session gets a single UpdateChannel: one background thread that sits in
+PropertyCollector.waitForUpdates() and hands the changes to whoever asked
+for them. Anything that used to poll the server in a sleep loop (task state,
+pending questions, ...) can instead register a PropertyFilter on the channel
+and be woken up the moment the property changes. Many filters share the one
+long-poll, so a hundred outstanding tasks cost one connection, not a hundred
+polling loops. The thread only runs while there's something to watch.
+
+Note: the ESX/vijava version we build against predates WaitForUpdatesEx, so
+this uses WaitForUpdates and cancelWaitForUpdates() to stop.
+
+Example:
+>> waiter = TaskWaiter(getChannel(session),task,vm)
+>> state = waiter.wait()
+"""
+
+from com.vmware.vim25 import ObjectSpec,ObjectUpdateKind,PropertyChangeOp,PropertyFilterSpec, \
+    PropertySpec,RequestCanceled,TaskInfoState
+from com.vmware.vim25.mo.util import PropertyCollectorUtil
+
+from honeyclient.util.config import *
+from honeyclient.manager import errors,metrics,sessions
+import threading,time
+
+# How many times in a row waitForUpdates can fail before the
+# channel gives up and fails all of its listeners
+MAX_ERRORS = 3
+
+# The final states of a task
+DONE_STATES = [str(TaskInfoState.success),str(TaskInfoState.error)]
+
+
+class UpdateChannel(object):
+    """
+    A single WaitForUpdates loop for a session, dispatching property changes
+    to the callbacks registered with watch()
+    """
+    def __init__(self,session):
+        self.session = session
+        self.collector = session.getPropertyCollector()
+        self.__listeners = {}
+        self.__lock = threading.RLock()
+        self.__thread = None
+        self.__running = False
+        self.__version = ""
+
+    def watch(self,objects,callback,errback=None):
+        """
+        Watch properties on a set of managed objects.
+
+        :param objects: a list of (ManagedObjectReference,[property paths])
+        :param callback: called as callback(mor,{path:value}) from the channel
+                         thread. The first call has the current values. If an
+                         object goes away, it's called with changes=None
+        :param errback: (optional) called as errback(exception) if the channel dies
+        :return: the PropertyFilter, pass it to unwatch() when done
+        """
+        paths_by_type = {}
+        objSpecs = []
+        for mor,paths in objects:
+            type_paths = paths_by_type.setdefault(mor.getType(),[])
+            for p in paths:
+                if p not in type_paths:
+                    type_paths.append(p)
+            objSpec = ObjectSpec()
+            objSpec.setObj(mor)
+            objSpec.setSkip(False)
+            objSpecs.append(objSpec)
+
+        propSpecs = []
+        for mo_type,paths in paths_by_type.items():
+            propSpec = PropertySpec()
+            propSpec.setType(mo_type)
+            propSpec.setAll(False)
+            propSpec.setPathSet(paths)
+            propSpecs.append(propSpec)
+
+        spec = PropertyFilterSpec()
+        spec.setPropSet(propSpecs)
+        spec.setObjectSet(objSpecs)
+        return self.watchSpec(spec,callback,errback)
+
+    def watchSpec(self,spec,callback,errback=None,partial=True):
+        """
+        Same as watch(), but with a prebuilt PropertyFilterSpec. Use this to
+        watch through a traversal, ex: every VM in a ContainerView
+
+        :param spec: the PropertyFilterSpec
+        :param callback: see watch()
+        :param errback: see watch()
+        :param partial: if False, a change to a nested property reports the
+                        whole requested property
+        :return: the PropertyFilter
+        """
+        self.__lock.acquire()
+        try:
+            pfilter = self.collector.createFilter(spec,partial)
+            self.__listeners[pfilter.getMOR().get_value()] = (pfilter,callback,errback)
+            self.__start()
+            return pfilter
+        finally:
+            self.__lock.release()
+
+    def unwatch(self,pfilter):
+        """
+        Stop watching and destroy the filter on the server. The channel
+        thread stops with the last filter, watch() starts it again.
+
+        :param pfilter: the PropertyFilter returned by watch()
+        """
+        self.__lock.acquire()
+        try:
+            key = pfilter.getMOR().get_value()
+            if not self.__listeners.has_key(key):
+                return
+            del self.__listeners[key]
+            idle = self.__running and not self.__listeners
+            if idle:
+                self.__running = False
+        finally:
+            self.__lock.release()
+        self.__destroy(pfilter)
+        if idle:
+            self.__cancel()
+
+    def isRunning(self):
+        """
+        :return: True while the channel thread is waiting for updates
+        """
+        return self.__running
+
+    def watching(self):
+        """
+        :return: the number of filters being watched
+        """
+        return len(self.__listeners)
+
+    def close(self):
+        """
+        Stop the channel thread. The filters go away with the channel, so
+        every listener still watching fails with SessionExpired instead of
+        waiting forever.
+        """
+        self.__lock.acquire()
+        try:
+            self.__running = False
+            listeners = self.__listeners.values()
+            self.__listeners.clear()
+        finally:
+            self.__lock.release()
+        self.__cancel()
+        self.__drop(listeners,errors.SessionExpired("The property update channel was closed"))
+
+    def __start(self):
+        if self.__running:
+            return
+        self.__running = True
+        self.__thread = threading.Thread(target=self.__run,name="esx-update-channel")
+        self.__thread.setDaemon(True)
+        self.__thread.start()
+
+    def __cancel(self):
+        try:
+            self.collector.cancelWaitForUpdates()
+        except Exception:
+            pass
+
+    def __current(self):
+        # False once this thread was stopped, even if a new one was started since
+        return self.__running and self.__thread is threading.currentThread()
+
+    def __run(self):
+        failures = 0
+        while self.__current():
+            try:
+                updates = self.collector.waitForUpdates(self.__version)
+                failures = 0
+            except RequestCanceled:
+                # Either the channel was stopped or someone else on this session
+                # did a WaitForUpdates. Either way, try again with the same version
+                continue
+            except Exception, e:
+                if not self.__current():
+                    return
+                failures += 1
+                LOG.error("Error waiting for property updates: %s" % e)
+                if failures >= MAX_ERRORS:
+                    self.__fail(e)
+                    return
+                time.sleep(1)
+                continue
+
+            if not updates:
+                continue
+            self.__version = updates.getVersion()
+            if updates.getFilterSet():
+                for fu in updates.getFilterSet():
+                    self.__dispatch(fu)
+
+    def __dispatch(self,filter_update):
+        self.__lock.acquire()
+        try:
+            listener = self.__listeners.get(filter_update.getFilter().get_value())
+        finally:
+            self.__lock.release()
+        if not listener or not filter_update.getObjectSet():
+            return
+
+        pfilter,callback,errback = listener
+        for ou in filter_update.getObjectSet():
+            changes = {}
+            if ou.getKind() == ObjectUpdateKind.leave:
+                changes = None
+            elif ou.getChangeSet():
+                for chg in ou.getChangeSet():
+                    if chg.getOp() == PropertyChangeOp.remove:
+                        changes[chg.getName()] = None
+                    else:
+                        changes[chg.getName()] = PropertyCollectorUtil.convertProperty(chg.getVal())
+            try:
+                callback(ou.getObj(),changes)
+            except Exception, e:
+                LOG.error("Error in property update callback: %s" % e)
+
+    def __fail(self,e):
+        self.__lock.acquire()
+        try:
+            self.__running = False
+            listeners = self.__listeners.values()
+            self.__listeners.clear()
+            self.__version = ""
+        finally:
+            self.__lock.release()
+        self.__drop(listeners,e)
+
+    def __destroy(self,pfilter):
+        try:
+            pfilter.destroyPropertyFilter()
+        except Exception, e:
+            LOG.debug("Unable to destroy property filter: %s" % e)
+
+    def __drop(self,listeners,e):
+        # Destroy the filters of listeners that were removed without
+        # unwatch(), and tell them why
+        for pfilter,callback,errback in listeners:
+            self.__destroy(pfilter)
+            if errback:
+                try:
+                    errback(e)
+                except Exception, err:
+                    LOG.error("Error in property update errback: %s" % err)
+
+
+class TaskWaiter(object):
+    """
+    Waits for a Task to finish, optionally also watching a VM for pending
+    questions, with one filter on the session's UpdateChannel
+    """
+    def __init__(self,channel,task,vm=None):
+        """
+        :param channel: the UpdateChannel of the session
+        :param task: the Task to wait on
+        :param vm: (optional) the VirtualMachine to watch for questions
+        """
+        self.channel = channel
+        self.task = task
+        self.state = None
+        # What the task does, ex: 'VirtualMachine.powerOn'
+        self.name = None
+        self.question = None
+        self.error = None
+        self.started = time.time()
+        self.__cond = threading.Condition()
+
+        objects = [(task.getMOR(),["info.state","info.descriptionId"])]
+        if vm:
+            objects.append((vm.getMOR(),["runtime.question"]))
+        self.__filter = channel.watch(objects,self.__update,self.__failed)
+
+    def wait(self,timeout=None,on_question=None):
+        """
+        Block until the task succeeds or fails
+
+        :param timeout: (optional) seconds to wait before giving up
+        :param on_question: (optional) called as on_question(question) from the
+                            calling thread when the VM asks a question
+        :return: the state of the task as a string ('success','error') or
+                 None on timeout
+        """
+        deadline = None
+        if timeout is not None:
+            deadline = time.time() + timeout
+
+        self.__cond.acquire()
+        try:
+            while self.state not in DONE_STATES:
+                if self.error:
+                    raise self.error
+                if self.question and on_question:
+                    question = self.question
+                    self.question = None
+                    self.__cond.release()
+                    try:
+                        on_question(question)
+                    finally:
+                        self.__cond.acquire()
+                    continue
+                if deadline is None:
+                    self.__cond.wait()
+                else:
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        break
+                    self.__cond.wait(remaining)
+            state = self.state
+        finally:
+            self.__cond.release()
+
+        if state in DONE_STATES:
+            self.close()
+            return state
+        return None
+
+    def close(self):
+        """
+        Remove the filter from the channel
+        """
+        if self.__filter:
+            self.channel.unwatch(self.__filter)
+            self.__filter = None
+
+    def __update(self,mor,changes):
+        if changes is None:
+            return
+        self.__cond.acquire()
+        try:
+            if changes.has_key("info.state"):
+                self.state = str(changes["info.state"])
+            if changes.get("info.descriptionId"):
+                self.name = str(changes["info.descriptionId"])
+            if changes.has_key("runtime.question"):
+                self.question = changes["runtime.question"]
+            self.__cond.notifyAll()
+        finally:
+            self.__cond.release()
+
+    def __failed(self,e):
+        self.__cond.acquire()
+        try:
+            self.error = e
+            self.__cond.notifyAll()
+        finally:
+            self.__cond.release()
+
+
+class TaskSetWaiter(object):
+    """
+    Waits on many Tasks at once. Tasks can be added at any time, and wait()
+    returns as soon as any of them finishes, so a caller can keep a fixed
+    number of tasks running.
+    """
+    def __init__(self,channel):
+        """
+        :param channel: the UpdateChannel of the session
+        """
+        self.channel = channel
+        self.error = None
+        self.__tasks = {}
+        self.__filters = {}
+        self.__done = []
+        self.__cond = threading.Condition()
+
+    def add(self,task):
+        """
+        Start watching a task
+
+        :param task: the Task
+        """
+        key = task.getMOR().get_value()
+        self.__cond.acquire()
+        try:
+            self.__tasks[key] = task
+        finally:
+            self.__cond.release()
+        pfilter = self.channel.watch([(task.getMOR(),["info.state"])],self.__update,self.__failed)
+        self.__cond.acquire()
+        try:
+            # The task may have finished and been returned by wait() already
+            if self.__tasks.has_key(key):
+                self.__filters[key] = pfilter
+                pfilter = None
+        finally:
+            self.__cond.release()
+        if pfilter:
+            self.channel.unwatch(pfilter)
+
+    def pending(self):
+        """
+        :return: the number of tasks that haven't been returned by wait() yet
+        """
+        return len(self.__tasks)
+
+    def wait(self,timeout=None):
+        """
+        Block until at least one task finishes
+
+        :param timeout: (optional) seconds to wait
+        :return: a list of (task,state) for the tasks that finished since the
+                 last call, empty on timeout or if no task is pending
+        """
+        deadline = None
+        if timeout is not None:
+            deadline = time.time() + timeout
+
+        self.__cond.acquire()
+        try:
+            while not self.__done and self.__tasks:
+                if self.error:
+                    raise self.error
+                if deadline is None:
+                    self.__cond.wait()
+                else:
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        break
+                    self.__cond.wait(remaining)
+            done = self.__done
+            self.__done = []
+            filters = []
+            for task,state in done:
+                key = task.getMOR().get_value()
+                del self.__tasks[key]
+                if self.__filters.has_key(key):
+                    filters.append(self.__filters.pop(key))
+        finally:
+            self.__cond.release()
+
+        for pfilter in filters:
+            self.channel.unwatch(pfilter)
+        return done
+
+    def close(self):
+        """
+        Remove all the filters from the channel
+        """
+        self.__cond.acquire()
+        try:
+            filters = self.__filters.values()
+            self.__filters = {}
+            self.__tasks = {}
+        finally:
+            self.__cond.release()
+        for pfilter in filters:
+            self.channel.unwatch(pfilter)
+
+    def __update(self,mor,changes):
+        if not changes or not changes.has_key("info.state"):
+            return
+        state = str(changes["info.state"])
+        if state not in DONE_STATES:
+            return
+        self.__cond.acquire()
+        try:
+            task = self.__tasks.get(mor.get_value())
+            if task and task not in [t for t,s in self.__done]:
+                self.__done.append((task,state))
+                self.__cond.notifyAll()
+        finally:
+            self.__cond.release()
+
+    def __failed(self,e):
+        self.__cond.acquire()
+        try:
+            self.error = e
+            self.__cond.notifyAll()
+        finally:
+            self.__cond.release()
+
+
+# Registry of channels by session
+__channels = {}
+__channels_lock = threading.Lock()
+
+def getChannel(session):
+    """
+    Return the UpdateChannel for the session, creating it if needed
+
+    :param session: the session returned by esx.login() or a SessionPool
+    :return: UpdateChannel
+    """
+    session = sessions.resolveSession(session)
+    __channels_lock.acquire()
+    try:
+        channel = __channels.get(session)
+        if channel is None:
+            channel = UpdateChannel(session)
+            __channels[session] = channel
+        return channel
+    finally:
+        __channels_lock.release()
+
+def closeChannel(session):
+    """
+    Stop and remove the UpdateChannel of the session. Called on logout.
+
+    :param session: the session returned by esx.login()
+    """
+    __channels_lock.acquire()
+    try:
+        channel = __channels.get(session)
+        if channel is None:
+            return
+        del __channels[session]
+    finally:
+        __channels_lock.release()
+    channel.close()
+
+def waitForTask(session,task,vm=None,on_question=None,timeout=None):
+    """
+    Wait for a task to finish using the session's UpdateChannel. A drop-in
+    replacement for task.waitForMe() that doesn't poll.
+
+    :param session:
+    :param task: the Task to wait on
+    :param vm: (optional) the VirtualMachine to watch for questions
+    :param on_question: (optional) called as on_question(question) when the VM asks one
+    :param timeout: (optional) seconds to wait
+    :return: the final state of the task ('success' or 'error') or None on timeout
+    """
+    waiter = TaskWaiter(getChannel(session),task,vm)
+    try:
+        state = waiter.wait(timeout,on_question)
+        metrics.taskDone(waiter.name,state,time.time() - waiter.started)
+        return state
+    finally:
+        waiter.close()
@@ -1,31 +1,177 @@
+"""
+The honeyclient.xml configuration and the 'honeyclient' logger.
 
-import org.dom4j.Document
-import org.dom4j.Node
-from org.dom4j.io import SAXReader
-import org.dom4j.XPath
+Nothing is read when the module is imported: the configuration file is
+loaded by the first getArg(), and the logger is set up (see
+configureLogging()) the first time LOG is used.
+"""
 
-import logging,inspect,re
+from honeyclient.util import logs
+import logging,os,sys,threading
 
+# The configuration file. A relative path is looked for in the working
+# directory, then next to the honeyclient package. The HONEYCLIENT_CONF
+# environment variable overrides it.
 CONF_FILE = "etc/honeyclient.xml"
 
-# Global XPath and Logger
+# The dom4j Document of the configuration, once it's loaded. See getDocument()
 XP = None
-LOG = None
- 
+
+# The flattened configuration: (values,attributes). See flattenConfig()
+__flat = None
+__lock = threading.RLock()
+
+def getConfigFile():
+    """
+    return the path of the configuration file
+    """
+    path = os.environ.get('HONEYCLIENT_CONF') or CONF_FILE
+    if os.path.isabs(path) or os.path.exists(path):
+        return path
+    root = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    return os.path.join(root,path)
+
 def loadConfig():
     """
     Load the configuration file
     return Document
     """
+    # dom4j is only loaded when the configuration is
+    from org.dom4j import DocumentException
+    from org.dom4j.io import SAXReader
+
     document = None
     reader = SAXReader()
     try:
-        document = reader.read(CONF_FILE)
+        document = reader.read(getConfigFile())
     except DocumentException, detail:
         print "Error: %s" % detail.getMessage()
         
     return document
 
+def flattenConfig(document):
+    """
+    Flatten the configuration document into two dictionaries, so getArg()
+    doesn't have to evaluate an XPath expression on every call.
+
+    Every element is stored under each suffix of its lowercased path, ex:
+    'honeyclient/manager/esx/timeout', 'manager/esx/timeout', 'esx/timeout'
+    and 'timeout'. The first element in document order wins, like
+    selectSingleNode() on '//namespace/name' did.
+
+    document: the dom4j Document (may be None)
+    return (values,attributes) where values maps a path to the text (or dict)
+           getArg() returns, and attributes maps (path,attribute) to its text
+    """
+    values = {}
+    attributes = {}
+    if document is None:
+        return (values,attributes)
+
+    def walk(element,path):
+        path = path + [element.getName().lower()]
+        value = __elementValue(element)
+        attrs = []
+        for a in element.attributes():
+            attrs.append((a.getName().lower(),a.getText().strip()))
+
+        for i in range(len(path)):
+            key = "/".join(path[i:])
+            if not values.has_key(key):
+                values[key] = value
+            for attr_name,attr_value in attrs:
+                if not attributes.has_key((key,attr_name)):
+                    attributes[(key,attr_name)] = attr_value
+
+        for child in element.elements():
+            walk(child,path)
+
+    walk(document.getRootElement(),[])
+    return (values,attributes)
+
+def __elementValue(node):
+    """
+    The value getArg() returns for an element: its text if it's a single
+    Element, otherwise a dict of its children
+    """
+    if node.nodeCount() == 1:
+        # we have a single Element
+        return node.getText().strip()
+
+    # If we get this far we have multiple elements - create a hash
+    val = {}
+    for n in node.elementIterator():
+        tag_name = n.getName()
+        if not val.get(tag_name):
+            # new key
+            val[tag_name] = []
+        if n.attributes().size() > 0:
+            attr = {}
+            #Create a hash of the attributes
+            for a in n.attributes():
+                attr[a.getName()] = a.getText()
+            attr2 = {n.getText().strip():attr}
+            val[tag_name].append(attr2)
+        else:
+            val[tag_name].append(n.getText().strip())
+    return val
+
+def __copyValue(value):
+    # Hand out copies of dict values so callers can't change the snapshot
+    if isinstance(value,dict):
+        return dict([(k,__copyValue(v)) for k,v in value.items()])
+    if isinstance(value,list):
+        return [__copyValue(v) for v in value]
+    return value
+
+def reloadConfig():
+    """
+    Read the configuration file again and swap in the new values. Threads
+    calling getArg() see either the old or the new configuration, never a
+    mix of both. If the file can't be read, the current values are kept.
+
+    return True if the configuration was reloaded
+    """
+    global XP,__flat
+    document = loadConfig()
+    if document is None:
+        LOG.error("Unable to reload %s, keeping the current configuration" % getConfigFile())
+        return False
+    flat = flattenConfig(document)
+    __lock.acquire()
+    try:
+        XP = document
+        __flat = flat
+    finally:
+        __lock.release()
+    configureLogging()
+    return True
+
+def getDocument():
+    """
+    return the dom4j Document of the configuration, loading it if needed
+    (None if it couldn't be read)
+    """
+    __getFlat()
+    return XP
+
+def __getFlat():
+    """
+    return the flattened configuration, loading it the first time
+    """
+    global XP,__flat
+    flat = __flat
+    if flat is None:
+        __lock.acquire()
+        try:
+            if __flat is None:
+                XP = loadConfig()
+                __flat = flattenConfig(XP)
+            flat = __flat
+        finally:
+            __lock.release()
+    return flat
+
 def getArg(name,namespace=None,attribute=None):
     """
     Helper function to extract values from the honeyclient.xml configuration file.
@@ -37,6 +183,8 @@ def getArg(name,namespace=None,attribute=None):
                  based upon that
       attribute: the name of an attribute to extract
 
+    Names, namespaces and attributes are not case sensitive.
+
     Example:
     <honeyclient>
         <manager>
@@ -59,15 +207,7 @@ def getArg(name,namespace=None,attribute=None):
     if not namespace:
         # If the user does not specify the namespace. Attempt to locate where we're
         # at in the package space using the caller.
-
-        # Get the package name of the *caller*
-        frm = inspect.stack()[1]
-        mod = inspect.getmodule(frm[0])
-        
-        # Convert the package name into Xpath substituting '.' for '/'
-        namespace = "//" + re.sub(r'\.','/',mod.__name__)
-    else:
-        namespace = "//" + re.sub(r'::','/',namespace)
+        namespace = sys._getframe(1).f_globals.get('__name__','').replace('.','::')
 
     # Here I deviate from the logic in the original Perl code. I instead
     # check to see if there's a matching node from 'namespace/name' if NOT
@@ -76,64 +216,119 @@ def getArg(name,namespace=None,attribute=None):
     # use this to grab all ancestors to find the value of the tag you're looking for.  
     # This (to me) seems like it tries to compensate for user error and could lead
     # to the possibilty of someone grabbing the wrong value for a tag.
-        
-    # build xpath expression
-    xpath = namespace + "/" + name
+
+    key = (namespace.replace('::','/') + "/" + name).lower()
+
+    # Take one reference, reloadConfig() may swap in a new one at any time
+    values,attributes = __getFlat()
+
     if attribute:
         # Just return the value of the attribute
-        xpath = xpath + "/@"+ attribute
+        return attributes.get((key,attribute.lower()),'undef')
+
+    value = values.get(key)
 
-    # Do the search
-    node = XP.selectSingleNode(xpath)
-    
     # If no results return undef
-    if not node:
-            return 'undef'
-    
-    # Check if it's an attribute
-    if attribute:
-        return node.text.strip()
-    
-    if node.nodeCount() == 1:
-        # we have a single Element
-        return node.text.strip()
-        
-    # If we get this far we have multiple elements - create a hash
-    val = {}
-    for n in node.elementIterator():
-        tag_name = n.name
-        if not val.get(tag_name):
-            # new key
-            val[tag_name] = []
-        if n.attributes().size() > 0:
-            attr = {}
-            #Create a hash of the attributes
-            for a in n.attributes():
-                attr[a.name] = a.text
-            attr2 = {n.text.strip():attr}
-            val[tag_name].append(attr2)
-        else:
-            val[tag_name].append(n.text.strip())
-   
-    return val
+    if value is None:
+        return 'undef'
+    return __copyValue(value)
+
+def getIntArg(name,namespace,default=None,value=None):
+    """
+    Helper to read an integer setting, see getArg()
+
+      name:      the name of the tag
+      namespace: the namespace of the tag, ex: 'HoneyClient::Manager::ESX'
+      default:   returned if the setting is missing or empty
+      value:     a value given by the caller, which wins over the setting
+
+    return int (or default)
+    """
+    if value is not None:
+        return int(value)
+    arg = getArg(name,namespace)
+    if arg in ('undef',''):
+        return default
+    return int(arg)
         
 
 def getLogger():
     """
-    Hardcoded logger for now. This will use a configuration file in the future.
+    The 'honeyclient' logger, as configured by configureLogging()
     returns a logger
     """
-    # Format definition for the logger
-    format = "%(asctime)s %(levelname)5s [%(funcName)s] (%(filename)s:%(lineno)d) - [PID: %(process)d] - %(message)s"
-    
-    log = logging.getLogger('honeyclient')
-    log.setLevel(logging.DEBUG)
-    ch = logging.StreamHandler() 
-    ch.setLevel(logging.DEBUG)
-    formatter = logging.Formatter(format)
-    ch.setFormatter(formatter)
-    log.addHandler(ch)
-    return log
-
-LOG = getLogger()
-XP = loadConfig()
+    return logging.getLogger('honeyclient')
+
+def configureLogging():
+    """
+    Set the 'honeyclient' logger up from the HoneyClient::Logging section
+    of the configuration and 'syslog_address', see honeyclient.util.logs.
+    Missing settings keep their defaults.
+    returns the logger
+    """
+    def setting(name,default,convert=str):
+        value = getArg(name,'HoneyClient::Logging')
+        if value in ('undef',''):
+            return default
+        return convert(value)
+
+    def flag(value):
+        return value.lower() in ('1','true','yes')
+
+    syslog_address = None
+    if setting('syslog',False,flag):
+        syslog_address = getArg('syslog_address','HoneyClient')
+    return logs.configure(getLogger(),
+                          level=setting('level',logs.DEFAULT_LEVEL),
+                          async=setting('async',True,flag),
+                          queue_size=setting('queue_size',logs.DEFAULT_QUEUE_SIZE,int),
+                          caller_info=setting('caller_info',False,flag),
+                          format=setting('format','text'),
+                          rate_limit_interval=setting('rate_limit_interval',
+                                                      logs.DEFAULT_RATE_LIMIT_INTERVAL,float),
+                          rate_limit_burst=setting('rate_limit_burst',logs.DEFAULT_RATE_LIMIT_BURST,int),
+                          stderr=setting('stderr',True,flag),
+                          syslog_address=syslog_address)
+
+class _LazyLogger(object):
+    """
+    Stands in for the 'honeyclient' logger: the first time one of its
+    methods is used, the logger is set up with configureLogging(). If that
+    fails, the logger gets the defaults of logs.configure() and the error is
+    logged. Its methods are then kept, so later calls go straight to the logger.
+    """
+    def __init__(self):
+        self._logger = None
+        self._pending = None
+        self._lock = threading.RLock()
+
+    def __getattr__(self,name):
+        value = getattr(self._get(),name)
+        if callable(value):
+            setattr(self,name,value)
+        return value
+
+    def _get(self):
+        log = self._logger
+        if log is None:
+            self._lock.acquire()
+            try:
+                if self._logger is None and self._pending is None:
+                    # Messages logged while configuring go to the bare logger
+                    self._pending = getLogger()
+                    try:
+                        try:
+                            configureLogging()
+                        except Exception, e:
+                            # A bad or unreadable configuration mustn't keep
+                            # the caller from logging, fall back to the defaults
+                            logs.configure(self._pending)
+                            self._pending.error("Unable to configure logging, using the defaults: %s" % e)
+                    finally:
+                        self._logger = self._pending
+                log = self._logger or self._pending
+            finally:
+                self._lock.release()
+        return log
+
+LOG = _LazyLogger()
@@ -0,0 +1,182 @@
+"""
+A small JSON encoder and decoder. Jython 2.5 doesn't ship the json module.
+
+Encodes dicts, lists, tuples, strings, numbers, booleans and None. Anything
+else is written as its str(). NaN and infinities are written as null.
+
+>> text = dumps({'p50':0.25,'ops':[1,2]})
+>> loads(text)['ops']
+[1, 2]
+"""
+
+import re
+
+__escapes = {'"':'\\"','\\':'\\\\','\n':'\\n','\r':'\\r','\t':'\\t','\b':'\\b','\f':'\\f'}
+__unescapes = {'"':'"','\\':'\\','/':'/','n':'\n','r':'\r','t':'\t','b':'\b','f':'\f'}
+__number = re.compile(r"-?(0|[1-9]\d*)(\.\d+)?([eE][-+]?\d+)?")
+__space = re.compile(r"\s*")
+
+
+def dumps(value,indent=None):
+    """
+    :param value: the value to encode
+    :param indent: (optional) the number of spaces to indent nested values by.
+                   By default everything is on one line
+    :return: the JSON text
+    """
+    out = []
+    __encode(value,out,indent,0)
+    return "".join(out)
+
+def loads(text):
+    """
+    :param text: JSON text
+    :return: the decoded value. Objects are dicts, arrays are lists
+    :raise ValueError: if the text isn't valid JSON
+    """
+    value,end = __decode(text,__skip(text,0))
+    end = __skip(text,end)
+    if end != len(text):
+        raise ValueError("Extra data at %d" % end)
+    return value
+
+
+def __encode(value,out,indent,level):
+    if value is None:
+        out.append("null")
+    elif value is True:
+        out.append("true")
+    elif value is False:
+        out.append("false")
+    elif isinstance(value,(int,long)):
+        out.append(str(value))
+    elif isinstance(value,float):
+        # NaN and the infinities
+        if value != value or value - value != 0:
+            out.append("null")
+        else:
+            out.append(repr(value))
+    elif isinstance(value,basestring):
+        out.append(__string(value))
+    elif isinstance(value,dict):
+        keys = value.keys()
+        keys.sort()
+        items = [(__string(str(k)),value[k]) for k in keys]
+        __container("{","}",items,out,indent,level)
+    elif isinstance(value,(list,tuple)):
+        __container("[","]",[(None,v) for v in value],out,indent,level)
+    else:
+        out.append(__string(str(value)))
+
+def __container(start,end,items,out,indent,level):
+    out.append(start)
+    for i in range(len(items)):
+        key,v = items[i]
+        if i:
+            out.append(",")
+        if indent is not None:
+            out.append("\n" + " " * (indent * (level + 1)))
+        if key is not None:
+            out.append(key)
+            out.append(": ")
+        __encode(v,out,indent,level + 1)
+    if indent is not None and items:
+        out.append("\n" + " " * (indent * level))
+    out.append(end)
+
+def __string(s):
+    chars = ['"']
+    for c in s:
+        if __escapes.has_key(c):
+            chars.append(__escapes[c])
+        elif c < " " or c > "~":
+            chars.append("\\u%04x" % ord(c))
+        else:
+            chars.append(c)
+    chars.append('"')
+    return "".join(chars)
+
+
+def __skip(text,i):
+    return __space.match(text,i).end()
+
+def __decode(text,i):
+    """
+    :return: (value,index after it)
+    """
+    if i >= len(text):
+        raise ValueError("Expected a value at %d" % i)
+    c = text[i]
+    if c == "{":
+        return __object(text,i + 1)
+    if c == "[":
+        return __array(text,i + 1)
+    if c == '"':
+        return __parseString(text,i + 1)
+    for word,value in (("null",None),("true",True),("false",False)):
+        if text.startswith(word,i):
+            return (value,i + len(word))
+    m = __number.match(text,i)
+    if m is None or m.end() == i:
+        raise ValueError("Unexpected %r at %d" % (c,i))
+    if m.group(2) or m.group(3):
+        return (float(m.group(0)),m.end())
+    return (int(m.group(0)),m.end())
+
+def __object(text,i):
+    result = {}
+    i = __skip(text,i)
+    if text[i:i + 1] == "}":
+        return (result,i + 1)
+    while True:
+        if text[i:i + 1] != '"':
+            raise ValueError("Expected a name at %d" % i)
+        key,i = __parseString(text,i + 1)
+        i = __skip(text,i)
+        if text[i:i + 1] != ":":
+            raise ValueError("Expected ':' at %d" % i)
+        value,i = __decode(text,__skip(text,i + 1))
+        result[key] = value
+        i = __skip(text,i)
+        if text[i:i + 1] == "}":
+            return (result,i + 1)
+        if text[i:i + 1] != ",":
+            raise ValueError("Expected ',' or '}' at %d" % i)
+        i = __skip(text,i + 1)
+
+def __array(text,i):
+    result = []
+    i = __skip(text,i)
+    if text[i:i + 1] == "]":
+        return (result,i + 1)
+    while True:
+        value,i = __decode(text,i)
+        result.append(value)
+        i = __skip(text,i)
+        if text[i:i + 1] == "]":
+            return (result,i + 1)
+        if text[i:i + 1] != ",":
+            raise ValueError("Expected ',' or ']' at %d" % i)
+        i = __skip(text,i + 1)
+
+def __parseString(text,i):
+    chars = []
+    while True:
+        if i >= len(text):
+            raise ValueError("Unterminated string")
+        c = text[i]
+        if c == '"':
+            return ("".join(chars),i + 1)
+        if c == "\\":
+            e = text[i + 1:i + 2]
+            if e == "u":
+                chars.append(unichr(int(text[i + 2:i + 6],16)))
+                i += 6
+                continue
+            if not __unescapes.has_key(e):
+                raise ValueError("Bad escape at %d" % i)
+            chars.append(__unescapes[e])
+            i += 2
+            continue
+        chars.append(c)
+        i += 1
@@ -0,0 +1,296 @@
+"""
+The logging of the honeyclient modules.
+
+config.py sets the 'honeyclient' logger up with configure(), from the
+HoneyClient::Logging section of honeyclient.xml and 'syslog_address'.
+
+Records go through an AsyncHandler: the thread that logs only renders the
+message and puts the record on a queue, and a daemon thread writes it to
+stderr and/or syslog. When the queue is full records are dropped, and
+counted, rather than making the caller wait.
+
+Looking up the function, file and line of every record walks the stack,
+which is slow on Jython. It's only done when 'caller_info' is set.
+
+A RateLimitFilter lets the same message through 'rate_limit_burst' times
+every 'rate_limit_interval' seconds, so a loop polling for something can't
+flood the log. The next one let through says how many were suppressed.
+
+With 'format' set to 'json' each record is written as one JSON object,
+see JSONFormatter.
+
+Example:
+>> log = logs.configure(logging.getLogger('honeyclient'),caller_info=True,format='json')
+"""
+
+from honeyclient.util import jsonutil
+import logging,logging.handlers,Queue,threading,time
+
+# The formats of the text records, with and without the caller's function, file and line
+TEXT_FORMAT = "%(asctime)s %(levelname)5s [%(threadName)s] - [PID: %(process)d] - %(message)s"
+CALLER_FORMAT = "%(asctime)s %(levelname)5s [%(funcName)s] (%(filename)s:%(lineno)d) - [PID: %(process)d] - %(message)s"
+
+# Defaults of configure(), see HoneyClient::Logging in honeyclient.xml
+DEFAULT_LEVEL = "DEBUG"
+DEFAULT_QUEUE_SIZE = 10000
+DEFAULT_RATE_LIMIT_INTERVAL = 60.0
+DEFAULT_RATE_LIMIT_BURST = 5
+SYSLOG_PORT = 514
+
+# What logging looks the callers up with, see configure()
+__srcfile = logging._srcfile
+
+
+class RateLimitFilter(logging.Filter):
+    """
+    Lets the same message (same logger, level and text) through 'burst'
+    times every 'interval' seconds
+    """
+    def __init__(self,interval=DEFAULT_RATE_LIMIT_INTERVAL,burst=DEFAULT_RATE_LIMIT_BURST):
+        logging.Filter.__init__(self)
+        self.interval = interval
+        self.burst = burst
+        self.__lock = threading.Lock()
+        # key -> [start of the interval,records let through,records suppressed]
+        self.__seen = {}
+
+    def filter(self,record):
+        if self.interval <= 0:
+            return True
+        now = time.time()
+        key = (record.name,record.levelno,record.getMessage())
+        self.__lock.acquire()
+        try:
+            seen = self.__seen.get(key)
+            if seen is None or now - seen[0] >= self.interval:
+                suppressed = 0
+                if seen is not None:
+                    suppressed = seen[2]
+                elif len(self.__seen) > 1000:
+                    self.__expire(now)
+                self.__seen[key] = [now,1,0]
+            elif seen[1] < self.burst:
+                seen[1] += 1
+                return True
+            else:
+                seen[2] += 1
+                return False
+        finally:
+            self.__lock.release()
+        if suppressed:
+            record.msg = "%s (suppressed %d times in the last %gs)" % \
+                (record.getMessage(),suppressed,self.interval)
+            record.args = ()
+        return True
+
+    def __expire(self,now):
+        for key,seen in self.__seen.items():
+            if now - seen[0] >= self.interval:
+                del self.__seen[key]
+
+
+class JSONFormatter(logging.Formatter):
+    """
+    Formats a record as one line of JSON, ex:
+    {"level": "INFO","logger": "honeyclient","message": "...","process": 1,"thread": "MainThread","time": "..."}
+    The function, file and line are in it when caller info is on
+    """
+    def __init__(self,caller_info=False):
+        logging.Formatter.__init__(self)
+        self.caller_info = caller_info
+
+    def format(self,record):
+        value = {'time':self.formatTime(record),
+                 'level':record.levelname,
+                 'logger':record.name,
+                 'message':record.getMessage(),
+                 'thread':record.threadName,
+                 'process':record.process}
+        if self.caller_info:
+            value['function'] = record.funcName
+            value['file'] = record.filename
+            value['line'] = record.lineno
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            value['exception'] = record.exc_text
+        return jsonutil.dumps(value)
+
+
+class _Flush(object):
+    """
+    Put on the queue of an AsyncHandler to know when the records before it were written
+    """
+    def __init__(self):
+        self.done = threading.Event()
+
+
+class AsyncHandler(logging.Handler):
+    """
+    Hands records to other handlers from a daemon thread
+    """
+    def __init__(self,handlers,queue_size=DEFAULT_QUEUE_SIZE):
+        """
+        :param handlers: the handlers that write the records
+        :param queue_size: (optional) how many records can wait to be written
+        """
+        logging.Handler.__init__(self)
+        self.handlers = handlers
+        self.dropped = 0
+        self.__queue = Queue.Queue(queue_size)
+        self.__thread = threading.Thread(target=self.__run,name="honeyclient-log")
+        self.__thread.setDaemon(True)
+        self.__thread.start()
+
+    def prepare(self,record):
+        """
+        Render what may change before the record is written by another
+        thread: the message with its arguments, and the exception
+        """
+        record.msg = record.getMessage()
+        record.args = ()
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+    def emit(self,record):
+        try:
+            self.__queue.put_nowait(self.prepare(record))
+        except Queue.Full:
+            self.dropped += 1
+        except:
+            self.handleError(record)
+
+    def flush(self):
+        """
+        Wait until the records queued so far are written
+        """
+        marker = _Flush()
+        try:
+            self.__queue.put(marker,True,5)
+        except Queue.Full:
+            return
+        marker.done.wait(5)
+
+    def close(self):
+        if self.__thread.isAlive():
+            self.flush()
+            try:
+                self.__queue.put(None,True,5)
+                self.__thread.join(5)
+            except Queue.Full:
+                pass
+        for h in self.handlers:
+            h.close()
+        logging.Handler.close(self)
+
+    def __run(self):
+        while True:
+            record = self.__queue.get()
+            if record is None:
+                return
+            if isinstance(record,_Flush):
+                for h in self.handlers:
+                    h.flush()
+                record.done.set()
+                continue
+            if self.dropped:
+                dropped = self.dropped
+                self.dropped = 0
+                self.__write(logging.makeLogRecord({'name':record.name,'levelno':logging.WARNING,
+                                                    'levelname':'WARNING',
+                                                    'msg':"Dropped %d log records, the queue was full" % dropped}))
+            self.__write(record)
+
+    def __write(self,record):
+        for h in self.handlers:
+            try:
+                if record.levelno >= h.level:
+                    h.handle(record)
+            except:
+                # Nowhere else to report it
+                pass
+
+
+def configure(log,level=DEFAULT_LEVEL,async=True,queue_size=DEFAULT_QUEUE_SIZE,caller_info=False,
+              format="text",rate_limit_interval=DEFAULT_RATE_LIMIT_INTERVAL,
+              rate_limit_burst=DEFAULT_RATE_LIMIT_BURST,stderr=True,syslog_address=None):
+    """
+    Set a logger up. The handlers of an earlier configure() are closed
+    and replaced.
+
+    :param log: the Logger, ex: logging.getLogger('honeyclient')
+    :param level: (optional) the lowest level logged, ex: 'INFO'
+    :param async: (optional) if True, records are written by a daemon thread
+    :param queue_size: (optional) how many records can wait to be written
+    :param caller_info: (optional) if True, the function, file and line of
+                        every record are looked up and written
+    :param format: (optional) 'text' or 'json'
+    :param rate_limit_interval: (optional) seconds, see RateLimitFilter. 0 lets everything through
+    :param rate_limit_burst: (optional) see RateLimitFilter
+    :param stderr: (optional) if True, records are written to stderr
+    :param syslog_address: (optional) the host records are sent to over UDP port 514
+    :return: the logger
+    """
+    if format not in ("text","json"):
+        raise ValueError("Unknown log format: %s" % format)
+    # logging walks the stack for every record unless _srcfile is None
+    if caller_info:
+        logging._srcfile = __srcfile
+    else:
+        logging._srcfile = None
+
+    if format == "json":
+        formatter = JSONFormatter(caller_info)
+    elif caller_info:
+        formatter = logging.Formatter(CALLER_FORMAT)
+    else:
+        formatter = logging.Formatter(TEXT_FORMAT)
+
+    handlers = []
+    if stderr:
+        handlers.append(logging.StreamHandler())
+    if syslog_address:
+        handlers.append(logging.handlers.SysLogHandler((syslog_address,SYSLOG_PORT)))
+    for h in handlers:
+        h.setFormatter(formatter)
+
+    if async:
+        handler = AsyncHandler(handlers,queue_size)
+    else:
+        handler = _Handlers(handlers)
+    handler.addFilter(RateLimitFilter(rate_limit_interval,rate_limit_burst))
+
+    for old in list(log.handlers):
+        if getattr(old,'_honeyclient',False):
+            log.removeHandler(old)
+            old.close()
+    handler._honeyclient = True
+    log.addHandler(handler)
+    log.setLevel(getattr(logging,str(level).upper(),logging.DEBUG))
+    return log
+
+
+class _Handlers(logging.Handler):
+    """
+    Writes records to several handlers from the thread that logs them, so
+    they share one RateLimitFilter
+    """
+    def __init__(self,handlers):
+        logging.Handler.__init__(self)
+        self.handlers = handlers
+
+    def emit(self,record):
+        for h in self.handlers:
+            if record.levelno >= h.level:
+                h.handle(record)
+
+    def flush(self):
+        for h in self.handlers:
+            h.flush()
+
+    def close(self):
+        for h in self.handlers:
+            h.close()
+        logging.Handler.close(self)
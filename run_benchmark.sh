@@ -0,0 +1,14 @@
+#!/bin/sh -e
+
+# Runs the benchmarks in tests/benchmark.py. ex: ./run_benchmark.sh -n 10 -o results.json
+# Pass -h for the scenarios and options
+# './run_benchmark.sh startup ...' runs the startup benchmark, tests/benchmark_startup.py
+
+export CLASSPATH=$PWD/deps/jna.jar:$PWD/deps/vix.jar:$PWD/deps/dom4j-1.6.1.jar:$PWD/deps/jaxen-1.1.1.jar:$PWD/deps/vijava.jar
+
+
+if [ "$1" = "startup" ]; then
+    shift
+    exec jython -Dpython.path=$PWD tests/benchmark_startup.py $*
+fi
+exec jython -Dpython.path=$PWD tests/benchmark.py $*
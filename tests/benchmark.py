@@ -0,0 +1,309 @@
+"""
+Benchmarks of the clone lifecycle, against an ESX server or the simulator.
+
+Each scenario times the esx operations it makes and reports, per operation,
+the latency percentiles (p50/p95/p99), how many it did per minute and how
+many SOAP calls they took. The results are written as JSON, so the runs of
+two versions can be compared with --baseline.
+
+Scenarios:
+ clone_lifecycle    make a Clone (quick clone, boot, network, operational
+                    snapshot) and destroy it, --iterations times
+ concurrent_clones  make --concurrency quick clones at once and destroy them,
+                    --iterations times
+ revert_loop        revert a quick clone to a snapshot --iterations times
+ status_scan        get the state of every VM --iterations times
+ destroy_sweep      make --concurrency quick clones and destroy them one by one
+
+Examples:
+ ./run_benchmark.sh
+ ./run_benchmark.sh -u 'sim://bench/sdk?vms=500&latency=0.005' status_scan
+ ./run_benchmark.sh -n 20 -c 8 -o results.json --baseline old.json
+
+By default the test server and VM of honeyclient.xml (HoneyClient::Manager::ESX::Test)
+are used. The SOAP calls are counted by honeyclient.manager.instrument, which
+the benchmark turns on.
+"""
+
+import math,optparse,sys,threading,time
+from honeyclient.manager import clone,esx,instrument
+from honeyclient.util import jsonutil
+from honeyclient.util.config import *
+
+SCENARIOS = ['clone_lifecycle','concurrent_clones','revert_loop','status_scan','destroy_sweep']
+
+# The latency percentiles reported
+PERCENTILES = [50,95,99]
+
+
+def percentile(values,p):
+    """
+    :param values: the samples
+    :param p: the percentile, ex: 95
+    :return: the nearest-rank percentile of values, None if there aren't any
+    """
+    if not values:
+        return None
+    ordered = sorted(values)
+    rank = int(math.ceil(p / 100.0 * len(ordered)))
+    return ordered[max(rank,1) - 1]
+
+
+class Recorder(object):
+    """
+    Collects the time each operation of a scenario took. Safe to use from
+    several threads
+    """
+    def __init__(self):
+        self.__lock = threading.Lock()
+        self.samples = {}
+        self.errors = {}
+
+    def record(self,op,seconds,ok=True):
+        self.__lock.acquire()
+        try:
+            if ok:
+                self.samples.setdefault(op,[]).append(seconds)
+            else:
+                self.errors[op] = self.errors.get(op,0) + 1
+        finally:
+            self.__lock.release()
+
+    def time(self,op,fn,*args,**kwargs):
+        """
+        Call fn and record how long it took under op. Errors are recorded
+        and raised again
+        """
+        start = time.time()
+        try:
+            result = fn(*args,**kwargs)
+        except:
+            self.record(op,time.time() - start,False)
+            raise
+        self.record(op,time.time() - start)
+        return result
+
+    def summary(self,elapsed):
+        """
+        :param elapsed: the duration of the scenario in seconds
+        :return: {op:{'count','errors','mean','min','max','p50','p95','p99','per_minute'}}
+        """
+        results = {}
+        ops = self.samples.keys() + [op for op in self.errors.keys() if not self.samples.has_key(op)]
+        for op in ops:
+            values = self.samples.get(op,[])
+            r = {'count':len(values),
+                 'errors':self.errors.get(op,0),
+                 'mean':None,'min':None,'max':None,
+                 'per_minute':0.0}
+            if values:
+                r['mean'] = sum(values) / len(values)
+                r['min'] = min(values)
+                r['max'] = max(values)
+            for p in PERCENTILES:
+                r['p%d' % p] = percentile(values,p)
+            if elapsed > 0:
+                r['per_minute'] = len(values) * 60.0 / elapsed
+            results[op] = r
+        return results
+
+
+class Benchmark(object):
+    """
+    Runs the scenarios against one server
+    """
+    def __init__(self,options):
+        self.options = options
+        self.url = options.url
+        self.master = options.master
+        instrument.enable()
+        self.session = esx.login(self.url,options.user,options.password)
+
+    def close(self):
+        esx.logout(self.session)
+
+    def run(self,name):
+        """
+        Run a scenario
+
+        :param name: one of SCENARIOS
+        :return: its results, as written in the JSON file
+        """
+        LOG.info("Benchmark: running %s" % name)
+        recorder = Recorder()
+        stats = instrument.getStats()
+        stats.reset()
+        start = time.time()
+        error = None
+        info = None
+        try:
+            info = getattr(self,name)(recorder)
+        except:
+            error = str(sys.exc_info()[1])
+            LOG.error("Benchmark: %s failed: %s" % (name,error))
+        elapsed = time.time() - start
+
+        result = {'scenario':name,
+                  'elapsed':elapsed,
+                  'error':error,
+                  'operations':recorder.summary(elapsed),
+                  'soap_calls':stats.callCount(),
+                  'soap_methods':{},
+                  'info':info or {}}
+        for method,h in stats.byMethod().items():
+            result['soap_methods'][method] = h.count
+        return result
+
+    # --- Scenarios ---
+
+    def clone_lifecycle(self,recorder):
+        o = self.options
+        for i in range(o.iterations):
+            start = time.time()
+            c = clone.Clone(vm_session=self.session,
+                            master_vm_name=self.master,
+                            guest_username=o.guest_user,
+                            guest_password=o.guest_password)
+            # A clone that failed to come up is left suspended
+            recorder.record("clone_init",time.time() - start,c.status == 'operational')
+            for state,seconds in c.lifecycle_timings.items():
+                recorder.record("state:%s" % state,seconds)
+            if c.quick_clone_vm_name:
+                recorder.time("destroyVM",esx.destroyVM,self.session,c.quick_clone_vm_name)
+
+    def concurrent_clones(self,recorder):
+        for i in range(self.options.iterations):
+            names = self.__cloneMany(recorder)
+            self.__destroyAll(names)
+
+    def revert_loop(self,recorder):
+        s,name = recorder.time("quickCloneVM",esx.quickCloneVM,self.session,self.master)
+        try:
+            s,snapshot = recorder.time("snapshotVM",esx.snapshotVM,self.session,name)
+            for i in range(self.options.iterations):
+                recorder.time("revertVM",esx.revertVM,self.session,name,snapshot)
+        finally:
+            self.__destroyAll([name])
+
+    def status_scan(self,recorder):
+        states = {}
+        for i in range(self.options.iterations):
+            s,states = recorder.time("getStatusAllVMS",esx.getStatusAllVMS,self.session)
+        return {'fleet_size':len(states)}
+
+    def destroy_sweep(self,recorder):
+        names = self.__cloneMany(recorder)
+        for name in names:
+            recorder.time("destroyVM",esx.destroyVM,self.session,name)
+
+    def __cloneMany(self,recorder):
+        """
+        Make --concurrency quick clones at once
+
+        :return: the names of the clones made
+        """
+        n = self.options.concurrency
+        s,batch = recorder.time("quickCloneMany",esx.quickCloneMany,self.session,self.master,n,n)
+        for r in batch.results:
+            recorder.record("quickCloneVM",r.elapsed or 0,r.ok())
+        return [r.name for r in batch.succeeded()]
+
+    def __destroyAll(self,names):
+        for name in names:
+            try:
+                esx.destroyVM(self.session,name)
+            except:
+                LOG.error("Benchmark: unable to destroy %s: %s" % (name,sys.exc_info()[1]))
+
+
+def compare(results,baseline):
+    """
+    Print how each operation's latency changed since a baseline run
+
+    :param results: the results of this run
+    :param baseline: the results of an earlier run, as read from its JSON file
+    """
+    old = {}
+    for scenario in baseline['scenarios']:
+        old[scenario['scenario']] = scenario['operations']
+    print "%-20s %-20s %12s %12s %8s" % ("scenario","operation","old p50","new p50","change")
+    for scenario in results['scenarios']:
+        for op,new in sorted(scenario['operations'].items()):
+            before = old.get(scenario['scenario'],{}).get(op)
+            if before is None or not before['p50'] or new['p50'] is None:
+                continue
+            change = (new['p50'] - before['p50']) * 100.0 / before['p50']
+            print "%-20s %-20s %12.3f %12.3f %+7.1f%%" % \
+                (scenario['scenario'],op,before['p50'],new['p50'],change)
+
+def report(results):
+    """
+    Print the results of a run
+    """
+    for scenario in results['scenarios']:
+        print "%s: %0.1fs, %s SOAP calls" % (scenario['scenario'],scenario['elapsed'],
+                                              scenario['soap_calls'])
+        if scenario['error']:
+            print "  failed: %s" % scenario['error']
+        for op,r in sorted(scenario['operations'].items()):
+            if r['count']:
+                print "  %-20s n=%-5d p50=%8.3fs p95=%8.3fs p99=%8.3fs %8.1f/min errors=%d" % \
+                    (op,r['count'],r['p50'],r['p95'],r['p99'],r['per_minute'],r['errors'])
+            else:
+                print "  %-20s errors=%d" % (op,r['errors'])
+
+def parseArgs(argv):
+    test = 'honeyclient::manager::esx::test'
+    parser = optparse.OptionParser(usage="%prog [options] [scenario ...]\n\nScenarios: " + ", ".join(SCENARIOS))
+    parser.add_option("-u","--url",default=getArg('service_url',test),
+                      help="the ESX server, or a sim:// URL for the simulator")
+    parser.add_option("--user",default=getArg('user_name',test))
+    parser.add_option("--password",default=getArg('password',test))
+    parser.add_option("-m","--master",default=getArg('test_vm_name',test),
+                      help="the VM to clone")
+    parser.add_option("-n","--iterations",type="int",default=5)
+    parser.add_option("-c","--concurrency",type="int",default=4,
+                      help="the number of clones made at once")
+    parser.add_option("--guest-user",dest="guest_user",default="benchmark")
+    parser.add_option("--guest-password",dest="guest_password",default="benchmark")
+    parser.add_option("--label",default="",help="a name for the run, ex: the version tested")
+    parser.add_option("-o","--output",help="the JSON file to write the results to")
+    parser.add_option("--baseline",help="the JSON file of an earlier run to compare with")
+    options,scenarios = parser.parse_args(argv)
+    for name in scenarios:
+        if name not in SCENARIOS:
+            parser.error("Unknown scenario: %s" % name)
+    return (options,scenarios or SCENARIOS)
+
+def main(argv):
+    options,scenarios = parseArgs(argv)
+    benchmark = Benchmark(options)
+    try:
+        started = time.time()
+        results = {'label':options.label,
+                   'url':options.url,
+                   'master':options.master,
+                   'iterations':options.iterations,
+                   'concurrency':options.concurrency,
+                   'started':time.strftime("%Y-%m-%dT%H:%M:%S",time.localtime(started)),
+                   'scenarios':[benchmark.run(name) for name in scenarios]}
+    finally:
+        benchmark.close()
+
+    report(results)
+    if options.output:
+        f = open(options.output,"w")
+        try:
+            f.write(jsonutil.dumps(results,2))
+        finally:
+            f.close()
+    if options.baseline:
+        f = open(options.baseline)
+        try:
+            compare(results,jsonutil.loads(f.read()))
+        finally:
+            f.close()
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
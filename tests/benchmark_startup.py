@@ -0,0 +1,183 @@
+"""
+Benchmark of how long a new process takes to start using the honeyclient
+modules: the short lived command line tools and the workers that are
+restarted pay it every time.
+
+Each run starts a new Jython, which times, in order:
+
+ jvm_startup     from the start of the JVM to the first line of this script
+ import_config   import honeyclient.util.config
+ first_getarg    the first getArg(), which reads honeyclient.xml
+ first_log       the first LOG call, which sets the logger up
+ import_esx      import honeyclient.manager.esx
+ import_vijava   import the vijava classes esx loads on first use, see VIJAVA_CLASSES
+ import_helpers  import the helper modules esx loads on first use, see ESX_HELPERS
+ import_clone    import honeyclient.manager.clone
+ total           from the start of the JVM to the end of all of the above
+
+The results are written in the format of tests/benchmark.py, so runs can
+be compared with --baseline the same way.
+
+Examples:
+ ./run_benchmark.sh startup
+ ./run_benchmark.sh startup -n 20 -o startup.json --baseline old_startup.json
+"""
+
+import time
+__started = time.time()
+
+import optparse,os,subprocess,sys
+
+# The steps timed in each new process, in order
+STEPS = ['jvm_startup','import_config','first_getarg','first_log','import_esx','import_vijava',
+         'import_helpers','import_clone','total']
+
+# The vijava classes esx only imports in the functions that use them
+VIJAVA_CLASSES = {'java.net':['URL'],
+                  'com.vmware.vim25':['MethodFault','ObjectSpec','OptionValue','PropertyFilterSpec',
+                                      'PropertySpec','SelectionSpec','TraversalSpec',
+                                      'VirtualDeviceConfigSpec','VirtualDeviceConfigSpecOperation',
+                                      'VirtualDiskSpec','VirtualMachineConfigSpec'],
+                  'com.vmware.vim25.mo':['ComputeResource','InventoryNavigator','ServiceInstance','Task',
+                                         'VirtualMachine','VirtualMachineSnapshot'],
+                  'com.vmware.vim25.mo.util':['MorUtil','PropertyCollectorUtil']}
+
+# The modules esx only imports in the functions that use them
+ESX_HELPERS = ['batch','deletion','devices','futures','instrument','names','sessions','transfer','updates']
+
+# Marks the line of the child's output with its timings
+RESULT_PREFIX = "STARTUP "
+
+
+def child():
+    """
+    Time the steps in this process and print them
+    """
+    from java.lang.management import ManagementFactory
+    jvm_started = ManagementFactory.getRuntimeMXBean().getStartTime() / 1000.0
+    timings = {'jvm_startup':__started - jvm_started}
+
+    def step(name,fn):
+        start = time.time()
+        fn()
+        timings[name] = time.time() - start
+
+    def importConfig():
+        global config
+        from honeyclient.util import config
+
+    def importEsx():
+        from honeyclient.manager import esx
+
+    def importVijava():
+        for package,classes in VIJAVA_CLASSES.items():
+            __import__(package,globals(),locals(),classes)
+
+    def importHelpers():
+        __import__('honeyclient.manager',globals(),locals(),ESX_HELPERS)
+
+    def importClone():
+        from honeyclient.manager import clone
+
+    step('import_config',importConfig)
+    step('first_getarg',lambda: config.getArg('service_url','HoneyClient::Manager::ESX::Test'))
+    step('first_log',lambda: config.LOG.debug("Timing the startup"))
+    step('import_esx',importEsx)
+    step('import_vijava',importVijava)
+    step('import_helpers',importHelpers)
+    step('import_clone',importClone)
+    timings['total'] = time.time() - jvm_started
+
+    from honeyclient.util import jsonutil
+    print RESULT_PREFIX + jsonutil.dumps(timings)
+    return 0
+
+
+def runChild(options):
+    """
+    Start a new Jython running child()
+
+    :return: ({step:seconds},wall clock seconds of the process)
+    """
+    from honeyclient.util import jsonutil
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    command = options.jython.split() + ["-Dpython.path=%s" % root,os.path.abspath(__file__),"--child"]
+    start = time.time()
+    p = subprocess.Popen(command,stdout=subprocess.PIPE,stderr=subprocess.PIPE,cwd=options.cwd or root)
+    out,err = p.communicate()
+    elapsed = time.time() - start
+    for line in out.splitlines():
+        if line.startswith(RESULT_PREFIX):
+            return (jsonutil.loads(line[len(RESULT_PREFIX):]),elapsed)
+    raise RuntimeError("The child process failed (exit code %s): %s" % (p.returncode,err.strip()[-2000:]))
+
+def run(options):
+    """
+    :return: the results, as written in the JSON file
+    """
+    import benchmark
+    recorder = benchmark.Recorder()
+    error = None
+    started = time.time()
+    for i in range(options.iterations):
+        try:
+            timings,elapsed = runChild(options)
+        except Exception,e:
+            error = str(e)
+            recorder.record("process",0,False)
+            continue
+        recorder.record("process",elapsed)
+        for name in STEPS:
+            if timings.has_key(name):
+                recorder.record(name,timings[name])
+    elapsed = time.time() - started
+    scenario = {'scenario':'startup',
+                'elapsed':elapsed,
+                'error':error,
+                'operations':recorder.summary(elapsed),
+                'soap_calls':0,
+                'info':{'command':options.jython}}
+    return {'label':options.label,
+            'iterations':options.iterations,
+            'started':time.strftime("%Y-%m-%dT%H:%M:%S",time.localtime(started)),
+            'scenarios':[scenario]}
+
+def parseArgs(argv):
+    parser = optparse.OptionParser(usage="%prog [options]")
+    parser.add_option("-n","--iterations",type="int",default=5,
+                      help="the number of processes started")
+    parser.add_option("--jython",default="jython",
+                      help="the command that starts Jython, ex: 'jython -J-Xmx512m'")
+    parser.add_option("--cwd",help="the working directory of the processes (default: the top of the tree)")
+    parser.add_option("--label",default="",help="a name for the run, ex: the version tested")
+    parser.add_option("-o","--output",help="the JSON file to write the results to")
+    parser.add_option("--baseline",help="the JSON file of an earlier run to compare with")
+    parser.add_option("--child",action="store_true",help=optparse.SUPPRESS_HELP)
+    options,args = parser.parse_args(argv)
+    return options
+
+def main(argv):
+    options = parseArgs(argv)
+    if options.child:
+        return child()
+
+    import benchmark
+    from honeyclient.util import jsonutil
+    results = run(options)
+    benchmark.report(results)
+    if options.output:
+        f = open(options.output,"w")
+        try:
+            f.write(jsonutil.dumps(results,2))
+        finally:
+            f.close()
+    if options.baseline:
+        f = open(options.baseline)
+        try:
+            benchmark.compare(results,jsonutil.loads(f.read()))
+        finally:
+            f.close()
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
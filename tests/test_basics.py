@@ -25,6 +25,19 @@ class TestBasics(unittest.TestCase):
         s,r = listAllRegisteredVMS(self.session)
         self.assertTrue(len(r) > 0)
 
+    def testInventory(self):
+        s,r = getInventoryESX(self.session,'VirtualMachine',['name','runtime.powerState'])
+        names = [rec['name'] for rec in r]
+        self.assertTrue(self.testvm in names)
+        for rec in r:
+            self.assert_(rec['mor'])
+            self.assert_(rec['runtime.powerState'])
+
+    def testStatusAllVMS(self):
+        s,r = getStatusAllVMS(self.session)
+        s,state = getStateVM(self.session,self.testvm)
+        self.assertEqual(r[self.testvm],state)
+
     def testEsxHostname(self):
         s,hostname = getHostnameESX(self.session)
         self.assert_(hostname,"Hostname was null")
@@ -83,6 +96,12 @@ class TestBasics(unittest.TestCase):
         # Note using a special VM name I know has snapshots
         s, h = getAllSnapshotsVM(self.session,'Drone')
         self.assertTrue(len(h) > 0)
+
+    def test_get_snapshot_tree(self):
+        s, tree = getSnapshotTreeVM(self.session,'Drone')
+        s, h = getAllSnapshotsVM(self.session,'Drone')
+        roots = [n['name'] for n in tree if n['depth'] == 0]
+        self.assertEqual(sorted(roots),sorted(h.keys()))
         
 
     def testDataStoreSpaceAvailable(self):
@@ -0,0 +1,87 @@
+import unittest
+from honeyclient.manager.batch import *
+from honeyclient.manager import errors
+import threading,time
+
+class TestBatch(unittest.TestCase):
+    """
+    Unit tests for batch.py. These don't need an ESX server
+    """
+    def testResults(self):
+        def double(x): return x * 2
+        jobs = [BatchJob("job%d" % i,double,(i,)) for i in range(5)]
+        b = runBatch(jobs,3)
+        self.assertEqual([r.result for r in b.results],[0,2,4,6,8])
+        self.assertEqual(len(b.succeeded()),5)
+        self.assert_(b.elapsed >= 0)
+
+    def testErrors(self):
+        def fail(): raise errors.ESXError("croaked")
+        def boom(): raise ValueError("boom")
+        def fine(): return True
+        b = runBatch([BatchJob("a",fail),BatchJob("b",boom),BatchJob("c",fine)],2)
+        self.assertEqual([r.name for r in b.failed()],["a","b"])
+        self.assertEqual(b.results[2].result,True)
+        self.assertTrue(isinstance(b.results[0].error,errors.ESXError))
+
+    def testLimits(self):
+        lock = threading.Lock()
+        state = {'running':0,'max':0}
+        def work():
+            lock.acquire()
+            state['running'] += 1
+            state['max'] = max(state['max'],state['running'])
+            lock.release()
+            time.sleep(0.05)
+            lock.acquire()
+            state['running'] -= 1
+            lock.release()
+        key = ('datastore','test-limits')
+        jobs = [BatchJob("job%d" % i,work,keys=[key]) for i in range(6)]
+        b = runBatch(jobs,6,{key:2})
+        self.assertEqual(len(b.succeeded()),6)
+        self.assertTrue(state['max'] <= 2)
+
+    def testSharedLimits(self):
+        lock = threading.Lock()
+        state = {'running':0,'max':0}
+        def work():
+            lock.acquire()
+            state['running'] += 1
+            state['max'] = max(state['max'],state['running'])
+            lock.release()
+            time.sleep(0.05)
+            lock.acquire()
+            state['running'] -= 1
+            lock.release()
+        key = ('datastore','test-shared-limits')
+        # Two batches at once share the limit
+        threads = []
+        for i in range(2):
+            jobs = [BatchJob("job%d" % i,work,keys=[key]) for i in range(6)]
+            t = threading.Thread(target=runBatch,args=(jobs,6,{key:2}))
+            t.start()
+            threads.append(t)
+        for t in threads:
+            t.join()
+        self.assertEqual(getLimit(key),2)
+        self.assertTrue(state['max'] <= 2)
+
+        # A later batch can raise it
+        state['max'] = 0
+        jobs = [BatchJob("job%d" % i,work,keys=[key]) for i in range(6)]
+        runBatch(jobs,6,{key:4})
+        self.assertEqual(getLimit(key),4)
+        self.assertTrue(state['max'] > 2)
+        self.assertTrue(state['max'] <= 4)
+
+        # or lower it
+        state['max'] = 0
+        jobs = [BatchJob("job%d" % i,work,keys=[key]) for i in range(6)]
+        runBatch(jobs,6,{key:1})
+        self.assertEqual(getLimit(key),1)
+        self.assertEqual(state['max'],1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,49 @@
+import unittest
+from honeyclient.manager.cache import *
+from time import sleep
+
+class TestCache(unittest.TestCase):
+    """
+    Unit tests for cache.py. These don't need an ESX server
+    """
+    def testPutGet(self):
+        c = VMCache(60)
+        c.put('vm1','mor-1')
+        self.assertEqual(c.get('vm1'),'mor-1')
+        self.assertEqual(c.get('vm2'),None)
+
+    def testExpire(self):
+        c = VMCache(0)
+        c.put('vm1','mor-1')
+        sleep(0.1)
+        self.assertEqual(c.get('vm1'),None)
+        self.assertEqual(len(c),0)
+
+    def testNoExpire(self):
+        c = VMCache(-1)
+        c.put('vm1','mor-1')
+        sleep(0.1)
+        self.assertEqual(c.get('vm1'),'mor-1')
+
+    def testInvalidate(self):
+        c = VMCache(60)
+        c.put('vm1','mor-1')
+        c.put('vm2','mor-2')
+        c.invalidate('vm1')
+        self.assertEqual(c.get('vm1'),None)
+        self.assertEqual(c.get('vm2'),'mor-2')
+        c.invalidate()
+        self.assertEqual(len(c),0)
+
+    def testSessionRegistry(self):
+        session = object()
+        c = getCache(session,10)
+        self.assert_(getCache(session) is c)
+        self.assertEqual(c.ttl,10)
+        dropCache(session)
+        self.assert_(getCache(session) is not c)
+        dropCache(session)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,78 @@
+import threading,time
+import unittest
+from honeyclient.manager.esx import *
+from honeyclient.manager import capacity,errors
+from honeyclient.util.config import *
+
+GB = capacity.GB
+
+class TestCapacity(unittest.TestCase):
+    """
+    Reserve datastore space on a simulated ESX server
+    """
+    url = "sim://test-capacity/sdk?capacity=20&memory=256"
+
+    def setUp(self):
+        self.testvm = getArg('test_vm_name','honeyclient::manager::esx::test')
+        self.session = login(TestCapacity.url + "&vm_names=" + self.testvm,"root","")
+        self.tracker = capacity.CapacityTracker(self.session,min_free=2 * GB,delta_growth=512,
+                                                refresh_interval=300,wait_timeout=0)
+        self.tracker.refresh()
+
+    def tearDown(self):
+        logout(self.session)
+
+    def test_footprint(self):
+        # The delta disks and twice the memory
+        self.assertEqual(self.tracker.footprint(self.testvm),(512 + 2 * 256) * capacity.MB)
+        s,stores = getDatastoreSpaceAvailableVM(self.session,self.testvm)
+        self.assertEqual(self.tracker.free(),stores)
+
+    def test_reserve(self):
+        name = self.tracker.free().keys()[0]
+        footprint = self.tracker.footprint(self.testvm)
+        n = int(self.tracker.available(name) / footprint)
+        self.assertTrue(n > 0)
+        reservations = [self.tracker.reserve(self.testvm) for i in range(n)]
+        self.assertEqual(self.tracker.reserved()[name],n * footprint)
+        self.assertFalse(self.tracker.hasSpace(self.testvm))
+        self.assertRaises(errors.DatastoreFull,self.tracker.reserve,self.testvm)
+
+        reservations[0].release()
+        reservations[0].release()
+        self.assertTrue(self.tracker.hasSpace(self.testvm))
+        reservations[0] = self.tracker.reserve(self.testvm)
+        for r in reservations:
+            r.release()
+        self.assertEqual(self.tracker.reserved(),{})
+
+    def test_wait(self):
+        name = self.tracker.free().keys()[0]
+        held = self.tracker.reserve(self.testvm,self.tracker.available(name))
+        threading.Timer(0.2,held.release).start()
+        start = time.time()
+        r = self.tracker.reserve(self.testvm,timeout=10)
+        self.assertTrue(held.released)
+        self.assertTrue(time.time() - start < 10)
+        r.release()
+
+    def test_quick_clone(self):
+        tracker = capacity.getTracker(self.session)
+        s,clone = quickCloneVM(self.session,self.testvm)
+        self.assertNotEqual(tracker.reserved(),{})
+
+        # The space is held until the clone is destroyed
+        destroyVM(self.session,clone)
+        self.assertEqual(tracker.reserved(),{})
+
+        # A clone that doesn't fit isn't made
+        name = tracker.free().keys()[0]
+        held = tracker.reserve(self.testvm,tracker.available(name))
+        try:
+            self.assertRaises(errors.DatastoreFull,quickCloneVM,self.session,self.testvm)
+        finally:
+            held.release()
+        self.assertEqual(tracker.reserved(),{})
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,3 +1,4 @@
+import os
 import unittest
 from honeyclient.util.config import *
 
@@ -7,9 +8,10 @@ class TestConfig(unittest.TestCase):
     """
     def testLoadDocument(self):
         """
-        Assert the document is loaded on import config
+        Assert the document is loaded on first use
         """
-        self.assert_(XP)
+        self.assert_(getDocument())
+        self.assert_(os.path.exists(getConfigFile()))
 
     def testGetAttribute(self):
         r = getArg('session_timeout','honeyclient::manager::esx','description')
@@ -19,5 +21,52 @@ class TestConfig(unittest.TestCase):
         r = getArg('session_timeout','honeyclient::manager::esx')
         self.assertEqual(r,"900")
 
+    def testCaseInsensitive(self):
+        r = getArg('Session_Timeout','HoneyClient::Manager::ESX')
+        self.assertEqual(r,"900")
+        r = getArg('session_timeout','HoneyClient::Manager::ESX','DESCRIPTION')
+        self.assertEqual(r,"A")
+
+    def testMissing(self):
+        self.assertEqual(getArg('no_such_tag','honeyclient::manager::esx'),'undef')
+        self.assertEqual(getArg('session_timeout','honeyclient::manager::esx','nope'),'undef')
+
+    def testGetIntArg(self):
+        self.assertEqual(getIntArg('session_timeout','honeyclient::manager::esx'),900)
+        self.assertEqual(getIntArg('session_timeout','honeyclient::manager::esx',5),900)
+        self.assertEqual(getIntArg('no_such_tag','honeyclient::manager::esx',5),5)
+        self.assertEqual(getIntArg('no_such_tag','honeyclient::manager::esx'),None)
+        # A value given by the caller wins
+        self.assertEqual(getIntArg('session_timeout','honeyclient::manager::esx',5,"10"),10)
+
+    def testGetDict(self):
+        r = getArg('esx','honeyclient::manager')
+        self.assertEqual(r['session_timeout'],[{'900':{'description':'A','default':'900'}}])
+        # Changing the result doesn't change the configuration
+        r['session_timeout'] = []
+        r = getArg('esx','honeyclient::manager')
+        self.assertEqual(len(r['session_timeout']),1)
+
+    def testReload(self):
+        self.assert_(reloadConfig())
+        r = getArg('session_timeout','honeyclient::manager::esx')
+        self.assertEqual(r,"900")
+
+    def testLoggerFallback(self):
+        """
+        Assert a logger that can't be configured still logs, with the defaults
+        """
+        from honeyclient.util import config
+        def broken():
+            raise ImportError("No module named org.dom4j")
+        saved = config.configureLogging
+        config.configureLogging = broken
+        try:
+            log = config._LazyLogger()
+            log.debug("Logged with the default settings")
+            self.assertEqual(len(getLogger().handlers),1)
+        finally:
+            config.configureLogging = saved
+
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,38 @@
+import unittest
+from honeyclient.manager.deletion import *
+
+class Files(object):
+    def __init__(self,vmx,suspend=None,snapshot=None,log=None):
+        self.vmx = vmx
+        self.suspend = suspend
+        self.snapshot = snapshot
+        self.log = log
+    def getVmPathName(self): return self.vmx
+    def getSuspendDirectory(self): return self.suspend
+    def getSnapshotDirectory(self): return self.snapshot
+    def getLogDirectory(self): return self.log
+
+class Config(object):
+    def __init__(self,files):
+        self.files = files
+    def getFiles(self): return self.files
+
+class TestDeletion(unittest.TestCase):
+    """
+    Unit tests for deletion.py. These need the VI Java API but not an ESX server
+    """
+    def testVMDirectories(self):
+        config = Config(Files("[datastore1] vm/vm.vmx","[datastore1] vm/","[datastore1] vm/snaps",None))
+        self.assertEqual(vmDirectories(config),["[datastore1] vm"])
+
+    def testSharedDirectories(self):
+        # A quick clone's vmx points at its master's working directory
+        config = Config(Files("[datastore1] clone/master.vmx","[datastore1] master/",
+                              "[datastore1] master/","[datastore2] logs"))
+        self.assertEqual(vmDirectories(config),["[datastore1] clone"])
+
+    def testDatastoreRoot(self):
+        self.assertEqual(vmDirectories(Config(Files("[datastore1] vm.vmx"))),[])
+
+if __name__ == '__main__':
+    unittest.main()
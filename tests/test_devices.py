@@ -0,0 +1,59 @@
+import unittest
+from com.vmware.vim25 import *
+from honeyclient.manager.devices import *
+
+def controller(key,summary):
+    ctrl = VirtualLsiLogicController()
+    ctrl.setKey(key)
+    info = Description()
+    info.setLabel("SCSI controller")
+    info.setSummary(summary)
+    ctrl.setDeviceInfo(info)
+    return ctrl
+
+def disk(key,controller_key,filename):
+    dev = VirtualDisk()
+    dev.setKey(key)
+    dev.setControllerKey(controller_key)
+    backing = VirtualDiskFlatVer2BackingInfo()
+    backing.setFileName(filename)
+    dev.setBacking(backing)
+    return dev
+
+class TestDevices(unittest.TestCase):
+    """
+    Unit tests for devices.py. These need the VI Java API but not an ESX server
+    """
+    def setUp(self):
+        self.devices = [controller(1000,"LSI Logic"),
+                        controller(1001,"Bus Logic"),
+                        disk(2000,1000,"[datastore1] vm/vm.vmdk"),
+                        disk(2001,1001,"[datastore1] vm/vm_1.vmdk")]
+
+    def testIndex(self):
+        t = DeviceTopology(self.devices,"[datastore1] vm/vm.vmx","v1")
+        self.assertEqual(len(t.disks),2)
+        self.assertEqual(t.device(2001).getKey(),2001)
+        self.assertEqual(t.device(3000),None)
+        self.assertEqual(t.version,"v1")
+
+    def testAdapterType(self):
+        t = DeviceTopology(self.devices)
+        self.assertEqual(t.adapterType(t.device(2000)),"lsiLogic")
+        self.assertEqual(t.adapterType(t.device(2001)),"busLogic")
+        self.assertEqual(t.adapterType(disk(2002,1002,"[datastore1] vm/vm_2.vmdk")),None)
+
+    def testExternalDisks(self):
+        t = DeviceTopology(self.devices,"[datastore1] vm/vm.vmx")
+        self.assertFalse(t.hasExternalDisks())
+        t = DeviceTopology(self.devices + [disk(2002,1000,"[datastore1] master/master.vmdk")],
+                           "[datastore1] vm/vm.vmx")
+        self.assertTrue(t.hasExternalDisks())
+
+    def testEmpty(self):
+        t = DeviceTopology(None)
+        self.assertEqual(t.disks,[])
+        self.assertFalse(t.hasExternalDisks())
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,50 @@
+import unittest
+from honeyclient.manager.errors import *
+
+class NotAuthenticated(Exception):
+    pass
+
+class NoDiskSpace(Exception):
+    pass
+
+class OutOfDiskSpace(NoDiskSpace):
+    pass
+
+class LocalizedFault:
+    def __init__(self,fault):
+        self.fault = fault
+    def getFault(self):
+        return self.fault
+
+class TestErrors(unittest.TestCase):
+    """
+    Unit tests for errors.py. These don't need an ESX server
+    """
+    def testHierarchy(self):
+        for cls in [LoginFailed,SessionExpired,VMNotFound,SnapshotNotFound,
+                    NameCollision,InvalidVMState,TaskFailed,QuestionUnanswerable,
+                    DatastoreFull,FileOperationFailed,CloneError,TimedOut,Cancelled]:
+            self.assert_(issubclass(cls,ESXError))
+
+    def testDetails(self):
+        e = VMNotFound("VM name: vm1 not found","vm1")
+        self.assertEqual(str(e),"VM name: vm1 not found")
+        self.assertEqual(e.vm,"vm1")
+        self.assertEqual(e.task,None)
+        self.assertEqual(e.fault,None)
+
+    def testErrorForFault(self):
+        self.assertEqual(errorForFault(None),ESXError)
+        self.assertEqual(errorForFault(None,TaskFailed),TaskFailed)
+        self.assertEqual(errorForFault(NotAuthenticated()),SessionExpired)
+        self.assertEqual(errorForFault(ValueError(),TaskFailed),TaskFailed)
+        self.assertEqual(errorForFault(SessionExpired("closed"),TaskFailed),SessionExpired)
+
+    def testErrorForSubclassedFault(self):
+        self.assertEqual(errorForFault(OutOfDiskSpace()),DatastoreFull)
+
+    def testErrorForLocalizedFault(self):
+        self.assertEqual(errorForFault(LocalizedFault(NoDiskSpace())),DatastoreFull)
+
+if __name__ == '__main__':
+    unittest.main()
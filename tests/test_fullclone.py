@@ -1,4 +1,5 @@
 import unittest
+from com.vmware.vim25.mo import InventoryNavigator
 from honeyclient.manager.esx import *
 from honeyclient.util.config import *
 
@@ -43,6 +44,25 @@ class FullCloneTest(unittest.TestCase):
         s,state2 = getStateVM(s,self.testvm)
         self.assertEqual('poweredOff',state2)
 
+    def test_full_copy_report(self):
+        s,state = getStateVM(self.session,self.testvm)
+        if state == 'poweredOn':
+            stopVM(self.session,self.testvm)
+
+        dst = "copy-report-test"
+        s,vmx,report = fullCopyVM(self.session,self.testvm,dst,2,True)
+        self.assert_(vmx.endswith(".vmx"))
+        self.assert_(report.ok())
+        self.assertEqual(report.failed(),[])
+        for op in report.ops:
+            self.assert_(op.elapsed is not None)
+        self.assertEqual(report.ops[-1].dst,vmx)
+
+        # Clean up the copy
+        datacenter = InventoryNavigator(self.session.getRootFolder()).searchManagedEntity("Datacenter","ha-datacenter")
+        task = self.session.getFileManager().deleteDatastoreFile_Task(os.path.dirname(vmx),datacenter)
+        task.waitForMe()
+
 
 if __name__ == '__main__':
     unittest.main()
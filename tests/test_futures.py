@@ -0,0 +1,137 @@
+import unittest,time
+from honeyclient.manager import errors
+from honeyclient.manager.esx import *
+from honeyclient.manager.futures import *
+from honeyclient.util.config import *
+
+class TestFutures(unittest.TestCase):
+    """
+    Unit tests for futures.py. These need Jython but not an ESX server
+    """
+    def testResult(self):
+        f = Future("op")
+        self.assertFalse(f.done())
+        self.assertFalse(f.wait(0.1))
+        self.assertTrue(f.setResult(1))
+        self.assertFalse(f.setResult(2))
+        self.assertTrue(f.done())
+        self.assertEqual(f.result(),1)
+        self.assertEqual(f.error(),None)
+
+    def testError(self):
+        f = failed(errors.VMNotFound("gone","vm1"))
+        self.assertRaises(errors.VMNotFound,f.result)
+        self.assertEqual(f.error().vm,"vm1")
+
+    def testTimeout(self):
+        f = Future("op")
+        self.assertRaises(errors.TimedOut,f.result,0.1)
+        # The operation isn't affected
+        self.assertFalse(f.done())
+
+    def testCancel(self):
+        cancelled = []
+        f = Future("op")
+        f.setCancelHook(lambda: cancelled.append(True))
+        self.assertTrue(f.cancel())
+        self.assertTrue(f.cancelled())
+        self.assertEqual(cancelled,[True])
+        self.assertRaises(errors.Cancelled,f.result)
+        self.assertFalse(f.cancel())
+
+    def testCallback(self):
+        seen = []
+        f = Future()
+        f.addCallback(lambda x: seen.append(x.result()))
+        f.setResult(3)
+        completed(4).addCallback(lambda x: seen.append(x.result()))
+        self.assertEqual(seen,[3,4])
+
+    def testThen(self):
+        inner = Future()
+        f = Future()
+        chained = f.then(lambda x: x + 1).then(lambda x: inner)
+        f.setResult(1)
+        self.assertFalse(chained.done())
+        inner.setResult("done")
+        self.assertEqual(chained.result(1),"done")
+
+        f = Future()
+        chained = f.then(lambda x: x + 1)
+        f.setError(errors.TaskFailed("failed"))
+        self.assertRaises(errors.TaskFailed,chained.result)
+
+        chained = completed(1).then(lambda x: x / 0)
+        self.assertRaises(ZeroDivisionError,chained.result)
+
+    def testAllOf(self):
+        a = Future()
+        b = Future()
+        f = allOf([a,b])
+        b.setResult(2)
+        self.assertFalse(f.done())
+        a.setResult(1)
+        self.assertEqual(f.result(),[1,2])
+        self.assertEqual(allOf([]).result(),[])
+
+        a = Future()
+        f = allOf([a,completed(2)])
+        a.setError(errors.TaskFailed("failed"))
+        self.assertRaises(errors.TaskFailed,f.result)
+
+    def testAnyOf(self):
+        a = Future()
+        b = Future()
+        f = anyOf([a,b])
+        a.setError(errors.TaskFailed("failed"))
+        self.assertFalse(f.done())
+        b.setResult(2)
+        self.assertTrue(f.result() is b)
+
+        f = anyOf([failed(errors.TaskFailed("a")),failed(errors.VMNotFound("b"))])
+        self.assertRaises(errors.VMNotFound,f.result)
+
+    def testSubmit(self):
+        f = submit(lambda x,y: x * y,6,7)
+        self.assertEqual(f.result(5),42)
+        f = submit(lambda: completed("nested"))
+        self.assertEqual(f.result(5),"nested")
+
+    def testSchedule(self):
+        f = Future()
+        schedule(0.1,f.setResult,"later")
+        self.assertEqual(f.result(5),"later")
+
+
+class TestAsyncOperations(unittest.TestCase):
+    """
+    Test the _async operations against the ESX server
+    """
+    def setUp(self):
+        self.url = getArg('service_url','honeyclient::manager::esx::test')
+        self.un = getArg('user_name','honeyclient::manager::esx::test')
+        self.pw = getArg('password','honeyclient::manager::esx::test')
+        self.testvm = getArg('test_vm_name','honeyclient::manager::esx::test')
+        self.session = login(self.url,self.un,self.pw)
+
+    def tearDown(self):
+        logout(self.session)
+
+    def test_start_stop_async(self):
+        f = startVM_async(self.session,self.testvm).then(lambda r: stopVM_async(self.session,self.testvm))
+        s,stopped = f.result(600)
+        self.assertTrue(stopped)
+        s,state = getStateVM(self.session,self.testvm)
+        self.assertEqual('poweredOff',state)
+
+    def test_snapshot_async(self):
+        f = snapshotVM_async(self.session,self.testvm)
+        s,name = f.result(600)
+        s,tree = getAllSnapshotsVM(self.session,self.testvm)
+        self.assertTrue(tree.has_key(name))
+        removeSnapshotVM_async(self.session,self.testvm,name).result(600)
+        s,tree = getAllSnapshotsVM(self.session,self.testvm)
+        self.assertFalse(tree.has_key(name))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,76 @@
+import unittest
+from com.vmware.vim25 import *
+from honeyclient.manager.esx import *
+from honeyclient.manager.guestnet import *
+from honeyclient.util.config import *
+
+def nic(mac,ips,network="VM Network"):
+    n = GuestNicInfo()
+    n.setMacAddress(mac)
+    n.setIpAddress(ips)
+    n.setNetwork(network)
+    n.setConnected(True)
+    return n
+
+class TestGuestNetwork(unittest.TestCase):
+    """
+    Unit tests for guestnet.py. These need the VI Java API but not an ESX server
+    """
+    def testLinkLocal(self):
+        for ip in ["169.254.1.1","fe80::20c:29ff:fe00:1","FE80::1","febf::1","0.0.0.0","::",""]:
+            self.assertTrue(isLinkLocal(ip),ip)
+        for ip in ["10.0.0.5","192.168.1.1","2001:db8::1","fec0::1"]:
+            self.assertFalse(isLinkLocal(ip),ip)
+
+    def testAllNics(self):
+        net = fromGuest("vm1",[nic("00:0c:29:00:00:01",["169.254.9.9","fe80::1"]),
+                               nic("00:0c:29:00:00:02",["fe80::2","2001:db8::2","10.0.1.5"])],
+                        "guestToolsRunning")
+        self.assertEqual(len(net.nics),2)
+        self.assertEqual(net.nics[0].ips,[])
+        self.assertFalse(net.nics[0].ready())
+        self.assertEqual(net.nics[1].ips,["2001:db8::2","10.0.1.5"])
+        self.assertEqual(net.primary().mac,"00:0c:29:00:00:02")
+        # IPv4 first
+        self.assertEqual(net.primary().ip(),"10.0.1.5")
+        self.assertTrue(net.ready())
+
+    def testTools(self):
+        nics = [nic("00:0c:29:00:00:01",["10.0.0.5"])]
+        self.assertFalse(fromGuest("vm1",nics,"guestToolsNotRunning").ready())
+        self.assertTrue(fromGuest("vm1",nics,"guestToolsRunning").ready())
+        # Servers that don't report the status
+        self.assertTrue(fromGuest("vm1",nics).ready())
+        self.assertFalse(fromGuest("vm1",None,"guestToolsRunning").ready())
+
+
+class TestGuestNetWatcher(unittest.TestCase):
+    """
+    Wait for the network of the test VM on the ESX server
+    """
+    def setUp(self):
+        self.url = getArg('service_url','honeyclient::manager::esx::test')
+        self.un = getArg('user_name','honeyclient::manager::esx::test')
+        self.pw = getArg('password','honeyclient::manager::esx::test')
+        self.testvm = getArg('test_vm_name','honeyclient::manager::esx::test')
+        self.session = login(self.url,self.un,self.pw)
+
+    def tearDown(self):
+        stopVM(self.session,self.testvm)
+        logout(self.session)
+
+    def test_watch(self):
+        watcher = GuestNetWatcher(self.session)
+        seen = []
+        f = watcher.watch(self.testvm,seen.append,600)
+        self.assertTrue(watcher.watch(self.testvm) is f)
+        startVM(self.session,self.testvm)
+        network = f.result()
+        self.assertTrue(network.ready())
+        self.assertEqual(seen,[network])
+        s,mac = getMACaddrVM(self.session,self.testvm)
+        self.assertTrue(mac in [n.mac for n in network.nics])
+        watcher.close()
+
+if __name__ == '__main__':
+    unittest.main()
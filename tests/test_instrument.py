@@ -0,0 +1,86 @@
+import unittest
+from honeyclient.manager.esx import *
+from honeyclient.manager import instrument
+from honeyclient.util.config import *
+
+class TestHistogram(unittest.TestCase):
+    """
+    Unit tests for the histograms and stats. These need the VI Java API but not an ESX server
+    """
+    def testPercentile(self):
+        h = instrument.Histogram()
+        self.assertEqual(h.percentile(50),None)
+        for seconds in [0.002] * 90 + [0.2] * 9 + [100.0]:
+            h.add(seconds)
+        self.assertEqual(h.count,100)
+        self.assertEqual(h.percentile(50),0.0025)
+        self.assertEqual(h.percentile(95),0.25)
+        self.assertEqual(h.percentile(100),100.0)
+        self.assertEqual(h.toDict()['buckets'],{'0.0025':90,'0.25':9,'+Inf':1})
+
+    def testStats(self):
+        stats = instrument.Stats()
+        stats.record('getStateVM','vm1','retrieveProperties',['runtime.powerState'],0.01,None)
+        stats.record('getStateVM','vm1','retrieveProperties',['runtime.powerState'],0.02,None)
+        stats.record('startVM','vm2','powerOnVM_Task',[],0.5,Exception("no"))
+        self.assertEqual(stats.callCount(),3)
+        self.assertEqual(stats.callCount('powerOnVM_Task'),1)
+        self.assertEqual(stats.byOperation()['getStateVM'].count,2)
+        self.assertEqual(stats.byMethod()['powerOnVM_Task'].errors,1)
+        self.assertEqual(stats.vms,{'vm1':2,'vm2':1})
+        self.assertEqual(stats.properties[('getStateVM','runtime.powerState')],2)
+        # The slowest first
+        self.assertTrue(stats.report().splitlines()[1].startswith('startVM'))
+        stats.reset()
+        self.assertEqual(stats.callCount(),0)
+
+    def testTrace(self):
+        stats = instrument.getStats()
+        trace = stats.startTrace('test')
+        stats.record('getStateVM','vm1','retrieveProperties',[],0.01,None)
+        trace.stop()
+        stats.record('getStateVM','vm1','retrieveProperties',[],0.01,None)
+        self.assertEqual(len(trace.events),1)
+        self.assertEqual(trace.events[0]['vm'],'vm1')
+        self.assertEqual(len(trace.format().splitlines()),2)
+
+
+class TestInstrument(unittest.TestCase):
+    """
+    Instrument a session on a simulated ESX server
+    """
+    url = "sim://test-instrument/sdk?vms=3"
+
+    def setUp(self):
+        self.testvm = getArg('test_vm_name','honeyclient::manager::esx::test')
+        instrument.enable()
+        self.session = login(TestInstrument.url + "&vm_names=" + self.testvm,"root","")
+        self.stats = instrument.getStats()
+        self.stats.reset()
+
+    def tearDown(self):
+        logout(self.session)
+        instrument.enable(False)
+
+    def test_calls(self):
+        s,state = getStateVM(self.session,self.testvm)
+        self.assertEqual(state,'poweredOff')
+        self.assertTrue(self.stats.callCount() > 0)
+        self.assertTrue(self.stats.byOperation().has_key('getStateVM'))
+        self.assertTrue(self.stats.vms.get(self.testvm,0) > 0)
+        # Wrapping it again doesn't count the calls twice
+        instrument.instrument(self.session)
+        self.stats.reset()
+        getStateVM(self.session,self.testvm)
+        self.assertEqual(self.stats.callCount(),self.stats.byOperation()['getStateVM'].count)
+
+    def test_trace(self):
+        trace = instrument.startTrace('test_trace')
+        listAllRegisteredVMS(self.session)
+        trace.stop()
+        self.assertTrue(trace.events)
+        self.assertEqual(trace.events[0]['op'],'listAllRegisteredVMS')
+        self.assertEqual(trace.toDict()['calls'],len(trace.events))
+
+if __name__ == '__main__':
+    unittest.main()
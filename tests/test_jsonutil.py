@@ -0,0 +1,29 @@
+import unittest
+from honeyclient.util.jsonutil import *
+
+class TestJSON(unittest.TestCase):
+    """
+    Unit tests for jsonutil.py
+    """
+    def testDumps(self):
+        self.assertEqual(dumps(None),"null")
+        self.assertEqual(dumps([True,False,1,2.5]),"[true,false,1,2.5]")
+        self.assertEqual(dumps({'b':1,'a':"x"}),'{"a": "x","b": 1}')
+        self.assertEqual(dumps('say "hi"\n'),'"say \\"hi\\"\\n"')
+        self.assertEqual(dumps(float("nan")),"null")
+        self.assertEqual(dumps([]),"[]")
+
+    def testRoundTrip(self):
+        value = {'label':"v1",'scenarios':[{'p50':0.25,'count':10,'error':None,'ok':True}],
+                 'empty':{},'text':u"caf\xe9\ttab"}
+        self.assertEqual(loads(dumps(value)),value)
+        self.assertEqual(loads(dumps(value,2)),value)
+
+    def testLoads(self):
+        self.assertEqual(loads(' { "a" : [ 1 , -2e3 , "\\u0041" ] } '),{'a':[1,-2000.0,"A"]})
+        self.assertRaises(ValueError,loads,"[1,2")
+        self.assertRaises(ValueError,loads,"{'a':1}")
+        self.assertRaises(ValueError,loads,"[1] x")
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,82 @@
+import unittest
+from com.vmware.vim25 import *
+from honeyclient.manager.esx import *
+from honeyclient.manager.lifecycle import *
+from honeyclient.util.config import *
+
+def nic(mac,ips):
+    n = GuestNicInfo()
+    n.setMacAddress(mac)
+    n.setIpAddress(ips)
+    return n
+
+class TestConditions(unittest.TestCase):
+    """
+    Unit tests for the lifecycle conditions. These need the VI Java API
+    but not an ESX server
+    """
+    def testRegistered(self):
+        self.assertFalse(isRegistered({}))
+        self.assertTrue(isRegistered({"config.files.vmPathName":"[datastore1] vm/vm.vmx"}))
+
+    def testRunning(self):
+        self.assertFalse(isRunning({}))
+        self.assertFalse(isRunning({"runtime.powerState":VirtualMachinePowerState.suspended}))
+        self.assertTrue(isRunning({"runtime.powerState":VirtualMachinePowerState.poweredOn}))
+
+    def testNetworked(self):
+        self.assertEqual(primaryNic({}),(None,None))
+        self.assertFalse(isNetworked({"guest.net":[nic("00:0c:29:00:00:01",[])]}))
+        props = {"guest.net":[nic("00:0c:29:00:00:01",["10.0.0.5"]),nic("00:0c:29:00:00:02",["10.0.1.5"])]}
+        self.assertEqual(primaryNic(props),("00:0c:29:00:00:01","10.0.0.5"))
+        self.assertTrue(isNetworked(props))
+        # Not until Tools says it's running
+        props["guest.toolsRunningStatus"] = "guestToolsNotRunning"
+        self.assertFalse(isNetworked(props))
+        # Link-local addresses don't count
+        props = {"guest.net":[nic("00:0c:29:00:00:01",["169.254.3.4"]),nic("00:0c:29:00:00:02",["10.0.1.5"])]}
+        self.assertEqual(primaryNic(props),("00:0c:29:00:00:02","10.0.1.5"))
+
+    def testCloneStates(self):
+        states = cloneStates(None,"vm1","desc","initial")
+        self.assertEqual([s.name for s in states],['registered','running','networked','operational'])
+        self.assertEqual(states[2].retries > 0,True)
+        self.assertEqual(states[0].timeout,stateTimeout('registered'))
+
+
+class TestLifecycle(unittest.TestCase):
+    """
+    Follow the test VM through a lifecycle on the ESX server
+    """
+    def setUp(self):
+        self.url = getArg('service_url','honeyclient::manager::esx::test')
+        self.un = getArg('user_name','honeyclient::manager::esx::test')
+        self.pw = getArg('password','honeyclient::manager::esx::test')
+        self.testvm = getArg('test_vm_name','honeyclient::manager::esx::test')
+        self.session = login(self.url,self.un,self.pw)
+
+    def tearDown(self):
+        stopVM(self.session,self.testvm)
+        logout(self.session)
+
+    def test_running(self):
+        def start(tracker):
+            return startVM_async(self.session,self.testvm)
+        states = [State('registered',["config.files.vmPathName"],isRegistered,timeout=60),
+                  State('running',["runtime.powerState"],isRunning,enter=start,timeout=300)]
+        seen = []
+        engine = getEngine(self.session)
+        tracker = engine.track(self.testvm,states,lambda t,name: seen.append(name))
+        props = tracker.result(600)
+        self.assertEqual(seen,['registered','running'])
+        self.assertTrue(isRunning(props))
+        self.assertTrue(tracker.timings.has_key('running'))
+        self.assertEqual(engine.metrics()['running']['count'] >= 1,True)
+
+    def test_timeout(self):
+        never = State('never',["runtime.powerState"],lambda props: False,timeout=2)
+        tracker = getEngine(self.session).track(self.testvm,[never])
+        self.assertRaises(errors.TimedOut,tracker.result,60)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,74 @@
+import logging,time
+import unittest
+from honeyclient.util import jsonutil,logs
+
+class Capture(logging.Handler):
+    def __init__(self):
+        logging.Handler.__init__(self)
+        self.records = []
+
+    def emit(self,record):
+        self.records.append(record)
+
+
+def makeRecord(msg,*args):
+    return logging.LogRecord('honeyclient.test',logging.INFO,__file__,1,msg,args,None)
+
+
+class TestLogs(unittest.TestCase):
+    """
+    Unit tests for logs.py
+    """
+    def testRateLimit(self):
+        f = logs.RateLimitFilter(60,2)
+        self.assertTrue(f.filter(makeRecord("Waiting for %s","vm1")))
+        self.assertTrue(f.filter(makeRecord("Waiting for %s","vm1")))
+        self.assertFalse(f.filter(makeRecord("Waiting for %s","vm1")))
+        # Other messages aren't limited
+        self.assertTrue(f.filter(makeRecord("Waiting for %s","vm2")))
+
+    def testRateLimitSuppressed(self):
+        f = logs.RateLimitFilter(0.01,1)
+        self.assertTrue(f.filter(makeRecord("poll")))
+        self.assertFalse(f.filter(makeRecord("poll")))
+        self.assertFalse(f.filter(makeRecord("poll")))
+        time.sleep(0.02)
+        r = makeRecord("poll")
+        self.assertTrue(f.filter(r))
+        self.assertEqual(r.getMessage(),"poll (suppressed 2 times in the last 0.01s)")
+        self.assertTrue(logs.RateLimitFilter(0,1).filter(makeRecord("poll")))
+
+    def testJSON(self):
+        r = makeRecord("Cloned %s",'vm "1"')
+        value = jsonutil.loads(logs.JSONFormatter().format(r))
+        self.assertEqual(value['message'],'Cloned vm "1"')
+        self.assertEqual(value['level'],"INFO")
+        self.assertFalse(value.has_key('line'))
+        value = jsonutil.loads(logs.JSONFormatter(True).format(r))
+        self.assertEqual(value['line'],1)
+
+    def testAsync(self):
+        capture = Capture()
+        handler = logs.AsyncHandler([capture],10)
+        args = ["vm1"]
+        handler.handle(makeRecord("Started %s",args))
+        # The message is rendered when it's logged, not when it's written
+        args.append("vm2")
+        handler.flush()
+        self.assertEqual(len(capture.records),1)
+        self.assertEqual(capture.records[0].getMessage(),"Started ['vm1']")
+        handler.close()
+
+    def testConfigure(self):
+        log = logging.getLogger('honeyclient.test.configure')
+        logs.configure(log,level="INFO",stderr=False,caller_info=False)
+        self.assertEqual(logging._srcfile,None)
+        self.assertEqual(log.level,logging.INFO)
+        logs.configure(log,async=False,stderr=False,caller_info=True,format="json")
+        self.assertNotEqual(logging._srcfile,None)
+        # The earlier handler was replaced
+        self.assertEqual(len(log.handlers),1)
+        self.assertRaises(ValueError,logs.configure,log,format="xml")
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,73 @@
+import os,tempfile,urllib2
+import unittest
+from honeyclient.manager import metrics
+
+class TestMetrics(unittest.TestCase):
+    """
+    Unit tests for metrics.py. These don't need an ESX server
+    """
+    def setUp(self):
+        self.registry = metrics.Registry()
+
+    def testCounter(self):
+        c = self.registry.counter("test_total","Things done",("result",))
+        c.inc(result="ok")
+        c.inc(2,result="ok")
+        c.inc(result="error")
+        self.assertEqual(c.value(result="ok"),3)
+        self.assertRaises(ValueError,c.inc,-1,result="ok")
+        self.assertRaises(ValueError,c.inc,state="ok")
+        self.assertEqual(c.render(),['# HELP test_total Things done',
+                                     '# TYPE test_total counter',
+                                     'test_total{result="error"} 1',
+                                     'test_total{result="ok"} 3'])
+        # Asking for it again gives the same one, as another kind fails
+        self.assertTrue(self.registry.counter("test_total","",("result",)) is c)
+        self.assertRaises(ValueError,self.registry.gauge,"test_total","",("result",))
+
+    def testGauge(self):
+        g = self.registry.gauge("test_clones","Clones",("state",))
+        g.inc(state="running")
+        g.inc(state="running")
+        g.dec(state="running")
+        g.set(7,state='say "hi"')
+        self.assertEqual(g.value(state="running"),1)
+        self.assertTrue('test_clones{state="say \\"hi\\""} 7' in g.render())
+
+    def testTimer(self):
+        t = self.registry.timer("test_seconds","Durations")
+        t.observe(0.05)
+        t.observe(3.0)
+        t.observe(5000.0)
+        self.assertEqual(t.value()[0],3)
+        lines = t.render()
+        self.assertTrue('test_seconds_bucket{le="0.1"} 1' in lines)
+        self.assertTrue('test_seconds_bucket{le="5.0"} 2' in lines)
+        self.assertTrue('test_seconds_bucket{le="1800.0"} 2' in lines)
+        self.assertTrue('test_seconds_bucket{le="+Inf"} 3' in lines)
+        self.assertTrue('test_seconds_count 3' in lines)
+
+    def testCloneStatus(self):
+        before = metrics.CLONES.value(state="running")
+        metrics.cloneStatus(None,"initialized")
+        metrics.cloneStatus("initialized","running",2.0)
+        self.assertEqual(metrics.CLONES.value(state="running"),before + 1)
+        self.assertTrue(metrics.CLONE_STATE_SECONDS.value(state="initialized")[0] >= 1)
+        metrics.taskDone(None,None,1.0)
+        self.assertTrue(metrics.ESX_TASKS.value(task="unknown",result="timeout") >= 1)
+
+    def testExport(self):
+        self.registry.counter("test_total","Things done").inc()
+        path = os.path.join(tempfile.mkdtemp(),"metrics.prom")
+        server = metrics.MetricsServer(self.registry,0,path=path,interval=60)
+        server.start()
+        try:
+            text = urllib2.urlopen("http://127.0.0.1:%d/metrics" % server.port).read()
+            self.assertTrue("test_total 1\n" in text)
+            self.assertEqual(text,self.registry.render())
+            self.assertEqual(open(path).read(),text)
+        finally:
+            server.stop()
+
+if __name__ == '__main__':
+    unittest.main()
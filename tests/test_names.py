@@ -0,0 +1,58 @@
+import unittest
+from honeyclient.manager.names import *
+from time import sleep
+
+class TestNameIndex(unittest.TestCase):
+    """
+    Unit tests for the NameIndex in names.py. These don't need an ESX server
+    """
+    def setUp(self):
+        self.index = NameIndex()
+        self.index.updateVM('vm-1','Master',['Initial Snapshot','snap-a'])
+        self.index.updateVM('vm-2','Clone',['Initial Snapshot'])
+
+    def testMembership(self):
+        self.assertTrue(self.index.isVM('Master'))
+        self.assertFalse(self.index.isVM('snap-a'))
+        self.assertTrue(self.index.isSnapshot('snap-a'))
+        self.assertTrue(self.index.contains('Clone'))
+        self.assertFalse(self.index.contains('nothere'))
+
+    def testUpdateAndRemove(self):
+        # Rename a VM and change its snapshots
+        self.index.updateVM('vm-1','Master2',None)
+        self.assertFalse(self.index.isVM('Master'))
+        self.assertTrue(self.index.isSnapshot('snap-a'))
+        self.index.updateVM('vm-1',None,['snap-b'])
+        self.assertTrue(self.index.isVM('Master2'))
+        self.assertFalse(self.index.isSnapshot('snap-a'))
+
+        # The shared snapshot name is still used by vm-2
+        self.index.removeVM('vm-1')
+        self.assertFalse(self.index.isVM('Master2'))
+        self.assertTrue(self.index.isSnapshot('Initial Snapshot'))
+        self.index.removeVM('vm-2')
+        self.assertFalse(self.index.isSnapshot('Initial Snapshot'))
+
+    def testReserve(self):
+        self.assertFalse(self.index.reserve('Master'))
+        self.assertTrue(self.index.reserve('newname'))
+        self.assertFalse(self.index.reserve('newname'))
+        self.index.release('newname')
+        self.assertTrue(self.index.reserve('newname'))
+
+    def testReservationDroppedWhenSeen(self):
+        self.assertTrue(self.index.reserve('newvm'))
+        self.index.updateVM('vm-3','newvm',[])
+        self.assertTrue(self.index.isVM('newvm'))
+        self.assertFalse(self.index.isReserved('newvm'))
+
+    def testReservationExpires(self):
+        index = NameIndex(0)
+        self.assertTrue(index.reserve('temp'))
+        sleep(0.1)
+        self.assertFalse(index.isReserved('temp'))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,88 @@
+import time
+import unittest
+from honeyclient.manager.esx import *
+from honeyclient.manager import simulator
+from honeyclient.manager.pool import *
+from honeyclient.util.config import *
+
+class TestClonePool(unittest.TestCase):
+    """
+    Run a ClonePool against a simulated ESX server
+    """
+    url = "sim://test-pool/sdk?boot_time=0.05"
+
+    def setUp(self):
+        self.testvm = getArg('test_vm_name','honeyclient::manager::esx::test')
+        self.url = TestClonePool.url + "&vm_names=" + self.testvm
+        self.session = login(self.url,"root","")
+        self.pool = ClonePool(1,retry_period=1,vm_session=self.session,master_vm_name=self.testvm,
+                              guest_username="guest",guest_password="guest")
+
+    def tearDown(self):
+        self.pool.stop(True)
+        logout(self.session)
+        simulator.dropServer(self.url)
+
+    def waitFor(self,count,timeout=120):
+        deadline = time.time() + timeout
+        while self.pool.available() < count and time.time() < deadline:
+            time.sleep(0.1)
+        return self.pool.available()
+
+    def test_checkout(self):
+        self.pool.start()
+        clone = self.pool.checkout(120)
+        self.assertNotEqual(clone,None)
+        self.assertEqual(clone.status,'running')
+        s,state = getStateVM(self.session,clone.quick_clone_vm_name)
+        self.assertEqual(state,'poweredOn')
+
+        # The pool builds a replacement
+        self.assertEqual(self.waitFor(1),1)
+
+        # The pool is full again, so the clone is destroyed
+        self.pool.checkin(clone)
+        self.assertEqual(self.pool.available(),1)
+        self.assertEqual(clone.status,'deleted')
+        s,registered = isRegisteredVM(self.session,clone.quick_clone_vm_name,True)
+        self.assertFalse(registered)
+
+    def test_checkin_reuse(self):
+        self.pool.start()
+        clone = self.pool.checkout(120)
+        self.assertNotEqual(clone,None)
+
+        # A healthy clone goes back in the pool, suspended, if there's room
+        self.pool.size = 2
+        self.pool.checkin(clone)
+        self.assertEqual(clone.status,'suspended')
+        s,state = getStateVM(self.session,clone.quick_clone_vm_name)
+        self.assertEqual(state,'suspended')
+        self.assertTrue(self.pool.available() <= self.pool.size)
+
+    def test_checkin_discard(self):
+        self.pool.start()
+        clone = self.pool.checkout(120)
+        self.pool.stop()
+        self.pool.checkin(clone,False)
+        self.assertEqual(clone.status,'deleted')
+        self.assertEqual(self.pool.available(),0)
+        # The VM is gone too
+        s,registered = isRegisteredVM(self.session,clone.quick_clone_vm_name,True)
+        self.assertFalse(registered)
+
+    def test_stop(self):
+        self.pool.start()
+        # A clone is being built, stop() waits for it and destroys it
+        time.sleep(0.1)
+        self.pool.stop(True)
+        self.assertEqual(self.pool.available(),0)
+        time.sleep(1)
+        self.assertEqual(self.pool.available(),0)
+
+    def test_checkout_timeout(self):
+        # Nothing is built until the pool is started
+        self.assertEqual(self.pool.checkout(0.5),None)
+
+if __name__ == '__main__':
+    unittest.main()
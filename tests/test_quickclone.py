@@ -1,5 +1,7 @@
 import unittest
+from com.vmware.vim25.mo import InventoryNavigator
 from honeyclient.manager.esx import *
+from honeyclient.manager import deletion
 from honeyclient.util.config import *
 
 class QuickCloneTest(unittest.TestCase):
@@ -43,7 +45,41 @@ class QuickCloneTest(unittest.TestCase):
         
         s,state2 = getStateVM(s,self.testvm)
         self.assertEqual('poweredOff',state2)
-        
+
+    def test_quick_clone_many(self):
+        s, result = quickCloneMany(self.session,self.testvm,3)
+        self.assertEqual(len(result.succeeded()),3)
+
+        for r in result.succeeded():
+            s,shouldberegistered = isRegisteredVM(self.session,r.name)
+            self.assertTrue(shouldberegistered)
+            destroyVM(self.session,r.name)
+
+        # Make sure we return the test vm to it's off state
+        s,state1 = getStateVM(s,self.testvm)
+        if state1 == 'suspended':
+            startVM(self.session,self.testvm)
+            stopVM(self.session,self.testvm)
+
+
+    def test_destroy_in_background(self):
+        s, cloned_vm = quickCloneVM(self.session,self.testvm)
+
+        future = destroyVM(self.session,cloned_vm,True)
+        future.result()
+        s,should_not_be_registered = isRegisteredVM(self.session,cloned_vm,True)
+        self.assertFalse(should_not_be_registered)
+
+        # Deleting the files again is a no-op
+        datacenter = InventoryNavigator(self.session.getRootFolder()).searchManagedEntity("Datacenter","ha-datacenter")
+        self.assertEqual(deletion.deleteDirectories(self.session,datacenter,["[datastore1] " + cloned_vm]),[])
+
+        # Make sure we return the test vm to it's off state
+        s,state1 = getStateVM(s,self.testvm)
+        if state1 == 'suspended':
+            startVM(self.session,self.testvm)
+            stopVM(self.session,self.testvm)
+
 
 if __name__ == '__main__':
     unittest.main()
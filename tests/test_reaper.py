@@ -0,0 +1,71 @@
+import unittest,time,uuid
+from honeyclient.manager.esx import *
+from honeyclient.manager.reaper import *
+from honeyclient.util.config import *
+
+class TestReaperHelpers(unittest.TestCase):
+    """
+    Unit tests for reaper.py that don't need an ESX server
+    """
+    def testTopDirectory(self):
+        self.assertEqual(topDirectory("[datastore1] vm/vm.vmx"),"[datastore1] vm")
+        self.assertEqual(topDirectory("[datastore1] vm/sub/x.log"),"[datastore1] vm")
+        self.assertEqual(topDirectory("[datastore1] vm/"),"[datastore1] vm")
+        self.assertEqual(topDirectory("[datastore 2] my vm"),"[datastore 2] my vm")
+        self.assertEqual(topDirectory("[datastore1]"),None)
+        self.assertEqual(topDirectory("[datastore1] "),None)
+        self.assertEqual(topDirectory("not a path"),None)
+
+    def testGeneratedName(self):
+        self.assertTrue(GENERATED_NAME.match(uuid.uuid4().hex))
+        self.assertFalse(GENERATED_NAME.match("Ubuntu_Test_VM"))
+
+    def testOrphanAge(self):
+        o = Orphan("[datastore1] vm",10,1000.0)
+        self.assertEqual(o.age(1500.0),500.0)
+        self.assertEqual(Orphan("[datastore1] vm").age(),None)
+
+    def testReport(self):
+        report = ReapReport()
+        a = Orphan("[datastore1] a",100)
+        b = Orphan("[datastore1] b",50)
+        a.deleted = True
+        report.orphans = [a,b]
+        self.assertEqual(report.reclaimed(),100)
+        self.assertEqual(report.size(),150)
+        self.assertEqual(report.deleted(),[a])
+        self.assertTrue(report.summary().startswith("1 orphans deleted"))
+
+        report = ReapReport(True)
+        report.orphans = [a,b]
+        self.assertTrue(report.summary().startswith("2 orphans found"))
+
+
+class TestReaper(unittest.TestCase):
+    """
+    Test a reaper pass against the ESX server
+    """
+    def setUp(self):
+        self.url = getArg('service_url','honeyclient::manager::esx::test')
+        self.un = getArg('user_name','honeyclient::manager::esx::test')
+        self.pw = getArg('password','honeyclient::manager::esx::test')
+        self.testvm = getArg('test_vm_name','honeyclient::manager::esx::test')
+        self.session = login(self.url,self.un,self.pw)
+
+    def tearDown(self):
+        logout(self.session)
+
+    def test_dry_run_keeps_registered(self):
+        # Even with no minimum age, nothing a registered VM uses is an orphan
+        report = Reaper(self.session,min_age=0,dry_run=True).reapOnce()
+        s,vmx = getConfigVM(self.session,self.testvm)
+        testdir = topDirectory(vmx)
+        self.assertFalse(testdir in [o.path for o in report.orphans])
+        self.assertFalse(testdir in [o.path for o in report.kept])
+        for o in report.orphans:
+            self.assertTrue(o.reason in ["partial copy","unregistered quick clone"])
+        s,registered = isRegisteredVM(self.session,self.testvm)
+        self.assertTrue(registered)
+
+if __name__ == '__main__':
+    unittest.main()
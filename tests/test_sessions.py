@@ -0,0 +1,103 @@
+import threading
+import unittest
+from honeyclient.manager import errors,esx,simulator,updates
+from honeyclient.manager.sessions import *
+from honeyclient.util.config import *
+
+class TestSessions(unittest.TestCase):
+    """
+    Test the SessionPool against the test ESX server
+    """
+    def setUp(self):
+        self.url = getArg('service_url','honeyclient::manager::esx::test')
+        self.un = getArg('user_name','honeyclient::manager::esx::test')
+        self.pw = getArg('password','honeyclient::manager::esx::test')
+        self.testvm = getArg('test_vm_name','honeyclient::manager::esx::test')
+        self.pool = SessionPool(self.url,self.un,self.pw,2)
+
+    def tearDown(self):
+        esx.logout(self.pool)
+
+    def testPoolAsSession(self):
+        s,r = esx.isRegisteredVM(self.pool,self.testvm)
+        self.assertTrue(r)
+        self.assert_(s is self.pool)
+
+    def testCheckout(self):
+        a = self.pool.checkout()
+        b = self.pool.checkout()
+        self.assert_(a is not b)
+        # Both sessions are in use
+        self.assertEqual(self.pool.checkout(1),None)
+        self.pool.checkin(a)
+        c = self.pool.checkout(1)
+        self.assert_(c is a)
+        self.pool.checkin(b)
+        self.pool.checkin(c)
+
+    def testRelogin(self):
+        session = self.pool.checkout()
+        session.getSessionManager().logout()
+        self.pool.relogin(session)
+        self.assert_(session.currentTime())
+        self.pool.checkin(session)
+
+    def testSharedPool(self):
+        pool = getPool(self.url,self.un,self.pw)
+        self.assert_(getPool(self.url,self.un,self.pw) is pool)
+        esx.logout(pool)
+        self.assert_(getPool(self.url,self.un,self.pw) is not pool)
+        esx.logout(getPool(self.url,self.un,self.pw))
+
+
+class TestSimulatedSessions(unittest.TestCase):
+    """
+    Expire the sessions of a SessionPool on a simulated ESX server
+    """
+    url = "sim://test-sessions/sdk?task_time=30"
+
+    def setUp(self):
+        self.testvm = getArg('test_vm_name','honeyclient::manager::esx::test')
+        self.url = TestSimulatedSessions.url + "&vm_names=" + self.testvm
+        self.server = simulator.getServer(self.url)
+        self.pool = SessionPool(self.url,"root","",1)
+
+    def tearDown(self):
+        esx.logout(self.pool)
+        simulator.dropServer(self.url)
+
+    def testExpireWhileWaiting(self):
+        session = self.pool.checkout()
+        vm = esx.getVMbyName(session,self.testvm)
+        task = vm.powerOnVM_Task(None)
+        waiter = updates.TaskWaiter(updates.getChannel(session),task)
+        failures = []
+        def wait():
+            try:
+                waiter.wait()
+            except Exception, e:
+                failures.append(e)
+        thread = threading.Thread(target=wait)
+        thread.setDaemon(True)
+        thread.start()
+
+        # The task takes 30s, the waiter must fail well before that
+        self.server.expireSessions()
+        self.pool.relogin(session)
+        thread.join(10)
+        self.assertFalse(thread.isAlive())
+        self.assertEqual(len(failures),1)
+        self.assertTrue(isinstance(failures[0],errors.SessionExpired))
+        # The session works again
+        self.assert_(session.currentTime())
+        self.pool.checkin(session)
+
+    def testCallRetries(self):
+        s,state = esx.getStateVM(self.pool,self.testvm)
+        self.server.expireSessions()
+        # call() logs back in and tries again
+        s,again = call(self.pool,esx.getStateVM,self.testvm,True)
+        self.assertEqual(again,state)
+
+if __name__ == '__main__':
+    unittest.main()
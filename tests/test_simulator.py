@@ -0,0 +1,173 @@
+import time
+import unittest
+from com.vmware.vim25 import *
+from honeyclient.manager.esx import *
+from honeyclient.manager import errors,simulator
+from honeyclient.util.config import *
+
+class TestSettings(unittest.TestCase):
+    """
+    Unit tests for the simulator URLs. These need the VI Java API but not an ESX server
+    """
+    def testURL(self):
+        self.assertTrue(simulator.isSimulated("sim://localhost/sdk"))
+        self.assertTrue(simulator.isSimulated(" SIM://localhost"))
+        self.assertFalse(simulator.isSimulated("https://localhost/sdk"))
+        host,options = simulator.parseURL("sim://bench/sdk?vms=10&latency=0.5&version=3.5.0")
+        self.assertEqual(host,"bench")
+        self.assertEqual(options['vms'],10)
+        self.assertEqual(options['latency'],0.5)
+        self.assertEqual(options['version'],"3.5.0")
+        self.assertRaises(ValueError,simulator.parseURL,"sim://bench/sdk?nope=1")
+        self.assertRaises(ValueError,simulator.parseURL,"sim://bench/sdk?vms=many")
+
+    def testPaths(self):
+        self.assertEqual(simulator.splitPath("[datastore1] vm/vm.vmx"),("datastore1","vm/vm.vmx"))
+        self.assertEqual(simulator.splitPath("[datastore1]"),("datastore1",""))
+        self.assertEqual(simulator.extentOf("[ds] vm/vm.vmdk"),"[ds] vm/vm-flat.vmdk")
+        self.assertEqual(simulator.extentOf("[ds] vm/vm-000001.vmdk"),"[ds] vm/vm-000001-delta.vmdk")
+
+
+class TestSimulator(unittest.TestCase):
+    """
+    Run esx.py against a simulated ESX server
+    """
+    url = "sim://test-simulator/sdk?vms=5&boot_time=0.05"
+
+    def setUp(self):
+        self.testvm = getArg('test_vm_name','honeyclient::manager::esx::test')
+        self.url = TestSimulator.url + "&vm_names=" + self.testvm
+        self.server = simulator.getServer(self.url)
+        self.session = login(self.url,"root","")
+
+    def tearDown(self):
+        stopVM(self.session,self.testvm)
+        logout(self.session)
+
+    def test_inventory(self):
+        s,names = listAllRegisteredVMS(self.session)
+        self.assertTrue(self.testvm in names)
+        self.assertTrue("sim-vm-0005" in names)
+        s,name = getHostnameESX(self.session)
+        self.assertEqual(name,"test-simulator")
+        s,ip = getIPaddrESX(self.session)
+        self.assertEqual(ip,"10.0.0.1")
+
+    def test_power(self):
+        startVM(self.session,self.testvm)
+        s,state = getStateVM(self.session,self.testvm)
+        self.assertEqual(state,'poweredOn')
+        deadline = time.time() + 30
+        ip = None
+        while ip is None and time.time() < deadline:
+            s,ip = getIPaddrVM(self.session,self.testvm)
+            time.sleep(0.05)
+        self.assertEqual(ip,self.server.vm(self.testvm).ip)
+        suspendVM(self.session,self.testvm)
+        s,state = getStateVM(self.session,self.testvm)
+        self.assertEqual(state,'suspended')
+        stopVM(self.session,self.testvm)
+        s,state = getStateVM(self.session,self.testvm)
+        self.assertEqual(state,'poweredOff')
+
+    def test_question(self):
+        startVM(self.session,self.testvm)
+        self.server.ask(self.testvm,"msg.disk.adapterMismatch:The adapter doesn't match",
+                        [("0","Yes"),("1","No")])
+        s,state = getStateVM(self.session,self.testvm)
+        self.assertEqual(state,'pendingquestion')
+        answerVM(self.session,self.testvm)
+        s,state = getStateVM(self.session,self.testvm)
+        self.assertEqual(state,'poweredOn')
+
+    def test_quickClone(self):
+        s,clone = quickCloneVM(self.session,self.testvm)
+        try:
+            s,quick = isQuickCloneVM(self.session,clone)
+            self.assertTrue(quick)
+            s,state = getStateVM(self.session,clone)
+            self.assertEqual(state,'poweredOn')
+        finally:
+            destroyVM(self.session,clone)
+        self.assertEqual(self.server.vm(clone),None)
+
+    def test_fullClone(self):
+        s,clone = fullCloneVM(self.session,self.testvm)
+        try:
+            s,quick = isQuickCloneVM(self.session,clone)
+            self.assertFalse(quick)
+            vm = self.server.vm(clone)
+            self.assertNotEqual(vm.uuid,self.server.vm(self.testvm).uuid)
+        finally:
+            stopVM(self.session,clone)
+            destroyVM(self.session,clone)
+
+    def test_snapshots(self):
+        s,snapshot = snapshotVM(self.session,self.testvm,"test snapshot")
+        startVM(self.session,self.testvm)
+        revertVM(self.session,self.testvm,snapshot)
+        s,state = getStateVM(self.session,self.testvm)
+        self.assertEqual(state,'poweredOff')
+        removeSnapshotVM(self.session,self.testvm,snapshot)
+        self.assertEqual(self.server.vm(self.testvm).roots,[])
+
+    def test_snapshots_other_session(self):
+        other = login(self.url,"root","")
+        try:
+            # The other session has the tree cached when it changes
+            s,before = getSnapshotTreeVM(other,self.testvm)
+            s,snapshot = snapshotVM(self.session,self.testvm)
+            self.assertFalse(snapshot in [n['name'] for n in before])
+            # The change comes through the other session's UpdateChannel
+            deadline = time.time() + 10
+            while True:
+                s,after = getSnapshotTreeVM(other,self.testvm)
+                if snapshot in [n['name'] for n in after] or time.time() > deadline:
+                    break
+                time.sleep(0.05)
+            self.assertTrue(snapshot in [n['name'] for n in after])
+            # A cached tree is used without asking the server
+            self.server.resetCalls()
+            getSnapshotTreeVM(other,self.testvm)
+            self.assertEqual(self.server.callCount("retrieveProperties"),0)
+            removeSnapshotVM(self.session,self.testvm,snapshot)
+            self.assertRaises(errors.SnapshotNotFound,revertVM,other,self.testvm,snapshot)
+        finally:
+            logout(other)
+
+    def test_rename_releases_name(self):
+        from honeyclient.manager import names
+        self.assertRaises(errors.SnapshotNotFound,renameSnapshotVM,self.session,self.testvm,
+                          "no such snapshot","renamed snapshot")
+        # The new name was reserved, and is free again
+        self.assertFalse(names.getIndex(self.session).isReserved("renamed snapshot"))
+
+    def test_calls(self):
+        self.server.resetCalls()
+        listAllRegisteredVMS(self.session)
+        self.assertTrue(self.server.callCount("retrieveProperties") >= 1)
+        self.assertEqual(self.server.callCount("powerOnVM_Task"),0)
+        self.assertTrue(self.server.callCount() >= self.server.callCount("retrieveProperties"))
+
+    def test_latency(self):
+        url = "sim://test-latency/sdk?latency=0.2"
+        session = login(url,"root","")
+        try:
+            start = time.time()
+            session.currentTime()
+            self.assertTrue(time.time() - start >= 0.2)
+        finally:
+            logout(session)
+            simulator.dropServer(url)
+
+    def test_expired(self):
+        url = "sim://test-expired/sdk"
+        session = login(url,"root","")
+        try:
+            simulator.getServer(url).expireSessions()
+            self.assertRaises(NotAuthenticated,session.currentTime)
+        finally:
+            simulator.dropServer(url)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,65 @@
+import unittest
+from honeyclient.manager.snapshots import *
+
+class FakeTree(object):
+    """
+    Stands in for a VirtualMachineSnapshotTree
+    """
+    def __init__(self,name,children=None):
+        self.name = name
+        self.children = children
+    def getName(self): return self.name
+    def getSnapshot(self): return "mor-" + self.name
+    def getCreateTime(self): return None
+    def getDescription(self): return "desc " + self.name
+    def getChildSnapshotList(self): return self.children
+
+class FakeInfo(object):
+    """
+    Stands in for a VirtualMachineSnapshotInfo
+    """
+    def __init__(self,roots,current=None):
+        self.roots = roots
+        self.current = current
+    def getRootSnapshotList(self): return self.roots
+    def getCurrentSnapshot(self): return self.current
+
+
+class TestSnapshotIndex(unittest.TestCase):
+    """
+    Unit tests for snapshots.py. These don't need an ESX server
+    """
+    def setUp(self):
+        tree = [FakeTree('Initial',[FakeTree('op1',[FakeTree('Deleted Snapshot')]),
+                                    FakeTree('Deleted Snapshot',[FakeTree('op2')])])]
+        self.index = SnapshotIndex(FakeInfo(tree,'mor-op2'))
+
+    def testEmpty(self):
+        index = SnapshotIndex(None)
+        self.assertEqual(len(index),0)
+        self.assertEqual(index.find('Initial'),None)
+
+    def testFind(self):
+        self.assertEqual(len(self.index),5)
+        node = self.index.find('op2')
+        self.assertEqual(node.mor,'mor-op2')
+        self.assertEqual(node.depth,2)
+        self.assertEqual(node.parent.name,'Deleted Snapshot')
+        self.assertEqual(self.index.current,'mor-op2')
+        self.assertFalse('nothere' in self.index)
+
+    def testFirstMatchDepthFirst(self):
+        # The first 'Deleted Snapshot' in depth first order is the child of op1
+        node = self.index.find('Deleted Snapshot')
+        self.assertEqual(node.parent.name,'op1')
+
+    def testToDict(self):
+        d = self.index.find('Initial').toDict()
+        self.assertEqual(d['parent'],None)
+        self.assertEqual(d['children'],['op1','Deleted Snapshot'])
+        self.assertEqual(d['depth'],0)
+        self.assertEqual([r.name for r in self.index.roots],['Initial'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -68,6 +68,29 @@ class StateTest(unittest.TestCase):
         s, state2 = getStateVM(self.session,self.testvm)
         self.assertEqual("poweredOff",state2)
 
+    def test_power_many(self):
+        s, result = powerMany(self.session,[self.testvm,"blabblabblacb"],'start')
+        self.assertEqual([r.name for r in result.results],[self.testvm,"blabblabblacb"])
+        self.assertEqual(result.results[0].result,'poweredOn')
+        self.assertTrue(isinstance(result.results[1].error,errors.VMNotFound))
+
+        # Already on
+        s, result = powerMany(self.session,[self.testvm],'start')
+        self.assertEqual(result.results[0].result,'unchanged')
+
+        s, result = powerMany(self.session,[self.testvm],'suspend')
+        self.assertEqual(result.results[0].result,'suspended')
+
+        # Suspended VMs are started, then stopped
+        s, result = powerMany(self.session,[self.testvm],'stop')
+        self.assertTrue(result.results[0].ok())
+        s, state = getStateVM(self.session,self.testvm)
+        self.assertEqual("poweredOff",state)
+
+        # Can't reset a VM that's off
+        s, result = powerMany(self.session,[self.testvm],'reset')
+        self.assertTrue(isinstance(result.results[0].error,errors.InvalidVMState))
+
     def test_isregistered(self):
         s,shouldbetrue = isRegisteredVM(self.session,self.testvm)
         self.assertTrue(shouldbetrue)
@@ -0,0 +1,114 @@
+import threading
+import unittest
+from com.vmware.vim25 import *
+from honeyclient.manager.esx import *
+from honeyclient.manager import errors,simulator
+from honeyclient.manager.updates import *
+from honeyclient.util.config import *
+
+class TestUpdates(unittest.TestCase):
+    """
+    Run the UpdateChannel and the task waiters against a simulated ESX server
+    """
+    url = "sim://test-updates/sdk?vms=3&task_time=0.5"
+
+    def setUp(self):
+        self.testvm = getArg('test_vm_name','honeyclient::manager::esx::test')
+        self.url = TestUpdates.url + "&vm_names=" + self.testvm
+        self.server = simulator.getServer(self.url)
+        self.session = login(self.url,"root","")
+        self.channel = getChannel(self.session)
+        self.vm = getVMbyName(self.session,self.testvm)
+
+    def tearDown(self):
+        for name in [self.testvm,"sim-vm-0001","sim-vm-0002","sim-vm-0003"]:
+            stopVM(self.session,name)
+        logout(self.session)
+
+    def test_wait(self):
+        waiter = TaskWaiter(self.channel,self.vm.powerOnVM_Task(None),self.vm)
+        self.assertEqual(waiter.wait(0.05),None)
+        self.assertEqual(waiter.wait(30),"success")
+        self.assertEqual(waiter.name,"VirtualMachine.powerOn")
+        # The waiter's filter is gone, and the thread with it
+        self.assertEqual(self.channel.watching(),0)
+        self.assertFalse(self.channel.isRunning())
+
+    def test_question(self):
+        self.server.ask(self.testvm,"msg.disk.adapterMismatch:Continue?")
+        questions = []
+        def answer(question):
+            questions.append(question)
+            answerVM(self.session,self.testvm)
+        self.assertEqual(waitForTask(self.session,self.vm.powerOnVM_Task(None),self.vm,answer,30),
+                         "success")
+        self.assertEqual(len(questions),1)
+
+    def test_unwatch(self):
+        seen = threading.Event()
+        def update(mor,changes):
+            if changes and changes.has_key("runtime.powerState"):
+                seen.set()
+        destroyed = self.server.callCount("destroyPropertyFilter")
+        pfilter = self.channel.watch([(self.vm.getMOR(),["runtime.powerState"])],update)
+        seen.wait(10)
+        self.assertTrue(seen.isSet())
+        self.assertTrue(self.channel.isRunning())
+
+        self.channel.unwatch(pfilter)
+        self.assertEqual(self.server.callCount("destroyPropertyFilter"),destroyed + 1)
+        self.assertFalse(self.channel.isRunning())
+        # A second unwatch is a no-op
+        self.channel.unwatch(pfilter)
+        self.assertEqual(self.server.callCount("destroyPropertyFilter"),destroyed + 1)
+
+        # Watching again starts a new thread
+        waiter = TaskWaiter(self.channel,self.vm.powerOnVM_Task(None))
+        self.assertTrue(self.channel.isRunning())
+        self.assertEqual(waiter.wait(30),"success")
+
+    def test_task_set(self):
+        waiter = TaskSetWaiter(self.channel)
+        names = ["sim-vm-0001","sim-vm-0002","sim-vm-0003"]
+        for name in names:
+            waiter.add(getVMbyName(self.session,name).powerOnVM_Task(None))
+        self.assertEqual(waiter.pending(),3)
+        self.assertEqual(waiter.wait(0.05),[])
+
+        states = []
+        while waiter.pending():
+            done = waiter.wait(30)
+            self.assertTrue(done)
+            states.extend([state for task,state in done])
+        self.assertEqual(states,["success"] * 3)
+        self.assertEqual(waiter.wait(),[])
+        self.assertEqual(self.channel.watching(),0)
+
+    def test_close(self):
+        destroyed = self.server.callCount("destroyPropertyFilter")
+        waiter = TaskWaiter(self.channel,self.vm.powerOnVM_Task(None))
+        tasks = TaskSetWaiter(self.channel)
+        tasks.add(getVMbyName(self.session,"sim-vm-0001").powerOnVM_Task(None))
+
+        closeChannel(self.session)
+        self.assertRaises(errors.SessionExpired,waiter.wait,10)
+        self.assertRaises(errors.SessionExpired,tasks.wait,10)
+        self.assertEqual(self.server.callCount("destroyPropertyFilter"),destroyed + 2)
+        self.assertFalse(self.channel.isRunning())
+        self.assert_(getChannel(self.session) is not self.channel)
+
+    def test_errors(self):
+        waiter = TaskWaiter(self.channel,self.vm.powerOnVM_Task(None))
+        # Every waitForUpdates now fails, the channel gives up after MAX_ERRORS
+        self.server.expireSessions()
+        try:
+            waiter.wait(30)
+            self.fail("The waiter should have failed")
+        except NotAuthenticated, e:
+            self.assertEqual(errors.errorForFault(e),errors.SessionExpired)
+        self.assertFalse(self.channel.isRunning())
+        self.assertEqual(self.channel.watching(),0)
+        self.session.getSessionManager().login("root","",None)
+
+if __name__ == '__main__':
+    unittest.main()